@@ -7,16 +7,23 @@ from collections import defaultdict
 
 from kitchen.text.converters import to_unicode
 from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall
 from twisted.python.failure import Failure
-from txrequests import Session
+from plugins.urls.cache import TitleCache
+from plugins.urls.dispatch import HandlerIndex
+from plugins.urls.http import HTTPClient
 from plugins.urls.lazy import LazyRequest
 from plugins.urls.priority import Priority
+from plugins.urls.resolver import AddressResolver, is_public_address
+from plugins.urls.rules import RuleSet
+from plugins.urls.scheduler import FetchScheduler
 from plugins.urls.shorteners.exceptions import ShortenerDown
 from system.protocols.generic.channel import Channel
 from system.storage.formats import Formats
 from system.plugins.plugin import PluginObject
 from plugins.urls.constants import PREFIX_TRANSLATIONS, STOP_HANDLING
 from plugins.urls.events import URLsPluginLoaded
+from plugins.urls.handlers.media import MediaHandler
 from plugins.urls.handlers.website import WebsiteHandler
 from plugins.urls.matching import extract_urls
 from plugins.urls.shorteners.tinyurl import TinyURLShortener
@@ -34,13 +41,25 @@ class URLsPlugin(PluginObject):
     channels = None
     config = None
     shortened = None
+    title_cache = None
+    http = None
+    resolver = None
+    fetch_queue = None
+
+    blacklist = None
+    domain_proxies = None
+
+    channels_dirty = False
+    save_task = None
 
     shorteners = None
     handlers = None
+    handler_index = None
 
     def setup(self):
         self.shorteners = {}
         self.handlers = defaultdict(list)
+        self.handler_index = HandlerIndex(self.handlers)
 
         # Load up the configuration
 
@@ -70,6 +89,11 @@ class URLsPlugin(PluginObject):
             self, "data", Formats.YAML, "plugins/urls/channels.yml"
         )
 
+        self.save_task = LoopingCall(self.save_channels)
+        self.save_task.start(
+            self.config.get("channels_save_interval", 60), now=False
+        )
+
         self.shortened = self.storage.get_file(
             self,
             "data",
@@ -79,15 +103,36 @@ class URLsPlugin(PluginObject):
             check_same_thread=False
         )
 
+        self.title_cache = TitleCache(
+            path="data/plugins/urls/title_cache.json"
+        )
+
+        self.resolver = AddressResolver(
+            servers=self.get_dns_servers()
+        )
+
+        self.http = HTTPClient(
+            resolver=self.resolver, check_address=is_public_address
+        )
+
+        self.fetch_queue = FetchScheduler()
+
         self.config.add_callback(self.reload)
         self.reload()
 
+        if self.config.get("cache", {}).get("persist", False):
+            try:
+                self.title_cache.load()
+            except Exception:
+                self.logger.exception("Error loading the title cache")
+
         def message_event_filter(event):
             return event.type == "message"
 
         self.events.add_callback("MessageReceived", self, self.message_handler,
                                  1, message_event_filter)
 
+        self.add_handler(MediaHandler(self), Priority.MEDIA)
         self.add_handler(WebsiteHandler(self), Priority.MONITOR)
         self.add_shortener(TinyURLShortener(self))
 
@@ -118,10 +163,59 @@ class URLsPlugin(PluginObject):
                                 "shortener TEXT, "
                                 "result TEXT)")
 
+        # Compile the regexes now, rather than for every URL
+        self.blacklist = self.compile_rules(
+            "blacklist",
+            ((entry, entry) for entry in self.config.get("blacklist", [])),
+            str_to_regex_flags("ui")
+        )
+
+        self.domain_proxies = self.compile_rules(
+            "proxies.domains",
+            self.config.get("proxies", {}).get("domains", {}).iteritems(),
+            str_to_regex_flags("iu"), domains=True
+        )
+
+        cache_config = self.config.get("cache", {})
+
+        self.title_cache.ttl = cache_config.get("ttl", 600)
+        self.title_cache.error_ttl = cache_config.get("error_ttl", 60)
+        self.title_cache.max_ttl = cache_config.get("max_ttl", 86400)
+        self.title_cache.resize(cache_config.get("size", 1024))
+
+        dns_conf = self.config.get("dns", {})
+
+        self.resolver.configure(
+            min_ttl=dns_conf.get("min_ttl", 30),
+            max_ttl=dns_conf.get("max_ttl", 3600),
+            negative_ttl=dns_conf.get("negative_ttl", 60),
+            max_size=dns_conf.get("cache_size", 1024)
+        )
+
+        conns_conf = self.get_connection_config()
+
+        self.http.configure(
+            connections_per_host=conns_conf.get("connections_per_host", 2),
+            connect_timeout=conns_conf.get("connect_timeout", 10),
+            timeout=conns_conf.get("timeout", 30)
+        )
+
+        self.fetch_queue.configure(
+            max_fetches=conns_conf.get("max_fetches", 8),
+            max_per_domain=conns_conf.get("max_fetches_per_domain", 2),
+            domain_delay=conns_conf.get("domain_delay", 0.5),
+            max_queued=conns_conf.get("max_queued", 100),
+            overflow=conns_conf.get("overflow", "oldest"),
+            timeout=conns_conf.get("fetch_timeout", 60)
+        )
+
         for handler_list in self.handlers.itervalues():
             for handler in handler_list:
                 handler.reload()
 
+        # Their criteria may have changed
+        self.index_handlers()
+
     @inlineCallbacks
     def shorten(self, _url, shortener=None, target=None):
         if isinstance(_url, basestring):
@@ -181,6 +275,12 @@ class URLsPlugin(PluginObject):
         return self.default_shortener
 
     def deactivate(self):
+        if self.save_task is not None and self.save_task.running:
+            self.save_task.stop()
+
+        if self.channels is not None:
+            self.save_channels()
+
         for handler_list in self.handlers.itervalues():
             for handler in handler_list:
                 try:
@@ -191,6 +291,23 @@ class URLsPlugin(PluginObject):
                     )
 
         self.handlers = defaultdict(list)
+        self.index_handlers()
+
+        if self.fetch_queue is not None:
+            self.fetch_queue.clear()
+
+        if self.http is not None:
+            self.http.close()
+
+        if self.resolver is not None:
+            self.resolver.close()
+
+        if self.title_cache is not None and \
+                self.config.get("cache", {}).get("persist", False):
+            try:
+                self.title_cache.save()
+            except Exception:
+                self.logger.exception("Error saving the title cache")
 
     @inlineCallbacks
     def message_handler(self, event):
@@ -243,10 +360,9 @@ class URLsPlugin(PluginObject):
             while _url.domain in domains and redirects < max_redirects:
                 redirects += 1
 
-                session = Session()
-
-                #: :type: requests.Response
-                r = yield session.get(unicode(_url), allow_redirects=False)
+                #: :type: plugins.urls.http.Response
+                r = yield self.http.get(unicode(_url), allow_redirects=False)
+                r.discard()
 
                 if r.is_redirect:
                     # This only ever happens when we have a well-formed
@@ -268,13 +384,18 @@ class URLsPlugin(PluginObject):
                 self.logger.debug("URL has exceeded the redirects limit")
                 return
 
-            lazy_request = LazyRequest(req_args=[unicode(_url)])
+            lazy_request = LazyRequest(
+                self.http, req_args=[unicode(_url)],
+                max_size=self.get_connection_config().get(
+                    "max_read_size", 1024 * 16
+                )
+            )
 
             if isinstance(target, Channel):
-                with self.channels:
-                    self.channels[protocol.name][target.name]["last"] = (
-                        unicode(_url)
-                    )
+                self.channels[protocol.name][target.name]["last"] = (
+                    unicode(_url)
+                )
+                self.channels_dirty = True
 
             yield self.run_handlers(_url, {
                 "event": event,
@@ -285,15 +406,42 @@ class URLsPlugin(PluginObject):
             })
 
     def ensure_channel(self, protocol_name, source_name):
-        with self.channels:
-            if protocol_name not in self.channels:
-                self.channels[protocol_name] = {}
-            if source_name not in self.channels[protocol_name]:
-                self.channels[protocol_name][source_name] = {
-                    "status": True,
-                    "last": "",
-                    "shortener": self.default_shortener
-                }
+        """
+        Make sure we have settings for a channel. This only changes them in
+        memory - they're saved by `save_channels()`.
+        """
+
+        if protocol_name not in self.channels:
+            self.channels[protocol_name] = {}
+            self.channels_dirty = True
+
+        if source_name not in self.channels[protocol_name]:
+            self.channels[protocol_name][source_name] = {
+                "status": True,
+                "last": "",
+                "shortener": self.default_shortener
+            }
+            self.channels_dirty = True
+
+    def save_channels(self):
+        """
+        Save the channel settings, if they've changed since they were last
+        saved.
+
+        This is called every so often, when a command changes a setting, and
+        when the plugin is unloaded - we don't save for every message.
+        """
+
+        if not self.channels_dirty:
+            return
+
+        self.channels_dirty = False
+
+        try:
+            self.channels.save()
+        except Exception:
+            self.channels_dirty = True
+            self.logger.exception("Error saving channel settings")
 
     def match_to_url(self, match):
         """
@@ -359,6 +507,16 @@ class URLsPlugin(PluginObject):
         Command handler for the urls command
         """
 
+        if parsed_args and parsed_args[0].lower() == "stats":
+            caller.respond("Title cache: {0}".format(
+                self.title_cache.stats()
+            ))
+            caller.respond("DNS cache: {0}".format(self.resolver.stats()))
+            caller.respond("Fetch queue: {0}".format(
+                self.fetch_queue.describe()
+            ))
+            return
+
         if not isinstance(source, Channel):
             caller.respond("This command can only be used in a channel.")
             return
@@ -371,43 +529,35 @@ class URLsPlugin(PluginObject):
             caller.respond("  Shorteners: {0}".format(", ".join(
                 self.shorteners.keys()
             )))
+            caller.respond("  stats - Show how well the title and DNS "
+                           "caches and the fetch queue are working")
             return
 
         operation = parsed_args[0].lower()
         value = parsed_args[1].lower()
 
-        if protocol.name not in self.channels:
-            with self.channels:
-                self.channels[protocol.name] = {
-                    source.name: {
-                        "status": True,
-                        "last": "",
-                        "shortener": self.default_shortener
-                    }
-                }
-        elif source.name not in self.channels[protocol.name]:
-            with self.channels:
-                self.channels[protocol.name][source.name] = {
-                    "status": True,
-                    "last": "",
-                    "shortener": self.default_shortener
-                }
+        self.ensure_channel(protocol.name, source.name)
 
         if operation == "set":
             if value not in ["on", "off"]:
                 caller.respond("Usage: {CHARS}urls set <on|off>")
             else:
-                with self.channels:
-                    self.channels[protocol.name][source.name]["status"] = (
-                        value == "on"
-                    )
+                self.channels[protocol.name][source.name]["status"] = (
+                    value == "on"
+                )
+                self.channels_dirty = True
+                self.save_channels()
+
                 caller.respond("Title parsing for %s turned %s."
                                % (source.name, value))
         elif operation == "shortener":
             if value.lower() in self.shorteners:
-                with self.channels:
-                    self.channels[protocol.name][source.name]["shortener"] \
-                        = value.lower()
+                self.channels[protocol.name][source.name]["shortener"] = (
+                    value.lower()
+                )
+                self.channels_dirty = True
+                self.save_channels()
+
                 caller.respond("URL shortener for %s set to %s."
                                % (source.name, value))
             else:
@@ -488,17 +638,107 @@ class URLsPlugin(PluginObject):
                 caller.respond("Error fetching short URL.")
 
     def check_blacklist(self, _url, context):
-        for entry in context["config"]["blacklist"]:
-            if re.match(
-                    entry, _url.to_string(), flags=str_to_regex_flags("ui")
-            ):
-                self.logger.debug(
-                    "Matched blacklist regex: %s" % entry
-                )
-                return True
+        rule = self.blacklist.match(_url.to_string())
+
+        if rule is not None:
+            self.logger.debug(
+                "Matched blacklist regex: %s" % rule[0]
+            )
+            return True
 
         return False
 
+    def compile_rules(self, name, rules, flags, domains=False):
+        """
+        Compile some of the config's regexes into a RuleSet, logging any
+        that aren't valid.
+
+        :param name: Where they are in the config, for the log
+        """
+
+        rule_set = RuleSet(rules, flags, domains)
+
+        for pattern, error in rule_set.errors:
+            self.logger.error(
+                "Invalid regex in {0}: '{1}' ({2})".format(
+                    name, pattern, error
+                )
+            )
+
+        return rule_set
+
+    def get_connection_config(self):
+        # Older configs called this section "connections"
+        return self.config.get(
+            "connection", self.config.get("connections", {})
+        ) or {}
+
+    def get_dns_servers(self):
+        servers = self.config.get("dns", {}).get("servers")
+
+        if not servers:
+            return None  # Use the system's
+
+        result = []
+
+        for server in servers:
+            host, _, port = server.partition(":")
+            result.append((host, int(port or 53)))
+
+        return result
+
+    def get_cached_summary(self, _url, context):
+        """
+        Get the cached summary for a URL, if there is one.
+
+        Several handlers may want this for the same URL, when one cascades
+        to the next, so it's only looked up once - otherwise the cache's
+        hits and misses would be counted more than once.
+
+        :type _url: URL
+        :rtype: plugins.urls.cache.Summary
+        """
+
+        if "cached_summary" not in context:
+            context["cached_summary"] = self.title_cache.get(_url)
+
+        return context["cached_summary"]
+
+    def get_headers(self, _url):
+        """
+        The headers to send when fetching a URL - the user-agent we're
+        spoofing and the language we'd like, for its domain.
+
+        :type _url: URL
+        """
+
+        headers = {}
+
+        if _url.domain in self.config["spoofing"]:
+            user_agent = self.config["spoofing"][_url.domain]
+
+            if user_agent:
+                headers["User-Agent"] = user_agent
+        else:
+            headers["User-Agent"] = self.config.get(
+                "default_user_agent",
+                "Mozilla/5.0 (Windows NT 6.3; rv:36.0) Gecko/20100101 "
+                "Firefox/36.0"
+            )
+
+        domain_langs = self.config \
+            .get("accept_language", {}) \
+            .get("domains", {})
+
+        if _url.domain in domain_langs:
+            headers["Accept-Language"] = domain_langs.get(_url.domain)
+        else:
+            headers["Accept-Language"] = self.config \
+                .get("accept_language", {}) \
+                .get("default", "en")
+
+        return headers
+
     def get_proxy(self, _url=None, group=None):
         """
         :type _url: URL
@@ -514,11 +754,10 @@ class URLsPlugin(PluginObject):
                 return proxy
 
         if _url is not None:
-            domain_proxies = self.config.get("proxies", {}).get("domains", {})
+            rule = self.domain_proxies.match(_url.domain)
 
-            for pattern in domain_proxies.iterkeys():
-                if re.match(pattern, _url.domain, str_to_regex_flags("iu")):
-                    return domain_proxies[pattern]
+            if rule is not None:
+                return rule[1]
 
         return self.config.get("proxies", {}).get("global", None)
 
@@ -530,13 +769,42 @@ class URLsPlugin(PluginObject):
             )
             return
 
-        for priority in reversed(sorted(self.handlers.iterkeys())):
-            for handler in self.handlers[priority]:
+        # Only the handlers that could want this URL, already in order
+        for handler in self.handler_index.candidates(_url):
+            try:
+                d = handler.match(_url, context)
+            except Exception:
+                self.logger.exception(
+                    "Error caught while attempting to match "
+                    "handler {0}".format(
+                        handler.name
+                    )
+                )
+
+                continue
+
+            if isinstance(d, Deferred):
+                r = yield d
+            else:
+                r = d
+
+            if isinstance(r, Failure):
+                self.logger.error(
+                    "Error caught while attempting to match "
+                    "handler {0}".format(
+                        handler.name
+                    )
+                )
+
+                r.printTraceback()
+                continue
+
+            if r:
                 try:
-                    d = handler.match(_url, context)
+                    d = handler.call(_url, context)
                 except Exception:
                     self.logger.exception(
-                        "Error caught while attempting to match "
+                        "Error caught while attempting to call "
                         "handler {0}".format(
                             handler.name
                         )
@@ -548,10 +816,9 @@ class URLsPlugin(PluginObject):
                     r = yield d
                 else:
                     r = d
-
                 if isinstance(r, Failure):
                     self.logger.error(
-                        "Error caught while attempting to match "
+                        "Error caught while attempting to call "
                         "handler {0}".format(
                             handler.name
                         )
@@ -559,36 +826,8 @@ class URLsPlugin(PluginObject):
 
                     r.printTraceback()
                     continue
-
-                if r:
-                    try:
-                        d = handler.call(_url, context)
-                    except Exception:
-                        self.logger.exception(
-                            "Error caught while attempting to call "
-                            "handler {0}".format(
-                                handler.name
-                            )
-                        )
-
-                        continue
-
-                    if isinstance(d, Deferred):
-                        r = yield d
-                    else:
-                        r = d
-                    if isinstance(r, Failure):
-                        self.logger.error(
-                            "Error caught while attempting to call "
-                            "handler {0}".format(
-                                handler.name
-                            )
-                        )
-
-                        r.printTraceback()
-                        continue
-                    elif r == STOP_HANDLING:
-                        return
+                elif r == STOP_HANDLING:
+                    return
 
     def add_handler(self, handler, priority=0):
         if not self.has_handler(handler.name):  # Only add if it's not there
@@ -596,6 +835,7 @@ class URLsPlugin(PluginObject):
             handler.urls_plugin = self
 
             self.handlers[priority].append(handler)
+            self.index_handlers()
         else:
             self.logger.warn("Handler {} is already registered!".format(
                 handler.name
@@ -615,6 +855,17 @@ class URLsPlugin(PluginObject):
                 if handler == _handler.name:
                     handler_list.remove(_handler)
 
+        self.index_handlers()
+
+    def index_handlers(self):
+        """
+        Work out the order to try the handlers in, and which URLs each of
+        them could want, again - call this if a handler's domains,
+        protocols or criteria change.
+        """
+
+        self.handler_index = HandlerIndex(self.handlers)
+
     def add_shortener(self, shortener):
         if not self.has_handler(shortener.name):
             shortener.urls_plugin = self
@@ -0,0 +1,301 @@
+# coding=utf-8
+
+"""
+A cache of what we found at URLs, so we don't fetch the same page again
+every time it's pasted.
+
+Links tend to be pasted again, or relayed into other channels, within a few
+minutes - so we keep a short summary of each response (the title, status
+code, final host and content type), keyed on the normalised URL. Entries
+expire after a configurable time, or sooner if the server's Cache-Control or
+Expires headers say so, and the least recently used entries are dropped
+once the cache is full. The cache can also be saved when the plugin is
+unloaded, and loaded again when it starts.
+"""
+
+import json
+import os
+import time
+import urlparse
+
+from email.utils import mktime_tz, parsedate_tz
+
+from kitchen.text.converters import to_bytes, to_unicode
+
+from utils.lru import LRUCache
+
+__author__ = 'Gareth Coles'
+
+DEFAULT_PORTS = {
+    "http": 80,
+    "https": 443
+}
+
+
+def normalise_url(url):
+    """
+    Normalise a URL, so that different ways of writing the same one are
+    cached together.
+
+    The scheme and host are lowercased, default ports and fragments are
+    dropped, an empty path becomes "/" and query parameters are sorted.
+
+    :param url: A URL object or string
+    :rtype: unicode
+    """
+
+    parsed = urlparse.urlsplit(to_bytes(unicode(url)))
+
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or "").lower()
+    port = parsed.port
+
+    if port is not None and DEFAULT_PORTS.get(scheme) != port:
+        host = "%s:%s" % (host, port)
+
+    if parsed.username is not None:
+        auth = parsed.username
+
+        if parsed.password is not None:
+            auth += ":" + parsed.password
+
+        host = "%s@%s" % (auth, host)
+
+    query = "&".join(sorted(parsed.query.split("&"))) if parsed.query else ""
+
+    return to_unicode(urlparse.urlunsplit(
+        (scheme, host, parsed.path or "/", query, "")
+    ))
+
+
+def get_ttl(headers, default, maximum=None):
+    """
+    Work out how long to cache a response for, from its headers.
+
+    Cache-Control takes priority over Expires. If neither is present, the
+    default is used.
+
+    :param headers: The response headers - a case-insensitive mapping
+    :param default: How long to cache it for otherwise, in seconds
+    :param maximum: The longest to cache it for, whatever the headers say
+    :return: A number of seconds, which may be 0
+    """
+
+    ttl = None
+
+    cache_control = headers.get("cache-control")
+
+    if cache_control:
+        for directive in cache_control.lower().split(","):
+            directive = directive.strip()
+
+            if directive in ("no-store", "no-cache"):
+                return 0
+
+            if directive.startswith("max-age="):
+                try:
+                    ttl = max(0, int(directive[8:].strip('"')))
+                except ValueError:
+                    return 0
+
+    if ttl is None and headers.get("expires"):
+        expires = parsedate_tz(headers["expires"])
+
+        if expires is None:
+            # Invalid dates, like "0", mean it's already expired
+            return 0
+
+        date = parsedate_tz(headers.get("date", ""))
+        now = mktime_tz(date) if date is not None else time.time()
+
+        ttl = max(0, mktime_tz(expires) - now)
+
+    if ttl is None:
+        ttl = default
+
+    if maximum is not None:
+        ttl = min(ttl, maximum)
+
+    return ttl
+
+
+class Summary(object):
+    """
+    What we found at a URL.
+
+    :param title: The page's title, or None if it didn't have one
+    :param status_code: The HTTP status code
+    :param hostname: The host we ended up at, after redirects
+    :param content_type: The response's content type, without parameters
+    """
+
+    __slots__ = ("title", "status_code", "hostname", "content_type",
+                 "expires")
+
+    def __init__(self, title, status_code, hostname, content_type,
+                 expires=None):
+        self.title = title
+        self.status_code = status_code
+        self.hostname = hostname
+        self.content_type = content_type
+        self.expires = expires
+
+    def __repr__(self):
+        return "%s(%r, %r, %r, %r, %r)" % (
+            self.__class__.__name__, self.title, self.status_code,
+            self.hostname, self.content_type, self.expires
+        )
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class TitleCache(object):
+    """
+    A size-bounded, expiring cache of URL summaries.
+
+    :param max_size: The most URLs to keep
+    :param ttl: How long to keep a successful response, in seconds, unless
+        its headers say otherwise
+    :param error_ttl: How long to keep an error response, in seconds
+    :param max_ttl: The longest to keep anything, whatever its headers say
+    :param path: A file to save the cache to, if it should be kept across
+        restarts
+    """
+
+    def __init__(self, max_size=1024, ttl=600, error_ttl=60, max_ttl=86400,
+                 path=None, clock=time):
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_ttl = max_ttl
+        self.path = path
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+
+        self._cache = LRUCache(max_size)
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+
+        if not total:
+            return 0.0
+
+        return float(self.hits) / total
+
+    def get(self, url):
+        """
+        Get the summary for a URL, if we have one that hasn't expired.
+        """
+
+        key = normalise_url(url)
+        summary = self._cache.get(key)
+
+        if summary is not None and summary.expires <= self.clock.time():
+            del self._cache[key]
+            summary = None
+
+        if summary is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return summary
+
+    def put(self, url, summary, headers=None):
+        """
+        Store the summary for a URL, for as long as its response headers
+        allow.
+
+        :param headers: The response headers, if there were any
+        :return: Whether it was cached
+        """
+
+        if 200 <= summary.status_code < 400:
+            default, maximum = self.ttl, self.max_ttl
+        else:
+            # Errors are usually temporary, so we never keep them for long
+            default = maximum = min(self.error_ttl, self.max_ttl)
+
+        if headers is not None:
+            ttl = get_ttl(headers, default, maximum)
+        else:
+            ttl = min(default, maximum)
+
+        key = normalise_url(url)
+
+        if ttl <= 0:
+            self._cache.pop(key, None)
+            return False
+
+        summary.expires = self.clock.time() + ttl
+        self._cache[key] = summary
+
+        return True
+
+    def resize(self, max_size):
+        self._cache.max_size = max_size
+        self._cache._evict()
+
+    def clear(self):
+        self._cache.clear()
+
+    # Persistence
+
+    def load(self):
+        """
+        Load the cache from its file, skipping anything that's expired.
+        """
+
+        if self.path is None or not os.path.exists(self.path):
+            return
+
+        with open(self.path, "r") as fh:
+            data = json.load(fh)
+
+        now = self.clock.time()
+
+        for key, entry in data:
+            summary = Summary.from_dict(entry)
+
+            if summary.expires > now:
+                self._cache[key] = summary
+
+    def save(self):
+        if self.path is None:
+            return
+
+        now = self.clock.time()
+
+        # Least recently used first, so it's loaded back in the same order
+        data = [
+            (key, summary.to_dict())
+            for key, summary in self._cache.items()
+            if summary.expires > now
+        ]
+
+        directory = os.path.dirname(self.path)
+
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        temp = self.path + ".tmp"
+
+        with open(temp, "w") as fh:
+            json.dump(data, fh)
+
+        os.rename(temp, self.path)
+
+    def stats(self):
+        return "{0} URLs cached, {1} hits, {2} misses ({3:.0%} hit " \
+               "ratio)".format(len(self), self.hits, self.misses,
+                               self.hit_ratio)
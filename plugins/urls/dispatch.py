@@ -0,0 +1,136 @@
+# coding=utf-8
+
+"""
+Picking out which URL handlers to try for a URL.
+
+Handlers are tried in priority order, and most of them are only for a few
+sites - so rather than sort them and call every handler's `match()` for
+every URL, a `HandlerIndex` sorts them once, whenever they're added or
+removed, and indexes them by the domains and protocols they say they're
+for. For each URL, we only match the handlers that could want it - those
+for its domain or one of its parent domains, and those for any domain.
+
+A handler says what it's for with its `domains` and `protocols`
+attributes, or with plain strings in its criteria for "domain" and
+"protocol". Its `match()` still has the final say.
+"""
+
+from utils.lru import LRUCache
+
+__author__ = 'Gareth Coles'
+
+
+def get_domains(handler):
+    """
+    :return: (domains whose subdomains are included, exact domains), or
+        None if the handler could be for any domain
+    """
+
+    if handler.domains is not None:
+        return [domain.lower() for domain in handler.domains], []
+
+    value = (handler.criteria or {}).get("domain")
+
+    if isinstance(value, basestring):
+        return [], [value.lower()]
+
+    return None
+
+
+def get_protocols(handler):
+    """
+    :return: A frozenset of protocols, or None if the handler could be for
+        any protocol
+    """
+
+    if handler.protocols is not None:
+        return frozenset(protocol.lower() for protocol in handler.protocols)
+
+    value = (handler.criteria or {}).get("protocol")
+
+    if isinstance(value, basestring):
+        return frozenset((value.lower(),))
+
+    return None
+
+
+class HandlerIndex(object):
+    """
+    URL handlers, in the order they should be tried, indexed by domain.
+
+    :param handlers: A dict mapping priorities to lists of handlers, in the
+        order they were added - the higher the priority, the earlier the
+        handler is tried
+    :param cache_size: How many domains to remember the handlers for
+    """
+
+    def __init__(self, handlers, cache_size=1024):
+        self.order = []  # Every handler, in order
+
+        # (position, protocols, handler) for each handler
+        self.generic = []  # For any domain
+        self.domains = {}  # domain -> [entry], including its subdomains
+        self.exact = {}  # domain -> [entry]
+
+        self._cache = LRUCache(cache_size)  # (protocol, domain) -> handlers
+
+        for priority in sorted(handlers, reverse=True):
+            for handler in handlers[priority]:
+                self._add(handler)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def candidates(self, url):
+        """
+        Get the handlers that could want a URL, in the order to try them.
+
+        :type url: plugins.urls.url.URL
+        :rtype: list
+        """
+
+        key = ((url.protocol or "").lower(), (url.domain or "").lower())
+        handlers = self._cache.get(key)
+
+        if handlers is None:
+            handlers = self._find(*key)
+            self._cache[key] = handlers
+
+        return handlers
+
+    def _add(self, handler):
+        entry = (len(self.order), get_protocols(handler), handler)
+        self.order.append(handler)
+
+        domains = get_domains(handler)
+
+        if domains is None:
+            self.generic.append(entry)
+            return
+
+        for domain in domains[0]:
+            self.domains.setdefault(domain, []).append(entry)
+
+        for domain in domains[1]:
+            self.exact.setdefault(domain, []).append(entry)
+
+    def _find(self, protocol, domain):
+        found = dict((entry[0], entry) for entry in self.generic)
+
+        for entry in self.exact.get(domain, ()):
+            found[entry[0]] = entry
+
+        labels = domain.split(".")
+
+        for index in xrange(len(labels)):
+            for entry in self.domains.get(".".join(labels[index:]), ()):
+                found[entry[0]] = entry
+
+        return [
+            handler for _, protocols, handler in
+            (found[position] for position in sorted(found))
+            if protocols is None or protocol in protocols
+        ]
@@ -35,6 +35,14 @@ class URLHandler(object):
 
     Additionally, if the above matching is somehow not good enough for you, you
     may override the `match` function.
+
+    If your handler is only for some sites, set *domains* - the URLs plugin
+    indexes handlers by domain, and won't even try to match yours against
+    URLs for any other site. The same goes for *protocols*. A plain string
+    for "domain" or "protocol" in the criteria is indexed in the same way.
+
+    >>> domains = ["youtube.com", "youtu.be"]  # And their subdomains
+    >>> protocols = ["http", "https"]
     """
 
     # Remember to set this, so that there are no conflicting handlers - only
@@ -44,6 +52,13 @@ class URLHandler(object):
     plugin = None
     urls_plugin = None
 
+    # Domains this handler is for, including their subdomains - or None if
+    # it could be for any domain
+    domains = None
+
+    # Protocols this handler is for - or None if it could be for any
+    protocols = None
+
     criteria = {
         "protocol": None,
         "auth": None,
@@ -109,16 +124,12 @@ class URLHandler(object):
         :return: True if this handler should handle the URL, False otherwise
         """
 
-        for key in self.criteria.iterkeys():
-            value = self.criteria.get(key)
+        check_permission = False
 
+        for key, value in self.criteria.iteritems():
             if key == "permission":
-                event = context["event"]
-                result = self.plugin.commands.perm_handler.check(
-                    value, event.source, event.target, event.caller
-                )
-                if not result:
-                    return False
+                # This is the slowest check, so it's done last
+                check_permission = True
                 continue
 
             if callable(value):  # Function, lambda, etc
@@ -139,6 +150,14 @@ class URLHandler(object):
             else:
                 return False
 
+        if check_permission:
+            event = context["event"]
+
+            return bool(self.plugin.commands.perm_handler.check(
+                self.criteria["permission"], event.source, event.target,
+                event.caller
+            ))
+
         return True
 
     def teardown(self):
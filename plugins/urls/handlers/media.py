@@ -0,0 +1,184 @@
+# coding=utf-8
+
+import re
+import urlparse
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from plugins.urls.cache import Summary, normalise_url
+from plugins.urls.constants import CASCADE, STOP_HANDLING
+from plugins.urls.handlers.handler import URLHandler
+from plugins.urls.http import BlockedAddress, call_cancellable
+from plugins.urls.inflight import InFlight
+from plugins.urls.media import is_media_type, probe_url
+from plugins.urls.scheduler import QueueFull
+from utils.misc import str_to_regex_flags
+
+__author__ = 'Gareth Coles'
+
+DEFAULT_EXTENSIONS = [
+    "png", "jpg", "jpeg", "gif", "webp", "bmp", "avif", "heic",
+    "mp3", "flac", "wav", "ogg", "oga", "opus", "m4a",
+    "mp4", "m4v", "mov", "webm", "mkv", "ogv", "avi", "3gp"
+]
+
+
+class MediaHandler(URLHandler):
+    """
+    Describes links to images, audio and video - their format, dimensions,
+    length and size - from just the start of the file, rather than leaving
+    them to the website handler, which can't get a title from them.
+
+    Links are picked out by their file extension. If one turns out not to
+    be media after all - a page about an image, say - it cascades to the
+    website handler.
+    """
+
+    name = "media"
+
+    protocols = ["http", "https"]
+
+    criteria = {
+        "protocol": re.compile(r"http|https", str_to_regex_flags("iu")),
+        "path": None  # Set from the config, in reload()
+    }
+
+    def __init__(self, plugin):
+        self.fetches = InFlight()
+
+        super(MediaHandler, self).__init__(plugin)
+
+        self.reload()
+
+    @property
+    def config(self):
+        return self.plugin.config.get("media", {}) or {}
+
+    def match(self, url, context):
+        if not self.config.get("enable", True) or \
+                self.criteria["path"] is None:
+            return False
+
+        return super(MediaHandler, self).match(url, context)
+
+    def call(self, url, context):
+        summary = self.urls_plugin.get_cached_summary(url, context)
+
+        if summary is not None:
+            if not summary.title or not is_media_type(summary.content_type):
+                return CASCADE  # The website handler knows about this one
+
+            self.plugin.logger.debug("Using cached details for {0}", url)
+            self.respond(summary, context)
+
+            return STOP_HANDLING
+
+        event = context["event"]
+        channel = (event.caller.name, event.target.name)
+
+        # We have to wait for this one, in case it needs to cascade
+        return self.fetches.run(
+            normalise_url(url), self.urls_plugin.fetch_queue.submit,
+            url.domain, channel, call_cancellable, self.fetch, url
+        ).addCallback(self.fetched, context) \
+            .addErrback(self.fetch_failed, url)
+
+    @inlineCallbacks
+    def fetch(self, cancellable, url):
+        """
+        Find out what's at a URL, if it's media.
+
+        :type cancellable: plugins.urls.http.Cancellable
+        :return: A Deferred that fires with a Summary, or None if it wasn't
+            media
+        """
+
+        session = cancellable.watch(self.urls_plugin.http.session(
+            None, self.urls_plugin.get_proxy(url)
+        ))
+
+        try:
+            response, info = yield probe_url(
+                session, unicode(url), self.urls_plugin.get_headers(url),
+                self.config.get("max_read_size", 65536),
+                self.config.get("max_requests", 3)
+            )
+        finally:
+            session.close()
+
+        if info is None:
+            returnValue(None)
+            return
+
+        content_type = response.headers.get("content-type", "").lower()
+        content_type = content_type.split(";", 1)[0].strip()
+
+        description = None
+
+        if info.format is not None:
+            description = info.describe()
+
+        self.plugin.logger.debug("{0}: {1!r}", url, info)
+
+        summary = Summary(
+            description, response.status_code,
+            urlparse.urlparse(response.url).hostname, content_type
+        )
+
+        self.urls_plugin.title_cache.put(url, summary, response.headers)
+
+        returnValue(summary)
+
+    def fetched(self, summary, context):
+        if summary is None:
+            return CASCADE
+
+        if summary.title:
+            self.respond(summary, context)
+
+        return STOP_HANDLING
+
+    def fetch_failed(self, failure, url):
+        if failure.check(QueueFull):
+            self.plugin.logger.warn(
+                "Dropped URL {0}: {1}".format(url, failure.getErrorMessage())
+            )
+        elif failure.check(BlockedAddress):
+            self.plugin.logger.warn(
+                "Prevented connection to private/internal address: "
+                "{0}".format(failure.getErrorMessage())
+            )
+        else:
+            self.plugin.logger.error(
+                "Error handling URL {0}: {1}".format(
+                    url, failure.getErrorMessage()
+                )
+            )
+
+        return STOP_HANDLING
+
+    def respond(self, summary, context):
+        """
+        :type summary: plugins.urls.cache.Summary
+        """
+
+        context["event"].target.respond(
+            u"{0} at {1}".format(summary.title, summary.hostname)
+        )
+
+    def reload(self):
+        extensions = self.config.get("extensions", DEFAULT_EXTENSIONS)
+
+        self.criteria = dict(self.criteria)
+
+        if not extensions:
+            self.criteria["path"] = None
+            return
+
+        self.criteria["path"] = re.compile(
+            r".*\.(?:{0})$".format(
+                "|".join(re.escape(extension.lstrip("."))
+                         for extension in extensions)
+            ),
+            str_to_regex_flags("iu")
+        )
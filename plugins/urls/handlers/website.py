@@ -1,24 +1,25 @@
 # coding=utf-8
 
-from contextlib import closing
 import os
 import re
 import requests
 import urlparse
 
-from cookielib import LoadError
+from cookielib import CookieJar, LoadError
 from bs4 import BeautifulSoup
 from kitchen.text.converters import to_unicode
-from netaddr import IPAddress
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python.failure import Failure
 from twisted.web._newclient import ResponseNeverReceived
-from txrequests import Session
 
+from plugins.urls.cache import Summary, normalise_url
 from plugins.urls.constants import STATUS_CODES, STOP_HANDLING
 from plugins.urls.cookiejar import ChocolateCookieJar
 from plugins.urls.handlers.handler import URLHandler
-from plugins.urls.proxy_session import ProxySession
-from plugins.urls.resolver import AddressResolver
+from plugins.urls.http import BlockedAddress, call_cancellable
+from plugins.urls.inflight import InFlight
+from plugins.urls.scheduler import QueueFull
+from plugins.urls.titles import TitleExtractor
 from utils.misc import str_to_regex_flags
 
 __author__ = 'Gareth Coles'
@@ -27,17 +28,22 @@ __author__ = 'Gareth Coles'
 class WebsiteHandler(URLHandler):
     name = "website"
 
+    protocols = ["http", "https"]
+
     criteria = {
         "protocol": re.compile(r"http|https", str_to_regex_flags("iu"))
     }
 
     global_session = None
-    resolver = None
+
+    never_sessions = None
+    session_groups = None
 
     cookies_base_path = "data/plugins/urls/cookies"
 
     def __init__(self, plugin):
         self.group_sessions = {}
+        self.fetches = InFlight()
 
         super(WebsiteHandler, self).__init__(plugin)
 
@@ -49,205 +55,215 @@ class WebsiteHandler(URLHandler):
 
         self.reload()
 
-    def url_can_resolve(self, url):
-        return not re.match(
-            ".*\.onion|.*\.i2p",
-            url.domain,
-            str_to_regex_flags("iu")
-        )
-
-    @inlineCallbacks
     def call(self, url, context):
-        if self.url_can_resolve(url):
-            try:
-                ip = yield self.resolver.get_host_by_name(url.domain)
-                ip = IPAddress(ip)
-            except Exception:
-                # context["event"].target.respond(
-                #     u'[Error] Failed to handle URL: {}'.format(
-                #         url.to_string()
-                #     )
-                # )
-
-                self.plugin.logger.exception("Error while checking DNS")
-                returnValue(STOP_HANDLING)
-                return
-
-            if ip.is_loopback() or ip.is_private() or ip.is_link_local() \
-                    or ip.is_multicast():
-                self.plugin.logger.warn(
-                    "Prevented connection to private/internal address"
-                )
+        summary = self.urls_plugin.get_cached_summary(url, context)
 
-                returnValue(STOP_HANDLING)
-                return
+        if summary is not None:
+            self.plugin.logger.debug("Using cached title for {0}", url)
+            self.respond(summary, context)
 
-        headers = {}
+            return STOP_HANDLING
 
-        if url.domain in context["config"]["spoofing"]:
-            user_agent = context["config"]["spoofing"][url.domain]
+        key = normalise_url(url)
 
-            if user_agent:
-                headers["User-Agent"] = user_agent
-        else:
-            headers["User-Agent"] = context["config"].get(
-                "default_user_agent",
-                "Mozilla/5.0 (Windows NT 6.3; rv:36.0) Gecko/20100101 "
-                "Firefox/36.0"
+        if key in self.fetches:
+            self.plugin.logger.debug(
+                "Already fetching {0}, waiting for that", url
             )
 
-        domain_langs = context.get("config") \
-            .get("accept_language", {}) \
-            .get("domains", {})
+        event = context["event"]
+        channel = (event.caller.name, event.target.name)
 
-        if url.domain in domain_langs:
-            headers["Accept-Language"] = domain_langs.get(url.domain)
-        else:
-            headers["Accept-Language"] = context.get("config") \
-                .get("accept_language", {}) \
-                .get("default", "en")
+        # If the same URL is already being fetched - because it was relayed
+        # into several channels at once, for example - this waits for that
+        # fetch instead of starting another. New fetches wait their turn in
+        # the plugin's fetch queue.
+        self.fetches.run(
+            key, self.urls_plugin.fetch_queue.submit, url.domain, channel,
+            call_cancellable, self.fetch, url, context
+        ).addCallback(self.fetched, context) \
+            .addErrback(self.fetch_failed, url)
 
-        session = self.get_session(url, context)
-        session.get(unicode(url), headers=headers, stream=True,
-                    background_callback=self.background_callback) \
-            .addCallback(self.callback, url, context, session) \
-            .addErrback(self.errback, url, context, session)
+        return STOP_HANDLING
 
-        returnValue(STOP_HANDLING)
+    @inlineCallbacks
+    def fetch(self, cancellable, url, context):
+        """
+        Fetch a URL, and summarise what we found there.
+
+        :type cancellable: plugins.urls.http.Cancellable
+        :return: A Deferred that fires with a Summary, or None if we
+            couldn't or shouldn't fetch it
+        """
+
+        headers = self.urls_plugin.get_headers(url)
+
+        session = cancellable.watch(self.get_session(url, context))
+
+        try:
+            response = yield session.get(unicode(url), headers=headers)
+            title = yield self.read_title(response)
+        except Exception:
+            self.errback(Failure(), url, context, session)
+            returnValue(None)
+            return
+        finally:
+            if session.session_type is None:
+                session.close()
+
+        returnValue(self.callback(response, title, url, context, session))
+
+    def fetched(self, summary, context):
+        if summary is not None:
+            self.respond(summary, context)
+
+    def fetch_failed(self, failure, url):
+        if failure.check(QueueFull):
+            self.plugin.logger.warn(
+                "Dropped URL {0}: {1}".format(url, failure.getErrorMessage())
+            )
+            return
+
+        self.plugin.logger.error(
+            "Error handling URL {0}: {1}".format(
+                url, failure.getErrorMessage()
+            )
+        )
 
     def teardown(self):
         # Save all our cookie stores
         if self.global_session is not None:
-            self.global_session.cookies.save(ignore_discard=True)
+            self.save_session(self.global_session)
             self.global_session.close()
 
         for session in self.group_sessions.itervalues():
-            session.cookies.save(ignore_discard=True)
+            self.save_session(session)
             session.close()
 
-        if self.resolver is not None:
-            self.resolver.close()
-
     def reload(self):
         self.teardown()
         self.group_sessions = {}
-        self.resolver = AddressResolver()
 
-        proxy = self.plugin.get_proxy()
+        sessions = self.plugin.config.get("sessions", {})
+        flags = str_to_regex_flags("ui")
 
-        if not proxy:
-            self.global_session = Session()
-        else:
-            self.global_session = ProxySession(proxy)
+        self.never_sessions = self.plugin.compile_rules(
+            "sessions.never",
+            ((entry, entry) for entry in sessions.get("never", [])),
+            flags, domains=True
+        )
+
+        self.session_groups = self.plugin.compile_rules(
+            "sessions.group",
+            ((entry, group)
+             for group, entries in sessions.get("group", {}).iteritems()
+             for entry in entries),
+            flags, domains=True
+        )
+
+        proxy = self.plugin.get_proxy()
 
         try:
-            self.global_session.cookies = self.get_cookie_jar("/global.txt")
-            self.global_session.session_type = "global"
-            self.global_session.cookies.set_mode(
+            cookies = self.get_cookie_jar("/global.txt")
+            cookies.set_mode(
                 self.plugin.config.get("sessions", {})
                     .get("cookies", {})
                     .get("global", "discard")
             )
         except ValueError as e:
-            self.urls_plugin.logger.error(
+            self.plugin.logger.error(
                 "Failed to create global cookie jar: {0}".format(e)
             )
+            cookies = CookieJar()
+
+        self.global_session = self.plugin.http.session(
+            cookies, proxy, "global"
+        )
 
     def save_session(self, session):
-        if session.session_type:
+        if session.session_type and hasattr(session.cookies, "save"):
             session.cookies.save(ignore_discard=True)
 
-    def background_callback(self, session, response):
-        """
-        Does basic processing of the response in the background, including
-        reading the response's content. As such, response.content should not be
-        used.
-        :param session:
-        :param response:
-        :return: response, content
+    @inlineCallbacks
+    def read_title(self, response):
         """
-        conns_conf = self.urls_plugin.config.get("connections", {})
-        max_read = conns_conf.get("max_read_size", 1024 * 16)
-        # iter_content seems to only use chunk_size as a suggestion, so a large
-        # value (such as full value of max_read) can give a far large result
-        # than expected. Using max_read / 16 seems to give us a decent level of
-        # accuracy.
-        chunk_size = conns_conf.get("chunk_read_size",
-                                    max(1024, int(max_read / 16)))
+        Read as much of a response's body as we need to find its title, if
+        it's a type of content we can get a title from.
 
-        if "content-type" not in response.headers:
-            response.headers["Content-Type"] = ""
-
-        content_type = response.headers["content-type"].lower()
+        :type response: plugins.urls.http.Response
+        :return: A Deferred that fires with the title, or None if there
+            wasn't one or we didn't look
+        """
 
-        if ";" in content_type:
-            parts = content_type.split(";")
-            content_type = parts[0]
+        content_type = response.headers.get("content-type", "").lower()
+        content_type = content_type.split(";", 1)[0].strip()
 
         if content_type not in self.urls_plugin.config["content_types"]:
             self.plugin.logger.debug(
                 "Unsupported Content-Type: %s"
-                % response.headers["content-type"]
+                % response.headers.get("content-type", "")
             )
-            return response, None  # Not a supported content-type
-
-        # If the response specifies a charset in the header, let requests
-        # attempt to decode the contents. We can't use response.encoding as
-        # it falls back to ISO-8859-1 in cases such as Content-Type: text/html.
-        # In those cases, we want BeautifulSoup to perform its satanic ritual
-        # to magically figure out the encoding.
-        decode_unicode = False
-        if ";" in content_type:
-            for x in content_type.split(";"):
-                split = x.strip().split("=")
-                if len(split) > 1:
-                    if split[0].lower() == "charset":
-                        charset = split[1].lower()
-                        if charset == "binary":
-                            # Not a webpage, so return None content
-                            self.urls_plugin.logger.debug(
-                                "Unsupported charset: {0}", charset)
-                            return response, None
-                        # Contains charset header - let requests decode
-                        decode_unicode = True
-                        self.urls_plugin.logger.trace(
-                            "Charset specified in header: {0}", charset)
-                        break
-
-        amount_read = 0
-        chunks = []
-        self.plugin.logger.trace("Starting read...")
-        # We must close this when finished otherwise they'll hang if we don't
-        # read everything
-        with closing(response) as c_resp:
-            for chunk in c_resp.iter_content(chunk_size=chunk_size,
-                                             decode_unicode=decode_unicode):
-                # See comment beside chunk_size def - it's not a fixed limit
-                chunks.append(chunk)
-                amount_read += len(chunk)
-                self.plugin.logger.trace("Read a chunk of {0} bytes",
-                                         len(chunk))
-                if amount_read >= max_read:
-                    self.plugin.logger.debug(
-                        "Stopped reading response after {0} bytes",
-                        amount_read
-                    )
-                    break
-        self.plugin.logger.trace("Done reading")
-        # chunks can be bytes or unicode
-        if decode_unicode:
-            joiner = u""
-        else:
-            joiner = b""
-        content = joiner.join(chunks)
-        self.plugin.logger.trace("background_callback done")
-        return response, content
+            response.discard()
+            returnValue(None)  # Not a supported content-type
+            return
 
-    @inlineCallbacks
-    def callback(self, result, url, context, session):
-        response = result[0]
-        content = result[1]
+        charset = response.encoding
+
+        if charset == "binary":
+            # Not a webpage, so there's no title
+            self.urls_plugin.logger.debug(
+                "Unsupported charset: {0}", charset
+            )
+            response.discard()
+            returnValue(None)
+            return
+
+        if charset:
+            self.urls_plugin.logger.trace(
+                "Charset specified in header: {0}", charset
+            )
+
+        max_read = self.urls_plugin.get_connection_config().get(
+            "max_read_size", 1024 * 16
+        )
 
+        extractor = TitleExtractor(
+            charset, self.urls_plugin.config.get("meta_titles", False)
+        )
+
+        # We stop reading as soon as the extractor has the title, or after
+        # max_read bytes - the connection is closed instead, so we don't
+        # download the rest of a huge page
+        content = yield response.read(max_read, extractor.feed)
+        extractor.finish()
+
+        if extractor.done:
+            self.plugin.logger.trace(
+                "Found the title after {0} bytes", len(content)
+            )
+        elif len(content) >= max_read:
+            self.plugin.logger.debug(
+                "Stopped reading response after {0} bytes", len(content)
+            )
+
+        if not extractor.needs_parsing:
+            returnValue(extractor.get_title())
+            return
+
+        # Something the extractor can't follow, so let BeautifulSoup perform
+        # its satanic ritual to magically figure out the encoding and title
+        self.plugin.logger.trace("Parsing the page to find its title")
+
+        soup = BeautifulSoup(content, from_encoding=extractor.get_charset())
+
+        if soup.title and soup.title.text:
+            title = re.sub("[\n\s]+", " ", soup.title.text).strip()
+            returnValue(to_unicode(title) or None)
+            return
+
+        returnValue(None)
+
+    def callback(self, response, title, url, context, session):
         self.plugin.logger.trace(
             "Headers: {0}", list(response.headers)
         )
@@ -256,74 +272,65 @@ class WebsiteHandler(URLHandler):
 
         new_url = urlparse.urlparse(response.url)
 
-        if self.url_can_resolve(url):
-            try:
-                ip = yield self.resolver.get_host_by_name(new_url.hostname)
-                ip = IPAddress(ip)
-            except Exception:
-                # context["event"].target.respond(
-                #     u'[Error] Failed to handle URL: {}'.format(
-                #         url.to_string()
-                #     )
-                # )
-
-                self.plugin.logger.exception("Error while checking DNS")
-                returnValue(STOP_HANDLING)
-                return
-
-            if ip.is_loopback() or ip.is_private() or ip.is_link_local() \
-                    or ip.is_multicast():
-                self.plugin.logger.warn(
-                    "Prevented connection to private/internal address"
-                )
+        content_type = response.headers.get("content-type", "").lower()
+        content_type = content_type.split(";", 1)[0].strip()
 
-                returnValue(STOP_HANDLING)
-                return
+        summary = Summary(
+            title, response.status_code, new_url.hostname, content_type
+        )
 
-        if content is None:
-            self.plugin.logger.debug("No content returned")
-            return
+        self.urls_plugin.title_cache.put(url, summary, response.headers)
 
-        soup = BeautifulSoup(content)
+        self.save_session(session)
 
-        if soup.title and soup.title.text:
-            title = soup.title.text.strip()
-            title = re.sub("[\n\s]+", " ", title)
-            title = to_unicode(title)
+        return summary
+
+    def respond(self, summary, context):
+        """
+        Tell the channel what we found at a URL.
+
+        :type summary: plugins.urls.cache.Summary
+        """
+
+        if summary.content_type not in \
+                self.urls_plugin.config["content_types"]:
+            # We didn't read it, so there's nothing to say
+            return
 
+        title = summary.title
+
+        if title:
             title_limit = self.urls_plugin.config.get("max_title_length", 150)
 
             if len(title) > title_limit:
                 title = title[:title_limit - 15] + u"... (truncated)"
 
-            if response.status_code == requests.codes.ok:
+            if summary.status_code == requests.codes.ok:
                 context["event"].target.respond(
                     u'"{0}" at {1}'.format(
-                        title, new_url.hostname
+                        title, summary.hostname
                     )
                 )
             else:
                 context["event"].target.respond(
                     u'[HTTP {0}] "{1}" at {2}'.format(
-                        response.status_code,
-                        title, new_url.hostname
+                        summary.status_code,
+                        title, summary.hostname
                     )
                 )
 
         else:
-            if response.status_code != requests.codes.ok:
+            if summary.status_code != requests.codes.ok:
                 context["event"].target.respond(
                     u'HTTP Error {0}: "{1}" at {2}'.format(
-                        response.status_code,
-                        STATUS_CODES.get(response.status_code, "Unknown"),
-                        new_url.hostname
+                        summary.status_code,
+                        STATUS_CODES.get(summary.status_code, "Unknown"),
+                        summary.hostname
                     )
                 )
             else:
                 self.plugin.logger.debug("No title")
 
-        self.save_session(session)
-
     def errback(self, error, url, context, session):
         # if isinstance(error.value, SSLError):
         #     context["event"].target.respond(
@@ -336,7 +343,12 @@ class WebsiteHandler(URLHandler):
         #         u'[Error] Failed to handle URL: {}'.format(url.to_string())
         #     )
 
-        if isinstance(error.value, ResponseNeverReceived):
+        if isinstance(error.value, BlockedAddress):
+            self.plugin.logger.warn(
+                "Prevented connection to private/internal address: "
+                "{0}".format(error.getErrorMessage())
+            )
+        elif isinstance(error.value, ResponseNeverReceived):
             for f in error.value.reasons:
                 f.printDetailedTraceback()
                 self.plugin.logger.error(f.getErrorMessage())
@@ -363,84 +375,62 @@ class WebsiteHandler(URLHandler):
         return cj
 
     def get_session(self, url, context):
+        """
+        :rtype: plugins.urls.http.Session
+        """
+
         sessions = context.get("config", {}).get("sessions", {})
+        http = self.urls_plugin.http
 
         if not sessions.get("enable", False):
             self.urls_plugin.logger.debug("Sessions are disabled.")
 
-            proxy = self.urls_plugin.get_proxy(url)
+            return http.session(CookieJar(), self.urls_plugin.get_proxy(url))
 
-            if not proxy:
-                s = Session()
-            else:
-                s = ProxySession(proxy)
+        if self.never_sessions.match(url.domain):
+            self.urls_plugin.logger.debug(
+                "Domain {0} is blacklisted for sessions.".format(
+                    url.domain
+                )
+            )
 
-            s.session_type = None
+            return http.session(CookieJar(), self.urls_plugin.get_proxy(url))
 
-            return s
+        rule = self.session_groups.match(url.domain)
 
-        for entry in sessions["never"]:
-            if re.match(entry, url.domain, flags=str_to_regex_flags("ui")):
-                self.urls_plugin.logger.debug(
-                    "Domain {0} is blacklisted for sessions.".format(
-                        url.domain
-                    )
+        if rule is not None:
+            group = rule[1]
+
+            self.urls_plugin.logger.debug(
+                "Domain {0} uses the '{1}' group sessions.".format(
+                    url.domain, group
                 )
-                proxy = self.urls_plugin.get_proxy(url)
-
-                if not proxy:
-                    s = Session()
-                else:
-                    s = ProxySession(proxy)
-
-                s.session_type = None
-
-                return s
-
-        for group, entries in sessions["group"].iteritems():
-            for entry in entries:
-                try:
-                    if re.match(
-                            entry, url.domain, flags=str_to_regex_flags("ui")
-                    ):
-                        self.urls_plugin.logger.debug(
-                            "Domain {0} uses the '{1}' group sessions.".format(
-                                url.domain, group
-                            )
-                        )
-
-                        if group not in self.group_sessions:
-                            proxy = self.urls_plugin.get_proxy(group=group)
-
-                            if not proxy:
-                                s = Session()
-                            else:
-                                s = ProxySession(proxy)
-
-                            s.cookies = (
-                                self.get_cookie_jar(
-                                    "/groups/{0}.txt".format(
-                                        group
-                                    )
-                                )
-                            )
-
-                            s.session_type = "group"
-                            s.cookies.set_mode(
-                                context.get("config")
-                                .get("sessions")
-                                .get("cookies")
-                                .get("group")
-                            )
-
-                            self.group_sessions[group] = s
-
-                        return self.group_sessions[group]
-                except ValueError as e:
-                    self.urls_plugin.logger.error(
-                        "Failed to create cookie jar: {0}".format(e)
+            )
+
+            try:
+                if group not in self.group_sessions:
+                    cookies = self.get_cookie_jar(
+                        "/groups/{0}.txt".format(group)
+                    )
+
+                    cookies.set_mode(
+                        context.get("config")
+                        .get("sessions")
+                        .get("cookies")
+                        .get("group")
                     )
-                    continue
+
+                    self.group_sessions[group] = http.session(
+                        cookies,
+                        self.urls_plugin.get_proxy(group=group),
+                        "group"
+                    )
+
+                return self.group_sessions[group]
+            except ValueError as e:
+                self.urls_plugin.logger.error(
+                    "Failed to create cookie jar: {0}".format(e)
+                )
 
         self.urls_plugin.logger.debug(
             "Domain {0} uses the global session storage.".format(
@@ -450,16 +440,8 @@ class WebsiteHandler(URLHandler):
 
         proxy = self.urls_plugin.get_proxy(url)
 
-        if not proxy:
+        if (proxy or {}) == self.global_session.proxies:
             return self.global_session
-        else:
-            s = ProxySession(proxy)
-            s.cookies = self.get_cookie_jar("/global.txt")
-            s.session_type = "global"
-            s.cookies.set_mode(
-                self.plugin.config.get("sessions", {})
-                    .get("cookies", {})
-                    .get("global", "discard")
-            )
 
-            return s
+        # This domain has its own proxy, but shares the global cookies
+        return http.session(self.global_session.cookies, proxy)
@@ -0,0 +1,669 @@
+# coding=utf-8
+
+"""
+A non-blocking HTTP client for the URLs plugin, built on Twisted's Agent.
+
+All requests share one pool of persistent connections, so fetching a page
+from a site we've visited recently can re-use the connection, and no
+threads are involved - hundreds of fetches can be in progress at once.
+Responses are returned as soon as their headers arrive, and the body is
+only read if it's wanted, up to a limit.
+
+Sessions hold the cookie jar and proxies for a group of requests, much as
+requests' sessions did. Plain HTTP requests can go through HTTP proxies,
+but Twisted can't tunnel HTTPS through a proxy, so HTTPS requests for a
+session with an HTTPS proxy are made with a threaded requests session
+instead.
+
+Fetches are written with inlineCallbacks, which (in the Twisted we use)
+can't pass on being cancelled to whatever they're waiting on - so a fetch
+that should be cancellable keeps its requests and reads in a `Cancellable`,
+and cancelling that cancels them.
+
+Given an AddressResolver, the client resolves hostnames itself and connects
+to the address it resolved, refusing to connect to any address its
+`check_address` callable doesn't allow - for every request, including each
+hop of a redirect.
+"""
+
+import urlparse
+
+from requests.structures import CaseInsensitiveDict
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, \
+    maybeDeferred, succeed
+from twisted.internet.endpoints import SSL4ClientEndpoint, \
+    TCP4ClientEndpoint
+from twisted.internet.error import ConnectError, TimeoutError
+from twisted.internet.interfaces import IStreamClientEndpoint
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, BrowserLikePolicyForHTTPS, \
+    BrowserLikeRedirectAgent, ContentDecoderAgent, CookieAgent, \
+    GzipDecoder, HTTPConnectionPool, ProxyAgent, ResponseDone
+from twisted.web.error import SchemeNotSupported
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IAgentEndpointFactory, UNKNOWN_LENGTH
+from zope.interface import implementer
+
+from kitchen.text.converters import to_bytes
+
+from plugins.urls.proxy_session import ProxySession, get_charset
+
+__author__ = 'Gareth Coles'
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+#: Bodies we don't want that are no bigger than this are read and thrown
+#: away, so their connection can go back to the pool - anything bigger, or
+#: of unknown size, is cut off instead
+MAX_DRAIN_SIZE = 8192
+
+
+class BlockedAddress(ConnectError):
+    """
+    A host resolved to an address we aren't allowed to connect to.
+    """
+
+    def __init__(self, host, address):
+        ConnectError.__init__(
+            self, string="{0} resolved to {1}, which isn't allowed".format(
+                host, address
+            )
+        )
+
+        self.host = host
+        self.address = address
+
+
+@implementer(IStreamClientEndpoint)
+class ResolvingEndpoint(object):
+    """
+    Connects to a host at the address our resolver gives for it, if we're
+    allowed to.
+
+    :param tls: A TLS connection creator, for HTTPS, or None for plain TCP
+    """
+
+    def __init__(self, clock, resolver, host, port, timeout=30, tls=None,
+                 check_address=None):
+        self.clock = clock
+        self.resolver = resolver
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.tls = tls
+        self.check_address = check_address
+
+    def connect(self, factory):
+        d = self.resolver.get_host_by_name(self.host)
+        d.addCallback(self._connect, factory)
+
+        return d
+
+    def _connect(self, address, factory):
+        if self.check_address is not None and \
+                not self.check_address(address):
+            raise BlockedAddress(self.host, address)
+
+        if self.tls is None:
+            endpoint = TCP4ClientEndpoint(
+                self.clock, address, self.port, timeout=self.timeout
+            )
+        else:
+            # The connection creator has the hostname, for SNI and checking
+            # the certificate
+            endpoint = SSL4ClientEndpoint(
+                self.clock, address, self.port, self.tls,
+                timeout=self.timeout
+            )
+
+        return endpoint.connect(factory)
+
+
+@implementer(IAgentEndpointFactory)
+class ResolvingEndpointFactory(object):
+    """
+    Makes ResolvingEndpoints for an Agent.
+    """
+
+    def __init__(self, clock, resolver, connect_timeout=30,
+                 check_address=None):
+        self.clock = clock
+        self.resolver = resolver
+        self.connect_timeout = connect_timeout
+        self.check_address = check_address
+
+        self.policy = BrowserLikePolicyForHTTPS()
+
+    def endpointForURI(self, uri):
+        if uri.scheme == b"http":
+            tls = None
+        elif uri.scheme == b"https":
+            tls = self.policy.creatorForNetloc(uri.host, uri.port)
+        else:
+            raise SchemeNotSupported("Unsupported scheme: %r" % uri.scheme)
+
+        return ResolvingEndpoint(
+            self.clock, self.resolver, uri.host, uri.port,
+            self.connect_timeout, tls, self.check_address
+        )
+
+
+class BodyReader(Protocol):
+    """
+    Reads a response's body, stopping once we've read enough.
+
+    :param max_size: The most bytes to read
+    :param consumer: A callable that's given each chunk as it arrives, and
+        returns True once it doesn't want any more
+    """
+
+    def __init__(self, finished, max_size=None, consumer=None):
+        self.finished = finished
+        self.max_size = max_size
+        self.consumer = consumer
+
+        self.chunks = []
+        self.size = 0
+
+    def dataReceived(self, data):
+        if self.finished is None:
+            return
+
+        done = False
+
+        if self.max_size is not None and \
+                self.size + len(data) >= self.max_size:
+            data = data[:self.max_size - self.size]
+            done = True
+
+        self.chunks.append(data)
+        self.size += len(data)
+
+        if self.consumer is not None and self.consumer(data):
+            done = True
+
+        if done:
+            self._finish()
+
+            # Drop the rest - this closes the connection
+            self.transport.stopProducing()
+
+    def timedOut(self):
+        """
+        Give up on a body that's taking too long to arrive.
+        """
+
+        self.abort(TimeoutError(
+            string="Gave up reading the response after {0} bytes".format(
+                self.size
+            )
+        ))
+
+    def cancel(self, finished):
+        """
+        Stop reading, when our Deferred is cancelled.
+        """
+
+        self.abort(CancelledError())
+
+    def abort(self, reason):
+        """
+        Stop reading, and close the connection.
+        """
+
+        if self.finished is None:
+            return
+
+        finished, self.finished = self.finished, None
+        finished.errback(reason)
+
+        self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self._finish()
+        elif self.finished is not None:
+            finished, self.finished = self.finished, None
+            finished.errback(reason)
+
+    def _finish(self):
+        if self.finished is not None:
+            finished, self.finished = self.finished, None
+            finished.callback(b"".join(self.chunks))
+
+
+class Discarder(Protocol):
+    """
+    Throws away a response's body.
+
+    Small bodies are read, so that the connection can be re-used once
+    they're done, but if it's too big - or it's taking too long - we close
+    the connection instead.
+
+    :param length: The body's length, from its headers, or UNKNOWN_LENGTH
+    :param timeout: How long to spend reading a small body, in seconds, or
+        None to wait as long as it takes
+    """
+
+    def __init__(self, length=UNKNOWN_LENGTH, clock=None, timeout=None):
+        self.length = length
+        self.clock = clock or reactor
+        self.timeout = timeout
+
+        self.size = 0
+        self.stopped = False
+
+        self._timeout_call = None
+
+    def connectionMade(self):
+        if self.length is UNKNOWN_LENGTH or self.length > MAX_DRAIN_SIZE:
+            self.stop()
+        elif self.timeout is not None:
+            self._timeout_call = self.clock.callLater(self.timeout, self.stop)
+
+    def dataReceived(self, data):
+        self.size += len(data)
+
+        if self.size > MAX_DRAIN_SIZE:
+            self.stop()  # It's bigger than it said
+
+    def connectionLost(self, reason):
+        if self._timeout_call is not None and self._timeout_call.active():
+            self._timeout_call.cancel()
+
+        self._timeout_call = None
+
+    def stop(self):
+        if not self.stopped:
+            self.stopped = True
+            self.transport.stopProducing()
+
+
+class Response(object):
+    """
+    A response, with an interface much like requests' - but the body isn't
+    read until you call `read()`.
+
+    :param clock: The reactor to time reading the body with
+    :param timeout: How long to wait for the body, in seconds, or None to
+        wait as long as it takes
+    """
+
+    def __init__(self, response, clock=None, timeout=None):
+        self.original = response
+        self.clock = clock or reactor
+        self.timeout = timeout
+
+        #: If set, a Cancellable to keep track of reads with
+        self.cancellable = None
+
+        self.status_code = response.code
+        self.reason = response.phrase
+        self.url = response.request.absoluteURI
+
+        self.headers = CaseInsensitiveDict(
+            (name, values[-1])
+            for name, values in response.headers.getAllRawHeaders()
+        )
+
+        self.content = None
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def is_redirect(self):
+        return self.status_code in REDIRECT_CODES and \
+            "location" in self.headers
+
+    @property
+    def encoding(self):
+        return get_charset(self.headers.get("content-type", ""))
+
+    @property
+    def text(self):
+        if self.content is None:
+            return None
+
+        return self.content.decode(self.encoding or "utf-8", "replace")
+
+    def read(self, max_size=None, consumer=None):
+        """
+        Read the body.
+
+        :param max_size: The most bytes to read - the rest is dropped
+        :param consumer: A callable that's given each chunk as it arrives,
+            and returns True to stop reading
+        :return: A Deferred that fires with the body, as bytes, or fails
+            with a TimeoutError if it doesn't arrive in time - cancelling
+            it stops reading
+        """
+
+        if self.content is not None:
+            if consumer is not None and self.content:
+                consumer(self.content)
+
+            return succeed(self.content)
+
+        reader = BodyReader(None, max_size, consumer)
+        finished = reader.finished = Deferred(reader.cancel)
+
+        # The headers' timeout is done with once they've arrived, so the
+        # body gets one of its own - otherwise a site that stops sending
+        # halfway through would keep us waiting forever
+        timeout = None
+
+        if self.timeout is not None:
+            timeout = self.clock.callLater(self.timeout, reader.timedOut)
+
+        self.original.deliverBody(reader)
+
+        def done(content):
+            if timeout is not None and timeout.active():
+                timeout.cancel()
+
+            self.content = content
+            return content
+
+        def failed(failure):
+            if timeout is not None and timeout.active():
+                timeout.cancel()
+
+            return failure
+
+        finished.addCallbacks(done, failed)
+
+        if self.cancellable is not None:
+            self.cancellable.track(finished)
+
+        return finished
+
+    def discard(self):
+        """
+        Throw away the body, if we don't want it.
+        """
+
+        if self.content is None:
+            self.content = b""
+            self.original.deliverBody(Discarder(
+                self.original.length, self.clock, self.timeout
+            ))
+
+
+class Cancellable(object):
+    """
+    The requests and reads a fetch is waiting on, so that they can all be
+    cancelled if the fetch is given up on.
+
+    Use `watch()` to have everything done with a session kept track of, or
+    `track()` for a single Deferred.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+
+        self._pending = set()
+
+    def track(self, deferred):
+        """
+        Keep track of a Deferred until it fires, so it can be cancelled.
+
+        :return: The same Deferred
+        """
+
+        if self.cancelled:
+            deferred.cancel()
+            return deferred
+
+        self._pending.add(deferred)
+
+        def done(result):
+            self._pending.discard(deferred)
+            return result
+
+        return deferred.addBoth(done)
+
+    def watch(self, session):
+        """
+        :return: Something like the session, which keeps track of its
+            requests, and of the reads from their responses
+        """
+
+        return WatchedSession(session, self)
+
+    def cancel(self):
+        self.cancelled = True
+
+        pending, self._pending = self._pending, set()
+
+        for deferred in pending:
+            deferred.cancel()
+
+
+class WatchedSession(object):
+    """
+    A session whose requests, and their responses' reads, are kept track of
+    by a Cancellable. Everything else is passed through to the session.
+    """
+
+    def __init__(self, session, cancellable):
+        self.session = session
+        self.cancellable = cancellable
+
+    def __getattr__(self, item):
+        return getattr(self.session, item)
+
+    def get(self, *args, **kwargs):
+        def got(response):
+            response.cancellable = self.cancellable
+            return response
+
+        return self.cancellable.track(
+            self.session.get(*args, **kwargs)
+        ).addCallback(got)
+
+
+def call_cancellable(func, *args, **kwargs):
+    """
+    Call a function that does its requests through a Cancellable, which is
+    passed to it first.
+
+    :return: A Deferred that fires with the function's result, and cancels
+        whatever it's waiting on if it's cancelled
+    """
+
+    cancellable = Cancellable()
+    deferred = Deferred(lambda _: cancellable.cancel())
+
+    def done(result):
+        if deferred.called:
+            return  # It was cancelled, so nobody's waiting for this
+
+        if isinstance(result, Failure):
+            deferred.errback(result)
+        else:
+            deferred.callback(result)
+
+    maybeDeferred(func, cancellable, *args, **kwargs).addBoth(done)
+
+    return deferred
+
+
+class HTTPClient(object):
+    """
+    Makes HTTP requests, sharing a pool of persistent connections.
+
+    :param connections_per_host: How many idle connections to keep open to
+        each host
+    :param connect_timeout: How long to wait to connect, in seconds
+    :param timeout: How long to wait for a response's headers, and then
+        for its body, in seconds
+    :param resolver: An AddressResolver to look up hosts with, or None to
+        let Twisted look them up
+    :param check_address: A callable taking an address, which returns
+        whether we may connect to it - only used with a resolver
+    """
+
+    def __init__(self, connections_per_host=2, connect_timeout=10,
+                 timeout=30, resolver=None, check_address=None, clock=None):
+        self.clock = clock or reactor
+        self.resolver = resolver
+        self.check_address = check_address
+
+        self.pool = HTTPConnectionPool(self.clock, persistent=True)
+        self.pool.cachedConnectionTimeout = 60
+
+        self.configure(connections_per_host, connect_timeout, timeout)
+
+    def configure(self, connections_per_host=2, connect_timeout=10,
+                  timeout=30):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+
+        self.pool.maxPersistentPerHost = connections_per_host
+
+        if self.resolver is None:
+            self.agent = Agent(
+                self.clock, connectTimeout=connect_timeout, pool=self.pool
+            )
+        else:
+            self.agent = Agent.usingEndpointFactory(
+                self.clock, ResolvingEndpointFactory(
+                    self.clock, self.resolver, connect_timeout,
+                    self.check_address
+                ), self.pool
+            )
+
+        self._proxy_agents = {}
+
+    def session(self, cookies=None, proxies=None, session_type=None):
+        return Session(self, cookies, proxies, session_type)
+
+    def get(self, url, headers=None, allow_redirects=True, max_redirects=15):
+        """
+        Make a GET request, without cookies or proxies.
+
+        :return: A Deferred that fires with a Response
+        """
+
+        return self.request(
+            self.agent, "GET", url, headers, allow_redirects, max_redirects
+        )
+
+    def get_agent(self, proxy=None):
+        if proxy is None:
+            return self.agent
+
+        agent = self._proxy_agents.get(proxy)
+
+        if agent is None:
+            parsed = urlparse.urlparse(proxy)
+
+            endpoint = TCP4ClientEndpoint(
+                self.clock, parsed.hostname, parsed.port or 80,
+                timeout=self.connect_timeout
+            )
+
+            agent = ProxyAgent(endpoint, self.clock, pool=self.pool)
+            self._proxy_agents[proxy] = agent
+
+        return agent
+
+    def request(self, agent, method, url, headers=None, allow_redirects=True,
+                max_redirects=15, cookies=None):
+        if cookies is not None:
+            agent = CookieAgent(agent, cookies)
+
+        if allow_redirects:
+            agent = BrowserLikeRedirectAgent(agent, max_redirects)
+
+        agent = ContentDecoderAgent(agent, [("gzip", GzipDecoder)])
+
+        request_headers = Headers()
+
+        for name, value in (headers or {}).iteritems():
+            request_headers.setRawHeaders(to_bytes(name), [to_bytes(value)])
+
+        deferred = agent.request(
+            to_bytes(method), to_bytes(url), request_headers
+        )
+
+        timeout = self.clock.callLater(self.timeout, deferred.cancel)
+
+        def done(result):
+            if timeout.active():
+                timeout.cancel()
+
+            return result
+
+        return deferred.addBoth(done).addCallback(
+            Response, self.clock, self.timeout
+        )
+
+    def close(self):
+        """
+        Close all of the idle connections.
+
+        :return: A Deferred that fires once they're closed
+        """
+
+        return self.pool.closeCachedConnections()
+
+
+class Session(object):
+    """
+    A cookie jar and proxies, for a group of requests.
+
+    :param client: The HTTPClient to make requests with
+    :param cookies: A cookielib CookieJar, or None to not use cookies
+    :param proxies: A dict mapping URL schemes to proxy URLs
+    :param session_type: What sort of session this is - "global", "group"
+        or None for a throwaway session
+    """
+
+    def __init__(self, client, cookies=None, proxies=None, session_type=None):
+        self.client = client
+        self.cookies = cookies
+        self.proxies = proxies or {}
+        self.session_type = session_type
+
+        self._threaded = None
+
+    def get(self, url, headers=None, allow_redirects=True, max_redirects=15):
+        """
+        Make a GET request.
+
+        :return: A Deferred that fires with a Response
+        """
+
+        url = unicode(url)
+        scheme = urlparse.urlparse(url).scheme.lower()
+        proxy = self.proxies.get(scheme)
+
+        if proxy and scheme == "https":
+            return self._get_threaded().fetch(
+                url, headers=headers, allow_redirects=allow_redirects
+            )
+
+        return self.client.request(
+            self.client.get_agent(proxy or None), "GET", url, headers,
+            allow_redirects, max_redirects, self.cookies
+        )
+
+    def close(self):
+        if self._threaded is not None:
+            self._threaded.close()
+            self._threaded = None
+
+    def _get_threaded(self):
+        if self._threaded is None:
+            self._threaded = ProxySession(self.proxies)
+
+            if self.cookies is not None:
+                self._threaded.cookies = self.cookies
+
+        return self._threaded
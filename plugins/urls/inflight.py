@@ -0,0 +1,67 @@
+# coding=utf-8
+
+"""
+Coalescing identical requests that are in progress at the same time.
+
+When a link is relayed into several channels at once, we get a message for
+each of them before the first fetch has finished. Rather than fetch the
+same URL once per message, everyone after the first waits for the first
+fetch, and gets its result.
+"""
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+__author__ = 'Gareth Coles'
+
+
+class InFlight(object):
+    """
+    Runs at most one call per key at a time; anyone asking for the same key
+    while it's running gets the same result.
+    """
+
+    def __init__(self):
+        self.pending = {}  # key -> [Deferred]
+
+        self.started = 0
+        self.joined = 0
+
+    def __contains__(self, key):
+        return key in self.pending
+
+    def __len__(self):
+        return len(self.pending)
+
+    def run(self, key, func, *args, **kwargs):
+        """
+        Call something, unless a call for the same key is already running -
+        in which case, wait for that one instead.
+
+        :param key: What identifies identical calls
+        :param func: A callable, which may return a Deferred
+        :return: A Deferred that fires with the call's result
+        """
+
+        deferred = Deferred()
+        waiting = self.pending.get(key)
+
+        if waiting is not None:
+            self.joined += 1
+            waiting.append(deferred)
+
+            return deferred
+
+        self.started += 1
+        self.pending[key] = [deferred]
+
+        maybeDeferred(func, *args, **kwargs).addBoth(self._finished, key)
+
+        return deferred
+
+    def _finished(self, result, key):
+        for deferred in self.pending.pop(key, []):
+            if isinstance(result, Failure):
+                deferred.errback(result)
+            else:
+                deferred.callback(result)
@@ -1,36 +1,50 @@
 # coding=utf-8
 
-from txrequests import Session
-
 __author__ = 'Gareth Coles'
 
 
 class LazyRequest(object):
+    """
+    A request that's only made if a handler asks for it, and only once.
+
+    :param client: The plugin's HTTPClient
+    :param max_size: The most bytes of the body to read
+    """
+
     result = None
 
     _args = []
     _kwargs = {}
 
-    def __init__(self, pool=None, minthreads=1, maxthreads=4, req_args=None,
-                 req_kwargs=None, session_kwargs=None):
+    def __init__(self, client, req_args=None, req_kwargs=None,
+                 max_size=None):
         if not req_args:
             req_args = []
         if not req_kwargs:
             req_kwargs = {}
-        if not session_kwargs:
-            session_kwargs = {}
 
         self._args = req_args
         self._kwargs = req_kwargs
 
-        self._session = Session(
-            pool=pool, minthreads=minthreads, maxthreads=maxthreads,
-            **session_kwargs
-        )
+        self._client = client
+        self._max_size = max_size
 
     def get(self):
+        """
+        :return: A Deferred that fires with a plugins.urls.http.Response,
+            with its body already read
+        """
+
         if self.result is None:
-            self.result = self._session.get(*self._args, **self._kwargs)
-            del self._session
+            self.result = self._client.get(*self._args, **self._kwargs)
+            self.result.addCallback(self._read)
+
+            del self._client
 
         return self.result
+
+    def _read(self, response):
+        d = response.read(self._max_size)
+        d.addCallback(lambda _: response)
+
+        return d
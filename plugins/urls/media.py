@@ -0,0 +1,1043 @@
+# coding=utf-8
+
+"""
+Finding out what's in image, audio and video files from just the start of
+them.
+
+Most media formats say what they are - and how big, and how long - in
+their first few bytes, so for links to media we ask for the start of the
+file with a Range request, rather than downloading the whole thing. A
+`MediaProbe` is fed the file as it arrives, and says when it has what it
+needs, at which point we stop reading.
+
+Some formats keep their details somewhere else - MP4s that weren't written
+for streaming have their index at the end, Ogg files only say how long they
+are in their last page and MP3s may have a big ID3 tag in front of the
+audio. For these, the probe asks to carry on from another offset, and we
+make another Range request for it, if the server supports them.
+"""
+
+import struct
+import sys
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+__author__ = 'Gareth Coles'
+
+#: Returned by a parser that needs more of the file than it's been given
+NEED_MORE = object()
+
+#: Content types we'll look at - anything else at a media URL is probably
+#: a page about the media, so it's left to the website handler
+MEDIA_TYPES = frozenset(("image", "audio", "video"))
+OTHER_MEDIA_TYPES = frozenset((
+    "application/ogg", "application/octet-stream", "binary/octet-stream"
+))
+
+# How far into an MP3 (after any ID3 tag) to look for the first frame
+_MP3_SEARCH = 4096
+
+# How much of the end of an Ogg file to look for the last page in
+_OGG_TAIL = 8192
+
+# The biggest box or element we'll wait for all of - anything bigger is
+# skipped instead
+_MAX_LEAF = 65536
+
+_MP3_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384,
+             416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+             384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+             320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224,
+             256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+_MP3_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG 1
+    2: (22050, 24000, 16000),  # MPEG 2
+    0: (11025, 12000, 8000),  # MPEG 2.5
+}
+
+_MP4_BRANDS = {
+    b"M4A ": ("M4A", "audio"),
+    b"M4B ": ("M4B", "audio"),
+    b"M4V ": ("M4V", "video"),
+    b"qt  ": ("QuickTime", "video"),
+    b"3gp4": ("3GP", "video"),
+    b"3gp5": ("3GP", "video"),
+    b"3gp6": ("3GP", "video"),
+    b"avif": ("AVIF", "image"),
+    b"avis": ("AVIF", "image"),
+    b"heic": ("HEIC", "image"),
+    b"heix": ("HEIC", "image"),
+    b"mif1": ("HEIF", "image"),
+}
+
+_MP4_CONTAINERS = frozenset((b"moov", b"trak"))
+_MP4_LEAVES = frozenset((b"mvhd", b"tkhd"))
+
+_EBML = 0x1A45DFA3
+_EBML_DOC_TYPE = 0x4282
+_MKV_SEGMENT = 0x18538067
+_MKV_INFO = 0x1549A966
+_MKV_TIMECODE_SCALE = 0x2AD7B1
+_MKV_DURATION = 0x4489
+_MKV_TRACKS = 0x1654AE6B
+_MKV_TRACK_ENTRY = 0xAE
+_MKV_VIDEO = 0xE0
+_MKV_PIXEL_WIDTH = 0xB0
+_MKV_PIXEL_HEIGHT = 0xBA
+_MKV_CLUSTER = 0x1F43B675
+
+_MKV_CONTAINERS = frozenset((
+    _EBML, _MKV_SEGMENT, _MKV_INFO, _MKV_TRACKS, _MKV_TRACK_ENTRY, _MKV_VIDEO
+))
+_MKV_LEAVES = frozenset((
+    _EBML_DOC_TYPE, _MKV_TIMECODE_SCALE, _MKV_DURATION, _MKV_PIXEL_WIDTH,
+    _MKV_PIXEL_HEIGHT, _MKV_CLUSTER
+))
+
+_JPEG_FRAMES = frozenset(
+    (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD,
+     0xCE, 0xCF)
+)
+_JPEG_STANDALONE = frozenset((0x01,) + tuple(range(0xD0, 0xD9)))
+
+
+def is_media_type(content_type):
+    """
+    :param content_type: A content type, without parameters
+    """
+
+    content_type = content_type.lower()
+
+    return content_type.split("/", 1)[0] in MEDIA_TYPES or \
+        content_type in OTHER_MEDIA_TYPES
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+
+        size /= 1024.0
+
+    if unit == "B":
+        return u"{0} B".format(size)
+
+    return u"{0:.1f} {1}".format(size, unit)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    if hours:
+        return u"{0}:{1:02d}:{2:02d}".format(hours, minutes, seconds)
+
+    return u"{0}:{1:02d}".format(minutes, seconds)
+
+
+def get_size(response):
+    """
+    Work out how big a file is, from the response to a request for some or
+    all of it.
+
+    :type response: plugins.urls.http.Response
+    :return: The size in bytes, or None if the server didn't say
+    """
+
+    if response.status_code == 206:
+        content_range = response.headers.get("content-range", "")
+        _, _, total = content_range.rpartition("/")
+    else:
+        total = response.headers.get("content-length", "")
+
+    try:
+        return int(total)
+    except ValueError:
+        return None
+
+
+def get_range_start(response):
+    """
+    :return: The offset the part of the file in a 206 response starts at,
+        or None if it didn't say
+    """
+
+    content_range = response.headers.get("content-range", "")
+    units, _, rest = content_range.strip().partition(" ")
+
+    if units.lower() != "bytes":
+        return None
+
+    try:
+        return int(rest.partition("-")[0])
+    except ValueError:
+        return None
+
+
+class MediaInfo(object):
+    """
+    What we know about a media file.
+
+    :param size: The file's size in bytes, if we know it
+    """
+
+    __slots__ = ("format", "kind", "width", "height", "duration", "size")
+
+    def __init__(self, size=None):
+        self.format = None  # "PNG", "MP3", etc
+        self.kind = None  # "image", "audio" or "video"
+        self.width = None
+        self.height = None
+        self.duration = None  # In seconds
+        self.size = size
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            self.__class__.__name__,
+            ", ".join("%s=%r" % (name, getattr(self, name))
+                      for name in self.__slots__)
+        )
+
+    def describe(self):
+        """
+        :return: Something like u"PNG image, 640x480, 12.3 KB"
+        """
+
+        parts = [u"{0} {1}".format(self.format, self.kind)]
+
+        if self.width and self.height:
+            parts.append(u"{0}x{1}".format(self.width, self.height))
+
+        if self.duration:
+            parts.append(format_duration(self.duration))
+
+        if self.size is not None:
+            parts.append(format_size(self.size))
+
+        return u", ".join(parts)
+
+
+class MediaProbe(object):
+    """
+    Works out what a media file is as it arrives.
+
+    Each read is of a part of the file, starting at an offset - the first
+    from the start of the file. Call `start()` before each read, `feed()`
+    with each chunk and `finish()` once the read is done. If the probe
+    wants to carry on from somewhere else, `seek` is the offset to read
+    from next.
+
+    :param size: The file's size in bytes, if we know it
+    """
+
+    def __init__(self, size=None):
+        self.info = MediaInfo(size)
+
+        self.done = False
+        self.seek = None
+
+        self.offset = 0  # Where the current read started
+        self._end = None  # Where the current read will stop
+
+        self._buffer = b""
+        self._parser = _identify
+        self._next = None
+
+    def start(self, offset, end=None):
+        """
+        Start reading part of the file.
+
+        :param offset: Where the read starts - after the first read, this
+            should be `seek`
+        :param end: The offset of the last byte we've asked for, if we
+            know it
+        """
+
+        if self._next is not None:
+            self.seek, self._parser = None, self._next
+            self._next = None
+
+        self.offset = offset
+        self._end = end
+        self._buffer = b""
+
+    def feed(self, data):
+        """
+        :param data: The next chunk of the file, as bytes
+        :return: Whether we can stop reading - because we have everything,
+            or want to carry on from somewhere else
+        """
+
+        if self.done or self.seek is not None:
+            return True
+
+        self._buffer += data
+
+        return self._run()
+
+    def finish(self):
+        """
+        The read is over - if we're not carrying on from somewhere else,
+        we know as much as we're going to.
+        """
+
+        if self.seek is None:
+            self.done = True
+
+    def _run(self):
+        start, parser = self.offset, self._parser
+
+        while True:
+            try:
+                result = parser(self._buffer[start - self.offset:], self.info)
+            except (ValueError, IndexError, struct.error):
+                result = None  # Broken, or not what we thought it was
+
+            if result is None:
+                self.done = True
+                return True
+
+            if result is NEED_MORE:
+                return False
+
+            start, parser = result
+
+            if self.offset <= start < self.offset + len(self._buffer):
+                continue  # We already have it
+
+            if start >= self.offset and self._end is not None and \
+                    start <= self._end:
+                # It's in the part we're reading - we just need to wait
+                # for it
+                return False
+
+            self.seek = start
+            self._next = parser
+
+            return True
+
+
+@inlineCallbacks
+def probe_url(session, url, headers=None, max_read=65536, max_requests=3):
+    """
+    Find out what's in a media file, reading as little of it as we can.
+
+    :type session: plugins.urls.http.Session
+    :param headers: Any headers to send with each request
+    :param max_read: The most bytes to read, over all the requests
+    :param max_requests: The most requests to make
+    :return: A Deferred that fires with (the first response, its MediaInfo),
+        or (the response, None) if it wasn't something we can look at
+    """
+
+    headers = dict(headers or {})
+
+    first = None
+    probe = None
+    offset = 0
+    read = 0
+    requests = 0
+
+    while True:
+        end = offset + max_read - read - 1
+
+        headers["Range"] = "bytes={0}-{1}".format(offset, end)
+        response = yield session.get(url, headers=headers)
+        requests += 1
+
+        if first is None:
+            first = response
+
+            content_type = response.headers.get("content-type", "")
+            content_type = content_type.split(";", 1)[0].strip()
+
+            if not response.ok or not is_media_type(content_type):
+                response.discard()
+                returnValue((response, None))
+                return
+
+            probe = MediaProbe(get_size(response))
+        elif response.status_code != 206 or \
+                get_range_start(response) != offset:
+            # Not the part we asked for, so we'll make do with what we have
+            response.discard()
+            break
+
+        probe.start(offset, end)
+        content = yield response.read(max_read - read, probe.feed)
+        probe.finish()
+
+        read += len(content)
+
+        if probe.done or first.status_code != 206 or \
+                requests >= max_requests or read >= max_read:
+            break
+
+        offset = probe.seek
+
+    returnValue((first, probe.info))
+
+
+# Parsers
+#
+# Each is given the part of the file we're reading (from wherever it
+# started) and the MediaInfo to fill in, and returns None once it's done,
+# NEED_MORE if it needs more of that part, or (offset, parser) to carry on
+# from an offset with another parser. They may be given the same data again
+# with more on the end, so they shouldn't keep any state of their own.
+
+
+def _identify(data, info):
+    if len(data) < 32:
+        return NEED_MORE
+
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return _parse_png(data, info)
+
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        info.format, info.kind = "GIF", "image"
+        info.width, info.height = struct.unpack("<HH", data[6:10])
+        return None
+
+    if data.startswith(b"\xff\xd8\xff"):
+        info.format, info.kind = "JPEG", "image"
+        return _jpeg_segments(2)(data[2:], info)
+
+    if data.startswith(b"BM") and \
+            struct.unpack("<I", data[14:18])[0] in (12, 40, 52, 56, 108, 124):
+        return _parse_bmp(data, info)
+
+    if data.startswith(b"RIFF"):
+        if data[8:12] == b"WEBP":
+            return _parse_webp(data, info)
+
+        if data[8:12] == b"WAVE":
+            info.format, info.kind = "WAV", "audio"
+            return _wav_chunks(12)(data[12:], info)
+
+        if data[8:12] == b"AVI ":
+            return _parse_avi(data, info)
+
+    if data[4:8] == b"ftyp":
+        return _parse_mp4(data, info)
+
+    if data.startswith(b"fLaC"):
+        return _parse_flac(data, info)
+
+    if data.startswith(b"OggS"):
+        return _parse_ogg(data, info)
+
+    if data.startswith(b"\x1a\x45\xdf\xa3"):
+        info.format, info.kind = "Matroska", "video"
+        return _ebml_elements(0)(data, info)
+
+    if data.startswith(b"ID3") or _mp3_header(data[:4]) is not None:
+        info.format, info.kind = "MP3", "audio"
+        return _parse_mp3(data, info)
+
+    return None
+
+
+def _parse_png(data, info):
+    if len(data) < 24:
+        return NEED_MORE
+
+    info.format, info.kind = "PNG", "image"
+    info.width, info.height = struct.unpack(">II", data[16:24])
+
+
+def _parse_bmp(data, info):
+    if len(data) < 26:
+        return NEED_MORE
+
+    info.format, info.kind = "BMP", "image"
+
+    if struct.unpack("<I", data[14:18])[0] == 12:  # OS/2
+        info.width, info.height = struct.unpack("<HH", data[18:22])
+    else:
+        width, height = struct.unpack("<ii", data[18:26])
+        info.width, info.height = width, abs(height)  # Negative if top-down
+
+
+def _parse_webp(data, info):
+    if len(data) < 30:
+        return NEED_MORE
+
+    info.format, info.kind = "WebP", "image"
+
+    chunk = data[12:16]
+
+    if chunk == b"VP8 ":  # Lossy
+        width, height = struct.unpack("<HH", data[26:30])
+        info.width, info.height = width & 0x3FFF, height & 0x3FFF
+    elif chunk == b"VP8L":  # Lossless
+        b = bytearray(data[21:25])
+        info.width = 1 + (((b[1] & 0x3F) << 8) | b[0])
+        info.height = 1 + (((b[3] & 0x0F) << 10) | (b[2] << 2) |
+                           ((b[1] & 0xC0) >> 6))
+    elif chunk == b"VP8X":  # Extended
+        b = bytearray(data[24:30])
+        info.width = 1 + (b[0] | (b[1] << 8) | (b[2] << 16))
+        info.height = 1 + (b[3] | (b[4] << 8) | (b[5] << 16))
+
+
+def _parse_avi(data, info):
+    if len(data) < 72:
+        return NEED_MORE
+
+    info.format, info.kind = "AVI", "video"
+
+    if data[12:16] != b"LIST" or data[20:28] != b"hdrlavih":
+        return None
+
+    frame_time = struct.unpack("<I", data[32:36])[0]  # In microseconds
+    frames = struct.unpack("<I", data[48:52])[0]
+    info.width, info.height = struct.unpack("<II", data[64:72])
+
+    if frame_time and frames:
+        info.duration = frames * frame_time / 1000000.0
+
+
+def _parse_flac(data, info):
+    if len(data) < 26:
+        return NEED_MORE
+
+    info.format, info.kind = "FLAC", "audio"
+
+    if ord(data[4]) & 0x7F != 0:
+        return None  # STREAMINFO should always be first
+
+    b = bytearray(data[18:26])
+    sample_rate = (b[0] << 12) | (b[1] << 4) | (b[2] >> 4)
+    samples = ((b[3] & 0x0F) << 32) | struct.unpack(">I", data[22:26])[0]
+
+    if sample_rate and samples:
+        info.duration = float(samples) / sample_rate
+
+
+def _jpeg_segments(base):
+    """
+    Walks a JPEG's segments, from the offset `base`, until we find the
+    frame header with the image's size.
+    """
+
+    def parse(data, info):
+        position = 0
+
+        while True:
+            if position > len(data):
+                return base + position, _jpeg_segments(base + position)
+
+            if position + 4 > len(data):
+                return NEED_MORE
+
+            marker, code = bytearray(data[position:position + 2])
+
+            if marker != 0xFF:
+                return None  # We've lost our place
+
+            if code == 0xFF:  # Padding
+                position += 1
+                continue
+
+            if code in _JPEG_STANDALONE:
+                position += 2
+                continue
+
+            if code in (0xD9, 0xDA):
+                return None  # The image started without a frame header
+
+            if code in _JPEG_FRAMES:
+                if position + 9 > len(data):
+                    return NEED_MORE
+
+                info.height, info.width = struct.unpack(
+                    ">HH", data[position + 5:position + 9]
+                )
+                return None
+
+            length = struct.unpack(">H", data[position + 2:position + 4])[0]
+            position += 2 + length
+
+    return parse
+
+
+def _wav_chunks(base, byte_rate=None):
+    """
+    Walks a WAV file's chunks, from the offset `base`, until we reach the
+    audio data.
+    """
+
+    def parse(data, info):
+        position = 0
+        rate = byte_rate
+
+        while True:
+            if position > len(data):
+                return base + position, _wav_chunks(base + position, rate)
+
+            if position + 8 > len(data):
+                return NEED_MORE
+
+            chunk, length = struct.unpack("<4sI", data[position:position + 8])
+
+            if chunk == b"fmt ":
+                if position + 20 > len(data):
+                    return NEED_MORE
+
+                rate = struct.unpack(
+                    "<I", data[position + 16:position + 20]
+                )[0]
+
+            elif chunk == b"data":
+                if length in (0, 0xFFFFFFFF) and info.size:
+                    # Written while streaming, so the length wasn't known
+                    length = info.size - (base + position + 8)
+
+                if rate:
+                    info.duration = float(length) / rate
+
+                return None
+
+            position += 8 + length + (length & 1)
+
+    return parse
+
+
+def _mp3_header(header):
+    """
+    :return: (layer, whether it's MPEG 1, bitrate in kbps, sample rate,
+        samples per frame, whether it's mono) or None if it's not a valid
+        MPEG audio frame header
+    """
+
+    if len(header) < 4:
+        return None
+
+    b = bytearray(header)
+
+    if b[0] != 0xFF or b[1] & 0xE0 != 0xE0:
+        return None
+
+    version = (b[1] >> 3) & 3
+    layer = 4 - ((b[1] >> 1) & 3)
+    bitrate_index = b[2] >> 4
+    rate_index = (b[2] >> 2) & 3
+
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or \
+            rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+
+    if mpeg1:
+        bitrate = _MP3_BITRATES[1, layer][bitrate_index]
+    else:
+        bitrate = _MP3_BITRATES[2, min(layer, 2)][bitrate_index]
+
+    if layer == 1:
+        samples = 384
+    elif mpeg1 or layer == 2:
+        samples = 1152
+    else:
+        samples = 576
+
+    return (layer, mpeg1, bitrate, _MP3_SAMPLE_RATES[version][rate_index],
+            samples, b[3] >> 6 == 3)
+
+
+def _parse_mp3(data, info):
+    if not data.startswith(b"ID3"):
+        return _mp3_frames(0)(data, info)
+
+    if len(data) < 10:
+        return NEED_MORE
+
+    b = bytearray(data[6:10])
+    size = 10 + ((b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3])
+
+    if ord(data[5]) & 0x10:  # There's a footer too
+        size += 10
+
+    # The audio starts after the tag
+    return size, _mp3_frames(size)
+
+
+def _mp3_frames(base):
+    """
+    Finds the first MPEG audio frame, from the offset `base`, and works out
+    the file's length from it.
+    """
+
+    def parse(data, info):
+        position = data.find(b"\xff")
+
+        while position != -1 and position < _MP3_SEARCH:
+            if position + 4 > len(data):
+                return NEED_MORE
+
+            header = _mp3_header(data[position:position + 4])
+
+            if header is not None:
+                break
+
+            position = data.find(b"\xff", position + 1)
+        else:
+            return NEED_MORE if len(data) < _MP3_SEARCH else None
+
+        if position + 54 > len(data):
+            return NEED_MORE
+
+        layer, mpeg1, bitrate, sample_rate, samples, mono = header
+
+        info.format = "MP{0}".format(layer)
+
+        # A VBR file should have a Xing (or Info) or VBRI header in its
+        # first frame, saying how many frames there are
+        if mpeg1:
+            xing = position + (21 if mono else 36)
+        else:
+            xing = position + (13 if mono else 21)
+
+        frames = None
+
+        if data[xing:xing + 4] in (b"Xing", b"Info"):
+            flags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+
+            if flags & 1:
+                frames = struct.unpack(">I", data[xing + 8:xing + 12])[0]
+
+        elif data[position + 36:position + 40] == b"VBRI":
+            frames = struct.unpack(">I", data[position + 50:position + 54])[0]
+
+        if frames:
+            info.duration = float(frames) * samples / sample_rate
+        elif info.size:
+            # Constant bitrate, hopefully
+            info.duration = (info.size - base - position) * 8.0 / \
+                (bitrate * 1000)
+
+        return None
+
+    return parse
+
+
+def _parse_ogg(data, info):
+    if len(data) < 27:
+        return NEED_MORE
+
+    header_end = 27 + ord(data[26])
+
+    if len(data) < header_end + 20:
+        return NEED_MORE
+
+    serial = struct.unpack("<I", data[14:18])[0]
+    packet = data[header_end:]
+
+    pre_skip = 0
+
+    if packet.startswith(b"\x01vorbis"):
+        info.format, info.kind = "Ogg Vorbis", "audio"
+        sample_rate = struct.unpack("<I", packet[12:16])[0]
+    elif packet.startswith(b"OpusHead"):
+        info.format, info.kind = "Opus", "audio"
+        sample_rate = 48000  # Always, whatever the input was
+        pre_skip = struct.unpack("<H", packet[10:12])[0]
+    elif packet.startswith(b"\x80theora"):
+        info.format, info.kind = "Ogg Theora", "video"
+        b = bytearray(packet[14:20])
+        info.width = (b[0] << 16) | (b[1] << 8) | b[2]
+        info.height = (b[3] << 16) | (b[4] << 8) | b[5]
+        return None
+    else:
+        info.format, info.kind = "Ogg", "audio"
+        return None
+
+    if not info.size or not sample_rate:
+        return None
+
+    # The last page says how many samples there were
+    tail = max(0, info.size - _OGG_TAIL)
+
+    return tail, _ogg_tail(tail, serial, sample_rate, pre_skip)
+
+
+def _ogg_tail(base, serial, sample_rate, pre_skip):
+    def parse(data, info):
+        if base + len(data) < info.size:
+            return NEED_MORE
+
+        position = data.rfind(b"OggS")
+
+        while position != -1:
+            if len(data) >= position + 18 and \
+                    struct.unpack("<I", data[position + 14:position + 18])[0] \
+                    == serial:
+                granule = struct.unpack(
+                    "<q", data[position + 6:position + 14]
+                )[0]
+
+                if granule > 0:
+                    info.duration = float(granule - pre_skip) / sample_rate
+                    return None
+
+            position = data.rfind(b"OggS", 0, position)
+
+        return None
+
+    return parse
+
+
+def _parse_mp4(data, info):
+    info.format, info.kind = _MP4_BRANDS.get(data[8:12], ("MP4", "video"))
+
+    if info.kind == "image":
+        return None  # The size is buried too deep to be worth it
+
+    return _walker(
+        _mp4_header, _MP4_CONTAINERS, _MP4_LEAVES, _visit_mp4, 0
+    )(data, info)
+
+
+def _mp4_header(data, start):
+    if start + 8 > len(data):
+        return None
+
+    size, box = struct.unpack(">I4s", data[start:start + 8])
+
+    if size == 1:  # A 64-bit size follows
+        if start + 16 > len(data):
+            return None
+
+        size = struct.unpack(">Q", data[start + 8:start + 16])[0]
+        return box, 16, size - 16
+
+    if size == 0:  # It runs to the end of the file
+        return box, 8, None
+
+    if size < 8:
+        raise ValueError("Broken box")
+
+    return box, 8, size - 8
+
+
+def _visit_mp4(box, payload, info, state):
+    if payload is None:
+        # We're done with the index once it's over
+        return box == b"moov"
+
+    version = ord(payload[0])
+
+    if box == b"mvhd":
+        if version == 1:
+            scale, duration = struct.unpack(">IQ", payload[20:32])
+        else:
+            scale, duration = struct.unpack(">II", payload[12:20])
+
+        if scale:
+            info.duration = float(duration) / scale
+
+    elif box == b"tkhd" and info.width is None:
+        # 16.16 fixed point, and 0 for tracks that aren't video
+        width, height = struct.unpack(">II", payload[-8:])
+
+        if width and height:
+            info.width, info.height = width >> 16, height >> 16
+
+    return info.duration is not None and (
+        info.width is not None or info.kind == "audio"
+    )
+
+
+def _ebml_number(data, position):
+    """
+    Reads one of EBML's variable-length numbers.
+
+    :return: (the number, or None if all its bits are set, and its length),
+        or None if we don't have all of it yet
+    """
+
+    if position >= len(data):
+        return None
+
+    first = ord(data[position])
+    length = 1
+    mask = 0x80
+
+    while not first & mask:
+        mask >>= 1
+        length += 1
+
+        if length > 8:
+            raise ValueError("Broken EBML number")
+
+    if position + length > len(data):
+        return None
+
+    value = first & (mask - 1)
+
+    for byte in bytearray(data[position + 1:position + length]):
+        value = (value << 8) | byte
+
+    if value == (1 << (7 * length)) - 1:
+        value = None  # Unknown
+
+    return value, length
+
+
+def _ebml_header(data, start):
+    element = _ebml_number(data, start)
+
+    if element is None:
+        return None
+
+    # Element IDs keep their length marker
+    length = element[1]
+    element_id = 0
+
+    for byte in bytearray(data[start:start + length]):
+        element_id = (element_id << 8) | byte
+
+    size = _ebml_number(data, start + length)
+
+    if size is None:
+        return None
+
+    return element_id, length + size[1], size[0]
+
+
+def _ebml_elements(base):
+    return _walker(
+        _ebml_header, _MKV_CONTAINERS, _MKV_LEAVES, _visit_ebml, base
+    )
+
+
+def _visit_ebml(element, payload, info, state):
+    if payload is None:
+        if element == _MKV_INFO:
+            duration = state.get("duration")
+
+            if duration:
+                scale = state.get("scale") or 1000000  # In nanoseconds
+                info.duration = duration * scale / 1000000000.0
+
+        elif element == _MKV_TRACKS:
+            if info.width is None:
+                info.kind = "audio"
+
+            return True
+
+        return element == _MKV_SEGMENT
+
+    if element == _EBML_DOC_TYPE:
+        if payload.rstrip(b"\0") == b"webm":
+            info.format = "WebM"
+
+    elif element == _MKV_TIMECODE_SCALE:
+        state["scale"] = _uint(payload)
+
+    elif element == _MKV_DURATION:
+        state["duration"] = struct.unpack(
+            ">f" if len(payload) == 4 else ">d", payload
+        )[0]
+
+    elif element == _MKV_PIXEL_WIDTH:
+        state.setdefault("width", _uint(payload))
+
+    elif element == _MKV_PIXEL_HEIGHT:
+        state.setdefault("height", _uint(payload))
+
+        if info.width is None and "width" in state:
+            info.width, info.height = state["width"], state["height"]
+
+    elif element == _MKV_CLUSTER:
+        return True  # The tracks and info come before the media itself
+
+    return False
+
+
+def _uint(data):
+    value = 0
+
+    for byte in bytearray(data):
+        value = (value << 8) | byte
+
+    return value
+
+
+def _walker(read_header, containers, leaves, visit, base, parents=(),
+            state=None):
+    """
+    Walks a tree of boxes or elements - as MP4 and Matroska files are laid
+    out - from the offset `base`.
+
+    :param read_header: Called with (data, offset), and returns (type,
+        header length, content length or None if it runs to the end of its
+        parent), or None if we don't have the whole header yet
+    :param containers: Types that we look inside
+    :param leaves: Types whose contents `visit` is given
+    :param visit: Called with (type, contents, info, state) for each leaf,
+        and with contents None when a container ends - returns True once
+        we're done
+    :param parents: The (type, end offset) of each container we start
+        inside
+    :param state: A dict for `visit` to keep things in
+    """
+
+    def parse(data, info):
+        position = base
+        stack = list(parents)
+        values = dict(state or {})
+
+        while True:
+            while stack and position >= stack[-1][1]:
+                if visit(stack.pop()[0], None, info, values):
+                    return None
+
+            start = position - base
+
+            if start > len(data):
+                return position, _walker(
+                    read_header, containers, leaves, visit, position,
+                    tuple(stack), values
+                )
+
+            header = read_header(data, start)
+
+            if header is None:
+                return NEED_MORE
+
+            kind, header_size, size = header
+
+            if size is None:
+                if kind not in containers:
+                    return None  # There's nothing after it
+
+                end = stack[-1][1] if stack else sys.maxint
+            else:
+                end = position + header_size + size
+
+            if kind in containers:
+                stack.append((kind, end))
+                position += header_size
+                continue
+
+            if kind in leaves and size <= _MAX_LEAF:
+                if start + header_size + size > len(data):
+                    return NEED_MORE
+
+                contents = data[start + header_size:start + header_size + size]
+
+                if visit(kind, contents, info, values):
+                    return None
+
+            position = end
+
+    return parse
@@ -5,6 +5,7 @@ __author__ = 'Gareth Coles'
 
 class Priority(object):
     MONITOR = -100  # Only really for the website handler
+    MEDIA = -90  # Only really for the media handler, just before that
     LATEST = 0
     LATER = 20
     LATE = 40
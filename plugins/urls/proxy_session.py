@@ -1,13 +1,129 @@
 # coding=utf-8
+
+import cgi
+
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
 from txrequests import Session
 
 __author__ = 'Gareth Coles'
 
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+def get_charset(content_type):
+    """
+    Get the charset from a Content-Type header, if there is one.
+    """
+
+    charset = cgi.parse_header(content_type)[1].get("charset")
+
+    if charset:
+        return charset.strip("\"'").lower()
+
+    return None
+
 
 class ProxySession(Session):
+    """
+    A threaded requests session, for proxying the HTTPS requests that the
+    Twisted-based client can't.
+    """
+
     def __init__(self, proxies, pool=None, minthreads=1, maxthreads=4,
                  **kwargs):
         super(ProxySession, self).__init__(pool, minthreads, maxthreads,
                                            **kwargs)
 
         self.proxies = proxies
+
+    def fetch(self, url, headers=None, allow_redirects=True):
+        """
+        Make a GET request, with the same interface as the Twisted-based
+        client's sessions.
+
+        :return: A Deferred that fires with a ThreadedResponse
+        """
+
+        d = self.get(url, headers=headers, stream=True,
+                     allow_redirects=allow_redirects)
+
+        return d.addCallback(ThreadedResponse, self.pool)
+
+
+class ThreadedResponse(object):
+    """
+    Wraps a streamed requests response, so its body can be read from the
+    session's threads.
+    """
+
+    def __init__(self, response, pool):
+        self.original = response
+
+        self.status_code = response.status_code
+        self.reason = response.reason
+        self.url = response.url
+        self.headers = response.headers
+
+        self.content = None
+
+        self._pool = pool
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def is_redirect(self):
+        return self.status_code in REDIRECT_CODES and \
+            "location" in self.headers
+
+    @property
+    def encoding(self):
+        return get_charset(self.headers.get("content-type", ""))
+
+    @property
+    def text(self):
+        if self.content is None:
+            return None
+
+        return self.content.decode(self.encoding or "utf-8", "replace")
+
+    def read(self, max_size=None, consumer=None):
+        d = deferToThreadPool(
+            reactor, self._pool, self._read, max_size, consumer
+        )
+
+        def done(content):
+            self.content = content
+            return content
+
+        return d.addCallback(done)
+
+    def discard(self):
+        if self.content is None:
+            self.content = b""
+            deferToThreadPool(reactor, self._pool, self.original.close)
+
+    def _read(self, max_size, consumer):
+        chunks = []
+        size = 0
+
+        try:
+            for chunk in self.original.iter_content(chunk_size=4096):
+                if max_size is not None:
+                    chunk = chunk[:max_size - size]
+
+                chunks.append(chunk)
+                size += len(chunk)
+
+                # The consumer's only used by this thread until we're done
+                if consumer is not None and consumer(chunk):
+                    break
+
+                if max_size is not None and size >= max_size:
+                    break
+        finally:
+            self.original.close()
+
+        return b"".join(chunks)
@@ -1,38 +1,218 @@
 # coding=utf-8
 
-import socket
-from twisted.internet import defer, reactor
-from twisted.python.threadpool import ThreadPool
+"""
+Resolving hostnames for the URLs plugin, without threads.
+
+Lookups are made with Twisted's DNS client, using the servers from
+/etc/resolv.conf unless others are given, after checking the hosts file.
+Answers are cached for as long as their TTL says (within limits), names
+that don't exist are remembered for a short while, and lookups for a name
+that's already being looked up wait for that lookup instead of starting
+another.
+
+The HTTP client connects to the address we resolved, rather than resolving
+the name again itself - so the address we checked is the one we connect to.
+"""
+
+from netaddr import IPAddress
+from twisted.internet import reactor
+from twisted.internet.abstract import isIPAddress
+from twisted.internet.defer import fail, succeed
+from twisted.internet.error import DNSLookupError
+from twisted.names import client, dns
+from twisted.names.error import DNSNameError
+from twisted.names.hosts import searchFileForAll
+from twisted.python.filepath import FilePath
+
+from plugins.urls.inflight import InFlight
+from utils.lru import LRUCache
 
 __author__ = 'Gareth Coles'
 
+#: How many CNAMEs to follow before giving up
+MAX_CNAMES = 8
+
+
+def is_public_address(ip):
+    """
+    Check that an address isn't a loopback, private, link-local or
+    multicast address - somewhere we shouldn't let people make us connect.
+    """
+
+    ip = IPAddress(ip)
+
+    return not (ip.is_loopback() or ip.is_private() or ip.is_link_local() or
+                ip.is_multicast())
+
 
 class AddressResolver(object):
-    pool = None
-
-    def __init__(self, minthreads=1, maxthreads=4):
-        self.pool = ThreadPool(minthreads=minthreads, maxthreads=maxthreads)
-        # unclosed ThreadPool leads to reactor hangs at shutdown
-        # this is a problem in many situation, so better enforce pool stop here
-        reactor.addSystemEventTrigger(
-            "before", "shutdown", self.pool.stop
+    """
+    An asynchronous, caching resolver for IPv4 addresses.
+
+    :param servers: A list of (address, port) tuples for the DNS servers to
+        use, or None to use the ones in resolv.conf
+    :param min_ttl: The shortest time to cache an address for, in seconds
+    :param max_ttl: The longest time to cache an address for, in seconds
+    :param negative_ttl: How long to remember that a name doesn't exist, in
+        seconds
+    :param max_size: The most names to cache
+    :param resolver: A Twisted IResolver to make lookups with, instead of
+        creating one
+    """
+
+    def __init__(self, servers=None, min_ttl=30, max_ttl=3600,
+                 negative_ttl=60, max_size=1024, resolvconf=None,
+                 hosts=b"/etc/hosts", resolver=None, clock=None):
+        self.clock = clock or reactor
+
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+
+        self.hosts = FilePath(hosts) if hosts else None
+
+        if resolver is None:
+            resolver = client.Resolver(
+                resolvconf or b"/etc/resolv.conf", servers,
+                reactor=self.clock
+            )
+
+        self.resolver = resolver
+
+        self.hits = 0
+        self.misses = 0
+
+        self._cache = LRUCache(max_size)  # name -> (address or None, expiry)
+        self._lookups = InFlight()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def configure(self, min_ttl=30, max_ttl=3600, negative_ttl=60,
+                  max_size=1024):
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+
+        self._cache.max_size = max_size
+        self._cache._evict()
+
+    def get_cached(self, name):
+        """
+        Get the address for a name if it's cached, without looking it up.
+
+        :return: The address, None if the name doesn't exist, or False if
+            we don't know yet
+        """
+
+        name = name.lower()
+        entry = self._cache.get(name)
+
+        if entry is None:
+            return False
+
+        address, expires = entry
+
+        if expires <= self.clock.seconds():
+            del self._cache[name]
+            return False
+
+        return address
+
+    def get_host_by_name(self, name):
+        """
+        Resolve a name to an IPv4 address.
+
+        :return: A Deferred that fires with the address as a string, or
+            fails with DNSLookupError if the name doesn't exist
+        """
+
+        if isIPAddress(name):
+            return succeed(name)
+
+        name = name.lower()
+        address = self.get_cached(name)
+
+        if address is False:
+            self.misses += 1
+
+            return self._lookups.run(name, self._lookup, name)
+
+        self.hits += 1
+
+        if address is None:
+            return fail(DNSLookupError(name))
+
+        return succeed(address)
+
+    def clear(self):
+        self._cache.clear()
+
+    def close(self):
+        # The client re-reads resolv.conf every so often
+        call = getattr(self.resolver, "_parseCall", None)
+
+        if call is not None and call.active():
+            call.cancel()
+
+    def stats(self):
+        return "{0} names cached, {1} hits, {2} misses".format(
+            len(self), self.hits, self.misses
         )
 
-        self.pool.start()
+    # Internals
 
-    def get_host_by_name(self, address):
-        d = defer.Deferred()
+    def _lookup(self, name):
+        if self.hosts is not None:
+            for address in searchFileForAll(self.hosts, name):
+                if isIPAddress(address):
+                    self._store(name, address, self.max_ttl)
+                    return address
 
-        def func():
-            try:
-                reactor.callFromThread(
-                    d.callback, socket.gethostbyname(address)
-                )
-            except Exception as e:
-                reactor.callFromThread(d.errback, e)
+        d = self._query(name, name, [])
+        d.addErrback(self._lookup_failed, name)
 
-        self.pool.callInThread(func)
         return d
 
-    def close(self):
-        self.pool.stop()
+    def _query(self, name, original, ttls):
+        d = self.resolver.lookupAddress(name)
+        d.addCallback(self._got_answers, name, original, ttls)
+
+        return d
+
+    def _got_answers(self, result, name, original, ttls):
+        answers = result[0]
+        cname = None
+
+        for record in answers:
+            if record.type == dns.A:
+                ttls.append(record.ttl)
+
+                address = record.payload.dottedQuad()
+                self._store(original, address, min(ttls))
+
+                return address
+
+            if record.type == dns.CNAME and cname is None:
+                ttls.append(record.ttl)
+                cname = record.payload.name.name
+
+        if cname is not None and len(ttls) <= MAX_CNAMES:
+            return self._query(cname, original, ttls)
+
+        # The name exists, but it has no IPv4 address
+        raise DNSNameError(name)
+
+    def _lookup_failed(self, failure, name):
+        if failure.check(DNSNameError):
+            # Remember that it doesn't exist, but not other errors (like
+            # timeouts), which are probably temporary
+            self._store(name, None, self.negative_ttl)
+
+        raise DNSLookupError(name)
+
+    def _store(self, name, address, ttl):
+        if address is not None:
+            ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+
+        self._cache[name] = (address, self.clock.seconds() + ttl)
@@ -0,0 +1,235 @@
+# coding=utf-8
+
+"""
+Matching URLs and domains against the regexes in the plugin's config.
+
+The blacklist, per-domain proxies and session rules are all lists of
+regexes, and we used to try each of them in turn on every URL. A `RuleSet`
+compiles a list of them once, when the config is loaded:
+
+* Domain rules that just name a domain - like `example\\.com$`,
+  `.*\\.example\\.com$` or `(.*\\.)?example\\.com$` - go into a trie of
+  domain labels, so looking them up takes one step per label
+* Everything else is joined into as few combined regexes as possible, so
+  a string that matches none of them (the usual case) is only matched
+  against those, rather than against every rule
+
+Rules keep their order - the first rule that matches wins, as before.
+"""
+
+import re
+
+__author__ = 'Gareth Coles'
+
+#: Python 2's re module can't handle more groups than this in one pattern
+MAX_GROUPS = 99
+
+# A domain, optionally with any subdomains, anchored at the end
+_SIMPLE_DOMAIN = re.compile(
+    r"^\^?(?P<prefix>\.\*\\\.|\(\?:\.\*\\\.\)\?|\(\.\*\\\.\)\?)?"
+    r"(?P<domain>(?:[A-Za-z0-9_-]+\\\.)*[A-Za-z0-9_-]+)\$$"
+)
+
+# Patterns that can't be combined with others - back-references, as their
+# group numbers would change, named groups, as two patterns may use the same
+# name, and inline flags, which would apply to every pattern
+_UNCOMBINABLE = re.compile(r"\\[1-9]|\(\?P[=<]|\(\?[aiLmsux]+\)")
+
+
+class DomainTrie(object):
+    """
+    Domains, and whether their subdomains are included, stored label by
+    label from the right.
+    """
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, domain, index, exact=True, subdomains=False):
+        """
+        :param domain: The domain, in lowercase
+        :param index: Identifies the rule - lower indexes win
+        :param exact: Whether the domain itself matches
+        :param subdomains: Whether its subdomains match
+        """
+
+        node = self.root
+
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+
+        # Keys that can't be labels mark the rules here
+        if exact:
+            node["."] = min(node.get(".", index), index)
+        if subdomains:
+            node["*"] = min(node.get("*", index), index)
+
+        self.size += 1
+
+    def find(self, domain):
+        """
+        :return: The lowest index of the rules that match, or None
+        """
+
+        labels = domain.lower().split(".")
+        node = self.root
+        found = None
+
+        for position in xrange(len(labels) - 1, -1, -1):
+            node = node.get(labels[position])
+
+            if node is None:
+                break
+
+            if position > 0:
+                index = node.get("*")
+            else:
+                index = node.get(".")
+
+            if index is not None and (found is None or index < found):
+                found = index
+
+        return found
+
+
+class RuleSet(object):
+    """
+    An ordered list of regex rules, compiled for matching all at once.
+
+    :param rules: An iterable of (pattern, value) pairs, in order
+    :param flags: The regex flags to match with
+    :param domains: Whether the rules will be matched against domains, so
+        simple domain rules can go in the trie - only used with
+        re.IGNORECASE, as the trie ignores case
+    """
+
+    def __init__(self, rules, flags=0, domains=False):
+        self.flags = flags
+
+        self.rules = []  # [(pattern, value)]
+        self.errors = []  # [(pattern, error message)]
+
+        self.trie = DomainTrie()
+
+        self._regexes = []  # [(index, compiled)], in order
+        self._combined = []  # Compiled alternations of the regexes
+
+        use_trie = domains and flags & re.IGNORECASE
+
+        for pattern, value in rules:
+            try:
+                compiled = re.compile(pattern, flags)
+            except re.error as e:
+                self.errors.append((pattern, str(e)))
+                continue
+
+            index = len(self.rules)
+            self.rules.append((pattern, value))
+
+            if use_trie and self._add_domain(pattern, index):
+                continue
+
+            self._regexes.append((index, compiled))
+
+        self._combine()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, string):
+        """
+        Find the first rule that matches a string, using re.match().
+
+        :return: The (pattern, value) pair, or None if nothing matched
+        """
+
+        if not self.rules:
+            return None
+
+        best = None
+
+        if self.trie.size:
+            best = self.trie.find(string)
+
+        if self._regexes and self._any_regex_matches(string):
+            for index, compiled in self._regexes:
+                if best is not None and index > best:
+                    break
+
+                if compiled.match(string):
+                    best = index
+                    break
+
+        if best is None:
+            return None
+
+        return self.rules[best]
+
+    def _add_domain(self, pattern, index):
+        match = _SIMPLE_DOMAIN.match(pattern)
+
+        if match is None:
+            return False
+
+        domain = match.group("domain").replace("\\.", ".").lower()
+        prefix = match.group("prefix")
+
+        if prefix is None:
+            self.trie.add(domain, index)
+        elif prefix == ".*\\.":
+            self.trie.add(domain, index, exact=False, subdomains=True)
+        else:
+            self.trie.add(domain, index, subdomains=True)
+
+        return True
+
+    def _combine(self):
+        """
+        Join the regexes into as few patterns as we can.
+        """
+
+        batch = []
+        groups = 0
+
+        for index, compiled in self._regexes:
+            if _UNCOMBINABLE.search(compiled.pattern):
+                # This one can't be combined, so it's a batch on its own
+                self._combined.append(compiled)
+                continue
+
+            if batch and groups + compiled.groups > MAX_GROUPS:
+                self._combined.extend(self._join(batch))
+                batch = []
+                groups = 0
+
+            batch.append(compiled)
+            groups += compiled.groups
+
+        if batch:
+            self._combined.extend(self._join(batch))
+
+    def _join(self, regexes):
+        """
+        :return: A list holding the combined regex - or, if they can't be
+            combined after all, the regexes as they were
+        """
+
+        try:
+            return [re.compile(
+                "|".join("(?:{0})".format(compiled.pattern)
+                         for compiled in regexes),
+                self.flags
+            )]
+        except (re.error, AssertionError):
+            return regexes
+
+    def _any_regex_matches(self, string):
+        for combined in self._combined:
+            if combined.match(string):
+                return True
+
+        return False
@@ -0,0 +1,377 @@
+# coding=utf-8
+
+"""
+Limiting how many URLs the plugin fetches at once.
+
+Every fetch goes through the plugin's `FetchScheduler`, which only lets a
+few run at once - overall, and to any one domain - and waits a little
+between starting fetches from the same domain, so we're polite to the sites
+we visit. Anything else waits in a queue.
+
+Each channel has its own queue, and the queues take turns, so one busy
+channel (or one person pasting a wall of links) can't hold up everyone
+else's titles. The queues are bounded as a whole; once they're full, jobs
+are dropped - either the oldest job from the longest queue, or the new job.
+
+A fetch that takes too long altogether is given up on, and its Deferred is
+cancelled, so one that's stuck can't hold on to its place forever. Fetches
+should make sure that cancelling them closes their connections - see
+`http.call_cancellable()` - or they'd carry on in the background, outside
+of the limits.
+"""
+
+from collections import deque, OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+from utils.lru import LRUCache
+
+__author__ = 'Gareth Coles'
+
+#: When the queue is full, drop the oldest job in the longest queue
+DROP_OLDEST = "oldest"
+
+#: When the queue is full, drop the job that was just submitted
+DROP_NEWEST = "newest"
+
+
+class QueueFull(Exception):
+    """
+    A fetch was dropped because too many were queued.
+    """
+
+
+class FetchTimeout(Exception):
+    """
+    A fetch was given up on because it took too long.
+    """
+
+
+class Job(object):
+    """
+    A fetch that's waiting to run, or running.
+    """
+
+    __slots__ = ("domain", "channel", "func", "args", "kwargs", "deferred",
+                 "queued_at", "timeout_call")
+
+    def __init__(self, domain, channel, func, args, kwargs, queued_at):
+        self.domain = domain
+        self.channel = channel
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.queued_at = queued_at
+
+        self.deferred = Deferred()
+        self.timeout_call = None
+
+
+class FetchStats(object):
+    """
+    How the fetch queue has been doing.
+
+    started: Fetches started
+    dropped: Fetches dropped because the queue was full
+    max_depth: The most fetches that have been queued at once
+    avg_wait: The average of the recent times fetches waited, in seconds
+    max_wait: The longest a fetch has waited, in seconds
+    """
+
+    __slots__ = ("started", "dropped", "max_depth", "max_wait", "waits")
+
+    #: How many recent waits to average
+    HISTORY = 100
+
+    def __init__(self):
+        self.started = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.max_wait = 0.0
+        self.waits = deque(maxlen=self.HISTORY)
+
+    @property
+    def avg_wait(self):
+        if not self.waits:
+            return 0.0
+        return sum(self.waits) / len(self.waits)
+
+    def add_wait(self, waited):
+        self.started += 1
+        self.max_wait = max(self.max_wait, waited)
+        self.waits.append(waited)
+
+
+class FetchScheduler(object):
+    """
+    Runs fetches with limits on how many run at once, overall and per
+    domain, taking jobs from each channel's queue in turn.
+
+    :param max_fetches: The most fetches to run at once
+    :param max_per_domain: The most fetches to run at once for any one
+        domain
+    :param domain_delay: How long to wait between starting fetches for the
+        same domain, in seconds
+    :param max_queued: The most fetches to keep waiting
+    :param overflow: What to drop when the queue is full - DROP_OLDEST or
+        DROP_NEWEST
+    :param timeout: The longest a fetch may run, in seconds, or None to let
+        it run for as long as it takes
+    """
+
+    def __init__(self, max_fetches=8, max_per_domain=2, domain_delay=0.5,
+                 max_queued=100, overflow=DROP_OLDEST, timeout=60,
+                 clock=None):
+        self.max_fetches = max_fetches
+        self.max_per_domain = max_per_domain
+        self.domain_delay = domain_delay
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self.timeout = timeout
+        self.clock = clock or reactor
+
+        self.queues = OrderedDict()  # channel -> deque of Jobs, in turn order
+        self.queued = 0
+        self.running = 0
+        self.domains = {}  # domain -> fetches running
+
+        self.stats = FetchStats()
+
+        self._last_started = LRUCache(1024)  # domain -> when we last started
+        self._process_call = None
+
+    def configure(self, max_fetches=8, max_per_domain=2, domain_delay=0.5,
+                  max_queued=100, overflow=DROP_OLDEST, timeout=60):
+        self.max_fetches = max_fetches
+        self.max_per_domain = max_per_domain
+        self.domain_delay = domain_delay
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self.timeout = timeout
+
+        self._schedule_processing(0)
+
+    def submit(self, domain, channel, func, *args, **kwargs):
+        """
+        Run a fetch when the limits allow.
+
+        :param domain: The domain being fetched from
+        :param channel: Something identifying where the fetch was asked for
+        :param func: A callable that does the fetch, and may return a
+            Deferred - which should stop the fetch if it's cancelled
+        :return: A Deferred that fires with the fetch's result, or fails with
+            QueueFull if the fetch was dropped, or FetchTimeout if it took
+            too long
+        """
+
+        job = Job(
+            domain.lower(), channel, func, args, kwargs, self.clock.seconds()
+        )
+
+        queue = self.queues.get(channel)
+
+        if queue is None:
+            # A channel with nothing waiting goes to the front of the line,
+            # as it hasn't had a turn lately
+            queue = deque()
+            self.queues = OrderedDict(
+                [(channel, queue)] + self.queues.items()
+            )
+
+        queue.append(job)
+        self.queued += 1
+
+        self._process_queue()
+
+        while self.queued > self.max_queued:
+            self._drop(job)
+
+        self.stats.max_depth = max(self.stats.max_depth, self.queued)
+
+        return job.deferred
+
+    def clear(self):
+        """
+        Drop everything that's waiting.
+        """
+
+        if self._process_call is not None and self._process_call.active():
+            self._process_call.cancel()
+
+        self._process_call = None
+
+        queues, self.queues = self.queues, OrderedDict()
+        self.queued = 0
+
+        for queue in queues.itervalues():
+            for job in queue:
+                job.deferred.errback(QueueFull("The queue was cleared"))
+
+    def describe(self):
+        return "{0} running, {1} queued, {2} dropped, waited {3:.1f}s on " \
+               "average ({4:.1f}s at most)".format(
+                   self.running, self.queued, self.stats.dropped,
+                   self.stats.avg_wait, self.stats.max_wait
+               )
+
+    # Internals
+
+    def _drop(self, new_job):
+        queue = None
+
+        if self.overflow == DROP_NEWEST:
+            queue = self.queues.get(new_job.channel)
+
+        if queue:
+            job = queue.pop()
+        else:
+            # Whoever's queued the most pays for it
+            queue = max(self.queues.itervalues(), key=len)
+            job = queue.popleft()
+
+        if not queue:
+            del self.queues[job.channel]
+
+        self.queued -= 1
+        self.stats.dropped += 1
+
+        job.deferred.errback(QueueFull(
+            "Too many fetches queued ({0})".format(self.max_queued)
+        ))
+
+    def _process_queue(self):
+        """
+        Start as many queued fetches as the limits allow, taking one from
+        each channel in turn.
+        """
+
+        if self._process_call is not None and self._process_call.active():
+            self._process_call.cancel()
+
+        self._process_call = None
+
+        now = self.clock.seconds()
+        retry_at = None
+        started = True
+
+        while started and self.queues and self.running < self.max_fetches:
+            started = False
+
+            for channel in list(self.queues):
+                if self.running >= self.max_fetches:
+                    break
+
+                queue = self.queues.get(channel)
+
+                if not queue:
+                    continue  # Emptied by a fetch that finished straight away
+
+                job, ready_at = self._take(queue, now)
+
+                if ready_at is not None and \
+                        (retry_at is None or ready_at < retry_at):
+                    retry_at = ready_at
+
+                if job is None:
+                    continue
+
+                # This channel goes to the back of the line
+                del self.queues[channel]
+
+                if queue:
+                    self.queues[channel] = queue
+
+                self._start(job, now)
+                started = True
+
+        if retry_at is not None and self.queues:
+            self._schedule_processing(retry_at - now)
+
+    def _take(self, queue, now):
+        """
+        Take the first job from a queue whose domain can be fetched from.
+
+        :return: (job or None, the soonest a waiting domain will be ready,
+            or None)
+        """
+
+        ready_at = None
+
+        for index, job in enumerate(queue):
+            if self.domains.get(job.domain, 0) >= self.max_per_domain:
+                continue
+
+            last = self._last_started.get(job.domain)
+
+            if last is not None and last + self.domain_delay > now:
+                if ready_at is None or last + self.domain_delay < ready_at:
+                    ready_at = last + self.domain_delay
+
+                continue
+
+            del queue[index]
+            return job, ready_at
+
+        return None, ready_at
+
+    def _start(self, job, now):
+        self.queued -= 1
+        self.running += 1
+        self.domains[job.domain] = self.domains.get(job.domain, 0) + 1
+        self._last_started[job.domain] = now
+
+        self.stats.add_wait(now - job.queued_at)
+
+        deferred = maybeDeferred(job.func, *job.args, **job.kwargs)
+        deferred.addBoth(self._finished, job)
+
+        if not deferred.called and self.timeout is not None:
+            job.timeout_call = self.clock.callLater(
+                self.timeout, self._timed_out, job, deferred
+            )
+
+    def _timed_out(self, job, deferred):
+        job.timeout_call = None
+
+        job.deferred.errback(FetchTimeout(
+            "Gave up on the fetch after {0} seconds".format(self.timeout)
+        ))
+
+        # This frees up its slot, once it's stopped
+        deferred.cancel()
+
+    def _finished(self, result, job):
+        if job.timeout_call is not None:
+            job.timeout_call.cancel()
+            job.timeout_call = None
+
+        self.running -= 1
+
+        count = self.domains.get(job.domain, 0) - 1
+
+        if count > 0:
+            self.domains[job.domain] = count
+        else:
+            self.domains.pop(job.domain, None)
+
+        # Not from inside the fetch's callbacks - it may have finished
+        # without waiting, while we were starting it
+        self._schedule_processing(0)
+
+        if job.deferred.called:
+            return  # It timed out, and we've already moved on
+        elif isinstance(result, Failure):
+            job.deferred.errback(result)
+        else:
+            job.deferred.callback(result)
+
+    def _schedule_processing(self, delay):
+        if self._process_call is not None:
+            if self._process_call.getTime() <= self.clock.seconds() + delay:
+                return
+
+            self._process_call.cancel()
+
+        self._process_call = self.clock.callLater(delay, self._process_queue)
@@ -2,7 +2,9 @@
 
 __author__ = 'Gareth Coles'
 
-from txrequests import Session
+import urllib
+
+from kitchen.text.converters import to_bytes
 
 from plugins.urls.shorteners.base import Shortener
 
@@ -12,11 +14,10 @@ class TinyURLShortener(Shortener):
     name = "tinyurl"
 
     def do_shorten(self, context):
-        session = Session()
-
-        params = {"url": unicode(context["url"])}
+        params = urllib.urlencode({"url": to_bytes(unicode(context["url"]))})
 
-        d = session.get(self.base_url, params=params)
+        d = self.urls_plugin.http.get(self.base_url + "?" + params)
+        d.addCallback(self.read_response)
 
         d.addCallbacks(
             self.shorten_success, self.shorten_error
@@ -24,9 +25,19 @@ class TinyURLShortener(Shortener):
 
         return d
 
+    def read_response(self, response):
+        """
+        :type response: plugins.urls.http.Response
+        """
+
+        d = response.read()
+        d.addCallback(lambda _: response)
+
+        return d
+
     def shorten_success(self, response):
         """
-        :type response: requests.Response
+        :type response: plugins.urls.http.Response
         """
 
         return response.text
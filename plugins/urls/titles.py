@@ -0,0 +1,234 @@
+# coding=utf-8
+
+"""
+Finding a page's title while it's still arriving.
+
+Almost every page has its title near the top, so rather than read as much
+as we're allowed to and then parse all of it with BeautifulSoup, we feed
+each chunk of the body to a `TitleExtractor` as it arrives. It looks for
+the <title> tag (and, if asked to, OpenGraph and Twitter title meta tags)
+and for meta tags declaring the page's charset, and says when it has what
+it needs - at which point we stop reading.
+
+If the page is something it can't follow - a title that's started but
+never finished, or a UTF-16 page - we fall back to BeautifulSoup.
+"""
+
+import re
+
+from bs4 import UnicodeDammit
+
+from utils.html import html_to_text
+
+__author__ = 'Gareth Coles'
+
+_TITLE_START = re.compile(br"<title\b[^>]*>", re.I)
+_TITLE_END = re.compile(br"</title\s*>", re.I)
+_HEAD_END = re.compile(br"</head\s*>|<body\b", re.I)
+_META = re.compile(br"<meta\b([^>]*)>", re.I)
+_ATTRIBUTE = re.compile(
+    br"""([\w:.-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))"""
+)
+_CHARSET = re.compile(br"""charset\s*=\s*["']?([\w.:-]+)""", re.I)
+_WHITESPACE = re.compile(r"\s+", re.U)
+
+#: Meta tags that give a page's title, if we're looking for them
+META_TITLES = frozenset((b"og:title", b"twitter:title"))
+
+_UTF16_BOMS = (b"\xff\xfe", b"\xfe\xff")
+
+
+def _resume_from(buffer, position):
+    """
+    Where to search from after the next chunk arrives - anything before the
+    last "<" has been searched already, but a tag may start there and end
+    in the next chunk.
+    """
+
+    last = buffer.rfind(b"<", position)
+
+    if last == -1:
+        return len(buffer)
+
+    return last
+
+
+def _get_attributes(tag):
+    attributes = {}
+
+    for match in _ATTRIBUTE.finditer(tag):
+        name = match.group(1).lower()
+        value = match.group(2)
+
+        if value is None:
+            value = match.group(3)
+
+            if value is None:
+                value = match.group(4)
+
+        attributes.setdefault(name, value)
+
+    return attributes
+
+
+class TitleExtractor(object):
+    """
+    Finds a page's title as its body arrives.
+
+    :param charset: The charset from the Content-Type header, if there was
+        one - this wins over any meta tags
+    :param meta_titles: Whether to prefer an OpenGraph or Twitter title
+        meta tag over the <title> tag
+    """
+
+    def __init__(self, charset=None, meta_titles=False):
+        self.charset = charset
+        self.meta_titles = meta_titles
+
+        self.done = False
+        self.size = 0
+
+        #: Whether the page needs a real parser to get its title
+        self.needs_parsing = False
+
+        self.title = None  # Raw bytes
+        self.meta_title = None  # Raw bytes
+        self.sniffed_charset = None
+
+        self._buffer = b""
+        self._meta_position = 0
+        self._title_position = 0
+        self._title_start = None
+        self._head_position = 0
+        self._head_ended = False
+
+    def feed(self, data):
+        """
+        Give the extractor the next chunk of the body.
+
+        :param data: Bytes
+        :return: Whether we have the title, and can stop reading
+        """
+
+        if self.done:
+            return True
+
+        if not self._buffer and data.startswith(_UTF16_BOMS):
+            # None of our patterns will match - leave it to BeautifulSoup
+            self.needs_parsing = True
+            self.done = True
+
+            return True
+
+        self._buffer += data
+        self.size += len(data)
+
+        self._scan_metas()
+        self._scan_title()
+
+        if not self._head_ended:
+            if _HEAD_END.search(self._buffer, self._head_position):
+                self._head_ended = True
+            else:
+                self._head_position = _resume_from(
+                    self._buffer, self._head_position
+                )
+
+        if self.meta_titles:
+            # The meta tags could come after the <title>, so we wait for
+            # them until the end of the <head>
+            self.done = self.meta_title is not None or (
+                self.title is not None and self._head_ended
+            )
+        else:
+            self.done = self.title is not None
+
+        return self.done
+
+    def finish(self):
+        """
+        We've read all we're going to - check whether we need to fall back
+        to parsing the page properly.
+        """
+
+        if self._title_start is not None and self.title is None:
+            # An unfinished or broken <title> - BeautifulSoup may do better
+            self.needs_parsing = True
+
+    def get_charset(self):
+        return self.charset or self.sniffed_charset
+
+    def get_title(self):
+        """
+        :return: The title, as unicode, or None if we didn't find one
+        """
+
+        raw = self.title
+
+        if self.meta_titles and self.meta_title is not None:
+            raw = self.meta_title
+
+        if raw is None:
+            return None
+
+        charset = self.get_charset()
+
+        title = UnicodeDammit(raw, [charset] if charset else []).unicode_markup
+        title = _WHITESPACE.sub(u" ", html_to_text(title or u"")).strip()
+
+        return title or None
+
+    def _scan_metas(self):
+        for match in _META.finditer(self._buffer, self._meta_position):
+            self._meta_position = match.end()
+
+            if self.sniffed_charset is not None and (
+                    not self.meta_titles or self.meta_title is not None):
+                continue
+
+            attributes = _get_attributes(match.group(1))
+
+            if self.sniffed_charset is None:
+                if "charset" in attributes:
+                    self.sniffed_charset = attributes["charset"].lower()
+                elif attributes.get("http-equiv", "").lower() == \
+                        "content-type":
+                    charset = _CHARSET.search(attributes.get("content", ""))
+
+                    if charset:
+                        self.sniffed_charset = charset.group(1).lower()
+
+            if self.meta_titles and self.meta_title is None:
+                name = attributes.get(
+                    "property", attributes.get("name", "")
+                ).lower()
+
+                if name in META_TITLES and attributes.get("content"):
+                    self.meta_title = attributes["content"]
+
+        self._meta_position = _resume_from(self._buffer, self._meta_position)
+
+    def _scan_title(self):
+        if self.title is not None:
+            return
+
+        if self._title_start is None:
+            match = _TITLE_START.search(self._buffer, self._title_position)
+
+            if match is None:
+                self._title_position = _resume_from(
+                    self._buffer, self._title_position
+                )
+                return
+
+            self._title_start = self._title_position = match.end()
+
+        match = _TITLE_END.search(self._buffer, self._title_position)
+
+        if match is None:
+            self._title_position = _resume_from(
+                self._buffer, self._title_position
+            )
+            return
+
+        self.title = self._buffer[self._title_start:match.start()]
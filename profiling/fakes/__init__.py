@@ -3,10 +3,13 @@
 __author__ = 'Gareth Coles'
 
 from system.events.base import BaseEvent, PluginEvent
+from system.logging.logger import getLogger
 from system.plugins.plugin import PluginObject
 from system.protocols.generic.user import User
 from system.protocols.generic.protocol import Protocol
+from system.protocols.irc.rank import Ranks
 
+from utils.irc import IRCUtils
 from utils.misc import AttrDict
 
 
@@ -42,3 +45,29 @@ class FakeUser(User):
 
     def respond(self, message):
         print "Fake message to %s: %s" % (self.name, message)
+
+
+class FakeIRCProtocol(object):
+    """
+    Just enough of the IRC protocol for the IRC user and channel objects to
+    work, without connecting to anything.
+    """
+
+    name = "Fake IRC"
+    control_chars = "."
+
+    def __init__(self):
+        self.log = getLogger(self.name)
+        self.utils = IRCUtils(self.log)
+        self.ranks = Ranks()
+        self.ranks.add_rank("o", "@", 0)
+        self.ranks.add_rank("h", "%", 1)
+        self.ranks.add_rank("v", "+", 2)
+
+        self._channels = {}
+
+    def get_channel(self, channel):
+        return self._channels.get(self.utils.lowercase_nick_chan(channel))
+
+    def set_channel(self, channel, channel_obj):
+        self._channels[self.utils.lowercase_nick_chan(channel)] = channel_obj
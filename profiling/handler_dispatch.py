@@ -0,0 +1,136 @@
+# coding=utf-8
+
+__author__ = 'Gareth Coles'
+
+"""
+Benchmark for picking out the URL handlers to try for each URL.
+
+This compares, with a few hundred site-specific handlers registered:
+
+* The old way - sort the priorities for every URL, and call every handler's
+  match() in turn
+* The new way - ask a HandlerIndex for the handlers that could want the URL,
+  and only call their match()
+
+Both have to find the same first handler that matches.
+
+Run it from the root of the repo: python profiling/handler_dispatch.py
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.getcwd())  # Because herp derp
+
+from plugins.urls.dispatch import HandlerIndex
+from plugins.urls.handlers.handler import URLHandler
+from plugins.urls.priority import Priority
+from plugins.urls.url import URL
+
+ROUNDS = 200
+SITES = 300
+
+HTTP = re.compile(u"http|https", re.I | re.U)
+PATHS = re.compile(u"/(watch|video|post)/.*", re.I | re.U)
+
+
+class SiteHandler(URLHandler):
+    def call(self, url, context):
+        pass
+
+
+def make_handlers():
+    handlers = {}
+
+    for index in xrange(SITES):
+        handler = SiteHandler(None)
+        handler.name = "site-{0}".format(index)
+
+        if index % 2:
+            # Declared, like a handler written for the index
+            handler.domains = ["site{0}.example.com".format(index)]
+            handler.protocols = ["http", "https"]
+            handler.criteria = {
+                "domain": re.compile(
+                    u"(.*\\.)?site{0}\\.example\\.com$".format(index), re.I
+                ),
+                "path": PATHS
+            }
+        else:
+            # Plain criteria, like an older handler
+            handler.criteria = {
+                "protocol": "https",
+                "domain": "site{0}.example.com".format(index),
+                "path": PATHS
+            }
+
+        handlers.setdefault(
+            (Priority.EARLY, Priority.LATE)[index % 2], []
+        ).append(handler)
+
+    website = SiteHandler(None)
+    website.name = "website"
+    website.criteria = {"protocol": HTTP}
+    handlers[Priority.MONITOR] = [website]
+
+    return handlers
+
+
+URLS = [
+    URL(None, "https", None, "www.example.com", None, "/some/page"),
+    URL(None, "https", None, "news.example.co.uk", None, "/article/12345"),
+    URL(None, "https", None, "site150.example.com", None, "/watch/abc"),
+    URL(None, "https", None, "site151.example.com", None, "/video/abc"),
+    URL(None, "http", None, "site151.example.com", None, "/about"),
+]
+
+
+def old(handlers, url):
+    for priority in reversed(sorted(handlers.iterkeys())):
+        for handler in handlers[priority]:
+            if handler.match(url, {}):
+                return handler
+
+
+def new(index, url):
+    for handler in index.candidates(url):
+        if handler.match(url, {}):
+            return handler
+
+
+def bench(name, func, handlers):
+    start = time.time()
+
+    for _ in xrange(ROUNDS):
+        for url in URLS:
+            func(handlers, url)
+
+    taken = time.time() - start
+    count = ROUNDS * len(URLS)
+
+    print("{:<24} {:>8.3f}s {:>12,.0f} URLs/sec".format(
+        name, taken, count / taken
+    ))
+
+    return taken
+
+
+def run():
+    handlers = make_handlers()
+    index = HandlerIndex(handlers)
+
+    for url in URLS:
+        assert old(handlers, url) is new(index, url), url
+
+    print("{0} handlers".format(len(index)))
+
+    old_taken = bench("Match every handler:", old, handlers)
+    new_taken = bench("HandlerIndex:", new, index)
+
+    print("Speedup: {:.2f}x".format(old_taken / new_taken))
+
+
+if __name__ == "__main__":
+    run()
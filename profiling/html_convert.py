@@ -0,0 +1,111 @@
+# coding=utf-8
+
+__author__ = 'Gareth Coles'
+
+"""
+Benchmark for converting between HTML and text, as the Mumble protocol does
+for every text message.
+
+This compares, over a mix of the sort of messages Mumble clients send:
+
+* The old HTMLParser-based converter
+* The new converter, without its cache
+* The new converter, with its cache
+* cgi.escape() and text_to_html() for outgoing messages
+
+Note that the new converter drops the contents of <style> tags, which the
+old one left in - so older Qt clients' messages come out differently.
+
+Run it from the root of the repo: python profiling/html_convert.py
+"""
+
+import cgi
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())  # Because herp derp
+
+from utils import html
+
+ROUNDS = 20000
+
+MESSAGES = [
+    "hello",
+    "anyone up for a game later?",
+    "!help",
+    "<p>brb</p>",
+    "fish &amp; chips &lt;3",
+    '<a href="https://www.example.com/watch?v=abc&amp;t=10">'
+    'https://www.example.com/watch?v=abc&amp;t=10</a>',
+    "<b>bold</b> and <i>italic</i><br />and a new line",
+    '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.0//EN" '
+    '"http://www.w3.org/TR/REC-html40/strict.dtd">'
+    '<html><head><meta name="qrichtext" content="1" />'
+    '<style type="text/css">p, li { white-space: pre-wrap; }</style></head>'
+    '<body style=" font-family:\'Sans\'; font-size:9pt;">'
+    '<p style=" margin-top:0px; margin-bottom:0px;">'
+    'A message from an older Qt client</p></body></html>',
+]
+
+TEXT = [
+    "hello",
+    "Usage: !roll <dice> [sides]",
+    "Title: Fish & Chips <3 | example.com",
+]
+
+
+def old_html_to_text(data, newlines=False):
+    s = html.HTMLTextExtractor(newlines)
+    s.feed(data)
+    return s.get_text()
+
+
+def new_html_to_text_uncached(data, newlines=False):
+    if "<" not in data and "&" not in data:
+        return data
+
+    return html._convert(data, newlines)
+
+
+def bench(name, func, messages):
+    start = time.time()
+
+    for _ in xrange(ROUNDS):
+        for message in messages:
+            func(message, True)
+
+    taken = time.time() - start
+    count = ROUNDS * len(messages)
+
+    print("{:<24} {:>8.3f}s {:>12,.0f} messages/sec".format(
+        name, taken, count / taken
+    ))
+
+    return taken
+
+
+def escape(message, _):
+    return cgi.escape(message)
+
+
+def run():
+    print("HTML to text")
+    old = bench("Old (HTMLParser):", old_html_to_text, MESSAGES)
+    new = bench("New (uncached):", new_html_to_text_uncached, MESSAGES)
+    cached = bench("New (cached):", html.html_to_text, MESSAGES)
+
+    print("Speedup: {:.2f}x uncached, {:.2f}x cached".format(
+        old / new, old / cached
+    ))
+
+    print("")
+    print("Text to HTML")
+    old = bench("cgi.escape():", escape, TEXT)
+    new = bench("text_to_html():", html.text_to_html, TEXT)
+
+    print("Speedup: {:.2f}x".format(old / new))
+
+
+if __name__ == "__main__":
+    run()
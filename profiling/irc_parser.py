@@ -0,0 +1,131 @@
+# coding=utf-8
+
+__author__ = 'Gareth Coles'
+
+"""
+Benchmark for the IRC protocol's line parser and dispatcher.
+
+This replays recorded server traffic through both the old path (Twisted's
+parsemsg() and handleCommand(), then splitting the prefix in the handler)
+and the new one (parse_line() and the protocol's dispatch table, with the
+prefix already split), and reports lines per second for each.
+
+The handlers themselves do nothing but get at the nick, ident and host, so
+that only the parsing and dispatch are measured.
+
+Run it from the root of the repo: python profiling/irc_parser.py [log file]
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())  # Because herp derp
+
+from twisted.words.protocols import irc
+
+from system.protocols.irc.parser import parse_line
+from system.protocols.irc.protocol import Protocol
+from utils.irc import split_hostmask
+
+DEFAULT_TRAFFIC = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "irc-traffic.log"
+)
+ROUNDS = 50
+
+COMMANDS = [
+    "PRIVMSG", "NOTICE", "JOIN", "PART", "QUIT", "MODE", "NICK", "TOPIC",
+    "PING", "RPL_WELCOME", "RPL_ISUPPORT", "RPL_TOPIC", "RPL_NAMREPLY",
+    "RPL_ENDOFNAMES", "RPL_ENDOFWHO", "354"
+]
+
+
+def _split_prefix(prefix, params):
+    try:
+        return split_hostmask(prefix)
+    except ValueError:
+        return prefix, None, None
+
+
+def _use_message(message):
+    return message.nick, message.ident, message.host
+
+
+class OldPath(object):
+    """
+    Handlers as Twisted's handleCommand() would find them.
+    """
+
+    def __init__(self):
+        for command in COMMANDS:
+            setattr(self, "irc_%s" % command, _split_prefix)
+
+    def irc_unknown(self, prefix, command, params):
+        pass
+
+    def run(self, lines):
+        handle = irc.IRCClient.handleCommand.__func__
+
+        for line in lines:
+            prefix, command, params = irc.parsemsg(irc.lowDequote(line))
+            if command in irc.numeric_to_symbolic:
+                command = irc.numeric_to_symbolic[command]
+            handle(self, command, prefix, params)
+
+
+class NewPath(object):
+    """
+    Handlers in a dispatch table, as the IRC protocol builds them.
+    """
+
+    log = None
+
+    def __init__(self):
+        self._handlers = dict(
+            (command, (_use_message, True)) for command in COMMANDS
+        )
+
+    def irc_unknown(self, prefix, command, params):
+        pass
+
+    def run(self, lines):
+        dispatch = Protocol.dispatch_message.__func__
+
+        for line in lines:
+            dispatch(self, parse_line(irc.lowDequote(line)))
+
+
+def load_traffic(path):
+    with open(path, "rb") as fh:
+        return [x for x in fh.read().replace("\r", "").split("\n") if x]
+
+
+def bench(name, path_obj, lines):
+    start = time.time()
+
+    for x in xrange(ROUNDS):
+        path_obj.run(lines)
+
+    taken = time.time() - start
+    rate = len(lines) * ROUNDS / taken
+
+    print("{:<6} {:>12,.0f} lines/sec".format(name, rate))
+    return rate
+
+
+def run(path=DEFAULT_TRAFFIC):
+    lines = load_traffic(path)
+
+    print("Replaying {:,} lines, {} times".format(len(lines), ROUNDS))
+
+    old = bench("Old:", OldPath(), lines)
+    new = bench("New:", NewPath(), lines)
+
+    print("Speedup: {:.2f}x".format(new / old))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+    else:
+        run()
@@ -0,0 +1,102 @@
+# coding=utf-8
+
+__author__ = 'Gareth Coles'
+
+"""
+Memory benchmark for the IRC user and channel model.
+
+This simulates a large network - 100,000 users spread over 2,000 channels,
+with a realistic amount of ops and voices - and reports how much memory the
+user-tracking objects take up.
+
+Run it from the root of the repo: python profiling/memory.py
+"""
+
+import os
+import random
+import sys
+
+sys.path.append(os.getcwd())  # Because herp derp
+
+import psutil
+
+from profiling.fakes import FakeIRCProtocol
+
+from system.protocols.irc.channel import Channel
+from system.protocols.irc.user import User
+
+USERS = 100000
+CHANNELS = 2000
+MAX_CHANNELS_PER_USER = 5
+
+IDENTS = 500
+HOSTS = 20000
+
+
+def rss():
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+def build_network(protocol):
+    # Strings are built fresh for every user, as they would be when parsed
+    # from the socket, so that interning actually has something to do.
+    rand = random.Random(1337)
+
+    channels = []
+    users = []
+
+    for x in xrange(CHANNELS):
+        name = "#channel-%s" % x
+        channel = Channel(protocol, name)
+        protocol.set_channel(name, channel)
+        channels.append(channel)
+
+    op = protocol.ranks.by_mode("o")
+    voice = protocol.ranks.by_mode("v")
+
+    for x in xrange(USERS):
+        user = User(
+            protocol,
+            "user-%s" % x,
+            "~%s" % "ident-%s" % rand.randint(0, IDENTS),
+            "%s.example.com" % "host-%s" % rand.randint(0, HOSTS),
+            is_tracked=True
+        )
+
+        for channel in rand.sample(
+            channels, rand.randint(1, MAX_CHANNELS_PER_USER)
+        ):
+            user.add_channel(channel)
+            channel.add_user(user)
+
+            roll = rand.random()
+
+            if roll < 0.05:
+                user.add_rank_in_channel(channel, op)
+            elif roll < 0.15:
+                user.add_rank_in_channel(channel, voice)
+
+        users.append(user)
+
+    return users, channels
+
+
+def run():
+    protocol = FakeIRCProtocol()
+
+    before = rss()
+    users, channels = build_network(protocol)
+    after = rss()
+
+    memberships = sum(len(user.channels) for user in users)
+    used = after - before
+
+    print("Users:           {:,}".format(len(users)))
+    print("Channels:        {:,}".format(len(channels)))
+    print("Memberships:     {:,}".format(memberships))
+    print("RSS used:        {:,.1f} MiB".format(used / 1024.0 / 1024.0))
+    print("Bytes per user:  {:,.0f}".format(used / float(len(users))))
+
+
+if __name__ == "__main__":
+    run()
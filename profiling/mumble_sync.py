@@ -0,0 +1,231 @@
+# coding=utf-8
+
+__author__ = 'Gareth Coles'
+
+"""
+Benchmark for the Mumble protocol's control channel framing and dispatch.
+
+This builds the burst of messages a server sends when we connect - its
+version, crypto and codec setup, a tree of 500 channels, 10,000 users and
+finally the ServerSync - and replays it in chunks as big as Twisted reads
+from a socket.
+
+It's replayed three times:
+
+* Through the old framer (string concatenation and re-slicing, and an
+  isinstance() chain), with handlers that do nothing
+* Through the protocol's framer, with handlers that do nothing
+* Through the protocol, with its real handlers, building the user and
+  channel model
+
+Run it from the root of the repo: python profiling/mumble_sync.py
+"""
+
+import os
+import struct
+import sys
+import time
+
+sys.path.append(os.getcwd())  # Because herp derp
+
+from system.logging.logger import getLogger
+from system.protocols.mumble import Mumble_pb2
+from system.protocols.mumble.protocol import Protocol
+
+USERS = 10000
+CHANNELS = 500
+CHUNK_SIZE = 65536  # The most Twisted reads from a socket at once
+
+CONFIG = {
+    "identity": {
+        "username": "Ultros",
+        "password": "",
+        "tokens": []
+    },
+    "network": {},
+    "control_chars": ".",
+    "channel": {}
+}
+
+
+class FakeTransport(object):
+    def write(self, data):
+        pass
+
+    def writeSequence(self, data):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+def frame(message):
+    data = message.SerializeToString()
+
+    return struct.pack(
+        Protocol.PREFIX_FORMAT, Protocol.MESSAGE_ID[type(message)], len(data)
+    ) + data
+
+
+def build_sync():
+    frames = []
+
+    version = Mumble_pb2.Version()
+    version.version = Protocol.VERSION_DATA
+    version.release = "1.2.4"
+    frames.append(frame(version))
+
+    crypt = Mumble_pb2.CryptSetup()
+    crypt.key = "k" * 16
+    crypt.client_nonce = "c" * 16
+    crypt.server_nonce = "s" * 16
+    frames.append(frame(crypt))
+
+    codec = Mumble_pb2.CodecVersion()
+    codec.alpha = -2147483637
+    codec.beta = 0
+    codec.prefer_alpha = True
+    codec.opus = True
+    frames.append(frame(codec))
+
+    for x in xrange(CHANNELS):
+        channel = Mumble_pb2.ChannelState()
+        channel.channel_id = x
+        channel.name = "Channel %s" % x
+        channel.position = x
+
+        if x:
+            channel.parent = (x - 1) // 10
+
+        frames.append(frame(channel))
+
+    for x in xrange(USERS):
+        user = Mumble_pb2.UserState()
+        user.session = x + 1
+        user.name = "User %s" % x
+        user.channel_id = x % CHANNELS
+        user.user_id = x
+        user.hash = "%040x" % x
+        user.self_mute = bool(x % 3)
+        frames.append(frame(user))
+
+    sync = Mumble_pb2.ServerSync()
+    sync.session = USERS + 1
+    sync.max_bandwidth = 72000
+    sync.welcome_text = "Welcome!"
+    sync.permissions = 0
+    frames.append(frame(sync))
+
+    data = "".join(frames)
+    chunks = [
+        data[x:x + CHUNK_SIZE] for x in xrange(0, len(data), CHUNK_SIZE)
+    ]
+
+    return len(frames), len(data), chunks
+
+
+class OldFramer(object):
+    """
+    The framing and dispatch the protocol used before, for comparison.
+    """
+
+    def __init__(self):
+        self.received = ""
+        self.handled = 0
+
+    def dataReceived(self, recv):
+        self.received = self.received + recv
+
+        while len(self.received) >= Protocol.PREFIX_LENGTH:
+            msg_type, length = struct.unpack(
+                Protocol.PREFIX_FORMAT,
+                self.received[:Protocol.PREFIX_LENGTH]
+            )
+
+            full_length = Protocol.PREFIX_LENGTH + length
+
+            if msg_type not in Protocol.MESSAGE_ID.values():
+                raise ValueError("Message ID not available.")
+
+            if len(self.received) < full_length:
+                return
+
+            msg = Protocol.ID_MESSAGE[msg_type]()
+            msg.ParseFromString(
+                self.received[Protocol.PREFIX_LENGTH:
+                              Protocol.PREFIX_LENGTH + length]
+            )
+
+            self.recvProtobuf(msg_type, msg)
+            self.received = self.received[full_length:]
+
+    def recvProtobuf(self, msg_type, message):
+        # Same order as the old isinstance() chain
+        for cls in (Mumble_pb2.Version, Mumble_pb2.Reject,
+                    Mumble_pb2.CodecVersion, Mumble_pb2.CryptSetup,
+                    Mumble_pb2.ChannelState, Mumble_pb2.PermissionQuery,
+                    Mumble_pb2.UserState, Mumble_pb2.ServerSync,
+                    Mumble_pb2.ServerConfig, Mumble_pb2.Ping,
+                    Mumble_pb2.UserRemove, Mumble_pb2.TextMessage,
+                    Mumble_pb2.UserStats):
+            if isinstance(message, cls):
+                self.handled += 1
+                return
+
+
+def make_protocol(real_handlers):
+    protocol = Protocol("Mumble sync", None, CONFIG)
+    protocol.log = getLogger("Mumble sync", add_handlers=False)
+    protocol.transport = FakeTransport()
+
+    if not real_handlers:
+        protocol.handled = 0
+
+        def handler(message):
+            protocol.handled += 1
+
+        protocol._handlers = [
+            (cls, handler if cls is not None else None)
+            for cls, __ in protocol._handlers
+        ]
+
+    return protocol
+
+
+def replay(name, receiver, chunks, frames):
+    start = time.time()
+
+    for chunk in chunks:
+        receiver.dataReceived(chunk)
+
+    taken = time.time() - start
+
+    print("{:<22} {:>8.3f}s {:>12,.0f} messages/sec".format(
+        name, taken, frames / taken
+    ))
+
+    return taken
+
+
+def run():
+    frames, size, chunks = build_sync()
+
+    print("Replaying {:,} messages ({:,} bytes) in {:,} chunks".format(
+        frames, size, len(chunks)
+    ))
+
+    old = replay("Old framing:", OldFramer(), chunks, frames)
+    new = replay("New framing:", make_protocol(False), chunks, frames)
+
+    print("Framing speedup: {:.2f}x".format(old / new))
+
+    protocol = make_protocol(True)
+    replay("Full sync (handlers):", protocol, chunks, frames)
+
+    print("Users: {:,}, channels: {:,}".format(
+        len(protocol.users), len(protocol.channels)
+    ))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,134 @@
+# coding=utf-8
+
+__author__ = 'Gareth Coles'
+
+"""
+Benchmark for Opus encoding and the Mumble audio playback pipeline.
+
+This needs libopus, but no server - it encodes a minute of generated audio
+(a 440Hz tone, 48kHz mono) in 20ms frames:
+
+* Allocating a new output buffer and casting the input for every frame, as
+  the encoder used to
+* With the encoder's reusable buffers
+* Through the whole playback pipeline - framing, encoding and building
+  packets - with a fake clock, so it runs as fast as it can
+
+Run it from the root of the repo: python profiling/opus_encode.py
+"""
+
+import ctypes
+import math
+import os
+import struct
+import sys
+import time
+
+sys.path.append(os.getcwd())  # Because herp derp
+
+from twisted.internet.task import Clock
+
+from system.protocols.mumble.audio import GeneratorSource, Player
+from utils.opus.encoder import Encoder
+from utils.opus.lib import AVAILABLE, opus
+
+SAMPLE_RATE = 48000
+FRAME_LENGTH = 20
+SECONDS = 60
+
+SAMPLES = SAMPLE_RATE * FRAME_LENGTH // 1000
+FRAMES = SECONDS * 1000 // FRAME_LENGTH
+
+
+class OldEncoder(Encoder):
+    """
+    The encoder's old encode(), for comparison.
+    """
+
+    def encode(self, pcm, frame_size):
+        max_data_bytes = len(pcm)
+        pcm = ctypes.cast(pcm, ctypes.c_void_p)
+        data = (ctypes.c_char * max_data_bytes)()
+
+        return opus.opus_encode(
+            self.encoder, pcm, frame_size, data, max_data_bytes
+        )
+
+
+class FakeProtocol(object):
+    name = "Opus benchmark"
+
+    def __init__(self):
+        self.packets = 0
+
+    def send_voice(self, packet):
+        self.packets += 1
+
+
+def build_frames():
+    frames = []
+
+    for x in xrange(FRAMES):
+        start = x * SAMPLES
+        frames.append(struct.pack("=%sh" % SAMPLES, *[
+            int(math.sin(2 * math.pi * 440 * (start + y) / SAMPLE_RATE) *
+                16000)
+            for y in xrange(SAMPLES)
+        ]))
+
+    return frames
+
+
+def encode(name, encoder, frames):
+    start = time.time()
+
+    for frame in frames:
+        encoder.encode(frame, SAMPLES)
+
+    taken = time.time() - start
+
+    print("{:<16} {:>8.3f}s {:>10,.0f} frames/sec {:>8.1f}x realtime".format(
+        name, taken, len(frames) / taken, SECONDS / taken
+    ))
+
+    return taken
+
+
+def pipeline(frames):
+    clock = Clock()
+    protocol = FakeProtocol()
+
+    player = Player(protocol, GeneratorSource(frames), clock=clock)
+    player.play()
+
+    start = time.time()
+
+    while player.playing:
+        clock.advance(FRAME_LENGTH / 1000.0)
+
+    taken = time.time() - start
+
+    print("{:<16} {:>8.3f}s {:>10,.0f} frames/sec {:>8.1f}x realtime".format(
+        "Pipeline:", taken, protocol.packets / taken, SECONDS / taken
+    ))
+    print(player.stats)
+
+
+def run():
+    if not AVAILABLE:
+        print("libopus isn't installed, so there's nothing to benchmark.")
+        return
+
+    print("Building {:,} frames of audio".format(FRAMES))
+    frames = build_frames()
+
+    old = encode("Old encode():", OldEncoder(SAMPLE_RATE, 1), frames)
+    new = encode("New encode():", Encoder(SAMPLE_RATE, 1), frames)
+
+    print("Encode speedup: {:.2f}x".format(old / new))
+
+    pipeline(frames)
+
+
+if __name__ == "__main__":
+    run()
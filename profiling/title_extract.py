@@ -0,0 +1,141 @@
+# coding=utf-8
+
+__author__ = 'Gareth Coles'
+
+"""
+Benchmark for finding page titles in the URLs plugin.
+
+This compares, for a few sorts of page:
+
+* The old way - read max_read_size bytes, then parse them all with
+  BeautifulSoup and take the <title>
+* The new way - feed the body to a TitleExtractor as it arrives, and stop
+  reading once it has the title
+
+For each, it shows how many bytes were read and how long each title took.
+Pages arrive in 4KB chunks, as they roughly do from the network.
+
+Run it from the root of the repo: python profiling/title_extract.py
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.getcwd())  # Because herp derp
+
+from bs4 import BeautifulSoup
+
+from plugins.urls.titles import TitleExtractor
+
+ROUNDS = 200
+CHUNK_SIZE = 4096
+MAX_READ = 1024 * 16
+
+HEAD = b'<meta charset="utf-8">' \
+       b'<meta name="viewport" content="width=device-width, ' \
+       b'initial-scale=1">' + b''.join(
+           b'<link rel="stylesheet" href="/static/css/style-%d.css">' % index
+           for index in range(20)
+       )
+
+BODY = b"<body>" + b"<div class='post'><p>Some text</p></div>" * 2000 + \
+       b"</body></html>"
+
+PAGES = [
+    (
+        "Typical page",
+        b"<!DOCTYPE html><html><head>" + HEAD +
+        b"<title>An article about something | Example News</title>" +
+        b"</head>" + BODY
+    ),
+    (
+        "Title after scripts",
+        b"<!DOCTYPE html><html><head>" + HEAD +
+        b"<script>" + b"var x = {'a': 1, 'b': 2};\n" * 400 + b"</script>"
+        b"<title>Buried under the analytics</title></head>" + BODY
+    ),
+    (
+        "Small page",
+        b"<html><head><title>Tiny</title></head><body>Hi</body></html>"
+    ),
+    (
+        "No title",
+        b"<html><head>" + HEAD + b"</head>" + BODY
+    ),
+]
+
+
+def chunks(page):
+    for index in xrange(0, len(page), CHUNK_SIZE):
+        yield page[index:index + CHUNK_SIZE]
+
+
+def old(page):
+    content = []
+    size = 0
+
+    for chunk in chunks(page):
+        content.append(chunk)
+        size += len(chunk)
+
+        if size >= MAX_READ:
+            break
+
+    soup = BeautifulSoup(b"".join(content)[:MAX_READ], "html.parser")
+    title = None
+
+    if soup.title and soup.title.text:
+        title = re.sub("[\n\\s]+", " ", soup.title.text).strip()
+
+    return title, min(size, MAX_READ)
+
+
+def new(page):
+    extractor = TitleExtractor()
+    size = 0
+
+    for chunk in chunks(page):
+        chunk = chunk[:MAX_READ - size]
+        size += len(chunk)
+
+        if extractor.feed(chunk) or size >= MAX_READ:
+            break
+
+    extractor.finish()
+
+    return extractor.get_title(), size
+
+
+def bench(func, page):
+    start = time.time()
+
+    for _ in xrange(ROUNDS):
+        title, size = func(page)
+
+    taken = (time.time() - start) / ROUNDS
+
+    return title, size, taken
+
+
+def run():
+    for name, page in PAGES:
+        old_title, old_size, old_taken = bench(old, page)
+        new_title, new_size, new_taken = bench(new, page)
+
+        print("{0} ({1:,} bytes)".format(name, len(page)))
+        print("  {:<14} {:>8,} bytes read {:>9.3f}ms per title".format(
+            "BeautifulSoup:", old_size, old_taken * 1000
+        ))
+        print("  {:<14} {:>8,} bytes read {:>9.3f}ms per title".format(
+            "Extractor:", new_size, new_taken * 1000
+        ))
+        print("  Same title: {0}, {1:.0f}% of the bytes, {2:.1f}x faster"
+              .format(old_title == new_title,
+                      100.0 * new_size / old_size, old_taken / new_taken))
+        print("")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,116 @@
+# coding=utf-8
+
+__author__ = 'Gareth Coles'
+
+"""
+Benchmark for matching URLs against the URLs plugin's blacklist and
+per-domain rules.
+
+This compares trying re.match() with each rule in turn, as the plugin used
+to, with a compiled RuleSet - for a blacklist of URL regexes, and for a set
+of domain rules like the ones used for proxies and sessions.
+
+Run it from the root of the repo: python profiling/url_rules.py
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.getcwd())  # Because herp derp
+
+from plugins.urls.rules import RuleSet
+
+ROUNDS = 20
+FLAGS = re.I | re.U
+
+BLACKLIST = [
+    r".*//site{0}\.example\.com/.*".format(index) for index in xrange(300)
+] + [
+    r".*//(www\.)?video{0}\.example\.net/watch\?.*".format(index)
+    for index in xrange(200)
+]
+
+DOMAINS = [
+    r"(.*\.)?domain{0}\.example\.org$".format(index) for index in xrange(400)
+] + [
+    r".*\.onion$", r".*\.i2p$"
+] + [
+    r"cdn[0-9]+\.host{0}\.example\.org".format(index) for index in xrange(100)
+]
+
+URLS = [
+    "https://www.example.com/some/page",
+    "https://news.example.co.uk/article/12345",
+    "http://site250.example.com/blacklisted",
+    "https://video150.example.net/watch?v=abc",
+]
+
+HOSTS = [
+    "www.example.com",
+    "news.example.co.uk",
+    "sub.domain300.example.org",
+    "abcdefghijklmnop.onion",
+    "cdn5.host50.example.org",
+]
+
+
+def old(rules, strings):
+    for string in strings:
+        for pattern in rules:
+            if re.match(pattern, string, FLAGS):
+                break
+
+
+def new(rules, strings):
+    for string in strings:
+        rules.match(string)
+
+
+def bench(name, func, rules, strings):
+    start = time.time()
+
+    for _ in xrange(ROUNDS):
+        func(rules, strings)
+
+    taken = time.time() - start
+    count = ROUNDS * len(strings)
+
+    print("{:<24} {:>8.3f}s {:>12,.0f} lookups/sec".format(
+        name, taken, count / taken
+    ))
+
+    return taken
+
+
+def run():
+    for name, rules, strings, domains in (
+            ("Blacklist", BLACKLIST, URLS, False),
+            ("Domain rules", DOMAINS, HOSTS, True)):
+        print("{0} ({1} rules)".format(name, len(rules)))
+
+        rule_set = RuleSet(
+            ((pattern, pattern) for pattern in rules), FLAGS, domains
+        )
+
+        for string in strings:
+            expected = None
+
+            for pattern in rules:
+                if re.match(pattern, string, FLAGS):
+                    expected = pattern
+                    break
+
+            result = rule_set.match(string)
+            assert expected == (result[0] if result else None), string
+
+        old_taken = bench("re.match() each:", old, rules, strings)
+        new_taken = bench("RuleSet:", new, rule_set, strings)
+
+        print("Speedup: {:.2f}x".format(old_taken / new_taken))
+        print("")
+
+
+if __name__ == "__main__":
+    run()
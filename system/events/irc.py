@@ -241,6 +241,28 @@ class WHOReplyEndEvent(IRCEvent):
         super(WHOReplyEndEvent, self).__init__(caller)
 
 
+class ChannelSyncedEvent(IRCEvent):
+    """
+    Thrown when we've joined a channel and finished receiving the WHO reply
+    for it, so its user list is complete
+
+    sync_time is the time taken, in seconds, from sending the JOIN to the end
+    of the WHO reply
+    """
+
+    channel = None
+    sync_time = 0
+
+    def __init__(self, caller, channel, sync_time):
+        """
+        Initialise the event object.
+        """
+
+        self.channel = channel
+        self.sync_time = sync_time
+        super(ChannelSyncedEvent, self).__init__(caller)
+
+
 class BanListEvent(IRCEvent):
     """
     Thrown when the server sends us a ban list reply chunk
@@ -64,6 +64,11 @@ class EventManager(object):
     #:     }
     callbacks = {}
 
+    #: If set, this is called with the callback name and event for every
+    #: event that's run - worker processes use this to pass their events on
+    #: to the main process. See system.workers.
+    forwarder = None
+
     def __init__(self):
         self.logger = getLogger("Events")
 
@@ -271,6 +276,8 @@ class EventManager(object):
             # to do any work.
             return reactor.callFromThread(self.run_callback, callback,
                                           event, threaded)
+        if self.forwarder is not None:
+            self.forwarder(callback, event)
         if self.has_callback(callback):
             event.threaded = threaded  # So devs can detect it easily.
 
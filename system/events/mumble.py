@@ -457,6 +457,9 @@ class UserUnregistered(UserRegisteredEvent):
 class ChannelCreated(MumbleEvent):
     """
     New channel - Sent when a channel is created
+
+    This isn't sent for the channels the server tells us about when we
+    connect, only for those created after it's sent us ServerSync.
     """
 
     channel = None
@@ -471,6 +474,23 @@ class ChannelCreated(MumbleEvent):
         super(ChannelCreated, self).__init__(caller)
 
 
+class ChannelRemoved(MumbleEvent):
+    """
+    Channel removed - Sent when a channel is deleted
+    """
+
+    channel = None
+
+    def __init__(self, caller, channel):
+        """
+        Initialise the event object.
+        """
+
+        self.channel = channel
+
+        super(ChannelRemoved, self).__init__(caller)
+
+
 class ChannelLinked(MumbleEvent):
     """
     Channel link added - Sent when two channels are linked together
@@ -507,3 +527,36 @@ class ChannelUnlinked(MumbleEvent):
         self.to_channel = to_
 
         super(ChannelUnlinked, self).__init__(caller)
+
+
+class VoicePacket(MumbleEvent):
+    """
+    Voice packet - Sent for every voice packet we receive, whether it came
+    over UDP or through the TCP tunnel
+
+    codec: One of the UDP_* packet types from system.protocols.mumble.udp
+    target: 0 for normal talking, 31 for server loopback, or a whisper
+        target
+    payload: The encoded audio frames, still in the codec's framing
+    """
+
+    user = None
+    codec = 0
+    target = 0
+    sequence = 0
+    payload = ""
+    udp = False
+
+    def __init__(self, caller, user, codec, target, sequence, payload, udp):
+        """
+        Initialise the event object.
+        """
+
+        self.user = user
+        self.codec = codec
+        self.target = target
+        self.sequence = sequence
+        self.payload = payload
+        self.udp = udp
+
+        super(VoicePacket, self).__init__(caller)
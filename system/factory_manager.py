@@ -14,11 +14,13 @@ from system.logging import logger
 from system.logging.logger import getLogger
 from system.metrics.public import Metrics
 from system.plugins.manager import PluginManager
+from system.protocols.generic.reconnect import ReconnectScheduler
 from system.singleton import Singleton
 from system.storage.config import Config
 from system.storage.formats import YAML
 from system.storage.manager import StorageManager
 from system.translations import Translations
+from system.workers.bus import WorkerBus
 from utils.misc import valid_path
 
 __author__ = "Gareth Coles"
@@ -64,6 +66,12 @@ class FactoryManager(object):
 
         self.metrics = None
 
+        #: Schedules reconnections for all of our protocols
+        self.reconnects = ReconnectScheduler()
+
+        #: The worker bus, if protocols are to be run in worker processes
+        self.workers = None
+
     @property
     def all_plugins(self):
         return self.plugman.info_objects
@@ -118,6 +126,8 @@ class FactoryManager(object):
         self.commands.set_factory_manager(self)
 
         self.load_config()  # Load the configuration
+        self.reconnects.configure(self.main_config.get("reconnections", {}))
+        self.setup_workers()
 
         try:
             self.metrics = Metrics(self.main_config, self)
@@ -193,6 +203,25 @@ class FactoryManager(object):
             return False
         return True
 
+    def setup_workers(self):
+        """
+        Start the worker bus, if protocols are configured to run in worker
+        processes.
+        """
+
+        config = self.main_config.get("workers", {})
+
+        if not config.get("enabled", False):
+            return
+
+        try:
+            self.workers = WorkerBus(self, config)
+            self.workers.start()
+        except Exception:
+            self.workers = None
+            self.logger.exception(_("Unable to start the worker bus - all "
+                                    "protocols will run in this process."))
+
     @inlineCallbacks
     def load_plugins(self):
         """
@@ -301,6 +330,15 @@ class FactoryManager(object):
         if name in self.factories:
             return ProtocolState.AlreadyLoaded
 
+        if self.workers is not None and self.workers.handles(name) \
+                and not isinstance(conf_location, Config):
+            # Loaded in the background - the factory is removed again if the
+            # worker can't load it
+            self.factories[name] = self.workers.load_protocol(
+                name, conf_location
+            )
+            return ProtocolState.Loaded
+
         config = conf_location
         if not isinstance(conf_location, Config):
             if not valid_path(self.storage.conf_path + conf_location):
@@ -436,6 +474,9 @@ class FactoryManager(object):
 
         __ = yield self.plugman.unload_plugins()
 
+        if self.workers is not None:
+            __ = yield self.workers.stop()
+
         if reactor.running:
             try:
                 reactor.stop()
@@ -15,6 +15,9 @@ class Channel(object):
     @ivar users A set containing all the User objects in the channel
     """
 
+    # See the note on the User class
+    __slots__ = ("name", "protocol", "users", "__weakref__")
+
     def __init__(self, name, protocol=None):
         """
         Initialise the channel. Remember to call super in subclasses!
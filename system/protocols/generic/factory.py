@@ -1,13 +1,13 @@
 # coding=utf-8
 import importlib
 
-from twisted.internet import reactor
 from twisted.internet.error import AlreadyCancelled, AlreadyCalled, \
     ConnectionDone
 from twisted.internet.protocol import ClientFactory
 from twisted.python.failure import Failure
 
 from system.protocols.generic.protocol import Protocol
+from system.protocols.generic.reconnect import backoff_delay
 from system.logging.logger import getLogger
 
 __author__ = 'Gareth Coles'
@@ -46,7 +46,8 @@ class BaseFactory(ClientFactory):
                 "Unable to find a \"reconnections\" section in settings.yml - "
                 "Please add one and ensure that it is configured to your needs"
             )
-            return {}
+
+        return {}
 
     def __init__(self, protocol_name, config, factory_manager):
         self.name = protocol_name
@@ -158,11 +159,19 @@ class BaseFactory(ClientFactory):
         This will check the configuration as specified in
         `get_reconnect_option`, and conditionally reconnect (or not) as
         configured.
+
+        Reconnections are handed to the factory manager's reconnection
+        scheduler, which waits an exponentially increasing, randomised delay
+        between attempts, and limits how many protocols are connecting at
+        once.
         """
 
         if self.shutting_down:
             return
 
+        scheduler = self.factory_manager.reconnects
+        scheduler.failed(self)
+
         if self.get_reconnect_option("on-{}".format(reason), False):
             if self.get_reconnect_option("attempts", 5) > 0:
                 if (
@@ -178,22 +187,27 @@ class BaseFactory(ClientFactory):
 
             self.reconnection_attempts += 1
 
-            max_delay = self.get_reconnect_option("max_delay", 300)
-
-            delay = self.get_reconnect_option("delay", 10)
-            delay *= self.reconnection_attempts
+            max_delay = self.get_reconnect_option(
+                "max-delay", self.get_reconnect_option("max_delay", 300)
+            )
 
-            if delay > max_delay:
-                delay = max_delay
+            delay = backoff_delay(
+                self.reconnection_attempts,
+                self.get_reconnect_option("delay", 10),
+                max_delay,
+                self.get_reconnect_option("jitter", True)
+            )
 
             self.logger.info(
-                "Connecting after {} seconds (attempt {}/{})".format(
+                "Connecting after {:.1f} seconds (attempt {}/{})".format(
                     delay, self.reconnection_attempts,
                     self.get_reconnect_option("attempts", 5) or "infinite"
                 )
             )
 
-            return reactor.callLater(delay, connector.connect)
+            return scheduler.schedule(self, connector, delay)
+        else:
+            scheduler.forget(self)
 
     def shutdown(self):
         """
@@ -206,6 +220,11 @@ class BaseFactory(ClientFactory):
 
         self.shutting_down = True
 
+        try:
+            self.factory_manager.reconnects.forget(self)
+        except Exception:
+            self.logger.exception("Failed to cancel reconnection")
+
         try:
             if self.task is not None:
                 self.task.cancel()
@@ -255,7 +274,9 @@ class BaseFactory(ClientFactory):
         reset the reconnection counter as appropriate.
         """
 
-        if self.reconnection_config["reset-on-success"]:
+        self.factory_manager.reconnects.connected(self)
+
+        if self.get_reconnect_option("reset-on-success", True):
             self.reconnection_attempts = 0
 
     def clientConnectionFailed(self, connector, reason):
@@ -0,0 +1,358 @@
+# coding=utf-8
+
+"""
+Scheduling reconnections for all of the bot's protocols.
+
+If every protocol reconnects on its own when our connection blips, they all
+reconnect at once - and servers that throttle connections will turn some of
+them away, which makes the outage last longer. Instead, factories hand their
+reconnections to the factory manager's `ReconnectScheduler`, which:
+
+* Waits an exponentially increasing delay between attempts, picked at
+  random between zero and that delay ("full jitter"), so connections that
+  dropped together don't come back together
+* Only lets a few connections be in progress at once, overall and to any
+  one host - the rest wait for a slot
+
+It also keeps track of how long each protocol took to get back online.
+"""
+
+import random
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+
+from system.logging.logger import getLogger
+
+__author__ = 'Gareth Coles'
+
+
+def backoff_delay(attempt, delay, max_delay, jitter=True):
+    """
+    Work out how long to wait before a reconnection attempt.
+
+    :param attempt: The attempt number, starting at 1
+    :param delay: The delay before the first attempt, in seconds
+    :param max_delay: The longest we should wait, in seconds
+    :param jitter: Whether to pick a random delay up to the full one
+    """
+
+    # Past this, the exponent is pointless and can overflow a float
+    attempt = min(attempt, 32)
+    full = min(max_delay, delay * 2 ** (attempt - 1))
+
+    if jitter:
+        return random.uniform(0, full)
+    return full
+
+
+def get_host(factory, connector):
+    """
+    Work out which host a connector connects to, for the per-host limit.
+    """
+
+    try:
+        return connector.getDestination().host
+    except Exception:
+        # Not a TCP/SSL connection, so we can't tell - just limit the
+        # factory against itself
+        return factory.name
+
+
+class Reconnection(object):
+    """
+    A reconnection that's waiting to happen.
+
+    This can be cancelled like a DelayedCall, which is what factories used
+    to keep before there was a scheduler.
+    """
+
+    WAITING = "waiting"  # For its delay to pass
+    QUEUED = "queued"  # For a free connection slot
+    CONNECTING = "connecting"
+    DONE = "done"
+    CANCELLED = "cancelled"
+
+    def __init__(self, scheduler, factory, connector, host, attempt):
+        self.scheduler = scheduler
+        self.factory = factory
+        self.connector = connector
+        self.host = host
+        self.attempt = attempt
+
+        self.state = self.WAITING
+        self.call = None
+
+    def active(self):
+        return self.state in (self.WAITING, self.QUEUED)
+
+    def cancel(self):
+        if self.state == self.CANCELLED:
+            raise AlreadyCancelled()
+        if not self.active():
+            raise AlreadyCalled()
+
+        self.scheduler.cancel(self)
+
+
+class ReconnectStats(object):
+    """
+    How reconnections have gone.
+
+    attempts: Reconnection attempts started
+    reconnects: Protocols that came back after being disconnected
+    queued: Attempts that had to wait for a free connection slot
+    last_time: How long the last protocol took to come back, in seconds
+    avg_time: The average of the recent times to come back, in seconds
+    max_time: The longest time to come back, in seconds
+    """
+
+    __slots__ = ("attempts", "reconnects", "queued", "last_time", "max_time",
+                 "times")
+
+    #: How many recent times to average
+    HISTORY = 50
+
+    def __init__(self):
+        self.attempts = 0
+        self.reconnects = 0
+        self.queued = 0
+        self.last_time = None
+        self.max_time = 0.0
+        self.times = deque(maxlen=self.HISTORY)
+
+    @property
+    def avg_time(self):
+        if not self.times:
+            return None
+        return sum(self.times) / len(self.times)
+
+    def add_time(self, taken):
+        self.reconnects += 1
+        self.last_time = taken
+        self.max_time = max(self.max_time, taken)
+        self.times.append(taken)
+
+    def __repr__(self):
+        return "%s(attempts=%s, reconnects=%s, queued=%s, last_time=%s, " \
+               "avg_time=%s, max_time=%s)" % (
+                   self.__class__.__name__, self.attempts, self.reconnects,
+                   self.queued, self.last_time, self.avg_time, self.max_time
+               )
+
+
+class ReconnectScheduler(object):
+    """
+    Schedules reconnections for factories, with backoff and limits on how
+    many connections can be in progress at once.
+
+    :param max_connecting: The most connections to have in progress at once
+    :param max_per_host: The most connections to have in progress to any
+        one host at once
+    """
+
+    #: If a connection attempt hasn't succeeded or failed after this many
+    #: seconds, we stop counting it against the limits
+    CONNECT_TIMEOUT = 120
+
+    def __init__(self, max_connecting=4, max_per_host=1, clock=None):
+        self.max_connecting = max_connecting
+        self.max_per_host = max_per_host
+        self.clock = clock or reactor
+
+        self.reconnections = {}  # Factory name -> Reconnection
+        self.queue = deque()  # Reconnections waiting for a slot
+        self.connecting = {}  # Factory name -> Reconnection
+        self.hosts = {}  # Host -> number of connections in progress
+        self.down_since = {}  # Factory name -> when it was disconnected
+
+        self.stats = ReconnectStats()
+
+        self._timeouts = {}  # Factory name -> DelayedCall
+
+        self.logger = getLogger("Reconnections")
+
+    def configure(self, config):
+        """
+        Set the limits from the "reconnections" section of the main config.
+        """
+
+        self.max_connecting = config.get("max-connecting", 4)
+        self.max_per_host = config.get("max-connecting-per-host", 1)
+
+    def schedule(self, factory, connector, delay):
+        """
+        Reconnect a factory after a delay, once there's a slot free.
+
+        Any reconnection already scheduled for the factory is replaced.
+
+        :param factory: The factory - its name identifies it
+        :param connector: The Twisted connector to reconnect with
+        :param delay: How long to wait first, in seconds
+        :return: A Reconnection, which can be cancelled
+        """
+
+        self._replace(factory)
+        self.down_since.setdefault(factory.name, self.clock.seconds())
+
+        reconnection = Reconnection(
+            self, factory, connector, get_host(factory, connector),
+            factory.reconnection_attempts
+        )
+        reconnection.call = self.clock.callLater(
+            delay, self._ready, reconnection
+        )
+
+        self.reconnections[factory.name] = reconnection
+
+        return reconnection
+
+    def cancel(self, reconnection):
+        if reconnection.state == Reconnection.WAITING:
+            if reconnection.call.active():
+                reconnection.call.cancel()
+        elif reconnection.state == Reconnection.QUEUED:
+            self.queue.remove(reconnection)
+
+        reconnection.state = Reconnection.CANCELLED
+
+        if self.reconnections.get(reconnection.factory.name) is reconnection:
+            del self.reconnections[reconnection.factory.name]
+
+    def forget(self, factory):
+        """
+        Stop tracking a factory - when it's shutting down, for example.
+        """
+
+        self._replace(factory)
+        self.down_since.pop(factory.name, None)
+
+    # Called by factories
+
+    def connected(self, factory):
+        """
+        A factory's protocol connected successfully.
+        """
+
+        self._finished(factory)
+
+        since = self.down_since.pop(factory.name, None)
+
+        if since is not None:
+            taken = self.clock.seconds() - since
+            self.stats.add_time(taken)
+
+            self.logger.info(
+                "{} reconnected after {:.1f} seconds".format(
+                    factory.name, taken
+                )
+            )
+
+    def failed(self, factory):
+        """
+        A factory's connection attempt failed, or its connection was lost.
+        """
+
+        self._finished(factory)
+
+        # If it was never connected, this is when we start counting from
+        self.down_since.setdefault(factory.name, self.clock.seconds())
+
+    # Internals
+
+    def _replace(self, factory):
+        reconnection = self.reconnections.get(factory.name)
+
+        if reconnection is not None and reconnection.active():
+            self.cancel(reconnection)
+
+        self._finished(factory)
+
+    def _ready(self, reconnection):
+        reconnection.state = Reconnection.QUEUED
+        self.queue.append(reconnection)
+        self._process_queue()
+
+        if reconnection.state == Reconnection.QUEUED:
+            self.stats.queued += 1
+
+            self.logger.debug(
+                "Waiting for a free slot to reconnect {}".format(
+                    reconnection.factory.name
+                )
+            )
+
+    def _process_queue(self):
+        """
+        Start as many queued connections as the limits allow.
+        """
+
+        skipped = deque()
+
+        while self.queue and len(self.connecting) < self.max_connecting:
+            reconnection = self.queue.popleft()
+
+            if self.hosts.get(reconnection.host, 0) >= self.max_per_host:
+                skipped.append(reconnection)
+                continue
+
+            self._connect(reconnection)
+
+        skipped.extend(self.queue)
+        self.queue = skipped
+
+    def _connect(self, reconnection):
+        name = reconnection.factory.name
+
+        reconnection.state = Reconnection.CONNECTING
+        self.connecting[name] = reconnection
+        self.hosts[reconnection.host] = self.hosts.get(
+            reconnection.host, 0
+        ) + 1
+
+        self.stats.attempts += 1
+
+        self._timeouts[name] = self.clock.callLater(
+            self.CONNECT_TIMEOUT, self._finished, reconnection.factory
+        )
+
+        try:
+            reconnection.connector.connect()
+        except Exception:
+            self.logger.exception("Error reconnecting {}".format(name))
+            self._finished(reconnection.factory)
+
+    def _finished(self, factory):
+        """
+        A factory's connection attempt is over, one way or another - free
+        up its slot.
+        """
+
+        name = factory.name
+        timeout = self._timeouts.pop(name, None)
+
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+
+        reconnection = self.connecting.pop(name, None)
+
+        if reconnection is None:
+            return
+
+        reconnection.state = Reconnection.DONE
+
+        if self.reconnections.get(name) is reconnection:
+            del self.reconnections[name]
+
+        count = self.hosts.get(reconnection.host, 0) - 1
+
+        if count > 0:
+            self.hosts[reconnection.host] = count
+        else:
+            self.hosts.pop(reconnection.host, None)
+
+        # Someone else can have the slot now - but not from inside the
+        # callback that freed it, which may be about to schedule again
+        self.clock.callLater(0, self._process_queue)
@@ -7,16 +7,21 @@ _ = Translations().get()
 
 
 class User(object):
-
-    authorized = False
-    auth_name = ""
-    away = False
+    # There can be a lot of users, so we avoid giving each one a __dict__.
+    # Subclasses should define their own __slots__ too - if they don't, they'll
+    # still work, but will have a __dict__ again.
+    __slots__ = ("nickname", "protocol", "is_tracked", "authorized",
+                 "auth_name", "away", "__weakref__")
 
     def __init__(self, nickname, protocol=None, is_tracked=False):
         self.nickname = nickname
         self.protocol = protocol
         self.is_tracked = is_tracked
 
+        self.authorized = False
+        self.auth_name = ""
+        self.away = False
+
     @property
     def name(self):
         return self.nickname
@@ -9,6 +9,8 @@ _ = Translations().get()
 
 
 class Channel(channel.Channel):
+    __slots__ = ("_modes",)
+
     def __init__(self, protocol, name):
         super(Channel, self).__init__(name, protocol)
         self.users = set()
@@ -0,0 +1,349 @@
+# coding=utf-8
+
+"""
+Channel join pipeline for the IRC protocol.
+
+Joining a lot of channels at once is a good way to get throttled or
+disconnected by the server, so instead of sending one JOIN and one WHO per
+channel as fast as we can, channels are queued up here, sent in batches of
+comma-separated JOIN lines and then WHO'd a few at a time.
+
+When the server advertises WHOX, the WHO requests only ask for the fields
+that user-tracking actually needs.
+"""
+
+import time
+
+from twisted.internet import reactor
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+
+from system.events import irc as irc_events
+from system.translations import Translations
+
+__author__ = 'Gareth Coles'
+_ = Translations().get()
+
+# Max length of a line, excluding the trailing \r\n
+MAX_LINE_LENGTH = 510
+
+# Fields we request with WHOX - see the WHOX spec for what these mean. The
+# server always replies with them in the order "tcuihsnfdlaor", regardless of
+# the order we ask for them in.
+WHOX_FIELDS = "tcuihsnfar"
+# Query type token, so we can tell our WHOX replies apart from anyone else's
+WHOX_TOKEN = "154"
+
+
+class JoinPipeline(object):
+    """
+    Batches, paces and tracks channel joins for a single IRC protocol.
+
+    Channels are queued with `queue()` and sent when `start()` is called.
+    Once we've joined a channel, its WHO request is queued with `request_who()`
+    and only a limited number of WHO requests will be outstanding at once.
+
+    The time between sending a channel's JOIN and receiving the end of its
+    WHO reply is stored in `sync_times`, and an `IRC/ChannelSynced` event is
+    thrown for each channel as it finishes syncing.
+    """
+
+    def __init__(self, protocol, config=None):
+        """
+        :param protocol: The IRC protocol this pipeline belongs to
+        :param config: The "join_pipeline" config section, if any
+        """
+
+        if config is None:
+            config = {}
+
+        self.protocol = protocol
+
+        self.batch_delay = config.get("batch_delay", 2)
+        self.max_channels = config.get("max_channels", 10)
+        self.who_concurrency = config.get("who_concurrency", 2)
+        self.use_whox = config.get("use_whox", True)
+
+        self.sync_times = {}
+
+        self._pending_joins = []
+        self._pending_who = []
+        self._who_in_progress = set()
+        self._join_times = {}
+        self._task = None
+
+    @property
+    def whox_enabled(self):
+        """
+        Whether we should be using WHOX for our WHO requests.
+        """
+
+        if not self.use_whox:
+            return False
+
+        supported = getattr(self.protocol, "supported", None)
+
+        if supported is None:
+            return False
+
+        return supported.hasFeature("WHOX")
+
+    # region Joins
+
+    def queue(self, channel, key=None):
+        """
+        Queue a channel to be joined.
+
+        :param channel: The name of the channel to join
+        :param key: The channel's key, if it has one
+        """
+
+        lowered = self._lower(channel)
+
+        for queued, ___ in self._pending_joins:
+            if self._lower(queued) == lowered:
+                return
+
+        self._pending_joins.append((channel, key))
+
+    def start(self, delay=0):
+        """
+        Start sending queued joins, if we aren't already.
+
+        :param delay: How long to wait before sending the first batch
+        """
+
+        if self._task is None and self._pending_joins:
+            self._task = reactor.callLater(delay, self._send_next_batch)
+
+    def stop(self):
+        """
+        Stop sending joins and WHO requests, and forget about anything queued.
+
+        This should be called when we disconnect.
+        """
+
+        if self._task is not None:
+            try:
+                self._task.cancel()
+            except (AlreadyCalled, AlreadyCancelled):
+                pass
+
+            self._task = None
+
+        del self._pending_joins[:]
+        del self._pending_who[:]
+
+        self._who_in_progress.clear()
+        self._join_times.clear()
+
+    def build_batch(self):
+        """
+        Take the next batch of channels from the queue and build a JOIN line
+        for them.
+
+        Channels with keys are placed first, since the server matches keys up
+        to channels in order. The line will stay within `MAX_LINE_LENGTH` and
+        the server's TARGMAX for JOIN, if it sent one.
+
+        :return: A tuple of (line, [channels]), or (None, []) if the queue is
+                 empty
+        """
+
+        if not self._pending_joins:
+            return None, []
+
+        keyed = [x for x in self._pending_joins if x[1]]
+        unkeyed = [x for x in self._pending_joins if not x[1]]
+
+        max_channels = self._get_max_targets()
+
+        channels = []
+        keys = []
+
+        for channel, key in keyed + unkeyed:
+            if max_channels and len(channels) >= max_channels:
+                break
+
+            new_channels = channels + [channel]
+            new_keys = keys + [key] if key else keys
+
+            if channels and len(
+                self._format_join(new_channels, new_keys)
+            ) > MAX_LINE_LENGTH:
+                break
+
+            channels = new_channels
+            keys = new_keys
+
+        sent = set(channels)
+        self._pending_joins = [
+            x for x in self._pending_joins if x[0] not in sent
+        ]
+
+        return self._format_join(channels, keys), channels
+
+    def _send_next_batch(self):
+        self._task = None
+
+        line, channels = self.build_batch()
+
+        if line is None:
+            return
+
+        now = time.time()
+
+        for channel in channels:
+            self._join_times[self._lower(channel)] = now
+
+        self.protocol.log.debug(
+            _("Joining %s channels: %s") % (len(channels), ", ".join(channels))
+        )
+        self.protocol.sendLine(line)
+
+        if self._pending_joins:
+            self._task = reactor.callLater(
+                self.batch_delay, self._send_next_batch
+            )
+
+    def join_failed(self, channel):
+        """
+        Called when the server refuses to let us join a channel - because
+        it's full or invite-only, for example - so we stop timing the join.
+
+        :param channel: The name of the channel we couldn't join
+        """
+
+        self._join_times.pop(self._lower(channel), None)
+
+    def _format_join(self, channels, keys):
+        if keys:
+            return u"JOIN %s %s" % (",".join(channels), ",".join(keys))
+        return u"JOIN %s" % ",".join(channels)
+
+    def _get_max_targets(self):
+        max_channels = self.max_channels
+        supported = getattr(self.protocol, "supported", None)
+
+        if supported is not None:
+            targmax = supported.getFeature("TARGMAX") or {}
+
+            if isinstance(targmax, dict) and targmax.get("JOIN"):
+                if max_channels:
+                    max_channels = min(max_channels, targmax["JOIN"])
+                else:
+                    max_channels = targmax["JOIN"]
+
+        return max_channels
+
+    # endregion
+
+    # region WHO requests
+
+    def joined(self, channel):
+        """
+        Called when we've joined a channel. This will queue a WHO request for
+        it and note when we joined it, if we didn't JOIN it through the
+        pipeline.
+
+        :param channel: The name of the channel we joined
+        """
+
+        lowered = self._lower(channel)
+
+        if lowered not in self._join_times:
+            self._join_times[lowered] = time.time()
+
+        self.request_who(channel)
+
+    def request_who(self, channel):
+        """
+        Queue a WHO request for a channel, sending it now if there's room.
+
+        :param channel: The name of the channel to request a WHO for
+        """
+
+        lowered = self._lower(channel)
+
+        if lowered in self._who_in_progress:
+            return
+
+        for queued in self._pending_who:
+            if self._lower(queued) == lowered:
+                return
+
+        self._pending_who.append(channel)
+        self._send_pending_who()
+
+    def who_finished(self, channel):
+        """
+        Called when the server has finished sending a WHO reply for a channel.
+
+        This will record how long the channel took to sync and send the next
+        queued WHO request, if there is one.
+
+        :param channel: The name of the channel the WHO reply was for
+        """
+
+        lowered = self._lower(channel)
+
+        if lowered in self._who_in_progress:
+            self._who_in_progress.remove(lowered)
+
+        started = self._join_times.pop(lowered, None)
+
+        if started is not None:
+            taken = time.time() - started
+            self.sync_times[lowered] = taken
+
+            self.protocol.log.debug(
+                _("Synced %s in %.2f seconds") % (channel, taken)
+            )
+
+            event = irc_events.ChannelSyncedEvent(
+                self.protocol, self.protocol.get_channel(channel), taken
+            )
+            self.protocol.event_manager.run_callback(
+                "IRC/ChannelSynced", event
+            )
+
+        self._send_pending_who()
+
+    def parted(self, channel):
+        """
+        Called when we leave a channel, so we don't wait for a WHO reply that
+        may never arrive.
+
+        :param channel: The name of the channel we left
+        """
+
+        lowered = self._lower(channel)
+
+        self._join_times.pop(lowered, None)
+        self.sync_times.pop(lowered, None)
+        self._pending_who = [
+            x for x in self._pending_who if self._lower(x) != lowered
+        ]
+
+        if lowered in self._who_in_progress:
+            self._who_in_progress.remove(lowered)
+            self._send_pending_who()
+
+    def _send_pending_who(self):
+        while self._pending_who and (
+            not self.who_concurrency or
+            len(self._who_in_progress) < self.who_concurrency
+        ):
+            channel = self._pending_who.pop(0)
+            self._who_in_progress.add(self._lower(channel))
+
+            if self.whox_enabled:
+                self.protocol.sendLine(
+                    u"WHO %s %%%s,%s" % (channel, WHOX_FIELDS, WHOX_TOKEN)
+                )
+            else:
+                self.protocol.send_who(channel)
+
+    # endregion
+
+    def _lower(self, channel):
+        return self.protocol.utils.lowercase_nick_chan(channel)
@@ -0,0 +1,171 @@
+# coding=utf-8
+
+"""
+A fast IRC line parser, with support for IRCv3 message tags.
+
+Each line is parsed exactly once into a `Message`, which holds the tags,
+the pre-split prefix (nick, ident and host), the command and its params.
+The protocol then dispatches that to its handlers without having to split
+anything again.
+"""
+
+from twisted.words.protocols.irc import IRCBadMessage, numeric_to_symbolic
+
+__author__ = 'Gareth Coles'
+
+_TAG_ESCAPES = {
+    ":": ";",
+    "s": " ",
+    "\\": "\\",
+    "r": "\r",
+    "n": "\n"
+}
+
+
+class Message(object):
+    """
+    A single parsed line from an IRC server.
+
+    *prefix* is the raw prefix (or an empty string if there wasn't one), as
+    Twisted's irc_* handlers expect. If it was a full hostmask, *nick*,
+    *ident* and *host* hold its parts - otherwise, *nick* is the whole prefix
+    (usually a server name) and *ident* and *host* are None.
+
+    *command* has numerics translated to their symbolic names, the same as
+    Twisted does, and *tags* is a dict of IRCv3 message tags, which is empty
+    if the server didn't send any.
+    """
+
+    __slots__ = ("tags", "prefix", "nick", "ident", "host", "command",
+                 "params")
+
+    def __init__(self, tags, prefix, nick, ident, host, command, params):
+        self.tags = tags
+        self.prefix = prefix
+        self.nick = nick
+        self.ident = ident
+        self.host = host
+        self.command = command
+        self.params = params
+
+    def __repr__(self):
+        return "%s(tags=%r, prefix=%r, command=%r, params=%r)" % (
+            self.__class__.__name__,
+            self.tags,
+            self.prefix,
+            self.command,
+            self.params
+        )
+
+    @property
+    def has_hostmask(self):
+        """
+        Whether the prefix was a full nick!ident@host hostmask.
+        """
+
+        return self.ident is not None and self.host is not None
+
+
+def unescape_tag_value(value):
+    """
+    Unescape an IRCv3 message tag value.
+
+    :param value: The escaped value
+    :return: The unescaped value
+    """
+
+    if "\\" not in value:
+        return value
+
+    result = []
+    escaped = False
+
+    for char in value:
+        if escaped:
+            result.append(_TAG_ESCAPES.get(char, char))
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        else:
+            result.append(char)
+
+    # A trailing lone backslash is dropped, as per the spec
+    return "".join(result)
+
+
+def parse_tags(raw_tags):
+    """
+    Parse the tags section of a line (without the leading @) into a dict.
+
+    Tags without a value are given an empty string as their value.
+
+    :param raw_tags: The raw tags string
+    :return: A dict of tags
+    """
+
+    tags = {}
+
+    for tag in raw_tags.split(";"):
+        if not tag:
+            continue
+
+        key, sep, value = tag.partition("=")
+        tags[key] = unescape_tag_value(value) if value else ""
+
+    return tags
+
+
+def parse_line(line):
+    """
+    Parse a line from an IRC server into a Message.
+
+    :param line: The line, without the trailing line ending
+    :return: The parsed Message
+    :raises IRCBadMessage: If the line is empty or has no command
+    """
+
+    if not line:
+        raise IRCBadMessage("Empty line.")
+
+    tags = {}
+    prefix = ""
+    nick = ident = host = None
+
+    try:
+        if line[0] == "@":
+            raw_tags, line = line[1:].split(" ", 1)
+            tags = parse_tags(raw_tags)
+
+        if line[0] == ":":
+            prefix, line = line[1:].split(" ", 1)
+
+            bang = prefix.find("!")
+            at = prefix.find("@", bang + 1)
+
+            if bang > 0 and at > bang:
+                nick = prefix[:bang]
+                ident = prefix[bang + 1:at]
+                host = prefix[at + 1:]
+            elif at > 0:
+                nick = prefix[:at]
+                host = prefix[at + 1:]
+            else:
+                nick = prefix
+    except (IndexError, ValueError):
+        raise IRCBadMessage("Line has no command: %r" % line)
+
+    trailing = line.find(" :")
+
+    if trailing != -1:
+        params = line[:trailing].split()
+        params.append(line[trailing + 2:])
+    else:
+        params = line.split()
+
+    if not params:
+        raise IRCBadMessage("Line has no command: %r" % line)
+
+    command = params.pop(0)
+    command = numeric_to_symbolic.get(command, command)
+
+    return Message(tags, prefix, nick, ident, host, command, params)
@@ -1,5 +1,6 @@
 # coding=utf-8
 import random
+import sys
 import time
 
 from kitchen.text.converters import to_bytes, to_unicode
@@ -18,10 +19,14 @@ from system.protocols.capabilities import Capabilities
 from system.protocols.generic.protocol import ChannelsProtocol
 from system.protocols.irc import constants
 from system.protocols.irc.channel import Channel
+from system.protocols.irc.joins import JoinPipeline, WHOX_TOKEN
+from system.protocols.irc.parser import parse_line
 from system.protocols.irc.rank import Ranks
 from system.protocols.irc.user import User
 from system.translations import Translations
 from utils.irc import IRCUtils
+from utils.ratelimit import KeyedTokenBuckets
+from utils.strings import intern_string
 from utils.switch import Switch
 _ = Translations().get()
 
@@ -32,6 +37,7 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
 
     Class layout:
         - Private send/recv functions
+        - Line parsing and dispatch
         - IRC message handling
             - Initial connection
             - Personal events (force-joined, kicked)
@@ -76,9 +82,10 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
     _ctcp_flood_enabled = True
     _ctcp_flood_time = 30
     _ctcp_flood_max_count = 5
+    _ctcp_flood_global_count = 0
+    _ctcp_flood_max_tracked = 10000
 
-    _ctcp_flood_last = 0
-    _ctcp_flood_count = 0
+    _ctcp_flood_buckets = None
 
     @property
     def num_channels(self):
@@ -88,6 +95,14 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
     def fingers(self):
         return self.config.get("fingers", [])
 
+    @property
+    def ctcp_flood_stats(self):
+        """
+        Counts of CTCPs that were accepted and dropped by flood protection.
+        """
+
+        return self._ctcp_flood_buckets.stats
+
     # TODO: Make users a set()?
     _users = []
     ourselves = None
@@ -139,10 +154,23 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
                 "ctcp_time"]
             self._ctcp_flood_max_count = config["ctcp_flood_protection"][
                 "ctcp_count"]
+            self._ctcp_flood_global_count = config[
+                "ctcp_flood_protection"].get("global_count", 0)
+            self._ctcp_flood_max_tracked = config[
+                "ctcp_flood_protection"].get("max_tracked", 10000)
         else:
             self.log.info(_("No ctcp_flood_protection block in config - "
                             "using default values"))
 
+        # One bucket per host, so one abuser can't block CTCPs for everyone
+        self._ctcp_flood_buckets = KeyedTokenBuckets(
+            self._ctcp_flood_max_count,
+            float(self._ctcp_flood_max_count) / self._ctcp_flood_time,
+            self._ctcp_flood_max_tracked,
+            self._ctcp_flood_global_count,
+            float(self._ctcp_flood_global_count) / self._ctcp_flood_time
+        )
+
         try:
             if config["network"]["password"]:
                 self.password = config["network"]["password"]
@@ -153,10 +181,21 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
         self.nickname = self.identity["nick"]
         self.invite_join = self.config.get("invite_join", False)
 
+        self.join_pipeline = JoinPipeline(
+            self, self.config.get("join_pipeline", {})
+        )
+
+        self._handlers = self._build_handlers()
+
     def shutdown(self):
+        self.join_pipeline.stop()
         self.sendLine("QUIT :%s" % _("Protocol shutdown"))
         self.transport.loseConnection()
 
+    def connectionLost(self, reason):
+        self.join_pipeline.stop()
+        irc.IRCClient.connectionLost(self, reason)
+
     def register(self, nickname, hostname='foo', servername='bar'):
         if self.identity["authentication"].lower() == "sasl":
             self.sendLine("CAP REQ :sasl")  # It has to be sent early
@@ -184,6 +223,110 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
 
     # endregion
 
+    # region Line parsing and dispatch
+
+    #######################################################################
+    # Instead of Twisted's parsemsg() and handleCommand(), which look up  #
+    # the irc_* method by name for every line, we parse each line once    #
+    # and dispatch it through a table built when the protocol is created. #
+    # Handlers named handle_* get the parsed Message, with its tags and   #
+    # pre-split prefix, and take precedence over irc_* handlers, which    #
+    # get (prefix, params) as they would with Twisted.                    #
+    #######################################################################
+
+    def _build_handlers(self):
+        handlers = {}
+
+        for name in dir(self):
+            if name.startswith("irc_") and name != "irc_unknown":
+                handlers.setdefault(name[4:], (getattr(self, name), False))
+            elif name.startswith("handle_"):
+                handlers[name[7:]] = (getattr(self, name), True)
+
+        return handlers
+
+    def lineReceived(self, line):
+        line = irc.lowDequote(line)
+
+        try:
+            message = parse_line(line)
+        except irc.IRCBadMessage:
+            self.badMessage(line, *sys.exc_info())
+        else:
+            self.dispatch_message(message)
+
+    def dispatch_message(self, message):
+        """
+        Call the handler for a parsed Message.
+
+        :type message: system.protocols.irc.parser.Message
+        """
+
+        try:
+            handler, takes_message = self._handlers[message.command]
+        except KeyError:
+            handler, takes_message = None, False
+
+        try:
+            if handler is None:
+                self.irc_unknown(message.prefix, message.command,
+                                 message.params)
+            elif takes_message:
+                handler(message)
+            else:
+                handler(message.prefix, message.params)
+        except Exception:
+            self.log.exception(_("Error handling message: %r") % message)
+
+    def handle_PRIVMSG(self, message):
+        user = message.prefix
+        channel = message.params[0]
+        text = message.params[-1]
+
+        if not text:
+            # Don't raise an exception if we get blank message.
+            return
+
+        if text[0] == irc.X_DELIM:
+            m = irc.ctcpExtract(text)
+            if m['extended']:
+                self.ctcpQuery(user, channel, m['extended'], message)
+
+            if not m['normal']:
+                return
+
+            text = ' '.join(m['normal'])
+
+        self.privmsg(user, channel, text, message)
+
+    def handle_NOTICE(self, message):
+        user = message.prefix
+        channel = message.params[0]
+        text = message.params[-1]
+
+        if not text:
+            return
+
+        if text[0] == irc.X_DELIM:
+            m = irc.ctcpExtract(text)
+            if m['extended']:
+                self.ctcpReply(user, channel, m['extended'])
+
+            if not m['normal']:
+                return
+
+            text = ' '.join(m['normal'])
+
+        self.noticed(user, channel, text, message)
+
+    def handle_JOIN(self, message):
+        self.irc_JOIN(message.prefix, message.params, message)
+
+    def handle_QUIT(self, message):
+        self.irc_QUIT(message.prefix, message.params, message)
+
+    # endregion
+
     # region Personal events
 
     #######################################################################
@@ -201,6 +344,7 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
         self.ourselves = None
         self._users = []
         self._channels = {}
+        self.join_pipeline.stop()
 
         self.factory.clientConnected()
 
@@ -226,11 +370,16 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
                     self.sendLine(line.replace("{NICK}", self.get_nickname()),
                                   output=True)
 
-            reactor.callLater(5, do_channel_joins)
+            reactor.callLater(
+                self.config.get("join_pipeline", {}).get("initial_delay", 5),
+                do_channel_joins
+            )
 
         def do_channel_joins():
             for channel in self.config["channels"]:
-                self.join_channel(channel["name"], channel["key"])
+                self.join_pipeline.queue(channel["name"], channel["key"])
+
+            self.join_pipeline.start()
 
             _event = general_events.PostSetupEvent(self, self.config)
             self.event_manager.run_callback("PostSetup", _event)
@@ -259,6 +408,7 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
         chan_obj = self.get_channel(channel)
         # User-tracking stuff:
         self.self_part_channel(chan_obj)
+        self.join_pipeline.parted(channel)
 
         event = irc_events.ChannelPartedEvent(self, chan_obj)
         self.event_manager.run_callback("IRC/ChannelParted", event)
@@ -272,6 +422,7 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
         channel_obj = self.get_channel(channel)
         # User-tracking stuff:
         self.self_part_channel(channel_obj)
+        self.join_pipeline.parted(channel)
 
         event = irc_events.KickedEvent(self, channel_obj, user_obj, message)
         self.event_manager.run_callback("IRC/SelfKicked", event)
@@ -305,11 +456,11 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
 
     # region Message events
 
-    def privmsg(self, user, channel, message):
+    def privmsg(self, user, channel, message, parsed=None):
         """ Called when we receive a message - channel or private. """
 
         try:
-            user_obj = self._get_user_from_user_string(user)
+            user_obj = self._get_user_from_user_string(user, parsed=parsed)
         except Exception:
             # Privmsg from the server itself and things (if that happens)
             self.log.trace(_("Message from irregular user: %s") % user)
@@ -371,11 +522,11 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
                 "MessageReceived", second_event
             )
 
-    def noticed(self, user, channel, message):
+    def noticed(self, user, channel, message, parsed=None):
         """ Called when we receive a notice - channel or private. """
 
         try:
-            user_obj = self._get_user_from_user_string(user)
+            user_obj = self._get_user_from_user_string(user, parsed=parsed)
         except Exception:
             # Notices from the server itself and things
             self.log.trace(_("Notice from irregular user: %s") % user)
@@ -403,35 +554,23 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
                                                       "notice")
         self.event_manager.run_callback("MessageReceived", second_event)
 
-    def ctcpQuery(self, user, channel, messages):
+    def ctcpQuery(self, user, channel, messages, parsed=None):
         """ Called when someone does a CTCP query - channel or private.
         Needs some param analysis."""
 
         message = messages[0]
         action, data = message[0].upper(), message[1]
 
-        should_block = False
         if self._ctcp_flood_enabled and action != "ACTION":
-            if self._ctcp_flood_last + self._ctcp_flood_time < time.time():
-                self.log.debug(
-                    _("First CTCP in over %s seconds - resetting counter") %
-                    self._ctcp_flood_time
-                )
-                # First CTCP in a while - reset counter
-                self._ctcp_flood_last = time.time()
-                self._ctcp_flood_count = 0
-
-            self._ctcp_flood_count += 1
-
-            if self._ctcp_flood_count > self._ctcp_flood_max_count:
-                self.log.info(_("Too many CTCPs received - blocking"))
-                # Received too many messages - block
-                should_block = True
-                # Reset timer so we continue blocking until the rate slows down
-                self._ctcp_flood_last = time.time()
+            # This is done before anything else, so that a flood costs us as
+            # little as possible
+            if not self._ctcp_flood_buckets.consume(user.split("@", 1)[-1]):
+                self.log.trace(_("Too many CTCPs received - dropping CTCP "
+                                 "from %s") % user)
+                return
 
         try:
-            user_obj = self._get_user_from_user_string(user)
+            user_obj = self._get_user_from_user_string(user, parsed=parsed)
         except Exception:
             # CTCP from the server itself and things (if that happens)
             self.log.trace(_("CTCP from irregular user: %s") % user)
@@ -444,8 +583,6 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
 
         event = irc_events.CTCPQueryEvent(self, user_obj, channel_obj,
                                           action, data)
-        if should_block:
-            event.cancelled = True
         self.event_manager.run_callback("IRC/CTCPQueryReceived", event)
 
         if action.upper() == "ACTION":
@@ -512,12 +649,16 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
                                            message)
         self.event_manager.run_callback("IRC/UserKicked", event)
 
-    def irc_QUIT(self, user, params):
+    def irc_QUIT(self, user, params, parsed=None):
         """ Called when someone else quits IRC. """
         quitmessage = params[0]
         self.log.info(_("%s has left IRC: %s") % (user, quitmessage))
         # User-tracking stuff
-        user_obj = self.get_user(fullname=user)
+        if parsed is not None and parsed.has_hostmask:
+            user_obj = self.get_user(nickname=parsed.nick,
+                                     ident=parsed.ident, host=parsed.host)
+        else:
+            user_obj = self.get_user(fullname=user)
         temp_chans = set(user_obj.channels)
         for channel in temp_chans:
             self.user_channel_part(user_obj, channel)
@@ -621,10 +762,11 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
     # typically call the ones above, such as joined() and useJoined().    #
     #######################################################################
 
-    def irc_JOIN(self, prefix, params):
+    def irc_JOIN(self, prefix, params, parsed=None):
         """ Called on any join message
         :param prefix: The user joining
         :param params: The channel(s?) joined
+        :param parsed: The parsed Message, if we have it
         """
         # irc.IRCClient.irc_JOIN(self, prefix, params)
         # Removed as we can do this better than the library
@@ -641,7 +783,10 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
             channel_obj = Channel(self, channel)
             self.set_channel(channel, channel_obj)
 
-        nickname, ident, host = self.utils.split_hostmask(prefix)
+        if parsed is not None and parsed.has_hostmask:
+            nickname, ident, host = parsed.nick, parsed.ident, parsed.host
+        else:
+            nickname, ident, host = self.utils.split_hostmask(prefix)
         user_obj = self.user_join_channel(nickname,
                                           ident,
                                           host,
@@ -651,7 +796,8 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
             # User-tracking stuff
             if self.ourselves is None:
                 self.ourselves = user_obj
-            self.send_who(channel)
+            # WHO requests are paced by the pipeline, rather than sent here
+            self.join_pipeline.joined(channel)
             # Call the self-joined-channel method manually, since we're no
             # longer calling the super method.
             self.joined(channel)
@@ -672,7 +818,7 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
 
         if not user_obj:
             user_obj = User(self, newnick, is_tracked=False)
-        user_obj.nickname = newnick
+        user_obj.nickname = intern_string(newnick)
 
         self.log.info(_("%s is now known as %s") % (oldnick, newnick))
 
@@ -801,6 +947,47 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
             event = irc_events.WHOReplyEvent(self, chan_obj, user_obj, data_)
             self.event_manager.run_callback("IRC/WHOReply", event)
 
+    def irc_354(self, prefix, params):
+        """ RPL_WHOSPCRPL - Called when we get a WHOX reply from the server.
+
+        We request the fields in joins.WHOX_FIELDS, which the server sends
+        back as: token, channel, ident, ip, host, server, nick, status,
+        account, realname
+        """
+
+        if len(params) < 11 or params[1] != WHOX_TOKEN:
+            # Not one of ours - someone else may be using WHOX
+            self.irc_unknown(prefix, "354", params)
+            return
+
+        (___, ___, channel, ident, ip, host, server, nick, status, account,
+         realname) = params[:11]
+
+        chan_obj = self.get_channel(channel)
+
+        if chan_obj is None:
+            # WHOX reply for a channel we're not in - doesn't matter for
+            #   user-tracking purposes.
+            return
+
+        # WHOX doesn't include the hop count, but channel_who_response
+        #   expects it in the gecos, like a normal WHO reply
+        self.channel_who_response(nick,
+                                  ident,
+                                  host,
+                                  server,
+                                  status,
+                                  "0 %s" % realname,
+                                  chan_obj)
+
+        user_obj = self.get_user(nickname=nick)
+        data_ = {"ident": ident, "host": host, "server": server,
+                 "status": status, "gecos": realname, "ip": ip,
+                 "account": None if account == "0" else account}
+
+        event = irc_events.WHOReplyEvent(self, chan_obj, user_obj, data_)
+        self.event_manager.run_callback("IRC/WHOReply", event)
+
     def irc_RPL_ENDOFWHO(self, *nargs):
         """ Called when the server's done spamming us with WHO replies. """
         data_ = nargs[1]
@@ -814,6 +1001,8 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
             event = irc_events.WHOReplyEndEvent(self, chan_obj)
             self.event_manager.run_callback("IRC/EndOfWHO", event)
 
+        self.join_pipeline.who_finished(channel)
+
     def irc_RPL_ISUPPORT(self, prefix, params):
         irc.IRCClient.irc_RPL_ISUPPORT(self, prefix, params)
         for param in params[1:-1]:
@@ -900,6 +1089,16 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
                                                            Channel(self,
                                                                    channel))
             self.event_manager.run_callback("IRC/InviteOnlyError", event)
+            self.join_pipeline.join_failed(channel)
+
+        elif command in ("ERR_CHANNELISFULL", "ERR_BANNEDFROMCHAN",
+                         "ERR_BADCHANNELKEY", "ERR_NOSUCHCHANNEL",
+                         "ERR_TOOMANYCHANNELS"):
+            channel = params[1]
+            self.log.warn(
+                _("Unable to join %s - %s") % (channel, params[-1]))
+
+            self.join_pipeline.join_failed(channel)
 
         elif command == "ERR_ALREADYREGISTRED":
             message = params[1]
@@ -1008,8 +1207,13 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
 
         return []
 
-    def _get_user_from_user_string(self, user_string, create_temp=True):
-        nick, ident, host = self.utils.split_hostmask(user_string)
+    def _get_user_from_user_string(self, user_string, create_temp=True,
+                                   parsed=None):
+        if parsed is not None and parsed.has_hostmask:
+            # Already split by the parser
+            nick, ident, host = parsed.nick, parsed.ident, parsed.host
+        else:
+            nick, ident, host = self.utils.split_hostmask(user_string)
         user = self.get_user(nickname=nick, ident=ident, host=host)
         if user is None and create_temp:
             user = User(self, nick, ident, host, is_tracked=False)
@@ -1115,7 +1319,7 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
                 self.log.debug(
                     _("Unexpected status in WHO response for user %s: %s") %
                     (user, s))
-        user.realname = gecos.split(" ")[-1]
+        user.realname = gecos.split(" ", 1)[-1]
 
     def user_channel_part(self, user, channel):
         """User-tracking related
@@ -1159,9 +1363,10 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
                 if not target:
                     return False
             else:
-                target = self.get_user(target)
-                if not target:
-                    target = User(self, target)
+                user = self.get_user(target)
+                if not user:
+                    user = User(self, target)
+                target = user
 
         if isinstance(target, User):
             self.send_notice(target, message, use_event)
@@ -1179,9 +1384,10 @@ class Protocol(irc.IRCClient, ChannelsProtocol):
                 if not target:
                     return False
             else:
-                target = self.get_user(target)
-                if not target:
-                    target = User(self, target)
+                user = self.get_user(target)
+                if not user:
+                    user = User(self, target)
+                target = user
 
         if isinstance(target, Channel) or isinstance(target, User):
             event = general_events.ActionSent(self, target, message)
@@ -15,11 +15,20 @@ class Rank(object):
     Note: A higher order means a lower rank, and vice-versa. This class
     overrides certain operators, and does so in terms of rank, not order.
     i.e. Rank("o","@","2") > Rank("v","+","5") == True
+
+    Users don't store Rank objects, they store a bitmask of Rank.bit values
+    for each channel they're in - see Ranks.from_bitmask().
     """
+
+    __slots__ = ("mode", "symbol", "order", "bit")
+
     def __init__(self, mode, symbol, order):
         self.mode = mode
         self.symbol = symbol
         self.order = order
+        # Lower order means higher rank, so the lowest set bit in a mask is
+        # always the highest rank
+        self.bit = 1 << int(order)
 
     def __str__(self):
         return "%s%s%s" % (self.mode, self.symbol, self.order)
@@ -68,6 +77,8 @@ class Rank(object):
 
 
 class Ranks(object):
+    __slots__ = ("_ranks_by_mode", "_ranks_by_symbol", "_ranks_by_order")
+
     def __init__(self):
         self._ranks_by_mode = {}
         self._ranks_by_symbol = {}
@@ -111,6 +122,46 @@ class Ranks(object):
             return self._ranks_by_order[order]
         return None
 
+    def from_bitmask(self, mask):
+        """
+        Get all of the ranks in a bitmask of Rank.bit values.
+
+        :param mask: The bitmask to decode
+        :return: A list of Rank objects, highest rank first
+        """
+
+        ranks = []
+
+        while mask:
+            bit = mask & -mask
+            rank = self.by_order(bit.bit_length() - 1)
+
+            if rank is not None:
+                ranks.append(rank)
+
+            mask ^= bit
+
+        return ranks
+
+    def highest_from_bitmask(self, mask):
+        """
+        Get the highest rank in a bitmask of Rank.bit values.
+
+        :param mask: The bitmask to check
+        :return: The highest Rank, or None if there aren't any
+        """
+
+        while mask:
+            bit = mask & -mask
+            rank = self.by_order(bit.bit_length() - 1)
+
+            if rank is not None:
+                return rank
+
+            mask ^= bit
+
+        return None
+
     def is_op(self, rank, or_above=True):
         op = self.by_mode("o")
         if or_above:
@@ -5,24 +5,41 @@ from system.protocols.generic import user
 from system.protocols.irc.channel import Channel
 
 from system.translations import Translations
+from utils.strings import intern_string
 _ = Translations().get()
 
 
 class User(user.User):
+    # Nicks, idents and hosts are interned, as they're heavily repeated on
+    # large networks (think "~user" and cloaked hosts).
+    #
+    # Rather than a set of channels and a dict of ranks, each user has a
+    # single dict of memberships, mapping the Channel object to a bitmask of
+    # the user's ranks in that channel - see Ranks.from_bitmask().
+    __slots__ = ("ident", "host", "realname", "is_oper", "_memberships")
+
     def __init__(self, protocol, nickname, ident=None, host=None,
                  realname=None, is_oper=False, is_tracked=False):
-        super(User, self).__init__(nickname, protocol, is_tracked)
-        self.ident = ident
-        self.host = host
+        super(User, self).__init__(intern_string(nickname), protocol,
+                                   is_tracked)
+        self.ident = intern_string(ident)
+        self.host = intern_string(host)
         self.realname = realname
         self.is_oper = is_oper
-        self.channels = set()
-        self._ranks = {}
+        self._memberships = {}
 
     @property
     def fullname(self):
         return "%s!%s@%s" % (self.nickname, self.ident, self.host)
 
+    @property
+    def channels(self):
+        """
+        A set-like view of the Channel objects this user is in.
+        """
+
+        return self._memberships.viewkeys()
+
     def __str__(self):
         return str(self.nickname)
 
@@ -30,52 +47,55 @@ class User(user.User):
         self.away = away
 
     def add_channel(self, channel):
-        self.channels.add(channel)
+        self._memberships.setdefault(channel, 0)
 
     def remove_channel(self, channel):
         try:
-            self.channels.remove(channel)
+            del self._memberships[channel]
         except KeyError:
             self.protocol.log.debug(
                 _("Tried to remove non-existent channel \"%s\" from user "
                   "\"%s\"")
                 % (channel, self))
 
+    def _get_membership_channel(self, channel):
+        if not isinstance(channel, Channel):
+            channel = self.protocol.get_channel(channel)
+        return channel
+
     def get_ranks_in_channel(self, channel):
-        if isinstance(channel, Channel):
-            channel = channel.name
-        channel = self.protocol.utils.lowercase_nick_chan(channel)
-        try:
-            return self._ranks[channel]
-        except KeyError:
+        channel = self._get_membership_channel(channel)
+        mask = self._memberships.get(channel, 0)
+
+        if not mask:
             return []
+        return self.protocol.ranks.from_bitmask(mask)
 
     def get_highest_rank_in_channel(self, channel):
-        ranks = self.get_ranks_in_channel(channel)
-        highest_rank = None
-        for rank in ranks:
-            if rank > highest_rank:
-                highest_rank = rank
-        return highest_rank
+        channel = self._get_membership_channel(channel)
+        mask = self._memberships.get(channel, 0)
+
+        if not mask:
+            return None
+        return self.protocol.ranks.highest_from_bitmask(mask)
 
     def add_rank_in_channel(self, channel, rank):
-        if isinstance(channel, Channel):
-            channel = channel.name
-        channel = self.protocol.utils.lowercase_nick_chan(channel)
-        if channel not in self._ranks:
-            self._ranks[channel] = set()
-        self._ranks[channel].add(rank)
+        channel = self._get_membership_channel(channel)
+
+        if channel not in self._memberships:
+            self.protocol.log.debug(
+                _("Tried to add rank \"%s\" to user \"%s\" in a channel "
+                  "they aren't in: \"%s\"")
+                % (rank, self, channel))
+            return
+
+        self._memberships[channel] |= rank.bit
 
     def remove_rank_in_channel(self, channel, rank):
-        if isinstance(channel, Channel):
-            channel = channel.name
-        channel = self.protocol.utils.lowercase_nick_chan(channel)
-        try:
-            self._ranks[channel].remove(rank)
-        except KeyError:
-            # Note: This can be thrown either by the dict lookup or the set
-            # - remove()
-            pass
+        channel = self._get_membership_channel(channel)
+
+        if channel in self._memberships:
+            self._memberships[channel] &= ~rank.bit
 
     def respond(self, message):
         message = message.replace("{CHARS}", self.protocol.control_chars)
@@ -0,0 +1,395 @@
+# coding=utf-8
+
+"""
+Audio playback for the Mumble protocol.
+
+A `Player` takes raw PCM - signed 16-bit native-endian, 48kHz mono unless
+you say otherwise - from a source, cuts it into 10ms or 20ms frames, encodes
+them with Opus and sends them as voice packets, one frame per packet.
+
+Sources can be a file (or anything with a `read()` method), the output of a
+process (use `ProcessSource.spawn()`, for example to have ffmpeg decode
+something for you) or a generator of strings. The player pulls a frame from
+its source each time one is due, so a source that falls behind just causes
+an underrun - a gap in the audio - rather than a delay.
+
+Packets are paced against the time playback started, rather than the time
+the last one was sent, so timer jitter doesn't build up into drift.
+
+Remember that the server won't pass our voice on while we're muted, so
+you'll want to set `should_mute_self` to false in the protocol's config.
+"""
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import ProcessProtocol
+
+from system.logging.logger import getLogger
+from system.protocols.mumble.udp import UDP_OPUS
+from system.translations import Translations
+
+from utils.opus.encoder import Encoder
+from utils.opus.lib import AVAILABLE as OPUS_AVAILABLE, APPLICATION_AUDIO
+from utils.protobuf import write_varint
+
+__author__ = 'Gareth Coles'
+_ = Translations().get()
+
+#: Set on the length of the last frame, to tell clients we've stopped talking
+TERMINATOR = 0x2000
+
+#: Frame lengths Mumble clients understand, in milliseconds
+FRAME_LENGTHS = (10, 20)
+
+
+class FileSource(object):
+    """
+    PCM from a file, or any other object with a `read()` method.
+    """
+
+    def __init__(self, source):
+        if isinstance(source, basestring):
+            source = open(source, "rb")
+
+        self.file = source
+        self.finished = False
+
+    def read(self, size):
+        data = self.file.read(size)
+
+        if len(data) < size:
+            self.finished = True
+
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class GeneratorSource(object):
+    """
+    PCM from a generator (or any other iterable) of strings, which may be
+    any length.
+
+    A generator can yield an empty string if it doesn't have anything ready,
+    which is counted as an underrun.
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.buffer = bytearray()
+        self.ended = False
+
+    @property
+    def finished(self):
+        return self.ended and not self.buffer
+
+    def read(self, size):
+        buf = self.buffer
+
+        while len(buf) < size and not self.ended:
+            try:
+                chunk = next(self.iterator)
+            except StopIteration:
+                self.ended = True
+                break
+
+            if not chunk:
+                break
+
+            buf.extend(chunk)
+
+        data = bytes(buf[:size])
+        del buf[:size]
+
+        return data
+
+    def close(self):
+        self.ended = True
+
+        if hasattr(self.iterator, "close"):
+            self.iterator.close()
+
+
+class ProcessSource(ProcessProtocol):
+    """
+    PCM from the standard output of a process.
+
+    Output is buffered as it arrives; if the process produces it faster than
+    we play it, we stop reading from it until we've caught up.
+    """
+
+    #: How much output to buffer before we stop reading, in bytes
+    MAX_BUFFER = 48000 * 2 * 5
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.ended = False
+        self.paused = False
+
+    @property
+    def finished(self):
+        return self.ended and not self.buffer
+
+    @classmethod
+    def spawn(cls, args, env=None, path=None):
+        """
+        Start a process, and return a source that plays its output.
+
+        :param args: The process' arguments, starting with the executable
+        """
+
+        source = cls()
+        reactor.spawnProcess(
+            source, args[0], args, env=env, path=path,
+            childFDs={0: "w", 1: "r", 2: 2}
+        )
+
+        return source
+
+    def outReceived(self, data):
+        self.buffer.extend(data)
+
+        if len(self.buffer) > self.MAX_BUFFER and not self.paused:
+            self.paused = True
+            self.transport.pauseProducing()
+
+    def processEnded(self, reason):
+        self.ended = True
+
+    def read(self, size):
+        buf = self.buffer
+
+        data = bytes(buf[:size])
+        del buf[:size]
+
+        if self.paused and len(buf) < self.MAX_BUFFER // 2:
+            self.paused = False
+            self.transport.resumeProducing()
+
+        return data
+
+    def close(self):
+        if not self.ended:
+            self.ended = True
+            self.transport.signalProcess("TERM")
+
+
+class PlaybackStats(object):
+    """
+    How playback went.
+
+    underruns: Frames that weren't ready when they were due
+    late_frames: Frames sent more than a frame's length late
+    jitter_avg: Average difference between when frames were due and when
+        they were sent, in milliseconds
+    jitter_max: The largest such difference, in milliseconds
+    """
+
+    __slots__ = ("frames_sent", "bytes_sent", "underruns", "late_frames",
+                 "resets", "jitter_avg", "jitter_max")
+
+    def __init__(self):
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.underruns = 0
+        self.late_frames = 0
+        self.resets = 0
+        self.jitter_avg = 0.0
+        self.jitter_max = 0.0
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            self.__class__.__name__,
+            ", ".join(
+                "%s=%s" % (name, getattr(self, name))
+                for name in self.__slots__
+            )
+        )
+
+
+class Player(object):
+    """
+    Plays audio from a source over a Mumble connection.
+
+    Call `play()` to start - it returns a Deferred that fires with the
+    player's stats once the source runs out, or once `stop()` is called.
+    """
+
+    #: If we fall this many frames behind, give up on catching up and
+    #: start counting again from now
+    MAX_LATE_FRAMES = 10
+
+    def __init__(self, protocol, source, frame_length=20, target=0,
+                 sample_rate=48000, channels=1, bitrate=None, encoder=None,
+                 clock=None):
+        if frame_length not in FRAME_LENGTHS:
+            raise ValueError(
+                "Frame length must be one of %s" % (FRAME_LENGTHS,)
+            )
+
+        self.protocol = protocol
+        self.source = source
+        self.target = target
+        self.clock = clock or reactor
+
+        self.frame_length = frame_length
+        self.interval = frame_length / 1000.0
+        self.samples_per_frame = sample_rate * frame_length // 1000
+        self.frame_bytes = self.samples_per_frame * channels * 2
+
+        if encoder is None:
+            if not OPUS_AVAILABLE:
+                raise RuntimeError("libopus is not installed")
+
+            encoder = Encoder(sample_rate, channels, APPLICATION_AUDIO)
+
+            if bitrate is not None:
+                encoder.set_bitrate(bitrate)
+
+        self.encoder = encoder
+
+        self.stats = PlaybackStats()
+        self.playing = False
+
+        self._header = chr(UDP_OPUS << 5 | target)
+        self._sequence = 0
+        self._frames = 0
+        self._ticks = 0
+        self._started = None
+        self._call = None
+        self._deferred = None
+
+        self.log = getLogger("%s/Audio" % protocol.name)
+
+    def play(self):
+        if self.playing:
+            return self._deferred
+
+        self.playing = True
+        self._deferred = Deferred()
+
+        self._started = self.clock.seconds()
+        self._frames = 0
+        self._call = self.clock.callLater(0, self._tick)
+
+        return self._deferred
+
+    def stop(self):
+        """
+        Stop playing, without waiting for the source to run out.
+        """
+
+        if not self.playing:
+            return
+
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+
+        self._call = None
+        self._finish(True)
+
+    def _tick(self):
+        self._call = None
+
+        now = self.clock.seconds()
+        due = self._started + self._frames * self.interval
+        stats = self.stats
+
+        # Jitter, as a running average
+        self._ticks += 1
+        jitter = abs(now - due) * 1000
+        stats.jitter_avg += (jitter - stats.jitter_avg) / self._ticks
+        stats.jitter_max = max(stats.jitter_max, jitter)
+
+        if now - due > self.interval:
+            stats.late_frames += 1
+
+        if now - due > self.interval * self.MAX_LATE_FRAMES:
+            # We're hopelessly behind - most likely the reactor was blocked
+            # - so don't try to send everything we missed all at once
+            stats.resets += 1
+            self._started = now
+            self._frames = 0
+
+        try:
+            frame = self.source.read(self.frame_bytes)
+        except Exception:
+            self.log.exception(_("Error reading audio"))
+            self._finish(True)
+            return
+
+        finished = self.source.finished
+
+        if len(frame) < self.frame_bytes:
+            if finished:
+                if frame:
+                    # Pad the end with silence
+                    frame += "\0" * (self.frame_bytes - len(frame))
+            else:
+                # We don't have enough - just skip this frame, and put back
+                # what we did read if we can
+                stats.underruns += 1
+                self._unread(frame)
+                frame = None
+
+        if frame:
+            self._send(frame, finished)
+
+        if finished:
+            self._finish(not frame)
+            return
+
+        self._frames += 1
+        delay = self._started + self._frames * self.interval - now
+        self._call = self.clock.callLater(max(0, delay), self._tick)
+
+    def _unread(self, data):
+        # Sources with a buffer (ours, and the receiver's PCMStreams) can
+        # have a partial frame put back; for anything else, it's lost
+        buf = getattr(self.source, "buffer", None)
+
+        if data and isinstance(buf, bytearray):
+            buf[0:0] = data
+
+    def _send(self, frame, last):
+        try:
+            encoded = self.encoder.encode(frame, self.samples_per_frame)
+        except Exception:
+            self.log.exception(_("Error encoding audio"))
+            return
+
+        length = len(encoded)
+
+        if last:
+            length |= TERMINATOR
+
+        packet = bytearray(self._header)
+        write_varint(self._sequence, packet)
+        write_varint(length, packet)
+
+        self.protocol.send_voice(bytes(packet) + encoded)
+
+        # Sequence numbers count 10ms frames
+        self._sequence += self.frame_length // 10
+
+        self.stats.frames_sent += 1
+        self.stats.bytes_sent += len(encoded)
+
+    def _finish(self, terminate):
+        if terminate and self.stats.frames_sent:
+            # Tell everyone we're done talking, if we didn't manage to with
+            # the last frame
+            self._send("\0" * self.frame_bytes, True)
+
+        self.playing = False
+
+        try:
+            self.source.close()
+        except Exception:
+            self.log.exception(_("Error closing audio source"))
+
+        deferred, self._deferred = self._deferred, None
+
+        if deferred is not None:
+            deferred.callback(self.stats)
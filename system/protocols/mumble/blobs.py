@@ -0,0 +1,333 @@
+# coding=utf-8
+
+"""
+Avatars and comments for the Mumble protocol, fetched only when asked for.
+
+The server tells us the SHA1 hash of each user's avatar and comment, and
+sometimes the whole thing too. We only keep the hashes on the users - the
+blobs themselves go into a cache shared by the whole connection, keyed by
+hash, so users with the same avatar share it. The cache is bounded by the
+total size of what's in it; anything pushed out can optionally be written to
+a directory, and read back from there if it's asked for again.
+
+If a plugin asks for a blob we don't have, we request it from the server
+with a RequestBlob message - requests made at the same time are sent
+together, and requests for a blob we're already waiting for are merged.
+"""
+
+import hashlib
+import os
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+
+from system.protocols.mumble import Mumble_pb2
+
+__author__ = 'Gareth Coles'
+
+AVATAR = "avatar"
+COMMENT = "comment"
+
+
+def blob_hash(data):
+    """
+    Hash a blob the way Mumble does.
+    """
+
+    return hashlib.sha1(data).digest()
+
+
+class BlobCache(object):
+    """
+    A least-recently-used cache of blobs, keyed by hash and bounded by the
+    total size of the blobs in it.
+
+    :param max_size: The most bytes to keep in memory
+    :param directory: Somewhere to write blobs pushed out of memory, if
+        they should be kept on disk
+    :param max_disk_size: The most bytes to keep in the directory
+    """
+
+    def __init__(self, max_size=4 * 1024 * 1024, directory=None,
+                 max_disk_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+
+        self.directory = directory
+        self.max_disk_size = max_disk_size
+        self.disk_size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        self._blobs = OrderedDict()
+        self._disk = OrderedDict()  # hash -> size, oldest first
+
+        if directory is not None:
+            self._load_directory()
+
+    def __contains__(self, key):
+        return key in self._blobs or key in self._disk
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def get(self, key):
+        """
+        Get a blob.
+
+        :return: The blob, or None if we don't have it
+        """
+
+        data = self._blobs.pop(key, None)
+
+        if data is not None:
+            self._blobs[key] = data
+            self.hits += 1
+            return data
+
+        if key in self._disk:
+            data = self._read(key)
+
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.put(key, data)
+
+        return data
+
+    def put(self, key, data):
+        if key in self._blobs:
+            self.size -= len(self._blobs.pop(key))
+
+        self._blobs[key] = data
+        self.size += len(data)
+
+        self._evict()
+
+    def clear(self):
+        self._blobs.clear()
+        self.size = 0
+
+    def _evict(self):
+        while self.size > self.max_size and self._blobs:
+            key, data = self._blobs.popitem(last=False)
+            self.size -= len(data)
+
+            if self.directory is not None:
+                self._write(key, data)
+
+    # Disk
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.encode("hex"))
+
+    def _load_directory(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        entries = []
+
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+
+            try:
+                key = filename.decode("hex")
+                stat = os.stat(path)
+            except (TypeError, OSError):
+                continue
+
+            entries.append((stat.st_mtime, key, stat.st_size))
+
+        for __, key, size in sorted(entries):
+            self._disk[key] = size
+            self.disk_size += size
+
+        self._evict_disk()
+
+    def _read(self, key):
+        size = self._disk.pop(key)
+        self.disk_size -= size
+
+        try:
+            with open(self._path(key), "rb") as fh:
+                data = fh.read()
+        except IOError:
+            return None
+
+        # It's back in memory now, but it'll stay on disk too
+        self._disk[key] = size
+        self.disk_size += size
+
+        return data
+
+    def _write(self, key, data):
+        if key in self._disk:
+            # Already there - just mark it as recently used
+            self._disk[key] = self._disk.pop(key)
+            return
+
+        try:
+            with open(self._path(key), "wb") as fh:
+                fh.write(data)
+        except IOError:
+            return
+
+        self._disk[key] = len(data)
+        self.disk_size += len(data)
+
+        self._evict_disk()
+
+    def _evict_disk(self):
+        while self.disk_size > self.max_disk_size and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self.disk_size -= size
+
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+class BlobFetcher(object):
+    """
+    Fetches avatars and comments for a protocol, through its blob cache.
+    """
+
+    #: How long to wait for the server to send a blob, in seconds
+    TIMEOUT = 30
+
+    def __init__(self, protocol, cache, clock=None):
+        self.protocol = protocol
+        self.cache = cache
+        self.clock = clock or reactor
+
+        self.pending = {}  # (kind, hash) -> [Deferred]
+        self.timeouts = {}  # (kind, hash) -> DelayedCall
+        self.requests = {AVATAR: set(), COMMENT: set()}  # kind -> sessions
+
+        self._send_call = None
+
+    def received(self, kind, data, key=None):
+        """
+        Store a blob the server sent us, and hand it to anyone waiting.
+
+        :return: The blob's hash
+        """
+
+        if kind == COMMENT and isinstance(data, unicode):
+            data = data.encode("utf-8")
+
+        if key is None:
+            key = blob_hash(data)
+
+        self.cache.put(key, data)
+
+        timeout = self.timeouts.pop((kind, key), None)
+
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+
+        for deferred in self.pending.pop((kind, key), []):
+            deferred.callback(self._decode(kind, data))
+
+        return key
+
+    def cached(self, kind, key):
+        """
+        Get a blob if we already have it, without fetching it.
+        """
+
+        if not key:
+            return None
+
+        data = self.cache.get(key)
+
+        if data is None:
+            return None
+
+        return self._decode(kind, data)
+
+    def fetch(self, user, kind):
+        """
+        Get a user's avatar or comment, from the server if we need to.
+
+        :return: A Deferred that fires with the blob, or None if the user
+            doesn't have one or the server doesn't send it
+        """
+
+        key = user.avatar_hash if kind == AVATAR else user.comment_hash
+
+        if not key:
+            return succeed(None)
+
+        data = self.cached(kind, key)
+
+        if data is not None:
+            return succeed(data)
+
+        deferred = Deferred()
+        waiting = self.pending.setdefault((kind, key), [])
+        waiting.append(deferred)
+
+        if len(waiting) == 1:
+            self.requests[kind].add(user.session)
+
+            if self._send_call is None:
+                self._send_call = self.clock.callLater(0, self.send_requests)
+
+            self.timeouts[(kind, key)] = self.clock.callLater(
+                self.TIMEOUT, self._timeout, kind, key
+            )
+
+        return deferred
+
+    def send_requests(self):
+        self._send_call = None
+
+        if not (self.requests[AVATAR] or self.requests[COMMENT]):
+            return
+
+        message = Mumble_pb2.RequestBlob()
+        message.session_texture.extend(sorted(self.requests[AVATAR]))
+        message.session_comment.extend(sorted(self.requests[COMMENT]))
+
+        self.requests[AVATAR].clear()
+        self.requests[COMMENT].clear()
+
+        self.protocol.sendProtobuf(message)
+
+    def clear(self):
+        if self._send_call is not None and self._send_call.active():
+            self._send_call.cancel()
+
+        self._send_call = None
+
+        for kind in self.requests:
+            self.requests[kind].clear()
+
+        for timeout in self.timeouts.itervalues():
+            if timeout.active():
+                timeout.cancel()
+
+        self.timeouts.clear()
+        pending, self.pending = self.pending, {}
+
+        for deferreds in pending.itervalues():
+            for deferred in deferreds:
+                deferred.callback(None)
+
+    def _timeout(self, kind, key):
+        del self.timeouts[(kind, key)]
+
+        for deferred in self.pending.pop((kind, key), []):
+            deferred.callback(None)
+
+    def _decode(self, kind, data):
+        if kind == COMMENT:
+            return data.decode("utf-8")
+        return data
@@ -8,6 +8,8 @@ _ = Translations().get()
 
 
 class Channel(channel.Channel):
+    __slots__ = ("channel_id", "parent", "position", "links")
+
     def __init__(self, protocol, channel_id, name, parent, position, links):
         super(Channel, self).__init__(name, protocol)
         self.channel_id = channel_id
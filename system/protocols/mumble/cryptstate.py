@@ -0,0 +1,337 @@
+# coding=utf-8
+
+"""
+OCB2-AES128, as used to encrypt Mumble's UDP voice packets.
+
+This follows Mumble's own CryptState - the key and nonces come from the
+server's CryptSetup message, and each packet starts with a four-byte header
+made up of the low byte of its IV and the first three bytes of its tag.
+Packets that arrive late or out of order are still accepted, as long as
+they're not too far out and we haven't seen them before.
+
+Blocks are handled as 128-bit integers, and all of the full blocks in a
+packet go through AES in one call, so this is reasonably quick for pure
+Python - a voice packet is only a few blocks long anyway.
+"""
+
+from binascii import hexlify, unhexlify
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, \
+        modes
+except ImportError:  # pragma: no cover
+    Cipher = None
+
+__author__ = 'Gareth Coles'
+
+#: Whether we're able to encrypt anything - UDP is disabled if not
+AVAILABLE = Cipher is not None
+
+BLOCK_SIZE = 16
+
+_MASK = (1 << 128) - 1
+
+
+def _to_int(data):
+    return int(hexlify(data), 16)
+
+
+def _to_bytes(value, length):
+    return unhexlify("%0*x" % (length * 2, value))
+
+
+def _s2(block):
+    # Multiply by two in GF(2^128)
+    if block >> 127:
+        return ((block << 1) & _MASK) ^ 0x87
+    return block << 1
+
+
+def _s3(block):
+    return block ^ _s2(block)
+
+
+def _fold(value):
+    # XOR together every 128-bit block in a number
+    checksum = 0
+
+    while value:
+        checksum ^= value & _MASK
+        value >>= 128
+
+    return checksum
+
+
+class CryptState(object):
+    """
+    Encryption state for one direction-pair of a Mumble UDP connection.
+
+    Call `set_key()` with the values from the server's CryptSetup message
+    before using it. The *good*, *late*, *lost* and *resync* counters are
+    what Mumble expects in our TCP pings.
+    """
+
+    def __init__(self):
+        self.key = None
+
+        self.encrypt_iv = bytearray(BLOCK_SIZE)
+        self.decrypt_iv = bytearray(BLOCK_SIZE)
+        self.decrypt_history = bytearray(256)
+
+        self.good = 0
+        self.late = 0
+        self.lost = 0
+        self.resync = 0
+
+        self._encrypt_block = None
+        self._decrypt_block = None
+
+    @property
+    def is_valid(self):
+        return self.key is not None
+
+    def set_key(self, key, encrypt_iv, decrypt_iv):
+        """
+        Set up the key and nonces.
+
+        For a client, *encrypt_iv* is the CryptSetup's client nonce and
+        *decrypt_iv* is its server nonce - the server does the opposite.
+        """
+
+        if not AVAILABLE:
+            raise RuntimeError("The cryptography package is not installed")
+
+        for value in (key, encrypt_iv, decrypt_iv):
+            if len(value) != BLOCK_SIZE:
+                raise ValueError("Keys and nonces must be 16 bytes long")
+
+        cipher = Cipher(
+            algorithms.AES(bytes(key)), modes.ECB(), backend=default_backend()
+        )
+
+        self._encrypt_block = cipher.encryptor().update
+        self._decrypt_block = cipher.decryptor().update
+
+        self.key = bytes(key)
+        self.encrypt_iv = bytearray(encrypt_iv)
+        self.decrypt_iv = bytearray(decrypt_iv)
+        self.decrypt_history = bytearray(256)
+
+    def set_decrypt_iv(self, iv):
+        """
+        Resynchronise with the server, after it's sent us a new nonce.
+        """
+
+        if len(iv) != BLOCK_SIZE:
+            raise ValueError("Nonces must be 16 bytes long")
+
+        self.decrypt_iv = bytearray(iv)
+        self.resync += 1
+
+    def encrypt(self, plain):
+        """
+        Encrypt a packet.
+
+        :param plain: The packet to encrypt, as a string
+        :return: The encrypted packet, including its four-byte header
+        """
+
+        iv = self.encrypt_iv
+
+        for x in xrange(BLOCK_SIZE):
+            iv[x] = (iv[x] + 1) & 0xFF
+
+            if iv[x]:
+                break
+
+        encrypted, tag = self.ocb_encrypt(bytes(plain), bytes(iv))
+        return chr(iv[0]) + tag[:3] + encrypted
+
+    def decrypt(self, data):
+        """
+        Decrypt a packet, updating the good/late/lost counters.
+
+        :param data: The encrypted packet, including its header
+        :return: The decrypted packet, or None if it's invalid or a replay
+        """
+
+        if len(data) < 4:
+            return None
+
+        data = bytes(data)
+        iv = self.decrypt_iv
+        saved = bytearray(iv)
+        iv_byte = ord(data[0])
+        restore = False
+        late = 0
+        lost = 0
+
+        if (iv[0] + 1) & 0xFF == iv_byte:
+            # In order, as expected
+            if iv_byte > iv[0]:
+                iv[0] = iv_byte
+            elif iv_byte < iv[0]:
+                iv[0] = iv_byte
+
+                for x in xrange(1, BLOCK_SIZE):
+                    iv[x] = (iv[x] + 1) & 0xFF
+
+                    if iv[x]:
+                        break
+            else:
+                return None
+        else:
+            # Either out of order, or a repeat
+            diff = iv_byte - iv[0]
+
+            if diff > 128:
+                diff -= 256
+            elif diff < -128:
+                diff += 256
+
+            if iv_byte < iv[0] and -30 < diff < 0:
+                # Late, but no wraparound
+                late = 1
+                lost = -1
+                iv[0] = iv_byte
+                restore = True
+            elif iv_byte > iv[0] and -30 < diff < 0:
+                # Late, from before the last wraparound
+                late = 1
+                lost = -1
+                iv[0] = iv_byte
+
+                for x in xrange(1, BLOCK_SIZE):
+                    iv[x] = (iv[x] - 1) & 0xFF
+
+                    if iv[x] != 0xFF:
+                        break
+
+                restore = True
+            elif iv_byte > iv[0] and diff > 0:
+                # We lost a few packets
+                lost = iv_byte - iv[0] - 1
+                iv[0] = iv_byte
+            elif iv_byte < iv[0] and diff > 0:
+                # We lost a few packets, and wrapped around
+                lost = 256 - iv[0] + iv_byte - 1
+                iv[0] = iv_byte
+
+                for x in xrange(1, BLOCK_SIZE):
+                    iv[x] = (iv[x] + 1) & 0xFF
+
+                    if iv[x]:
+                        break
+            else:
+                return None
+
+            if self.decrypt_history[iv[0]] == iv[1]:
+                # We've seen this one before
+                self.decrypt_iv = saved
+                return None
+
+        plain, tag = self.ocb_decrypt(data[4:], bytes(iv))
+
+        if tag[:3] != data[1:4]:
+            self.decrypt_iv = saved
+            return None
+
+        self.decrypt_history[iv[0]] = iv[1]
+
+        if restore:
+            self.decrypt_iv = saved
+
+        self.good += 1
+        self.late += late
+        self.lost += lost
+
+        return plain
+
+    def _deltas(self, nonce, blocks):
+        # The offsets for each full block, joined into one number, and the
+        # offset for the final block
+        delta = _to_int(self._encrypt_block(nonce))
+        joined = 0
+
+        for _ in xrange(blocks):
+            delta = _s2(delta)
+            joined = (joined << 128) | delta
+
+        return joined, _s2(delta)
+
+    def ocb_encrypt(self, plain, nonce):
+        """
+        Encrypt a string with OCB2.
+
+        :return: A tuple of (encrypted string, 16-byte tag)
+        """
+
+        length = len(plain)
+        blocks = max(0, (length - 1) // BLOCK_SIZE)
+        body_length = blocks * BLOCK_SIZE
+        final_length = length - body_length
+
+        deltas, delta = self._deltas(nonce, blocks)
+        checksum = 0
+        encrypted = ""
+
+        if blocks:
+            body = _to_int(plain[:body_length])
+            checksum = _fold(body)
+
+            crypted = self._encrypt_block(
+                _to_bytes(body ^ deltas, body_length)
+            )
+            encrypted = _to_bytes(_to_int(crypted) ^ deltas, body_length)
+
+        pad = self._encrypt_block(
+            _to_bytes(delta ^ (final_length * 8), BLOCK_SIZE)
+        )
+        final = _to_int(plain[body_length:] + pad[final_length:])
+        checksum ^= final
+
+        encrypted += _to_bytes(final ^ _to_int(pad), BLOCK_SIZE)[
+            :final_length
+        ]
+
+        tag = self._encrypt_block(_to_bytes(_s3(delta) ^ checksum, BLOCK_SIZE))
+        return encrypted, tag
+
+    def ocb_decrypt(self, encrypted, nonce):
+        """
+        Decrypt a string with OCB2.
+
+        :return: A tuple of (decrypted string, 16-byte tag)
+        """
+
+        length = len(encrypted)
+        blocks = max(0, (length - 1) // BLOCK_SIZE)
+        body_length = blocks * BLOCK_SIZE
+        final_length = length - body_length
+
+        deltas, delta = self._deltas(nonce, blocks)
+        checksum = 0
+        plain = ""
+
+        if blocks:
+            decrypted = self._decrypt_block(
+                _to_bytes(_to_int(encrypted[:body_length]) ^ deltas,
+                          body_length)
+            )
+            body = _to_int(decrypted) ^ deltas
+            checksum = _fold(body)
+            plain = _to_bytes(body, body_length)
+
+        pad = self._encrypt_block(
+            _to_bytes(delta ^ (final_length * 8), BLOCK_SIZE)
+        )
+        final = _to_int(
+            encrypted[body_length:] + "\0" * (BLOCK_SIZE - final_length)
+        ) ^ _to_int(pad)
+        checksum ^= final
+
+        plain += _to_bytes(final, BLOCK_SIZE)[:final_length]
+
+        tag = self._encrypt_block(_to_bytes(_s3(delta) ^ checksum, BLOCK_SIZE))
+        return plain, tag
@@ -0,0 +1,208 @@
+# coding=utf-8
+
+"""
+Caching our own permissions for the Mumble protocol.
+
+Mumble servers don't tell us our permissions up-front - we have to ask, one
+channel at a time, with a PermissionQuery message, and the server answers
+with a bitmask of `Perms`. We keep the answers per channel, so checks like
+"can we kick here?" are answered locally with a bit of masking.
+
+The server tells us when our permissions may have changed (when an ACL or a
+group is edited, for example) by setting the flush flag on a PermissionQuery
+- everything we have is thrown away then, and fetched again for the channels
+we care about. Those are the channel we're in and every channel below it,
+which are fetched whenever we join or move, so they're normally ready before
+anyone asks. Queries made at the same time are sent together, a few at a
+time, and queries for a channel we're already waiting on are merged.
+
+Kicking and banning are only ever checked in the root channel, as Murmur
+does.
+"""
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+
+from system.protocols.mumble import Mumble_pb2
+from system.protocols.mumble.acl import Perms
+
+__author__ = 'Gareth Coles'
+
+ROOT_CHANNEL = 0
+
+
+class PermissionCache(object):
+    """
+    Our permissions in each channel, as far as we know them.
+
+    :param protocol: The protocol - we call its `sendProtobuf()`
+    """
+
+    #: The most queries to send at once
+    BATCH_SIZE = 20
+
+    #: How long to wait between batches, in seconds
+    BATCH_INTERVAL = 0.5
+
+    #: How long to wait for the server to answer a query, in seconds
+    TIMEOUT = 30
+
+    def __init__(self, protocol, clock=None):
+        self.protocol = protocol
+        self.clock = clock or reactor
+
+        self.permissions = {}  # channel ID -> Perms bitmask
+        self.pending = {}  # channel ID -> [Deferred]
+        self.timeouts = {}  # channel ID -> DelayedCall
+        self.queue = []  # channel IDs, in the order they were asked for
+
+        self.queries = 0
+        self.flushes = 0
+
+        self._send_call = None
+
+    def __contains__(self, channel_id):
+        return channel_id in self.permissions
+
+    def get(self, channel_id):
+        """
+        Get our permissions in a channel, if we have them.
+
+        :return: A Perms bitmask, or None if we don't know them yet
+        """
+
+        return self.permissions.get(channel_id)
+
+    def has(self, channel_id, *perms):
+        """
+        Check whether we have all of the given permissions in a channel.
+
+        If we don't know our permissions there yet, they're fetched for
+        next time - but we say we don't have them for now.
+        """
+
+        permissions = self.permissions.get(channel_id)
+
+        if permissions is None:
+            self.query(channel_id)
+            return False
+
+        wanted = Perms.get_permissions_int(*perms)
+        return permissions & wanted == wanted
+
+    def set(self, channel_id, permissions, flush=False):
+        """
+        Store the permissions the server sent us, and hand them to anyone
+        waiting.
+        """
+
+        if flush:
+            self.flushes += 1
+            self.permissions.clear()
+
+        self.permissions[channel_id] = permissions
+
+        timeout = self.timeouts.pop(channel_id, None)
+
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+
+        for deferred in self.pending.pop(channel_id, []):
+            deferred.callback(permissions)
+
+    def remove(self, channel_id):
+        self.permissions.pop(channel_id, None)
+
+    def fetch(self, channel_id):
+        """
+        Get our permissions in a channel, from the server if we need to.
+
+        :return: A Deferred that fires with a Perms bitmask, or None if the
+            server doesn't answer
+        """
+
+        permissions = self.permissions.get(channel_id)
+
+        if permissions is not None:
+            return succeed(permissions)
+
+        deferred = Deferred()
+        self.pending.setdefault(channel_id, []).append(deferred)
+        self.query(channel_id)
+
+        return deferred
+
+    def query(self, channel_id):
+        """
+        Ask the server for our permissions in a channel, unless we've
+        already asked.
+        """
+
+        if channel_id in self.timeouts:
+            return
+
+        self.queue.append(channel_id)
+        self.timeouts[channel_id] = self.clock.callLater(
+            self.TIMEOUT, self._timeout, channel_id
+        )
+
+        if self._send_call is None:
+            self._send_call = self.clock.callLater(0, self.send_queries)
+
+    def prefetch(self, channels):
+        """
+        Fetch our permissions in some channels, if we don't have them.
+
+        :param channels: An iterable of Channel objects
+        """
+
+        for channel in channels:
+            if channel.channel_id not in self.permissions:
+                self.query(channel.channel_id)
+
+    def send_queries(self):
+        self._send_call = None
+
+        batch = self.queue[:self.BATCH_SIZE]
+        del self.queue[:self.BATCH_SIZE]
+
+        for channel_id in batch:
+            if channel_id not in self.timeouts:
+                continue  # Answered or timed out while it was queued
+
+            message = Mumble_pb2.PermissionQuery()
+            message.channel_id = channel_id
+
+            self.queries += 1
+            self.protocol.sendProtobuf(message)
+
+        if self.queue:
+            self._send_call = self.clock.callLater(
+                self.BATCH_INTERVAL, self.send_queries
+            )
+
+    def clear(self):
+        if self._send_call is not None and self._send_call.active():
+            self._send_call.cancel()
+
+        self._send_call = None
+
+        self.permissions.clear()
+        del self.queue[:]
+
+        for timeout in self.timeouts.itervalues():
+            if timeout.active():
+                timeout.cancel()
+
+        self.timeouts.clear()
+        pending, self.pending = self.pending, {}
+
+        for deferreds in pending.itervalues():
+            for deferred in deferreds:
+                deferred.callback(None)
+
+    def _timeout(self, channel_id):
+        del self.timeouts[channel_id]
+
+        for deferred in self.pending.pop(channel_id, []):
+            deferred.callback(None)
@@ -1,10 +1,9 @@
 # coding=utf-8
-import cgi
 import os
 import platform
 import struct
 
-from twisted.internet import reactor, ssl, task
+from twisted.internet import reactor, ssl
 
 from system.commands.manager import CommandManager
 
@@ -25,11 +24,20 @@ from system.protocols.mumble.user import User
 from system.protocols.mumble.channel import Channel
 from system.protocols.mumble.acl import Perms
 from system.protocols.mumble.structs import Version
+from system.protocols.mumble import cryptstate
+from system.protocols.mumble.audio import Player
+from system.protocols.mumble.blobs import AVATAR, COMMENT, BlobCache, \
+    BlobFetcher
+from system.protocols.mumble.receiver import VoiceReceiver
+from system.protocols.mumble.udp import VoiceTransport, UDP_OPUS, UDP_PING
+from system.protocols.mumble.permissions import ROOT_CHANNEL, \
+    PermissionCache
+from system.protocols.mumble.userstats import StatsScheduler
 
 from system.translations import Translations
 
-from utils.html import html_to_text
-from utils.protobuf import decode_varint
+from utils.html import html_to_text, text_to_html
+from utils.protobuf import read_varints
 from utils.switch import Switch
 __author__ = 'Gareth Coles'
 
@@ -60,6 +68,7 @@ class Protocol(SingleChannelProtocol):
     # From the Mumble protocol documentation
     PREFIX_FORMAT = ">HI"
     PREFIX_LENGTH = 6
+    PREFIX_STRUCT = struct.Struct(PREFIX_FORMAT)
 
     # This specific order of IDs is extracted from
     # https://github.com/mumble-voip/mumble/blob/master/src/Message.h
@@ -97,10 +106,6 @@ class Protocol(SingleChannelProtocol):
 
     PING_REPEAT_TIME = 5
 
-    channels = {}
-    users = {}
-    _acls = {}
-
     # Server config - defaults from official Mumble client
     max_bandwidth = -1
     welcome_text = None
@@ -125,7 +130,28 @@ class Protocol(SingleChannelProtocol):
         self.factory = factory
         self.config = config
 
-        self.received = ""
+        self._recv_buffer = bytearray()
+        self._send_queue = []
+        self._send_call = None
+        self._handlers = self._build_handlers()
+
+        # All of these are per-connection, keyed by channel ID or session
+        self.channels = {}
+        self.users = {}
+        self.permissions = PermissionCache(self)
+
+        # Indexes, maintained as the server tells us about changes:
+        #   lowercase channel name -> [Channel] (names are only unique
+        #   among siblings), lowercase username -> User, and parent
+        #   channel ID -> set of child channel IDs
+        self._channel_names = {}
+        self._user_names = {}
+        self._channel_children = {}
+
+        # Whether the server's finished telling us about everything that
+        # was already there when we connected
+        self.synced = False
+
         self.log = getLogger(self.name)
         self.log.info("Setting up..")
 
@@ -139,11 +165,31 @@ class Protocol(SingleChannelProtocol):
 
         self.control_chars = config["control_chars"]
 
+        # UDP voice - see handle_msg_cryptsetup()
+        self.use_udp = self.networking.get("udp", True)
+        self.crypt = cryptstate.CryptState()
+        self.voice = None
+        self.tunnel_packets = 0
+        self.players = set()
+        self.receiver = VoiceReceiver(self)
+
+        blob_conf = config.get("blobs", {})
+        self.blobs = BlobFetcher(self, BlobCache(
+            blob_conf.get("cache_size", 4 * 1024 * 1024),
+            blob_conf.get("directory"),
+            blob_conf.get("disk_size", 64 * 1024 * 1024)
+        ))
+
         audio_conf = config.get("audio", {})
         self.should_mute_self = audio_conf.get("should_mute_self", True)
         self.should_deafen_self = audio_conf.get("should_deafen_self", True)
 
         self.userstats_request_rate = config.get("userstats_request_rate", 60)
+        self.userstats = StatsScheduler(
+            self, self.userstats_request_rate,
+            idle_interval=config.get("userstats_idle_rate", 300),
+            max_rate=config.get("userstats_max_rate", 10)
+        )
 
     def _get_client_context(self):
         # Check if a cert file is specified in config
@@ -227,11 +273,15 @@ class Protocol(SingleChannelProtocol):
     def shutdown(self):
         self.msg(_("Disconnecting: Protocol shutdown"))
         self.stop_userstats_requests()
+        self.stop_voice()
+        self.flush_writes()
         self.transport.loseConnection()
 
     def connectionMade(self):
         self.log.info(_("Connected to server."))
 
+        self.synced = False
+
         # In the mumble protocol you must first send your current version
         # and immediately after that the authentication data.
         #
@@ -278,253 +328,493 @@ class Protocol(SingleChannelProtocol):
     def connectionLost(self, reason=None):
         self.pinging = False
         self.stop_userstats_requests()
+        self.userstats.clear()
+        self.blobs.clear()
+        self.permissions.clear()
+        self.stop_voice()
 
-    def dataReceived(self, recv):
-        # Append our received data
-        self.received = self.received + recv
-
-        # If we have enough bytes to read the header, we do that
-        while len(self.received) >= Protocol.PREFIX_LENGTH:
-            msg_type, length = \
-                struct.unpack(Protocol.PREFIX_FORMAT,
-                              self.received[:Protocol.PREFIX_LENGTH])
-
-            full_length = Protocol.PREFIX_LENGTH + length
+        if self._send_call is not None and self._send_call.active():
+            self._send_call.cancel()
 
-            self.log.trace("Length: %d" % length)
-            self.log.trace("Message type: %d" % msg_type)
+        self._send_call = None
+        self._send_queue = []
 
-            # Check if this this a valid message ID
-            if msg_type not in Protocol.MESSAGE_ID.values():
+    def dataReceived(self, recv):
+        buf = self._recv_buffer
+        buf.extend(recv)
+
+        view = memoryview(buf)
+        available = len(buf)
+        offset = 0
+        prefix_length = Protocol.PREFIX_LENGTH
+        unpack_prefix = Protocol.PREFIX_STRUCT.unpack_from
+        handlers = self._handlers
+        num_types = len(handlers)
+
+        # Frames are read in place, and the buffer is only trimmed once
+        # we've read everything we can - so a burst of messages doesn't copy
+        # the rest of the buffer once per message
+        while available - offset >= prefix_length:
+            msg_type, length = unpack_prefix(buf, offset)
+
+            if msg_type >= num_types:
                 self.log.error(_("Message ID not available."))
+                self.flush_writes()
                 self.transport.loseConnection()
                 return
 
-            # We need to check if we have enough bytes to fully read the
-            # message
-            if len(self.received) < full_length:
+            start = offset + prefix_length
+            end = start + length
+
+            if end > available:
                 self.log.trace(_("Need to fill data"))
-                return
+                break
 
-            # Read and handle the specific message
-            if msg_type == 1:
-                # Non-Protobuf messages
-                # 1 is taken from the position of UDPTunnel in ID_MESSAGE
-                self.recv_UDP(self.received[Protocol.PREFIX_LENGTH:
-                                            Protocol.PREFIX_LENGTH + length])
-            else:
-                # Regular (Protobuf) messages
-                msg = Protocol.ID_MESSAGE[msg_type]()
-                msg.ParseFromString(
-                    self.received[Protocol.PREFIX_LENGTH:
-                                  Protocol.PREFIX_LENGTH + length])
+            data = view[start:end].tobytes()
+            offset = end
+
+            message_class, handler = handlers[msg_type]
 
-                # Handle the message
+            if message_class is None:
+                # Non-Protobuf messages (the UDP tunnel)
                 try:
-                    self.recvProtobuf(msg_type, msg)
+                    self.recv_UDP(data)
                 except Exception:
                     self.log.exception(_("Exception while handling data."))
+                continue
+
+            # Regular (Protobuf) messages
+            msg = message_class()
+            msg.ParseFromString(data)
+
+            # Handle the message
+            try:
+                if handler is None:
+                    self.handle_msg_unknown(msg_type, msg)
+                else:
+                    handler(msg)
+            except Exception:
+                self.log.exception(_("Exception while handling data."))
+
+        # The buffer can't be resized while the view exists
+        del view
 
-            self.received = self.received[full_length:]
+        if offset:
+            del buf[:offset]
 
     def sendProtobuf(self, message):
         # We find the message ID
         msg_type = Protocol.MESSAGE_ID[message.__class__]
         # Serialize the message
         msg_data = message.SerializeToString()
-        length = len(msg_data)
 
-        # Compile the data with the header
-        data = struct.pack(Protocol.PREFIX_FORMAT, msg_type, length) + msg_data
+        self._send_queue.append(
+            Protocol.PREFIX_STRUCT.pack(msg_type, len(msg_data))
+        )
+        self._send_queue.append(msg_data)
+
+        # Everything sent in this pass through the reactor goes out in one
+        # write - for example, the replies to a burst of received messages
+        if self._send_call is None:
+            self._send_call = reactor.callLater(0, self.flush_writes)
+
+    def send_tunnel(self, packet):
+        """
+        Send a UDP packet through the TCP connection.
+        """
+
+        self._send_queue.append(
+            Protocol.PREFIX_STRUCT.pack(
+                Protocol.MESSAGE_ID[Mumble_pb2.UDPTunnel], len(packet)
+            )
+        )
+        self._send_queue.append(packet)
+
+        if self._send_call is None:
+            self._send_call = reactor.callLater(0, self.flush_writes)
+
+    def flush_writes(self):
+        """
+        Write out any messages that are waiting to be sent.
 
-        # Send the data
-        self.transport.write(data)
+        This happens automatically, but you'll want to call it yourself
+        before closing the connection.
+        """
+
+        if self._send_call is not None:
+            if self._send_call.active():
+                self._send_call.cancel()
+            self._send_call = None
+
+        if self._send_queue and self.transport is not None:
+            queue, self._send_queue = self._send_queue, []
+            self.transport.writeSequence(queue)
 
     def recvProtobuf(self, msg_type, message):
-        if isinstance(message, Mumble_pb2.Version):
-            # version, release, os, os_version
-            self.log.info(_("Connected to Murmur v%s") % message.release)
-            event = general_events.PostSetupEvent(self, self.config)
-            self.event_manager.run_callback("PostSetup", event)
-        elif isinstance(message, Mumble_pb2.Reject):
-            # version, release, os, os_version
-            self.log.info(_("Could not connect to server: %s - %s") %
-                          (message.type, message.reason))
-
-            self.transport.loseConnection()
-            self.pinging = False
-        elif isinstance(message, Mumble_pb2.CodecVersion):
-            # alpha, beta, prefer_alpha, opus
-            alpha = message.alpha
-            beta = message.beta
-            prefer_alpha = message.prefer_alpha
-            opus = message.opus
-
-            event = mumble_events.CodecVersion(self, alpha, beta, prefer_alpha,
-                                               opus)
-            self.event_manager.run_callback("Mumble/CodecVersion", event)
-        elif isinstance(message, Mumble_pb2.CryptSetup):
-            # key, client_nonce, server_nonce
-            key = message.key
-            c_n = message.client_nonce
-            s_n = message.server_nonce
-
-            event = mumble_events.CryptoSetup(self, key, c_n, s_n)
-            self.event_manager.run_callback("Mumble/CryptoSetup", event)
-        elif isinstance(message, Mumble_pb2.ChannelState):
-            # channel_id, name, position, [parent]
-            self.handle_msg_channelstate(message)
-        elif isinstance(message, Mumble_pb2.PermissionQuery):
-            # channel_id, permissions, flush
-            channel = self.channels[message.channel_id]
-            permissions = message.permissions
-            flush = message.flush
-            self.set_permissions(channel, permissions, flush)
-            self.log.trace("PermissionQuery received: channel: '%s', "
-                           "permissions: '%s', flush:'%s'" %
-                           (channel,
-                            Perms.get_permissions_names(permissions),
-                            flush))
-            event = mumble_events.PermissionsQuery(self, channel, permissions,
-                                                   flush)
-            self.event_manager.run_callback("Mumble/PermissionsQuery", event)
-        elif isinstance(message, Mumble_pb2.UserState):
-            # session, name,
-            # [user_id, suppress, hash, actor, self_mute, self_deaf]
-            self.handle_msg_userstate(message)
-        elif isinstance(message, Mumble_pb2.ServerSync):
-            # session, max_bandwidth, welcome_text, permissions
-            session = message.session
+        message_class, handler = self._handlers[msg_type]
+
+        if handler is None:
+            self.handle_msg_unknown(msg_type, message)
+        else:
+            handler(message)
+
+    def _build_handlers(self):
+        """
+        Build the table of message classes and their handlers, indexed by
+        message type ID.
+
+        Each message type is handled by a method named after it - for
+        example, handle_msg_userstate() - or handle_msg_unknown() if there
+        isn't one. The UDP tunnel isn't a Protobuf message, so its class is
+        None; it's passed to recv_UDP() instead.
+        """
+
+        handlers = []
+
+        for message_class in Protocol.ID_MESSAGE:
+            if message_class is Mumble_pb2.UDPTunnel:
+                handlers.append((None, None))
+                continue
+
+            handlers.append((
+                message_class,
+                getattr(
+                    self, "handle_msg_%s" % message_class.__name__.lower(),
+                    None
+                )
+            ))
+
+        return handlers
+
+    def handle_msg_version(self, message):
+        # version, release, os, os_version
+        self.log.info(_("Connected to Murmur v%s") % message.release)
+        event = general_events.PostSetupEvent(self, self.config)
+        self.event_manager.run_callback("PostSetup", event)
+
+    def handle_msg_reject(self, message):
+        # version, release, os, os_version
+        self.log.info(_("Could not connect to server: %s - %s") %
+                      (message.type, message.reason))
+
+        self.flush_writes()
+        self.transport.loseConnection()
+        self.pinging = False
+
+    def handle_msg_codecversion(self, message):
+        # alpha, beta, prefer_alpha, opus
+        alpha = message.alpha
+        beta = message.beta
+        prefer_alpha = message.prefer_alpha
+        opus = message.opus
+
+        event = mumble_events.CodecVersion(self, alpha, beta, prefer_alpha,
+                                           opus)
+        self.event_manager.run_callback("Mumble/CodecVersion", event)
+
+    def handle_msg_cryptsetup(self, message):
+        # key, client_nonce, server_nonce
+        key = message.key
+        c_n = message.client_nonce
+        s_n = message.server_nonce
+
+        if key and c_n and s_n:
+            # Initial setup - we can start using UDP now
+            self.start_voice(key, c_n, s_n)
+        elif s_n:
+            # The server resynchronising after we asked it to
+            if self.crypt.is_valid:
+                self.log.debug(_("Resynchronising UDP encryption"))
+                self.crypt.set_decrypt_iv(s_n)
+        elif self.crypt.is_valid:
+            # The server asking us to resynchronise
+            response = Mumble_pb2.CryptSetup()
+            response.client_nonce = bytes(self.crypt.encrypt_iv)
+            self.sendProtobuf(response)
+
+        event = mumble_events.CryptoSetup(self, key, c_n, s_n)
+        self.event_manager.run_callback("Mumble/CryptoSetup", event)
+
+    def handle_msg_permissionquery(self, message):
+        # channel_id, permissions, flush
+        channel = self.channels.get(message.channel_id)
+        permissions = message.permissions
+        flush = message.flush
+        self.set_permissions(message.channel_id, permissions, flush)
+        self.log.trace("PermissionQuery received: channel: '%s', "
+                       "permissions: '%s', flush:'%s'" %
+                       (channel,
+                        Perms.get_permissions_names(permissions),
+                        flush))
+        if flush:
+            # Our permissions may have changed anywhere - fetch them again
+            # for the channels we care about
+            self.prefetch_permissions()
+
+        event = mumble_events.PermissionsQuery(self, channel, permissions,
+                                               flush)
+        self.event_manager.run_callback("Mumble/PermissionsQuery", event)
+
+    def handle_msg_serversync(self, message):
+        # session, max_bandwidth, welcome_text, permissions
+        session = message.session
+        self.max_bandwidth = message.max_bandwidth
+        permissions = message.permissions
+        # These are our permissions in the root channel
+        self.set_permissions(ROOT_CHANNEL, permissions)
+        self.prefetch_permissions()
+        self.welcome_text = html_to_text(message.welcome_text, True)
+        self.synced = True
+        self.log.info(_("===   Welcome message   ==="))
+        self.log.trace("ServerSync received: max_bandwidth: '%s', "
+                       "permissions: '%s', welcome text: [below]" %
+                       (self.max_bandwidth,
+                        Perms.get_permissions_names(permissions)))
+        for line in self.welcome_text.split("\n"):
+            self.log.info(line)
+        self.log.info(_("=== End welcome message ==="))
+
+        event = mumble_events.ServerSync(self, session, self.max_bandwidth,
+                                         self.welcome_text, permissions)
+        self.event_manager.run_callback("Mumble/ServerSync", event)
+
+    def handle_msg_serverconfig(self, message):
+        # max_bandwidth, welcome_text, allow_html, message_length,
+        # image_message_length
+        if message.HasField("max_bandwidth"):
             self.max_bandwidth = message.max_bandwidth
-            permissions = message.permissions
-            # TODO: Check this permissions relevancy - root chan? We don't know
-            # what channel we're in yet, so it must be
-            self.set_permissions(0, permissions)
-            self.welcome_text = html_to_text(message.welcome_text, True)
-            self.log.info(_("===   Welcome message   ==="))
-            self.log.trace("ServerSync received: max_bandwidth: '%s', "
-                           "permissions: '%s', welcome text: [below]" %
-                           (self.max_bandwidth,
-                            Perms.get_permissions_names(permissions)))
-            for line in self.welcome_text.split("\n"):
-                self.log.info(line)
-            self.log.info(_("=== End welcome message ==="))
-
-            event = mumble_events.ServerSync(self, session, self.max_bandwidth,
-                                             self.welcome_text, permissions)
-            self.event_manager.run_callback("Mumble/ServerSync", event)
-        elif isinstance(message, Mumble_pb2.ServerConfig):
-            # max_bandwidth, welcome_text, allow_html, message_length,
-            # image_message_length
-            if message.HasField("max_bandwidth"):
-                self.max_bandwidth = message.max_bandwidth
-            if message.HasField("welcome_text"):
-                self.welcome_text = message.welcome_text
-            if message.HasField("allow_html"):
-                self.allow_html = message.allow_html
-            if message.HasField("message_length"):
-                self.message_length = message.message_length
-            if message.HasField("image_message_length"):
-                self.image_message_length = message.image_message_length
-
-            # TODO: FIXME: Not all of these are necessarily set by this packet,
-            # but the event acts as if they are.
-            event = mumble_events.ServerConfig(self, self.max_bandwidth,
-                                               self.welcome_text,
-                                               self.allow_html,
-                                               self.message_length,
-                                               self.image_message_length)
-            self.event_manager.run_callback("Mumble/ServerConfig", event)
-        elif isinstance(message, Mumble_pb2.Ping):
-            # timestamp, good, late, lost, resync, udp_packets, tcp_packets,
-            # udp_ping_avg, udp_ping_var, tcp_ping_avg, tcp_ping_var
-            timestamp = message.timestamp
-            good = message.good
-            late = message.late
-            lost = message.lost
-            resync = message.resync
-            udp = message.udp_packets
-            tcp = message.tcp_packets
-            udp_a = message.udp_ping_avg
-            udp_v = message.udp_ping_var
-            tcp_a = message.tcp_ping_avg
-            tcp_v = message.tcp_ping_var
-
-            event = mumble_events.Ping(self, timestamp, good, late, lost,
-                                       resync, tcp, udp, tcp_a, udp_a, tcp_v,
-                                       udp_v)
-
-            self.event_manager.run_callback("Mumble/Ping", event)
-        elif isinstance(message, Mumble_pb2.UserRemove):
-            # session, actor, reason, ban
-            session = message.session
-            actor = message.actor
-            reason = message.reason
-            ban = message.ban
-
-            if message.session in self.users:
-                user = self.users[message.session]
-                user.is_tracked = False
-                self.log.info(_("User left: %s") %
-                              user)
-                user.channel.remove_user(user)
-                del self.users[message.session]
+        if message.HasField("welcome_text"):
+            self.welcome_text = message.welcome_text
+        if message.HasField("allow_html"):
+            self.allow_html = message.allow_html
+        if message.HasField("message_length"):
+            self.message_length = message.message_length
+        if message.HasField("image_message_length"):
+            self.image_message_length = message.image_message_length
+
+        # TODO: FIXME: Not all of these are necessarily set by this packet,
+        # but the event acts as if they are.
+        event = mumble_events.ServerConfig(self, self.max_bandwidth,
+                                           self.welcome_text,
+                                           self.allow_html,
+                                           self.message_length,
+                                           self.image_message_length)
+        self.event_manager.run_callback("Mumble/ServerConfig", event)
+
+    def handle_msg_ping(self, message):
+        # timestamp, good, late, lost, resync, udp_packets, tcp_packets,
+        # udp_ping_avg, udp_ping_var, tcp_ping_avg, tcp_ping_var
+        timestamp = message.timestamp
+        good = message.good
+        late = message.late
+        lost = message.lost
+        resync = message.resync
+        udp = message.udp_packets
+        tcp = message.tcp_packets
+        udp_a = message.udp_ping_avg
+        udp_v = message.udp_ping_var
+        tcp_a = message.tcp_ping_avg
+        tcp_v = message.tcp_ping_var
+
+        event = mumble_events.Ping(self, timestamp, good, late, lost,
+                                   resync, tcp, udp, tcp_a, udp_a, tcp_v,
+                                   udp_v)
+
+        self.event_manager.run_callback("Mumble/Ping", event)
+
+    def _update_blobs(self, user, message):
+        # Users only keep the hashes - the blobs themselves are cached by
+        # hash, and fetched when a plugin asks for them
+        if message.HasField("comment_hash"):
+            user.comment_hash = message.comment_hash
+        if message.HasField("comment"):
+            if message.comment:
+                user.comment_hash = self.blobs.received(
+                    COMMENT, message.comment,
+                    message.comment_hash or None
+                )
+            else:
+                user.comment_hash = None
+        if message.HasField("texture_hash"):
+            user.avatar_hash = message.texture_hash
+        if message.HasField("texture"):
+            if message.texture:
+                user.avatar_hash = self.blobs.received(
+                    AVATAR, message.texture,
+                    message.texture_hash or None
+                )
             else:
-                user = None
-
-            if actor in self.users:
-                event = mumble_events.UserRemove(self, session, actor, user,
-                                                 reason, ban,
-                                                 self.users[actor])
-                self.event_manager.run_callback("Mumble/UserRemove", event)
-
-            s_event = general_events.UserDisconnected(self, user)
-            self.event_manager.run_callback("UserDisconnected", s_event)
-        elif isinstance(message, Mumble_pb2.TextMessage):
-            # actor, channel_id, message
-            self.handle_msg_textmessage(message)
-        elif isinstance(message, Mumble_pb2.UserStats):
-            self.handle_msg_userstats(message)
+                user.avatar_hash = None
+
+    def handle_msg_userremove(self, message):
+        # session, actor, reason, ban
+        session = message.session
+        actor = message.actor
+        reason = message.reason
+        ban = message.ban
+
+        if message.session in self.users:
+            user = self.users[message.session]
+            user.is_tracked = False
+            self.log.info(_("User left: %s") %
+                          user)
+            user.channel.remove_user(user)
+            del self.users[message.session]
+            self._unindex_user_name(user)
+            self.receiver.user_left(message.session)
+            self.userstats.remove(user)
         else:
-            self.log.trace(_("Unknown message type: %s") % message.__class__)
-            self.log.trace(_("Received message '%s' (%d):\n%s")
-                           % (message.__class__, msg_type, str(message)))
+            user = None
+
+        if actor in self.users:
+            event = mumble_events.UserRemove(self, session, actor, user,
+                                             reason, ban,
+                                             self.users[actor])
+            self.event_manager.run_callback("Mumble/UserRemove", event)
+
+        s_event = general_events.UserDisconnected(self, user)
+        self.event_manager.run_callback("UserDisconnected", s_event)
+
+    def handle_msg_channelremove(self, message):
+        # channel_id
+        channel = self.channels.pop(message.channel_id, None)
+
+        if channel is None:
+            return
+
+        self._unindex_channel(channel)
+        self._channel_children.pop(channel.channel_id, None)
+        self.permissions.remove(channel.channel_id)
+
+        for link in channel.links:
+            if link in self.channels:
+                self.channels[link].remove_link(channel.channel_id)
+
+        self.log.info(_("Channel removed: %s") % channel)
+
+        event = mumble_events.ChannelRemoved(self, channel)
+        self.event_manager.run_callback("Mumble/ChannelRemoved", event)
+
+    def handle_msg_unknown(self, msg_type, message):
+        self.log.trace(_("Unknown message type: %s") % message.__class__)
+        self.log.trace(_("Received message '%s' (%d):\n%s")
+                       % (message.__class__, msg_type, str(message)))
 
-            event = mumble_events.Unknown(self, type(message), message)
-            self.event_manager.run_callback("Mumble/Unknown", event)
+        event = mumble_events.Unknown(self, type(message), message)
+        self.event_manager.run_callback("Mumble/Unknown", event)
 
-    def recv_UDP(self, data):
+    def recv_UDP(self, data, udp=False):
         """
         Handle a UDP message (whether it be from actual UDP or via TCP tunnel)
-        :param data: UDP
+        :param data: UDP packet, already decrypted if it came over UDP
+        :param udp: Whether it came over UDP
         """
-        # TODO: Use UDP rather than TCP tunnel (see protocol docs section 5)
-        # We don't actually need to parse this atm
-        return
-        _first_byte = ord(data[0])
-        msg_type = (_first_byte & 0xE0) >> 5
-        target = _first_byte & 0x1F
-        pos = 1
-        session, pos = decode_varint(data, pos)
-        sequence, pos = decode_varint(data, pos)
+
+        if not udp:
+            self.tunnel_packets += 1
+
+        packet = bytearray(data)
+        msg_type = packet[0] >> 5
+        target = packet[0] & 0x1F
+
+        if msg_type == UDP_PING:
+            # Only sent over UDP, and the voice transport deals with those
+            return
+
+        (session, sequence), pos = read_varints(packet, 2, 1)
+
+        user = self.users.get(session)
+
         self.log.trace(
             "UDP Message: Type=%s, target=%s, session=%s, sequence=%s",
-            msg_type,
-            target,
-            self.get_user(session),
-            sequence
+            msg_type, target, user, sequence
+        )
+
+        payload = data[pos:]
+
+        if msg_type == UDP_OPUS:
+            self.receiver.packet_received(session, sequence, payload)
+
+        event = mumble_events.VoicePacket(
+            self, user, msg_type, target, sequence, payload, udp
+        )
+        self.event_manager.run_callback("Mumble/VoicePacket", event)
+
+    def start_voice(self, key, client_nonce, server_nonce):
+        """
+        Set up UDP encryption with the keys from the server's CryptSetup,
+        and start sending voice over UDP if it's enabled.
+        """
+
+        if not cryptstate.AVAILABLE:
+            self.log.warn(_("The cryptography package isn't installed, so "
+                            "voice will be sent over TCP"))
+            return
+
+        try:
+            self.crypt.set_key(key, client_nonce, server_nonce)
+        except ValueError:
+            self.log.warn(_("Server sent invalid UDP encryption keys, so "
+                            "voice will be sent over TCP"))
+            return
+
+        if not self.use_udp or self.voice is not None:
+            return
+
+        self.voice = VoiceTransport(self, self.crypt)
+        self.voice.start(
+            self.transport.getPeer().host, self.networking["port"]
         )
-        # TEMP: Forward the packet back to the server
 
-        msg_data = data
+    def play_audio(self, source, **kwargs):
+        """
+        Start playing audio.
+
+        See system.protocols.mumble.audio for the sources you can use, and
+        the Player class for the keyword arguments you can pass.
+
+        :return: The Player - call its stop() method to stop early
+        """
+
+        player = Player(self, source, **kwargs)
+        self.players.add(player)
+
+        def finished(result):
+            self.players.discard(player)
+            return result
+
+        player.play().addBoth(finished)
+        return player
+
+    def stop_voice(self):
+        for player in list(self.players):
+            player.stop()
+
+        self.receiver.stop()
+
+        if self.voice is not None:
+            voice, self.voice = self.voice, None
+            voice.stop()
 
-        length = len(msg_data)
+    def request_crypt_resync(self):
+        """
+        Ask the server for a new nonce, when we're unable to decrypt what it
+        sends us over UDP.
+        """
+
+        self.log.debug(_("Requesting UDP encryption resync"))
+        self.sendProtobuf(Mumble_pb2.CryptSetup())
+
+    def send_voice(self, packet):
+        """
+        Send a voice packet - over UDP if it's working, otherwise through the
+        TCP tunnel.
 
-        # Compile the data with the header
-        data = struct.pack(Protocol.PREFIX_FORMAT, 1, length) + msg_data
+        :param packet: The unencrypted packet, including its header
+        """
 
-        # Send the data
-        # self.transport.write(data)
+        if self.voice is None or not self.voice.send(packet):
+            self.send_tunnel(packet)
 
     def init_ping(self):
         # Call ping every PING_REPEAT_TIME seconds.
@@ -535,29 +825,32 @@ class Protocol(SingleChannelProtocol):
             return
         self.log.trace("Sending ping")
 
-        # Ping has only optional data, no required
+        # Ping has only optional data, no required - but the server likes
+        # to know how UDP is going
         ping = Mumble_pb2.Ping()
+
+        if self.crypt.is_valid:
+            ping.good = self.crypt.good
+            ping.late = self.crypt.late
+            ping.lost = self.crypt.lost
+            ping.resync = self.crypt.resync
+
+        ping.tcp_packets = self.tunnel_packets
+
+        if self.voice is not None:
+            ping.udp_packets = self.voice.packets_received
+            ping.udp_ping_avg = self.voice.ping_avg
+            ping.udp_ping_var = self.voice.ping_var
+
         self.sendProtobuf(ping)
 
         self.init_ping()
 
     def start_userstats_requests(self):
-        self._userstats_requests_task = task.LoopingCall(
-            self.userstats_request_handler
-        )
-        self._userstats_requests_task.start(self.userstats_request_rate, False)
+        self.userstats.start()
 
     def stop_userstats_requests(self):
-        if self._userstats_requests_task and \
-                self._userstats_requests_task.running:
-            self._userstats_requests_task.stop()
-
-    def userstats_request_handler(self):
-        try:
-            for user in self.users.itervalues():
-                self.request_userstats(user, True)
-        except Exception:
-            self.log.exception("Error in UserStats request loop")
+        self.userstats.stop()
 
     def handle_msg_channelstate(self, message):
         if message.channel_id not in self.channels:
@@ -567,17 +860,40 @@ class Protocol(SingleChannelProtocol):
             links = []
             if message.links:
                 links = list(message.links)
-                for link in links:
-                    self.log.debug(_("Channel link: %s to %s") %
-                                   (self.channels[link],
-                                    self.channels[message.channel_id]))
-            self.channels[message.channel_id] = Channel(self,
-                                                        message.channel_id,
-                                                        message.name,
-                                                        parent,
-                                                        message.position,
-                                                        links)
+            channel = Channel(self, message.channel_id, message.name, parent,
+                              message.position, links)
+            self.channels[message.channel_id] = channel
+            self._index_channel(channel)
+            for link in links:
+                self.log.debug(_("Channel link: %s to %s") %
+                               (self.channels.get(link, link), channel))
             self.log.info(_("New channel: %s") % message.name)
+
+            if self.synced:
+                # Otherwise, it was there before we connected
+                event = mumble_events.ChannelCreated(self, channel)
+                self.event_manager.run_callback(
+                    "Mumble/ChannelCreated", event
+                )
+        else:
+            channel = self.channels[message.channel_id]
+            if message.HasField('name') and message.name != channel.name:
+                self.log.info(_("Channel renamed: %s to %s") %
+                              (channel, message.name))
+                self._unindex_channel(channel)
+                channel.name = message.name
+                self._index_channel(channel)
+            if message.HasField('parent') and \
+                    message.parent != channel.parent:
+                self.log.info(_("Channel moved: %s to %s") %
+                              (channel,
+                               self.channels.get(message.parent,
+                                                 message.parent)))
+                self._unindex_channel(channel)
+                channel.parent = message.parent
+                self._index_channel(channel)
+            if message.HasField('position'):
+                channel.position = message.position
         if message.links_add:
             for link in message.links_add:
                 self.channels[message.channel_id].add_link(link)
@@ -622,17 +938,10 @@ class Protocol(SingleChannelProtocol):
                         message.priority_speaker,
                         message.recording)
             self.users[message.session] = user
+            self._user_names[user.nickname.lower()] = user
 
             # TODO: plugin_identity and plugin_context
-            # TODO: Handle comments and avatars properly
-            if message.HasField("comment_hash"):
-                user.comment_hash = message.comment_hash
-            if message.HasField("comment"):
-                user.comment = message.comment
-            if message.HasField("texture_hash"):
-                user.avatar_hash = message.texture_hash
-            if message.HasField("texture"):
-                user.avatar = message.texture
+            self._update_blobs(user, message)
 
             if message.HasField("user_id"):
                 user_id = message.user_id
@@ -692,8 +1001,9 @@ class Protocol(SingleChannelProtocol):
                 event = mumble_events.UserJoined(self, user)
                 self.event_manager.run_callback("Mumble/UserJoined", event)
 
-            # Request initial UserStats
-            self.request_userstats(user, False)
+            # Request initial UserStats, and poll them from now on
+            self.userstats.request(user, False)
+            self.userstats.add(user)
         else:
             # Note: More than one state change can happen at once
             user = self.users[message.session]
@@ -701,6 +1011,12 @@ class Protocol(SingleChannelProtocol):
                 actor = self.users[message.actor]
             else:
                 actor = None
+            if message.name and message.name != user.nickname:
+                self.log.info(_("User renamed: %s to %s") %
+                              (user, message.name))
+                self._unindex_user_name(user)
+                user.nickname = message.name
+                self._user_names[user.nickname.lower()] = user
             if message.HasField('channel_id'):
                 self.log.info(_("User moved channel: %s from %s to %s by %s") %
                               (user,
@@ -712,6 +1028,9 @@ class Protocol(SingleChannelProtocol):
                 self.channels[message.channel_id].add_user(user)
                 user.channel = self.channels[message.channel_id]
 
+                if user is self.ourselves:
+                    self.prefetch_permissions()
+
                 event = mumble_events.UserMoved(self, user, user.channel, old)
                 self.event_manager.run_callback("Mumble/UserMoved", event)
             if message.HasField('mute'):
@@ -797,18 +1116,8 @@ class Protocol(SingleChannelProtocol):
                                                           user.recording)
                 self.event_manager.run_callback("Mumble/UserRecordingToggle",
                                                 event)
-            # TODO: Events
-            # - Comments/avatars may want higher level events. For example, we
-            # - may want to automatically request the full comment/avatar if we
-            # - get a hash, and only provide an API for the full thing.
-            if message.HasField("comment_hash"):
-                user.comment_hash = message.comment_hash
-            if message.HasField("comment"):
-                user.comment = message.comment
-            if message.HasField("texture_hash"):
-                user.avatar_hash = message.texture_hash
-            if message.HasField("texture"):
-                user.avatar = message.texture
+            # TODO: Events for comment/avatar changes
+            self._update_blobs(user, message)
 
             if message.HasField("user_id"):
                 user_id = message.user_id
@@ -1084,7 +1393,7 @@ class Protocol(SingleChannelProtocol):
         self.log.trace(_("Sending text message: %s") % message)
 
         if self.use_cgi:
-            message = cgi.escape(message)
+            message = text_to_html(message)
 
         msg = Mumble_pb2.TextMessage()  # session, channel_id, tree_id, message
         msg.message = message
@@ -1153,11 +1462,12 @@ class Protocol(SingleChannelProtocol):
         if name_or_id is None:
             return self.ourselves.channel  # Yay
 
-        if isinstance(name_or_id, str) or isinstance(name_or_id, unicode):
-            name = name_or_id.lower()
-            for cid, channel in self.channels.iteritems():
-                if channel.name.lower() == name:
-                    return channel
+        if isinstance(name_or_id, basestring):
+            # If more than one channel has this name, the first we were told
+            # about wins
+            channels = self._channel_names.get(name_or_id.lower())
+            if channels:
+                return channels[0]
             return None
         else:
             # Assume ID - it's a hash lookup anyway
@@ -1167,12 +1477,8 @@ class Protocol(SingleChannelProtocol):
                 return None
 
     def get_user(self, name_or_session):
-        if isinstance(name_or_session, str):
-            name = name_or_session.lower()
-            for session, user in self.users.iteritems():
-                if user.nickname.lower() == name:
-                    return user
-            return None
+        if isinstance(name_or_session, basestring):
+            return self._user_names.get(name_or_session.lower())
         else:
             # Assume session - it's a hash lookup anyway
             try:
@@ -1180,19 +1486,134 @@ class Protocol(SingleChannelProtocol):
             except KeyError:
                 return None
 
+    def get_channel_children(self, channel):
+        """
+        Get the direct sub-channels of a channel.
+
+        :param channel: A Channel object or channel ID
+        :return: A list of Channel objects, sorted by position and then name
+        """
+
+        if isinstance(channel, Channel):
+            channel = channel.channel_id
+
+        children = [
+            self.channels[cid]
+            for cid in self._channel_children.get(channel, ())
+        ]
+        children.sort(key=lambda c: (c.position, c.name.lower()))
+
+        return children
+
+    def get_channel_subtree(self, channel):
+        """
+        Get a channel and all of the channels below it, at any depth.
+
+        :param channel: A Channel object or channel ID
+        :return: A list of Channel objects, starting with the given channel,
+            with each channel's sub-channels directly after it
+        """
+
+        if not isinstance(channel, Channel):
+            channel = self.channels[channel]
+
+        result = []
+        stack = [channel]
+
+        while stack:
+            current = stack.pop()
+            result.append(current)
+            stack.extend(reversed(self.get_channel_children(current)))
+
+        return result
+
+    def _index_channel(self, channel):
+        self._channel_names.setdefault(
+            channel.name.lower(), []
+        ).append(channel)
+
+        if channel.parent is not None:
+            self._channel_children.setdefault(
+                channel.parent, set()
+            ).add(channel.channel_id)
+
+    def _unindex_channel(self, channel):
+        name = channel.name.lower()
+        channels = self._channel_names.get(name)
+
+        if channels is not None:
+            if channel in channels:
+                channels.remove(channel)
+            if not channels:
+                del self._channel_names[name]
+
+        children = self._channel_children.get(channel.parent)
+
+        if children is not None:
+            children.discard(channel.channel_id)
+            if not children:
+                del self._channel_children[channel.parent]
+
+    def _unindex_user_name(self, user):
+        name = user.nickname.lower()
+
+        if self._user_names.get(name) is user:
+            del self._user_names[name]
+
     # region Permissions
 
     def set_permissions(self, channel, permissions, flush=False):
-        # TODO: Investigate flush properly
-        self._acls[channel] = permissions
+        if isinstance(channel, Channel):
+            channel = channel.channel_id
+
+        self.permissions.set(channel, permissions, flush)
 
     def has_permission(self, channel, *perms):
-        # TODO: Figure out how perms actually work, and how to store them, etc.
-        # Note: Do not use these yet.
+        """
+        Check whether we have all of the given permissions in a channel.
+
+        This is answered from the permission cache. If we don't know our
+        permissions in the channel yet, they're fetched for next time, and
+        this returns False.
+
+        :param channel: A Channel object, channel ID or channel name
+        :param perms: Perms values
+        """
+
         if not isinstance(channel, Channel):
             channel = self.get_channel(channel)
-        if channel is None or channel not in self._acls:
+        if channel is None:
             return False
-        return Perms.has_permission(self._acls[channel], *perms)
+        return self.permissions.has(channel.channel_id, *perms)
+
+    def get_permissions(self, channel):
+        """
+        Get our permissions in a channel, asking the server if we need to.
+
+        :param channel: A Channel object or channel ID
+        :return: A Deferred that fires with a Perms bitmask, or None if the
+            server doesn't answer
+        """
+
+        if isinstance(channel, Channel):
+            channel = channel.channel_id
+
+        return self.permissions.fetch(channel)
+
+    def prefetch_permissions(self, channel=None):
+        """
+        Fetch our permissions in a channel and every channel below it, so
+        they're ready when they're needed.
+
+        :param channel: A Channel object or channel ID - defaults to the
+            channel we're in
+        """
+
+        if channel is None:
+            if self.ourselves is None:
+                return
+            channel = self.ourselves.channel
+
+        self.permissions.prefetch(self.get_channel_subtree(channel))
 
     # endregion
@@ -0,0 +1,477 @@
+# coding=utf-8
+
+"""
+Receiving and decoding voice for the Mumble protocol.
+
+Every user who's talking gets their own stream, which puts their Opus
+packets back in order with a small jitter buffer, decodes them, and passes
+the PCM - signed 16-bit native-endian, 48kHz mono - on to anyone who's
+listening. Plugins can listen in two ways:
+
+* Add a callback with `add_callback()`, which is called with the user and
+  each chunk of PCM as it's decoded
+* Open a `PCMStream` with `open_stream()` and `read()` from it - streams can
+  be played back with the audio module's Player, too
+
+Nothing is decoded unless someone's listening. Decoders are only created
+when a user starts talking, and they're handed back to a shared pool when
+the user stops for a while or leaves, so only the people talking at once
+use any memory.
+
+Remember that the server won't send us anyone's voice while we're
+deafened, so you'll want to set `should_deafen_self` to false in the
+protocol's config.
+"""
+
+from twisted.internet import reactor, task
+
+from system.logging.logger import getLogger
+from system.translations import Translations
+
+from utils.opus.decoder import Decoder
+from utils.opus.lib import AVAILABLE as OPUS_AVAILABLE
+from utils.opus.packet import get_nb_samples
+from utils.protobuf import read_varint
+
+__author__ = 'Gareth Coles'
+_ = Translations().get()
+
+SAMPLE_RATE = 48000
+
+#: Mumble's sequence numbers count frames of this many samples (10ms)
+SEQUENCE_SAMPLES = SAMPLE_RATE // 100
+
+#: Set on the length of a user's last frame when they stop talking
+TERMINATOR = 0x2000
+
+
+def parse_opus_payload(payload):
+    """
+    Get the Opus packet out of a voice packet's payload.
+
+    :param payload: The payload, after the header, session and sequence
+    :return: A tuple of (Opus packet, whether it's the last one)
+    """
+
+    header, pos = read_varint(bytearray(payload[:9]))
+    length = header & 0x1FFF
+
+    # Anything after the packet is positional audio data, which we ignore
+    return payload[pos:pos + length], bool(header & TERMINATOR)
+
+
+class JitterBuffer(object):
+    """
+    Puts a user's packets back in order.
+
+    Packets come out in order of sequence number. If one goes missing, we
+    wait until *depth* later packets have arrived before giving up on it -
+    it's then passed on as None, so the decoder can fill the gap.
+    """
+
+    #: Gaps longer than this many sequence numbers are treated as the start
+    #: of a new stream, rather than something to fill
+    MAX_GAP = 12
+
+    def __init__(self, depth=3):
+        self.depth = depth
+
+        self.packets = {}
+        self.next = None
+
+        self.late = 0
+        self.lost = 0
+
+    def push(self, sequence, packet, last):
+        """
+        Add a packet.
+
+        :param packet: The Opus packet
+        :param last: Whether the user stopped talking after this packet
+        """
+
+        if self.next is not None and sequence < self.next:
+            if self.next - sequence > self.MAX_GAP:
+                # The user's client has most likely restarted its count
+                self.next = sequence
+            else:
+                self.late += 1
+                return
+
+        try:
+            units = max(1, get_nb_samples(packet) // SEQUENCE_SAMPLES)
+        except (IndexError, ValueError):
+            return
+
+        self.packets[sequence] = (packet, units, last)
+
+        if self.next is None:
+            self.next = sequence
+
+    def pop(self, flush=False):
+        """
+        Take out all of the packets that are ready.
+
+        :param flush: Don't wait for missing packets, and take everything
+        :return: A list of (Opus packet or None, length in sequence
+            numbers) tuples
+        """
+
+        ready = []
+        packets = self.packets
+
+        while packets:
+            if self.next in packets:
+                packet, units, last = packets.pop(self.next)
+                ready.append((packet, units))
+
+                if last:
+                    # Whatever comes next starts a new stream
+                    self.next = min(packets) if packets else None
+                else:
+                    self.next += units
+
+                continue
+
+            if not flush and len(packets) < self.depth:
+                break
+
+            following = min(packets)
+            gap = following - self.next
+
+            if gap <= self.MAX_GAP:
+                self.lost += 1
+                ready.append((None, gap))
+
+            self.next = following
+
+        return ready
+
+    def clear(self):
+        self.packets.clear()
+        self.next = None
+
+
+class DecoderPool(object):
+    """
+    Keeps a few idle decoders around for re-use.
+
+    :param factory: Called with no arguments to create a new decoder
+    :param max_idle: How many idle decoders to keep
+    """
+
+    def __init__(self, factory, max_idle=8):
+        self.factory = factory
+        self.max_idle = max_idle
+
+        self.idle = []
+        self.created = 0
+
+    def acquire(self):
+        if self.idle:
+            return self.idle.pop()
+
+        self.created += 1
+        return self.factory()
+
+    def release(self, decoder):
+        if len(self.idle) < self.max_idle:
+            decoder.reset()
+            self.idle.append(decoder)
+
+
+class PCMStream(object):
+    """
+    Decoded audio from one user, for reading.
+
+    Audio is buffered until it's read; if it isn't read quickly enough, the
+    oldest audio is dropped. The stream finishes once it's been closed - or
+    its user has left - and everything in it has been read.
+    """
+
+    #: How much audio to buffer, in bytes (five seconds)
+    MAX_BUFFER = SAMPLE_RATE * 2 * 5
+
+    def __init__(self, receiver, session):
+        self.receiver = receiver
+        self.session = session
+
+        self.buffer = bytearray()
+        self.closed = False
+        self.overruns = 0
+
+    @property
+    def finished(self):
+        return self.closed and not self.buffer
+
+    def write(self, pcm):
+        buf = self.buffer
+        buf.extend(pcm)
+
+        if len(buf) > self.MAX_BUFFER:
+            self.overruns += 1
+            del buf[:len(buf) - self.MAX_BUFFER]
+
+    def read(self, size):
+        buf = self.buffer
+
+        data = bytes(buf[:size])
+        del buf[:size]
+
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.receiver.close_stream(self)
+
+
+class UserStream(object):
+    """
+    The receiving state for one user who's talking.
+    """
+
+    __slots__ = ("session", "buffer", "decoder", "last_packet")
+
+    def __init__(self, session, depth):
+        self.session = session
+        self.buffer = JitterBuffer(depth)
+        self.decoder = None
+        self.last_packet = 0
+
+
+class VoiceReceiver(object):
+    """
+    Demultiplexes voice packets by user, decodes them and passes the audio
+    on to listeners.
+    """
+
+    #: How often to flush stalled jitter buffers and look for idle users, in
+    #: seconds
+    TICK = 0.1
+
+    #: How long a user can be quiet before we give their decoder back
+    IDLE_TIMEOUT = 5
+
+    #: How long to wait for a missing packet before giving up on it
+    FLUSH_TIMEOUT = 0.1
+
+    #: The most users we'll decode at once - if more than this are talking,
+    #: the one who's been quiet longest is dropped
+    MAX_STREAMS = 64
+
+    def __init__(self, protocol, depth=3, decoder_factory=None, clock=None):
+        self.protocol = protocol
+        self.depth = depth
+        self.clock = clock or reactor
+
+        #: Whether we're able to decode anything
+        self.available = decoder_factory is not None or OPUS_AVAILABLE
+
+        if decoder_factory is None:
+            decoder_factory = self._create_decoder
+
+        self.pool = DecoderPool(decoder_factory)
+
+        self.streams = {}  # session -> UserStream
+        self.callbacks = []  # (callback, session or None)
+        self.pcm_streams = {}  # session -> [PCMStream]
+
+        self.packets = 0
+        self.errors = 0
+
+        self._task = None
+
+        self.log = getLogger("%s/Voice" % protocol.name)
+
+    @property
+    def listening(self):
+        return bool(self.callbacks or self.pcm_streams)
+
+    # Listeners
+
+    def add_callback(self, callback, user=None):
+        """
+        Call something with the audio from every user, or just one.
+
+        :param callback: Called with the User and a string of PCM
+        :param user: A User, to only get their audio
+        """
+
+        self._check_available()
+
+        session = user.session if user is not None else None
+        self.callbacks.append((callback, session))
+
+    def remove_callback(self, callback):
+        self.callbacks = [
+            (cb, session) for cb, session in self.callbacks
+            if cb != callback
+        ]
+
+        self._check_listening()
+
+    def open_stream(self, user):
+        """
+        Open a stream of a user's audio.
+
+        :return: A PCMStream - close it when you're done with it
+        """
+
+        self._check_available()
+
+        stream = PCMStream(self, user.session)
+        self.pcm_streams.setdefault(user.session, []).append(stream)
+
+        return stream
+
+    def close_stream(self, stream):
+        streams = self.pcm_streams.get(stream.session)
+
+        if streams is not None and stream in streams:
+            streams.remove(stream)
+
+            if not streams:
+                del self.pcm_streams[stream.session]
+
+        self._check_listening()
+
+    def _check_available(self):
+        if not self.available:
+            raise RuntimeError("libopus is not installed")
+
+    def _check_listening(self):
+        if not self.listening:
+            for session in list(self.streams):
+                self._evict(session)
+
+    # Packets
+
+    def packet_received(self, session, sequence, payload):
+        """
+        Handle an Opus voice packet.
+        """
+
+        if not self.listening:
+            return
+
+        try:
+            packet, last = parse_opus_payload(payload)
+        except IndexError:
+            self.errors += 1
+            return
+
+        if not packet:
+            return
+
+        self.packets += 1
+
+        stream = self.streams.get(session)
+
+        if stream is None:
+            stream = self._new_stream(session)
+
+        stream.last_packet = self.clock.seconds()
+        stream.buffer.push(sequence, packet, last)
+
+        self._decode(stream, stream.buffer.pop())
+
+    def user_left(self, session):
+        self._evict(session)
+
+        for stream in self.pcm_streams.pop(session, []):
+            stream.closed = True
+
+    def stop(self):
+        for session in list(self.streams):
+            self._evict(session)
+
+        for streams in self.pcm_streams.values():
+            for stream in streams:
+                stream.closed = True
+
+        self.pcm_streams.clear()
+
+    def _new_stream(self, session):
+        if len(self.streams) >= self.MAX_STREAMS:
+            quietest = min(
+                self.streams.itervalues(), key=lambda s: s.last_packet
+            )
+            self._evict(quietest.session)
+
+        stream = UserStream(session, self.depth)
+        self.streams[session] = stream
+
+        if self._task is None:
+            self._task = task.LoopingCall(self._tick)
+            self._task.clock = self.clock
+            self._task.start(self.TICK, False)
+
+        return stream
+
+    def _evict(self, session):
+        stream = self.streams.pop(session, None)
+
+        if stream is not None and stream.decoder is not None:
+            self.pool.release(stream.decoder)
+            stream.decoder = None
+
+        if not self.streams and self._task is not None:
+            if self._task.running:
+                self._task.stop()
+            self._task = None
+
+    def _tick(self):
+        now = self.clock.seconds()
+
+        for session, stream in self.streams.items():
+            quiet = now - stream.last_packet
+
+            if quiet > self.IDLE_TIMEOUT:
+                self._evict(session)
+            elif quiet > self.FLUSH_TIMEOUT and stream.buffer.packets:
+                self._decode(stream, stream.buffer.pop(True))
+
+    def _decode(self, stream, packets):
+        if not packets:
+            return
+
+        if stream.decoder is None:
+            stream.decoder = self.pool.acquire()
+
+        decoder = stream.decoder
+        pcm = []
+
+        for packet, units in packets:
+            try:
+                pcm.append(decoder.decode(
+                    packet, units * SEQUENCE_SAMPLES
+                ))
+            except Exception:
+                self.errors += 1
+                self.log.debug(_("Unable to decode voice packet"),
+                               exc_info=1)
+
+        pcm = "".join(pcm)
+
+        if pcm:
+            self._deliver(stream.session, pcm)
+
+    def _deliver(self, session, pcm):
+        user = self.protocol.users.get(session)
+
+        if user is None:
+            return
+
+        for callback, wanted in self.callbacks:
+            if wanted is None or wanted == session:
+                try:
+                    callback(user, pcm)
+                except Exception:
+                    self.log.exception(_("Error in voice callback"))
+
+        for stream in self.pcm_streams.get(session, ()):
+            stream.write(pcm)
+
+    def _create_decoder(self):
+        return Decoder(SAMPLE_RATE, 1)
@@ -13,6 +13,8 @@ class Stats(object):
     Mumble user connection stats
     """
 
+    __slots__ = ("good", "late", "lost", "resync")
+
     def __init__(self, good=0, late=0, lost=0, resync=0):
         self.good = good
         self.late = late
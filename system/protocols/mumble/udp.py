@@ -0,0 +1,197 @@
+# coding=utf-8
+
+"""
+Mumble's UDP voice channel.
+
+Voice packets are sent over UDP, encrypted with the keys from the server's
+CryptSetup message, rather than being tunnelled over the TCP connection.
+We ping the server over UDP every few seconds - until it answers, or if it
+stops answering, voice goes through the TCP tunnel instead, just like the
+official client.
+"""
+
+import time
+
+from twisted.internet import reactor, task
+from twisted.internet.protocol import DatagramProtocol
+
+from system.logging.logger import getLogger
+from system.translations import Translations
+
+from utils.protobuf import encode_varints, read_varint
+
+__author__ = 'Gareth Coles'
+_ = Translations().get()
+
+# Voice packet types, from the top three bits of the header byte
+UDP_CELT_ALPHA = 0
+UDP_PING = 1
+UDP_SPEEX = 2
+UDP_CELT_BETA = 3
+UDP_OPUS = 4
+
+
+class VoiceTransport(DatagramProtocol):
+    """
+    The UDP side of a Mumble connection.
+
+    Decrypted voice packets are passed to the protocol's `recv_UDP()`; UDP
+    pings are dealt with here.
+    """
+
+    #: How often to ping the server, in seconds
+    PING_INTERVAL = 5
+
+    #: How long the server can go without answering before we stop using UDP
+    TIMEOUT = 15
+
+    #: How long to wait between asking the server to resynchronise our
+    #: encryption, when it's sending us packets we can't decrypt
+    RESYNC_INTERVAL = 5
+
+    def __init__(self, protocol, crypt):
+        self.protocol = protocol
+        self.crypt = crypt
+
+        self.address = None
+        self.port = None
+
+        self.active = False
+        self.last_good = 0
+        self.last_resync = 0
+
+        self.packets_sent = 0
+        self.packets_received = 0
+
+        self.ping_count = 0
+        self.ping_avg = 0.0
+        self._ping_m2 = 0.0
+
+        self._ping_task = None
+
+        self.log = getLogger("%s/UDP" % protocol.name)
+
+    @property
+    def ping_var(self):
+        if self.ping_count < 2:
+            return 0.0
+        return self._ping_m2 / (self.ping_count - 1)
+
+    def start(self, host, port):
+        """
+        Start listening, and pinging the server at *host*:*port*.
+
+        :return: A Deferred that fires once we're listening
+        """
+
+        def resolved(address):
+            self.address = (address, port)
+            self.port = reactor.listenUDP(0, self)
+
+            self._ping_task = task.LoopingCall(self.ping)
+            self._ping_task.start(self.PING_INTERVAL)
+
+        def failed(failure):
+            self.log.warn(
+                _("Unable to resolve %s, voice will be sent over TCP: %s") %
+                (host, failure.getErrorMessage())
+            )
+
+        return reactor.resolve(host).addCallbacks(resolved, failed)
+
+    def stop(self):
+        self.active = False
+
+        if self._ping_task is not None and self._ping_task.running:
+            self._ping_task.stop()
+
+        self._ping_task = None
+
+        if self.port is not None:
+            port, self.port = self.port, None
+            return port.stopListening()
+
+    def startProtocol(self):
+        self.transport.connect(*self.address)
+
+    def connectionRefused(self):
+        self.fallback(_("connection refused"))
+
+    def fallback(self, reason):
+        if self.active:
+            self.log.warn(
+                _("UDP voice isn't working (%s), falling back to TCP") %
+                reason
+            )
+
+        self.active = False
+
+    def ping(self):
+        if self.active and time.time() - self.last_good > self.TIMEOUT:
+            self.fallback(_("no response to pings"))
+
+        timestamp = int(time.time() * 1000000)
+        self.write(chr(UDP_PING << 5) + bytes(encode_varints(timestamp)))
+
+    def send(self, packet):
+        """
+        Send a voice packet over UDP, if it's working.
+
+        :return: False if UDP isn't working, and the packet should be
+            tunnelled over TCP instead
+        """
+
+        if not self.active:
+            return False
+
+        return self.write(packet)
+
+    def write(self, packet):
+        if self.transport is None or not self.crypt.is_valid:
+            return False
+
+        self.transport.write(self.crypt.encrypt(packet))
+        self.packets_sent += 1
+
+        return True
+
+    def datagramReceived(self, data, address):
+        plain = self.crypt.decrypt(data)
+        now = time.time()
+
+        if plain is None:
+            # If packets are arriving but we can't decrypt any of them, the
+            # server probably has a different IV for us
+            if now - self.last_good > self.RESYNC_INTERVAL and \
+                    now - self.last_resync > self.RESYNC_INTERVAL:
+                self.last_resync = now
+                self.protocol.request_crypt_resync()
+            return
+
+        self.last_good = now
+        self.packets_received += 1
+
+        if not self.active:
+            self.log.info(_("UDP voice is working"))
+            self.active = True
+
+        if not plain:
+            return
+
+        if ord(plain[0]) >> 5 == UDP_PING:
+            self.ping_received(plain)
+        else:
+            self.protocol.recv_UDP(plain, True)
+
+    def ping_received(self, packet):
+        timestamp, __ = read_varint(bytearray(packet), 1)
+        elapsed = (time.time() * 1000000 - timestamp) / 1000.0
+
+        if not 0 <= elapsed < 60000:
+            return
+
+        # Running mean and variance of the round trip time, in ms
+        self.ping_count += 1
+        delta = elapsed - self.ping_avg
+        self.ping_avg += delta / self.ping_count
+        self._ping_m2 += delta * (elapsed - self.ping_avg)
@@ -1,5 +1,7 @@
 # coding=utf-8
 from system.protocols.mumble.acl import Perms
+from system.protocols.mumble.blobs import AVATAR, COMMENT
+from system.protocols.mumble.permissions import ROOT_CHANNEL
 from system.protocols.mumble.structs import Stats
 
 __author__ = 'Sean'
@@ -8,6 +10,17 @@ from system.protocols.generic import user
 
 
 class User(user.User):
+    __slots__ = (
+        "session", "channel", "mute", "deaf", "suppress", "self_mute",
+        "self_deaf", "priority_speaker", "recording",
+        "comment_hash", "avatar_hash", "user_id", "certificate_hash",
+        "certificates", "packet_stats_from_client", "packet_stats_from_server",
+        "udp_packets_sent", "tcp_packets_sent", "udp_ping_avg",
+        "udp_ping_var", "tcp_ping_avg", "tcp_ping_var", "version",
+        "celt_versions", "address", "bandwidth", "online_time", "idle_time",
+        "strong_certificate", "opus"
+    )
+
     def __init__(self, protocol, session, name, channel, mute, deaf,
                  suppress, self_mute, self_deaf, priority_speaker, recording):
         # Mumble is always "tracked"
@@ -22,9 +35,9 @@ class User(user.User):
         self.priority_speaker = priority_speaker
         self.recording = recording
 
-        self.comment = None
+        # Only the hashes are kept here - see the comment and avatar
+        # properties, and get_comment() and get_avatar()
         self.comment_hash = None
-        self.avatar = None
         self.avatar_hash = None
 
         self.user_id = None
@@ -52,6 +65,42 @@ class User(user.User):
     def __str__(self):
         return "%s (%s)" % (self.nickname, self.session)
 
+    @property
+    def comment(self):
+        """
+        The user's comment, if we have it - use get_comment() to fetch it
+        from the server if we don't.
+        """
+
+        return self.protocol.blobs.cached(COMMENT, self.comment_hash)
+
+    @property
+    def avatar(self):
+        """
+        The user's avatar, if we have it - use get_avatar() to fetch it from
+        the server if we don't.
+        """
+
+        return self.protocol.blobs.cached(AVATAR, self.avatar_hash)
+
+    def get_comment(self):
+        """
+        Get the user's comment, fetching it from the server if needed.
+
+        :return: A Deferred that fires with the comment, or None
+        """
+
+        return self.protocol.blobs.fetch(self, COMMENT)
+
+    def get_avatar(self):
+        """
+        Get the user's avatar image, fetching it from the server if needed.
+
+        :return: A Deferred that fires with the avatar, or None
+        """
+
+        return self.protocol.blobs.fetch(self, AVATAR)
+
     def respond(self, message):
         message = message.replace("{CHARS}", self.protocol.control_chars)
         self.protocol.send_msg(self, message, target_type="user")
@@ -61,16 +110,24 @@ class User(user.User):
     # tightly coupled mess, and there aren't a whole lot of things you can
     # actually make generic between protocols anyway.
 
+    # Note: These only work for ourselves - the server only tells us our
+    # own permissions.
+
     def can_kick(self, user, channel):
-        # TODO: Look into how permissions work properly? It looks like you need
-        # kick in the root channel to kick
-        return self.protocol.has_permission(0, Perms.KICK)
+        # Kicking is only checked in the root channel
+        return self.protocol.has_permission(ROOT_CHANNEL, Perms.KICK)
 
     def can_ban(self, user, channel):
-        # TODO: See TODO in can_kick
-        # TODO: This doesn't work - need to look into how permissions work more
-        # closely
-        return self.protocol.has_permission(0, Perms.BAN)
+        # As is banning
+        return self.protocol.has_permission(ROOT_CHANNEL, Perms.BAN)
+
+    def can_move(self, user, channel):
+        # We need to be able to move people out of their channel, and into
+        # the new one
+        return (
+            self.protocol.has_permission(user.channel, Perms.MOVE) and
+            self.protocol.has_permission(channel, Perms.MOVE)
+        )
 
     # endregion
 
@@ -0,0 +1,180 @@
+# coding=utf-8
+
+"""
+Scheduling UserStats requests for the Mumble protocol.
+
+Rather than asking for every user's stats at once, each user gets their own
+slot - spread evenly over the polling interval - and requests go out a few
+at a time, at no more than a set rate. Users who've been idle for a while
+are polled less often, and we only poll users someone's interested in:
+everyone if a plugin handles the Mumble/UserStats event, otherwise just the
+users passed to `watch()`.
+"""
+
+import heapq
+import random
+
+from collections import deque
+
+from twisted.internet import reactor, task
+
+__author__ = 'Gareth Coles'
+
+
+class StatsScheduler(object):
+    """
+    Sends UserStats requests on behalf of a protocol.
+
+    :param protocol: The protocol - we call its `request_userstats()`
+    :param interval: How often to poll active users, in seconds
+    :param idle_interval: How often to poll idle users, in seconds
+    :param idle_threshold: How long a user has to be idle for, in seconds,
+        before they're polled less often
+    :param max_rate: The most requests to send per second
+    """
+
+    #: How often we send a batch of requests, in seconds
+    TICK = 0.5
+
+    def __init__(self, protocol, interval=60, idle_interval=300,
+                 idle_threshold=300, max_rate=10, clock=None):
+        self.protocol = protocol
+        self.interval = interval
+        self.idle_interval = max(interval, idle_interval)
+        self.idle_threshold = idle_threshold
+        self.max_rate = max_rate
+        self.clock = clock or reactor
+
+        self.due = {}  # session -> when it's due
+        self.heap = []  # (when it's due, session), may include stale entries
+        self.once = deque()  # (session, stats_only), sent before the rest
+        self.watched = set()
+
+        self.sent = 0
+        self.skipped = 0
+
+        self._allowance = 0.0
+        self._last_tick = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and self._task.running
+
+    def start(self):
+        if self.running:
+            return
+
+        self._last_tick = self.clock.seconds()
+        self._allowance = 0.0
+
+        self._task = task.LoopingCall(self._tick)
+        self._task.clock = self.clock
+        self._task.start(self.TICK, False)
+
+    def stop(self):
+        if self.running:
+            self._task.stop()
+
+        self._task = None
+
+    def clear(self):
+        self.due.clear()
+        del self.heap[:]
+        self.once.clear()
+        self.watched.clear()
+
+    # Users
+
+    def add(self, user):
+        """
+        Start polling a user, at a random point in the interval - this is
+        what spreads the requests out.
+        """
+
+        when = self.clock.seconds() + random.uniform(0, self.interval)
+
+        self.due[user.session] = when
+        heapq.heappush(self.heap, (when, user.session))
+
+    def remove(self, user):
+        self.due.pop(user.session, None)
+        self.watched.discard(user.session)
+
+    def watch(self, user):
+        """
+        Poll a user even if no plugin handles Mumble/UserStats.
+        """
+
+        self.watched.add(user.session)
+
+    def unwatch(self, user):
+        self.watched.discard(user.session)
+
+    def request(self, user, stats_only=False):
+        """
+        Request a user's stats once, as soon as we're able to.
+        """
+
+        self.once.append((user.session, stats_only))
+
+    # Sending
+
+    def _tick(self):
+        now = self.clock.seconds()
+
+        # Our allowance builds up at the max rate, but we don't let it build
+        # up past one tick's worth, so we never send a burst
+        self._allowance = min(
+            max(1, self.max_rate * self.TICK),
+            self._allowance + (now - self._last_tick) * self.max_rate
+        )
+        self._last_tick = now
+
+        users = self.protocol.users
+
+        while self.once and self._allowance >= 1:
+            session, stats_only = self.once.popleft()
+            user = users.get(session)
+
+            if user is not None:
+                self._send(user, stats_only)
+
+        heap = self.heap
+        interested = None
+
+        while heap and heap[0][0] <= now and self._allowance >= 1:
+            when, session = heapq.heappop(heap)
+
+            if self.due.get(session) != when:
+                continue  # Removed, or rescheduled
+
+            user = users.get(session)
+
+            if user is None:
+                del self.due[session]
+                continue
+
+            if interested is None:
+                interested = self.protocol.event_manager.has_callback(
+                    "Mumble/UserStats"
+                )
+
+            if interested or session in self.watched:
+                self._send(user, True)
+            else:
+                self.skipped += 1
+
+            if user.idle_time >= self.idle_threshold:
+                when = now + self.idle_interval
+            else:
+                when = now + self.interval
+
+            self.due[session] = when
+            heapq.heappush(heap, (when, session))
+
+    def _send(self, user, stats_only):
+        self._allowance -= 1
+        self.sent += 1
+
+        self.protocol.request_userstats(user, stats_only)
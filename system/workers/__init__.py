@@ -0,0 +1,23 @@
+# coding=utf-8
+
+"""
+Support for running protocols in separate worker processes.
+
+Normally, every protocol and plugin runs in a single process with a single
+reactor, which means a bot connected to a lot of networks is limited to one
+CPU core. When workers are enabled in settings.yml, the protocols listed there
+are instead loaded by worker processes, each running their own reactor.
+
+Plugins always stay in the main process. Events thrown by protocols in a
+worker are forwarded to the main process over a local AMP connection (the
+"bus"), and calls to send_msg(), send_action() and so on are forwarded back,
+so protocol-agnostic plugins such as the Bridge work as they always have.
+
+* bus: The main process' side of things
+* worker: The worker process' side of things, and its entry point
+* remote: Proxies standing in for protocols, users and channels in workers
+* commands: The AMP commands passed over the bus
+* serialization: Converting events to and from something we can send
+"""
+
+__author__ = 'Gareth Coles'
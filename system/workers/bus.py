@@ -0,0 +1,476 @@
+# coding=utf-8
+
+"""
+The main process' side of the worker bus.
+
+The bus listens on a local TCP port, spawns the worker processes, and keeps
+track of which protocols each of them is running. Workers connect back to it
+and identify themselves with a secret that's passed to them in their
+environment, so that nothing else on the machine can pretend to be one.
+"""
+
+import hmac
+import json
+import os
+import sys
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, fail
+from twisted.internet.protocol import Factory, ProcessProtocol
+from twisted.protocols import amp
+
+from system.enums import CommandState, ProtocolState
+from system.logging.logger import getLogger
+from system.translations import Translations
+from system.workers.commands import CallProtocol, FireEvent, Hello, \
+    LoadProtocol, ReconnectState, ScheduleReconnect, Shutdown, \
+    UnloadProtocol
+from system.workers.remote import RemoteConnector, RemoteFactory
+from system.workers.serialization import decode_event, decode_value, \
+    dump_args
+
+__author__ = 'Gareth Coles'
+_ = Translations().get()
+
+#: Environment variable used to pass the bus secret to workers
+SECRET_VARIABLE = "ULTROS_WORKER_SECRET"
+
+#: Command results that mean the message was handled as a command
+_HANDLED_STATES = (
+    CommandState.RateLimited, CommandState.UnknownOverridden,
+    CommandState.Success, CommandState.NoPermission, CommandState.Error
+)
+
+
+class WorkerProcess(ProcessProtocol):
+    """
+    A single worker process, and our AMP connection to it once it's up.
+
+    Commands sent before the worker has connected to the bus are queued up
+    and sent when it does.
+    """
+
+    def __init__(self, bus, worker_id):
+        self.bus = bus
+        self.id = worker_id
+
+        self.connection = None
+        self.protocols = set()
+
+        self._queued = []
+
+    def spawn(self, port):
+        env = dict(os.environ)
+        env[SECRET_VARIABLE] = self.bus.secret
+
+        reactor.spawnProcess(
+            self, sys.executable,
+            [sys.executable, "-m", "system.workers.worker",
+             str(self.id), str(port)],
+            env=env, path=os.getcwd(),
+            childFDs={0: "w", 1: 1, 2: 2}  # Share our console
+        )
+
+    def attach(self, connection):
+        self.connection = connection
+
+        queued, self._queued = self._queued, []
+
+        for command, kwargs, deferred in queued:
+            connection.callRemote(command, **kwargs).chainDeferred(deferred)
+
+    def call(self, command, **kwargs):
+        if self.connection is not None:
+            return self.connection.callRemote(command, **kwargs)
+
+        deferred = Deferred()
+        self._queued.append((command, kwargs, deferred))
+
+        return deferred
+
+    def processEnded(self, reason):
+        self.connection = None
+
+        queued, self._queued = self._queued, []
+
+        for command, kwargs, deferred in queued:
+            deferred.errback(reason)
+
+        self.bus.worker_ended(self, reason)
+
+
+class BusConnection(amp.AMP):
+    """
+    A connection from a worker process.
+    """
+
+    def __init__(self, bus):
+        amp.AMP.__init__(self)
+
+        self.bus = bus
+        self.worker = None
+
+    @Hello.responder
+    def hello(self, worker, secret):
+        process = self.bus.workers.get(worker)
+
+        if process is None or not hmac.compare_digest(secret,
+                                                      self.bus.secret):
+            self.bus.logger.warn(
+                _("Rejecting bus connection claiming to be worker %s") %
+                worker
+            )
+            self.transport.loseConnection()
+            return {}
+
+        self.worker = process
+        process.attach(self)
+
+        self.bus.logger.debug(_("Worker %s connected") % worker)
+
+        return {}
+
+    @FireEvent.responder
+    def fire_event(self, protocol, callback, state, event):
+        if self.worker is None:
+            return {}
+
+        try:
+            self.bus.handle_event(self.worker, protocol, callback, state,
+                                  event)
+        except Exception:
+            self.bus.logger.exception(
+                _("Error handling %s event from protocol %s") %
+                (callback, protocol)
+            )
+
+        return {}
+
+    @ScheduleReconnect.responder
+    def schedule_reconnect(self, protocol, host, delay, attempt):
+        if self.worker is not None:
+            self.bus.schedule_reconnect(
+                self.worker, protocol, host, delay, attempt
+            )
+
+        return {}
+
+    @ReconnectState.responder
+    def reconnect_state(self, protocol, state):
+        if self.worker is not None:
+            self.bus.reconnect_state(self.worker, protocol, state)
+
+        return {}
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+
+        if self.worker is not None and self.worker.connection is self:
+            self.worker.connection = None
+
+
+class WorkerBus(object):
+    """
+    Runs protocols in worker processes, on behalf of the factory manager.
+
+    The protocols listed in the config are spread over the configured number
+    of processes, in the order they're listed - protocol *n* always runs in
+    worker *n % processes*, so reloading a protocol puts it back in the same
+    worker.
+    """
+
+    def __init__(self, factory_manager, config):
+        self.factory_manager = factory_manager
+
+        self.processes = max(1, int(config.get("processes", 2)))
+        self.protocols = list(config.get("protocols", []))
+
+        self.secret = os.urandom(16).encode("hex")
+        self.workers = {}
+        self.connectors = {}  # Protocol name -> RemoteConnector
+
+        self.stopping = False
+        self.port = None
+
+        self.logger = getLogger("Workers")
+
+    def start(self):
+        factory = Factory.forProtocol(lambda: BusConnection(self))
+        self.port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+
+        self.logger.info(
+            _("Worker bus listening on port %s; %s protocol(s) over up to %s "
+              "worker(s)") % (self.port.getHost().port, len(self.protocols),
+                              self.processes)
+        )
+
+    def stop(self):
+        """
+        Shut down all of the workers.
+
+        :return: A Deferred that fires when they've all responded
+        """
+
+        self.stopping = True
+
+        deferreds = [
+            process.call(Shutdown) for process in self.workers.values()
+            if process.connection is not None
+        ]
+
+        deferred = DeferredList(deferreds, consumeErrors=True)
+
+        def stop_listening(result):
+            if self.port is not None:
+                return self.port.stopListening()
+
+        deferred.addBoth(stop_listening)
+        return deferred
+
+    def handles(self, name):
+        """
+        Whether a protocol should be run in a worker.
+        """
+
+        return name in self.protocols
+
+    def worker_for(self, name):
+        return self.protocols.index(name) % self.processes
+
+    def get_worker(self, worker_id):
+        process = self.workers.get(worker_id)
+
+        if process is None:
+            self.logger.info(_("Starting worker %s") % worker_id)
+
+            process = WorkerProcess(self, worker_id)
+            self.workers[worker_id] = process
+            process.spawn(self.port.getHost().port)
+
+        return process
+
+    # Protocol management
+
+    def load_protocol(self, name, conf_location):
+        """
+        Load a protocol in its worker, starting the worker if needed.
+
+        The protocol is loaded in the background - if that fails, it's
+        removed from the factory manager again.
+
+        :return: A RemoteFactory for the factory manager to keep track of
+        """
+
+        process = self.get_worker(self.worker_for(name))
+        process.protocols.add(name)
+
+        factory = RemoteFactory(name, self, process.id)
+
+        def loaded(result):
+            state = result["state"]
+
+            if state != ProtocolState.Loaded.name:
+                self.logger.warn(
+                    _("Worker %s failed to load protocol %s: %s") %
+                    (process.id, name, state)
+                )
+                self._forget_protocol(process, name, factory)
+            else:
+                self.logger.info(
+                    _("Protocol %s loaded in worker %s") % (name, process.id)
+                )
+
+        def failed(failure):
+            self.logger.error(
+                _("Error loading protocol %s in worker %s: %s") %
+                (name, process.id, failure.getErrorMessage())
+            )
+            self._forget_protocol(process, name, factory)
+
+        process.call(
+            LoadProtocol, protocol=name, config=conf_location
+        ).addCallbacks(loaded, failed)
+
+        return factory
+
+    def unload_protocol(self, name):
+        if name not in self.protocols:
+            return
+
+        process = self.workers.get(self.worker_for(name))
+
+        if process is None or name not in process.protocols:
+            return
+
+        process.protocols.discard(name)
+
+        if process.connection is None:
+            return
+
+        def failed(failure):
+            self.logger.error(
+                _("Error unloading protocol %s in worker %s: %s") %
+                (name, process.id, failure.getErrorMessage())
+            )
+
+        process.call(UnloadProtocol, protocol=name).addErrback(failed)
+
+    def call_protocol(self, worker_id, name, method, args):
+        process = self.workers.get(worker_id)
+
+        if process is None:
+            return fail(KeyError(worker_id))
+
+        deferred = process.call(
+            CallProtocol, protocol=name, method=method, args=dump_args(args)
+        )
+
+        def failed(failure):
+            self.logger.error(
+                _("Error calling %s on protocol %s: %s") %
+                (method, name, failure.getErrorMessage())
+            )
+
+        deferred.addCallback(lambda result: result["result"])
+        deferred.addErrback(failed)
+
+        return deferred
+
+    def worker_ended(self, process, reason):
+        if self.workers.get(process.id) is process:
+            del self.workers[process.id]
+
+        if self.stopping:
+            self.logger.debug(_("Worker %s exited") % process.id)
+            return
+
+        self.logger.error(
+            _("Worker %s exited unexpectedly: %s") %
+            (process.id, reason.getErrorMessage())
+        )
+
+        for name in list(process.protocols):
+            self.logger.warn(_("Protocol %s is no longer loaded") % name)
+            self._forget_protocol(process, name)
+
+        for name, connector in self.connectors.items():
+            if connector.process is process:
+                self.reconnect_state(process, name, "forgotten")
+
+    def _forget_protocol(self, process, name, factory=None):
+        process.protocols.discard(name)
+
+        current = self.factory_manager.get_factory(name)
+
+        if isinstance(current, RemoteFactory) and \
+                (factory is None or current is factory):
+            self.factory_manager.remove_protocol(name)
+
+    # Reconnections
+
+    def schedule_reconnect(self, process, name, host, delay, attempt):
+        """
+        Schedule a reconnection for a protocol in a worker, with the factory
+        manager's ReconnectScheduler - so the limits on connecting apply to
+        the workers' protocols along with our own.
+        """
+
+        connector = self._get_connector(process, name, host)
+        connector.reconnection_attempts = attempt
+
+        self.factory_manager.reconnects.schedule(connector, connector, delay)
+
+    def reconnect_state(self, process, name, state):
+        scheduler = self.factory_manager.reconnects
+        connector = self._get_connector(process, name)
+
+        if state == "connected":
+            scheduler.connected(connector)
+        elif state == "failed":
+            scheduler.failed(connector)
+        elif state == "cancelled":
+            reconnection = scheduler.reconnections.get(name)
+
+            if reconnection is not None and reconnection.active():
+                reconnection.cancel()
+        elif state == "forgotten":
+            scheduler.forget(connector)
+            del self.connectors[name]
+        else:
+            self.logger.warn(
+                _("Unknown reconnection state for protocol %s: %s") %
+                (name, state)
+            )
+
+    def _get_connector(self, process, name, host=None):
+        connector = self.connectors.get(name)
+
+        if connector is None or connector.process is not process:
+            connector = RemoteConnector(name, host or name, process)
+            self.connectors[name] = connector
+        elif host is not None:
+            connector.host = host
+
+        return connector
+
+    # Events
+
+    def handle_event(self, process, name, callback, state, data):
+        factory = self.factory_manager.get_factory(name)
+
+        if not isinstance(factory, RemoteFactory) or \
+                factory.worker != process.id:
+            self.logger.debug(
+                _("Dropping %s event for unknown protocol %s") %
+                (callback, name)
+            )
+            return
+
+        protocol = factory.protocol
+        resolve = self.factory_manager.get_protocol
+
+        protocol.update_state(
+            decode_value(json.loads(state), protocol, resolve)
+        )
+
+        event = decode_event(data, protocol, resolve)
+
+        if callback == "MessageReceived" and self.run_command(event):
+            return
+
+        self.factory_manager.event_manager.run_callback(callback, event)
+
+    def run_command(self, event):
+        """
+        Check whether a message from a worker is a command, and run it if so.
+
+        Commands live in the main process, so workers never find any and
+        just send on the MessageReceived event - this does what the protocol
+        would have done before throwing it.
+
+        :return: Whether the message was a command
+        """
+
+        if getattr(event, "type", None) != "message":
+            return False
+
+        protocol = event.caller
+
+        result = self.factory_manager.commands.process_input(
+            event.message, event.source, event.target, protocol,
+            protocol.control_chars, protocol.nickname
+        )
+
+        if not isinstance(result, tuple):
+            # Just the control characters, without a command after them
+            result = CommandState.NotACommand, None
+
+        state, error = result
+
+        if state is CommandState.RateLimited:
+            event.source.respond(_("That command has been rate-limited, "
+                                   "please try again later."))
+        elif state is CommandState.Error:
+            event.source.respond(_("Error running command: %s") % error)
+
+        return state in _HANDLED_STATES
@@ -0,0 +1,166 @@
+# coding=utf-8
+
+"""
+AMP commands passed between the main process and its workers.
+"""
+
+from twisted.protocols import amp
+
+__author__ = 'Gareth Coles'
+
+#: AMP values are limited to 65,535 bytes each
+CHUNK_SIZE = 0xffff
+
+
+class LongString(amp.Argument):
+    """
+    A byte string that may be longer than AMP's limit on the size of a value.
+
+    This is split into chunks, each stored under its own key in the box.
+    """
+
+    def toBox(self, name, strings, objects, proto):
+        value = objects[name]
+        chunks = 0
+
+        for chunks, start in enumerate(xrange(0, len(value), CHUNK_SIZE), 1):
+            strings["%s.%d" % (name, chunks)] = value[
+                start:start + CHUNK_SIZE
+            ]
+
+        strings[name] = str(chunks)
+
+    def fromBox(self, name, strings, objects, proto):
+        chunks = int(strings[name])
+
+        objects[name] = "".join(
+            strings["%s.%d" % (name, x)] for x in xrange(1, chunks + 1)
+        )
+
+
+# Worker -> main process
+
+
+class Hello(amp.Command):
+    """
+    Sent by a worker when it first connects, to identify itself.
+    """
+
+    arguments = [
+        ("worker", amp.Integer()),
+        ("secret", amp.String())
+    ]
+    response = []
+
+
+class FireEvent(amp.Command):
+    """
+    Sent by a worker for each event thrown by one of its protocols.
+    """
+
+    arguments = [
+        ("protocol", amp.String()),
+        ("callback", amp.String()),
+        ("state", amp.String()),
+        ("event", LongString())
+    ]
+    requiresAnswer = False
+
+
+class ScheduleReconnect(amp.Command):
+    """
+    Ask the main process' ReconnectScheduler to reconnect a protocol.
+
+    Workers don't reconnect on their own, so that the limits on how many
+    protocols can be connecting at once apply to all of them together. Once
+    the delay has passed and there's a slot free, the main process sends
+    Reconnect.
+    """
+
+    arguments = [
+        ("protocol", amp.String()),
+        ("host", amp.String()),
+        ("delay", amp.Float()),
+        ("attempt", amp.Integer())
+    ]
+    requiresAnswer = False
+
+
+class ReconnectState(amp.Command):
+    """
+    Tell the main process' ReconnectScheduler how a protocol's connection is
+    going, so it can free up its slot.
+
+    The state is one of "connected", "failed", "cancelled" or "forgotten".
+    """
+
+    arguments = [
+        ("protocol", amp.String()),
+        ("state", amp.String())
+    ]
+    requiresAnswer = False
+
+
+# Main process -> worker
+
+
+class LoadProtocol(amp.Command):
+    """
+    Load a protocol, as FactoryManager.load_protocol() would.
+
+    The response contains the name of the resulting ProtocolState.
+    """
+
+    arguments = [
+        ("protocol", amp.String()),
+        ("config", amp.String())
+    ]
+    response = [
+        ("state", amp.String())
+    ]
+
+
+class UnloadProtocol(amp.Command):
+    arguments = [
+        ("protocol", amp.String())
+    ]
+    response = [
+        ("unloaded", amp.Boolean())
+    ]
+
+
+class CallProtocol(amp.Command):
+    """
+    Call one of a protocol's public methods, such as send_msg().
+
+    Only methods in remote.FORWARDED_METHODS may be called.
+    """
+
+    arguments = [
+        ("protocol", amp.String()),
+        ("method", amp.String()),
+        ("args", LongString())
+    ]
+    response = [
+        ("result", amp.Boolean())
+    ]
+
+
+class Reconnect(amp.Command):
+    """
+    Sent once it's a protocol's turn to reconnect, after ScheduleReconnect.
+    """
+
+    arguments = [
+        ("protocol", amp.String())
+    ]
+    requiresAnswer = False
+
+
+class Shutdown(amp.Command):
+    """
+    Unload all of the worker's protocols and stop its reactor.
+    """
+
+    arguments = []
+    response = []
@@ -0,0 +1,285 @@
+# coding=utf-8
+
+"""
+Proxies that stand in for a protocol in a worker process, and its users and
+channels, in the main process.
+
+Plugins can treat these as they would any other protocol, user or channel,
+but they only know what they've been told by the events coming from the
+worker. Anything that changes the protocol's state - sending messages,
+joining channels and so on - is forwarded to the worker, and the return
+value only tells you whether the call was sent.
+"""
+
+from system.logging.logger import getLogger
+from system.protocols.generic.channel import Channel
+from system.protocols.generic.protocol import Protocol
+from system.protocols.generic.user import User
+from system.translations import Translations
+from system.workers.commands import Reconnect
+from utils.lru import LRUCache
+
+__author__ = 'Gareth Coles'
+_ = Translations().get()
+
+#: Protocol methods that may be called from the main process
+FORWARDED_METHODS = frozenset((
+    "send_msg", "send_action", "join_channel", "leave_channel",
+    "global_kick", "global_ban"
+))
+
+#: How many users to keep proxies for, per protocol
+MAX_USERS = 10000
+
+
+class RemoteUser(User):
+    """
+    A user on a protocol running in a worker.
+
+    Protocol-specific attributes, such as *ident* and *host* on IRC, are
+    available if the worker sent them.
+    """
+
+    __slots__ = ("serial", "attributes")
+
+    def __init__(self, nickname, protocol, serial):
+        super(RemoteUser, self).__init__(nickname, protocol)
+
+        self.serial = serial
+        self.attributes = {}
+
+    def __getattr__(self, item):
+        # Only called for attributes we don't have - check "attributes" so
+        # that we don't recurse if it hasn't been set yet
+        if item == "attributes" or item not in self.attributes:
+            raise AttributeError(item)
+
+        return self.attributes[item]
+
+    def respond(self, message):
+        self.protocol.send_msg(self.nickname, message, "user")
+
+    def __json__(self):
+        return {
+            "nickname": self.nickname,
+            "protocol": self.protocol.name,
+            "attributes": self.attributes
+        }
+
+
+class RemoteChannel(Channel):
+    """
+    A channel on a protocol running in a worker.
+
+    Workers don't send channel membership, so *users* is always empty.
+    """
+
+    __slots__ = ()
+
+    def respond(self, message):
+        self.protocol.send_msg(self.name, message, "channel")
+
+    def __json__(self):
+        return {
+            "name": self.name,
+            "protocol": self.protocol.name
+        }
+
+
+class RemoteProtocol(Protocol):
+    """
+    A protocol running in a worker process.
+    """
+
+    def __init__(self, name, factory, bus, worker):
+        # The generic protocol's __init__ expects a config, which we don't
+        # have, so we don't call it
+        self.name = name
+        self.factory = factory
+        self.bus = bus
+        self.worker = worker
+
+        self.log = getLogger(self.name)
+
+        self.TYPE = "remote"
+        self.CHANNELS = False
+
+        self._users = LRUCache(MAX_USERS, on_evict=self._user_evicted)
+        self._nicknames = {}  # Lowercase nickname -> serial, for get_user()
+        self._channels = {}
+
+    def update_state(self, state):
+        """
+        Update what we know about the protocol from the state a worker sent
+        along with an event.
+
+        :param state: The decoded state, from EventEncoder.encode_state()
+        :type state: dict
+        """
+
+        self.TYPE = state["type"]
+        self.CHANNELS = state["channels"]
+        self.nickname = state["nickname"]
+        self.control_chars = state["control_chars"]
+        self.ourselves = state["ourselves"]
+
+    def get_remote_user(self, serial, nickname, attributes):
+        user = self._users.get(serial)
+
+        if user is None:
+            user = RemoteUser(nickname, self, serial)
+            self._users[serial] = user
+        elif user.nickname != nickname:
+            self._forget_nickname(user)
+
+        user.nickname = nickname
+        user.attributes = attributes
+
+        self._nicknames[nickname.lower()] = serial
+
+        return user
+
+    def get_remote_channel(self, name):
+        key = name.lower()
+        channel = self._channels.get(key)
+
+        if channel is None:
+            channel = RemoteChannel(name, self)
+            self._channels[key] = channel
+
+        return channel
+
+    def shutdown(self):
+        self.bus.unload_protocol(self.name)
+
+    def get_user(self, user):
+        serial = self._nicknames.get(user.lower())
+
+        if serial is None:
+            return None
+
+        return self._users.peek(serial)
+
+    def get_channel(self, channel):
+        return self._channels.get(channel.lower())
+
+    def _forget_nickname(self, user):
+        key = user.nickname.lower()
+
+        # Someone else may have taken the nickname since
+        if self._nicknames.get(key) == user.serial:
+            del self._nicknames[key]
+
+    def _user_evicted(self, serial, user):
+        self._forget_nickname(user)
+
+    def call(self, method, *args):
+        """
+        Call one of the FORWARDED_METHODS on the protocol in the worker.
+
+        :return: A Deferred firing with the method's result, as a bool
+        """
+
+        if method not in FORWARDED_METHODS:
+            raise ValueError(_("Method can't be forwarded: %s") % method)
+
+        return self.bus.call_protocol(self.worker, self.name, method, args)
+
+    def send_msg(self, target, message, target_type=None, use_event=True):
+        target, target_type = self._resolve_target(target, target_type)
+        self.call("send_msg", target, message, target_type, use_event)
+        return True
+
+    def send_action(self, target, message, target_type=None, use_event=True):
+        target, target_type = self._resolve_target(target, target_type)
+        self.call("send_action", target, message, target_type, use_event)
+        return True
+
+    def join_channel(self, channel, password=None):
+        if isinstance(channel, Channel):
+            channel = channel.name
+
+        self.call("join_channel", channel, password)
+        return True
+
+    def leave_channel(self, channel, reason=None):
+        if isinstance(channel, Channel):
+            channel = channel.name
+
+        self.call("leave_channel", channel, reason)
+        return True
+
+    def global_kick(self, user, reason=None, force=False):
+        if isinstance(user, User):
+            user = user.nickname
+
+        self.call("global_kick", user, reason, force)
+        return True
+
+    def global_ban(self, user, reason=None, force=False):
+        if isinstance(user, User):
+            user = user.nickname
+
+        self.call("global_ban", user, reason, force)
+        return True
+
+    def _resolve_target(self, target, target_type):
+        if isinstance(target, User):
+            return target.nickname, "user"
+
+        if isinstance(target, Channel):
+            return target.name, "channel"
+
+        return target, target_type
+
+    def __json__(self):
+        return {
+            "name": self.name,
+            "type": self.TYPE,
+            "worker": self.worker
+        }
+
+
+class RemoteFactory(object):
+    """
+    Stands in for the factory of a protocol running in a worker, so that
+    the factory manager can keep track of it like any other.
+    """
+
+    def __init__(self, name, bus, worker):
+        self.name = name
+        self.bus = bus
+        self.worker = worker
+
+        self.protocol = RemoteProtocol(name, self, bus, worker)
+
+    def shutdown(self):
+        self.protocol.shutdown()
+
+
+class RemoteConnector(object):
+    """
+    Stands in for both the factory and the connector of a protocol running
+    in a worker, in the main process' ReconnectScheduler.
+
+    When it's the protocol's turn to reconnect, this tells the worker to go
+    ahead - the worker reports back how it went.
+    """
+
+    def __init__(self, name, host, process):
+        self.name = name
+        self.host = host
+        self.process = process
+
+        self.reconnection_attempts = 0
+
+    def getDestination(self):
+        return self
+
+    def connect(self):
+        if self.process.connection is None:
+            raise RuntimeError(
+                "Worker %s isn't connected" % self.process.id
+            )
+
+        self.process.connection.callRemote(Reconnect, protocol=self.name)
@@ -0,0 +1,249 @@
+# coding=utf-8
+
+"""
+Converting events to and from JSON, so that they can be passed over the bus.
+
+Events hold references to protocols, users and channels, which can't be sent
+to another process. These are replaced with small markers when an event is
+encoded in a worker, and with proxy objects from system.workers.remote when
+it's decoded in the main process. Values of any other type that can't be
+represented in JSON are dropped from the event.
+
+Users are given a serial number by the worker, which doesn't change for as
+long as the user object is alive, so that the main process can keep the same
+proxy object for them across events - and with it, anything plugins store on
+it, such as whether the user is logged in.
+"""
+
+import importlib
+import json
+
+from weakref import WeakKeyDictionary
+
+from kitchen.text.converters import to_bytes, to_unicode
+
+from system.events.base import BaseEvent
+from system.protocols.generic.channel import Channel
+from system.protocols.generic.protocol import Protocol
+from system.protocols.generic.user import User
+
+__author__ = 'Gareth Coles'
+
+_PRIMITIVES = (bool, int, long, float, type(None))
+
+#: User attributes that belong to the main process, and are never sent
+_USER_SKIP = frozenset(("nickname", "protocol", "authorized", "auth_name",
+                        "__weakref__"))
+
+
+class UnserializableValue(Exception):
+    pass
+
+
+class EventEncoder(object):
+    """
+    Encodes events in a worker process. There should be one of these per
+    worker, as it keeps track of user serial numbers.
+    """
+
+    def __init__(self):
+        self._serials = WeakKeyDictionary()
+        self._next_serial = 0
+
+    def user_serial(self, user):
+        try:
+            return self._serials[user]
+        except KeyError:
+            self._next_serial += 1
+            self._serials[user] = self._next_serial
+            return self._next_serial
+
+    def encode_event(self, event):
+        """
+        Encode an event to a JSON string.
+
+        The caller is left out, as it's always the protocol that the event
+        was forwarded for.
+
+        :param event: The event to encode
+        :type event: BaseEvent
+
+        :rtype: str
+        """
+
+        attributes = {}
+
+        for key, value in vars(event).iteritems():
+            if key == "caller":
+                continue
+
+            try:
+                attributes[key] = self.encode_value(value)
+            except UnserializableValue:
+                pass
+
+        return json.dumps({
+            "module": type(event).__module__,
+            "class": type(event).__name__,
+            "attributes": attributes
+        })
+
+    def encode_state(self, protocol):
+        """
+        Encode the parts of a protocol that the main process' proxy for it
+        needs to know about.
+
+        :rtype: str
+        """
+
+        ourselves = protocol.ourselves
+
+        if ourselves is not None:
+            ourselves = self.encode_value(ourselves)
+
+        return json.dumps({
+            "type": protocol.TYPE,
+            "channels": protocol.CHANNELS,
+            "nickname": to_unicode(protocol.nickname or ""),
+            "control_chars": to_unicode(protocol.control_chars),
+            "ourselves": ourselves
+        })
+
+    def encode_value(self, value):
+        if isinstance(value, _PRIMITIVES):
+            return value
+
+        if isinstance(value, basestring):
+            return to_unicode(value)
+
+        if isinstance(value, Protocol):
+            return {"$protocol": to_unicode(value.name)}
+
+        if isinstance(value, User):
+            return {
+                "$user": self.user_serial(value),
+                "nickname": to_unicode(value.nickname),
+                "attributes": self._user_attributes(value)
+            }
+
+        if isinstance(value, Channel):
+            return {"$channel": to_unicode(value.name)}
+
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return [self.encode_value(x) for x in value]
+
+        if isinstance(value, dict):
+            result = {}
+
+            for key, item in value.iteritems():
+                if not isinstance(key, basestring):
+                    raise UnserializableValue(type(key).__name__)
+
+                result[to_unicode(key)] = self.encode_value(item)
+
+            return result
+
+        raise UnserializableValue(type(value).__name__)
+
+    def _user_attributes(self, user):
+        attributes = {}
+
+        for cls in type(user).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if name in _USER_SKIP or name.startswith("_"):
+                    continue
+
+                try:
+                    value = getattr(user, name)
+                except AttributeError:
+                    continue
+
+                if isinstance(value, _PRIMITIVES):
+                    attributes[name] = value
+                elif isinstance(value, basestring):
+                    attributes[name] = to_unicode(value)
+
+        return attributes
+
+
+def decode_event(data, protocol, resolve_protocol):
+    """
+    Decode an event that was encoded with EventEncoder.encode_event().
+
+    :param data: The encoded event
+    :param protocol: The RemoteProtocol the event was forwarded for
+    :param resolve_protocol: Callable returning a protocol, given its name
+
+    :return: The event, with *protocol* as its caller
+    :rtype: BaseEvent
+    """
+
+    data = json.loads(data)
+
+    module = importlib.import_module(data["module"])
+    cls = getattr(module, data["class"])
+
+    if not isinstance(cls, type) or not issubclass(cls, BaseEvent):
+        raise TypeError("Not an event class: %s.%s" % (
+            data["module"], data["class"]
+        ))
+
+    # The event's attributes are set directly, so __init__ is skipped
+    event = cls.__new__(cls)
+    event.caller = protocol
+
+    for key, value in data["attributes"].iteritems():
+        setattr(event, to_bytes(key),
+                decode_value(value, protocol, resolve_protocol))
+
+    return event
+
+
+def decode_value(value, protocol=None, resolve_protocol=None):
+    if isinstance(value, unicode):
+        return to_bytes(value)
+
+    if isinstance(value, list):
+        return [decode_value(x, protocol, resolve_protocol) for x in value]
+
+    if isinstance(value, dict):
+        if "$user" in value:
+            return protocol.get_remote_user(
+                value["$user"], to_bytes(value["nickname"]),
+                decode_value(value["attributes"])
+            )
+
+        if "$channel" in value:
+            return protocol.get_remote_channel(to_bytes(value["$channel"]))
+
+        if "$protocol" in value:
+            return resolve_protocol(to_bytes(value["$protocol"]))
+
+        return dict(
+            (to_bytes(k), decode_value(v, protocol, resolve_protocol))
+            for k, v in value.iteritems()
+        )
+
+    return value
+
+
+def dump_args(args):
+    """
+    Encode a list of plain arguments for a CallProtocol command.
+
+    :rtype: str
+    """
+
+    return json.dumps([
+        to_unicode(x) if isinstance(x, basestring) else x for x in args
+    ])
+
+
+def load_args(data):
+    """
+    Decode a list of arguments encoded with dump_args().
+
+    :rtype: list
+    """
+
+    return [decode_value(x) for x in json.loads(data)]
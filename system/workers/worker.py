@@ -0,0 +1,257 @@
+# coding=utf-8
+
+"""
+The worker process' side of the worker bus.
+
+This is the entry point for worker processes, which are started by the bus
+in the main process - you shouldn't need to run it yourself. Each worker has
+its own factory manager, which loads protocols as usual but never loads any
+plugins; events are forwarded to the main process instead.
+
+Usage: python -m system.workers.worker <worker id> <bus port>
+"""
+
+import os
+import sys
+
+from twisted.internet import reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.protocols import amp
+
+from system.enums import ProtocolState
+from system.factory_manager import FactoryManager
+from system.logging.logger import getLogger
+from system.protocols.generic.protocol import Protocol
+from system.protocols.generic.reconnect import Reconnection, get_host
+from system.storage.formats import YAML
+from system.translations import Translations
+from system.workers.bus import SECRET_VARIABLE
+from system.workers.commands import CallProtocol, FireEvent, Hello, \
+    LoadProtocol, Reconnect, ReconnectState, ScheduleReconnect, Shutdown, \
+    UnloadProtocol
+from system.workers.remote import FORWARDED_METHODS
+from system.workers.serialization import EventEncoder, load_args
+
+__author__ = 'Gareth Coles'
+_ = Translations().get()
+
+#: Events thrown while looking for commands. Commands only exist in the main
+#: process, which looks for them again when it gets the message, throwing
+#: these itself - so forwarding them would have plugins see them twice.
+UNFORWARDED_EVENTS = frozenset((
+    "PreCommand", "UnknownCommand", "CommandNotFound"
+))
+
+
+class RemoteReconnectScheduler(object):
+    """
+    Takes the place of the factory manager's ReconnectScheduler in a worker.
+
+    Reconnections are scheduled by the main process' scheduler, which tells
+    us when it's a protocol's turn - so the limits on how many protocols can
+    be connecting at once apply to the whole bot, not to each worker.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.reconnections = {}  # Factory name -> Reconnection
+
+    def configure(self, config):
+        pass  # The main process has the limits
+
+    def schedule(self, factory, connector, delay):
+        self._replace(factory)
+
+        host = get_host(factory, connector)
+        reconnection = Reconnection(
+            self, factory, connector, host, factory.reconnection_attempts
+        )
+
+        self.reconnections[factory.name] = reconnection
+        self._call(
+            ScheduleReconnect, protocol=factory.name, host=host,
+            delay=float(delay), attempt=factory.reconnection_attempts
+        )
+
+        return reconnection
+
+    def cancel(self, reconnection):
+        reconnection.state = Reconnection.CANCELLED
+        name = reconnection.factory.name
+
+        if self.reconnections.get(name) is reconnection:
+            del self.reconnections[name]
+            self._send_state(name, "cancelled")
+
+    def forget(self, factory):
+        self._replace(factory)
+        self._send_state(factory.name, "forgotten")
+
+    def connected(self, factory):
+        self._send_state(factory.name, "connected")
+
+    def failed(self, factory):
+        self._send_state(factory.name, "failed")
+
+    def reconnect(self, name):
+        """
+        It's a protocol's turn to reconnect.
+        """
+
+        reconnection = self.reconnections.pop(name, None)
+
+        if reconnection is None or not reconnection.active():
+            # Cancelled while the main process was sending this
+            self._send_state(name, "forgotten")
+            return
+
+        reconnection.state = Reconnection.CONNECTING
+
+        try:
+            reconnection.connector.connect()
+        except Exception:
+            self.connection.logger.exception(
+                _("Error reconnecting %s") % name
+            )
+            self._send_state(name, "failed")
+
+    def _replace(self, factory):
+        reconnection = self.reconnections.get(factory.name)
+
+        if reconnection is not None and reconnection.active():
+            reconnection.state = Reconnection.CANCELLED
+            del self.reconnections[factory.name]
+
+    def _send_state(self, name, state):
+        self._call(ReconnectState, protocol=name, state=state)
+
+    def _call(self, command, **kwargs):
+        if self.connection is None:
+            return  # We've lost the main process, so nobody's listening
+
+        self.connection.callRemote(command, **kwargs)
+
+
+class WorkerConnection(amp.AMP):
+    """
+    A worker's connection to the bus in the main process.
+    """
+
+    def __init__(self, worker_id, secret, manager):
+        amp.AMP.__init__(self)
+
+        self.worker_id = worker_id
+        self.secret = secret
+        self.manager = manager
+
+        self.encoder = EventEncoder()
+        self.reconnects = RemoteReconnectScheduler(self)
+        self.stopping = False
+
+        self.logger = getLogger("Worker %s" % worker_id)
+
+    def connectionMade(self):
+        amp.AMP.connectionMade(self)
+
+        self.callRemote(Hello, worker=self.worker_id, secret=self.secret)
+        self.manager.event_manager.forwarder = self.forward_event
+        self.manager.reconnects = self.reconnects
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+
+        self.manager.event_manager.forwarder = None
+        self.reconnects.connection = None
+
+        if not self.stopping:
+            self.logger.info(_("Lost connection to the main process"))
+
+        self.manager.unload()
+
+    def forward_event(self, callback, event):
+        protocol = event.caller
+
+        if callback in UNFORWARDED_EVENTS or \
+                not isinstance(protocol, Protocol):
+            return
+
+        try:
+            data = self.encoder.encode_event(event)
+            state = self.encoder.encode_state(protocol)
+        except Exception:
+            self.logger.exception(
+                _("Unable to forward %s event") % callback
+            )
+            return
+
+        self.callRemote(
+            FireEvent, protocol=protocol.name, callback=callback,
+            state=state, event=data
+        )
+
+    @LoadProtocol.responder
+    def load_protocol(self, protocol, config):
+        state = self.manager.load_protocol(protocol, config)
+
+        if state is None:  # Invalid config path
+            state = ProtocolState.LoadError
+
+        return {"state": state.name}
+
+    @UnloadProtocol.responder
+    def unload_protocol(self, protocol):
+        return {"unloaded": self.manager.unload_protocol(protocol)}
+
+    @CallProtocol.responder
+    def call_protocol(self, protocol, method, args):
+        protocol = self.manager.get_protocol(protocol)
+
+        if protocol is None or method not in FORWARDED_METHODS:
+            return {"result": False}
+
+        result = getattr(protocol, method)(*load_args(args))
+        return {"result": bool(result)}
+
+    @Reconnect.responder
+    def reconnect(self, protocol):
+        self.reconnects.reconnect(protocol)
+        return {}
+
+    @Shutdown.responder
+    def shutdown(self):
+        self.stopping = True
+
+        # Closing the connection sends our response first, and then we'll
+        # unload everything once it's gone
+        reactor.callLater(0, self.transport.loseConnection)
+        return {}
+
+
+def main(worker_id, port, secret):
+    manager = FactoryManager()
+    manager.setup_logging(None)
+
+    manager.main_config = manager.storage.get_file(
+        manager, "config", YAML, "settings.yml"
+    )
+    manager.commands.set_factory_manager(manager)
+
+    endpoint = TCP4ClientEndpoint(reactor, "127.0.0.1", port)
+    connection = WorkerConnection(worker_id, secret, manager)
+
+    def failed(failure):
+        manager.logger.error(
+            _("Unable to connect to the main process: %s") %
+            failure.getErrorMessage()
+        )
+        reactor.stop()
+
+    connectProtocol(endpoint, connection).addErrback(failed)
+
+    # The main process handles Ctrl+C and tells us when to stop
+    manager.running = True
+    reactor.run(installSignalHandlers=False)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]), int(sys.argv[2]), os.environ[SECRET_VARIABLE])
@@ -0,0 +1,243 @@
+# coding=utf-8
+import logging
+
+import nose.tools as nosetools
+
+from mock import MagicMock as Mock, patch
+from twisted.words.protocols.irc import IRCBadMessage, \
+    ServerSupportedFeatures
+
+from system.protocols.irc.channel import Channel
+from system.protocols.irc.joins import JoinPipeline, MAX_LINE_LENGTH, \
+    WHOX_TOKEN
+from system.protocols.irc.parser import parse_line
+from system.protocols.irc.protocol import Protocol
+from system.protocols.irc.rank import Ranks
+from system.protocols.irc.user import User
+from utils.irc import IRCUtils
+
+__author__ = 'Gareth Coles'
+
+"""
+Tests for the parts of the IRC protocol that can be tested without a server
+"""
+
+
+class test_irc:
+    """
+    IRC   | Tests for the IRC protocol
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger("test_irc")
+        self.log.setLevel(logging.CRITICAL)
+
+    def make_protocol(self, features=None):
+        protocol = Mock(name="protocol")
+        protocol.log = self.log
+        protocol.utils = IRCUtils(self.log)
+        protocol.supported = ServerSupportedFeatures()
+
+        protocol.ranks = Ranks()
+        protocol.ranks.add_rank("o", "@", 0)
+        protocol.ranks.add_rank("h", "%", 1)
+        protocol.ranks.add_rank("v", "+", 2)
+
+        if features:
+            protocol.supported.parse(features)
+
+        return protocol
+
+    def test_join_batching(self):
+        """
+        IRC   | Test that joins are batched with keyed channels first
+        """
+
+        pipeline = JoinPipeline(self.make_protocol(), {"max_channels": 3})
+
+        pipeline.queue("#one")
+        pipeline.queue("#two", "key")
+        pipeline.queue("#three")
+        pipeline.queue("#four")
+        pipeline.queue("#ONE")  # Duplicate
+
+        line, channels = pipeline.build_batch()
+
+        nosetools.eq_(line, "JOIN #two,#one,#three key")
+        nosetools.eq_(channels, ["#two", "#one", "#three"])
+
+        line, channels = pipeline.build_batch()
+
+        nosetools.eq_(line, "JOIN #four")
+        nosetools.eq_(pipeline.build_batch(), (None, []))
+
+    def test_join_batching_limits(self):
+        """
+        IRC   | Test that join batches respect the line length and TARGMAX
+        """
+
+        pipeline = JoinPipeline(self.make_protocol(), {"max_channels": 0})
+
+        for x in xrange(200):
+            pipeline.queue("#channel-%03d" % x)
+
+        total = 0
+
+        while True:
+            line, channels = pipeline.build_batch()
+
+            if line is None:
+                break
+
+            nosetools.assert_true(len(line) <= MAX_LINE_LENGTH)
+            total += len(channels)
+
+        nosetools.eq_(total, 200)
+
+        pipeline = JoinPipeline(
+            self.make_protocol(["TARGMAX=JOIN:2,PRIVMSG:4"]),
+            {"max_channels": 10}
+        )
+
+        for x in xrange(5):
+            pipeline.queue("#channel-%s" % x)
+
+        nosetools.eq_(len(pipeline.build_batch()[1]), 2)
+
+    def test_join_failures(self):
+        """
+        IRC   | Test that joins the server refuses aren't left being timed
+        """
+
+        protocol = self.make_protocol()
+        pipeline = JoinPipeline(protocol)
+
+        pipeline.queue("#full")
+        pipeline.queue("#open")
+
+        with patch("system.protocols.irc.joins.time.time", return_value=10):
+            pipeline._send_next_batch()
+
+        for command in ("ERR_CHANNELISFULL", "ERR_INVITEONLYCHAN"):
+            Protocol.irc_unknown.im_func(
+                protocol, "server", command,
+                ["nick", "#FULL", "Cannot join channel"]
+            )
+            protocol.join_pipeline.join_failed.assert_called_with("#FULL")
+
+        pipeline.join_failed("#FULL")
+
+        nosetools.eq_(pipeline._join_times.keys(), ["#open"])
+
+        # Joining it later times it from then, not from the failed JOIN
+        with patch("system.protocols.irc.joins.time.time", return_value=30):
+            pipeline.joined("#full")
+
+        with patch("system.protocols.irc.joins.time.time", return_value=35):
+            pipeline.who_finished("#full")
+
+        nosetools.eq_(pipeline.sync_times["#full"], 5)
+
+    def test_who_pacing(self):
+        """
+        IRC   | Test that WHO requests are paced and use WHOX when available
+        """
+
+        protocol = self.make_protocol(["WHOX"])
+        pipeline = JoinPipeline(protocol, {"who_concurrency": 2})
+
+        for x in xrange(4):
+            pipeline.joined("#channel-%s" % x)
+
+        nosetools.eq_(protocol.sendLine.call_count, 2)
+        protocol.sendLine.assert_called_with(
+            u"WHO #channel-1 %%tcuihsnfar,%s" % WHOX_TOKEN
+        )
+
+        pipeline.who_finished("#channel-0")
+
+        nosetools.eq_(protocol.sendLine.call_count, 3)
+        nosetools.assert_true("#channel-0" in pipeline.sync_times)
+        nosetools.eq_(protocol.event_manager.run_callback.call_args[0][0],
+                      "IRC/ChannelSynced")
+
+        protocol = self.make_protocol()
+        pipeline = JoinPipeline(protocol)
+        pipeline.joined("#channel")
+
+        protocol.send_who.assert_called_with("#channel")
+
+    def test_user_ranks(self):
+        """
+        IRC   | Test storing user ranks per channel
+        """
+
+        protocol = self.make_protocol()
+
+        channel = Channel(protocol, "#channel")
+        other = Channel(protocol, "#other")
+        protocol.get_channel.return_value = channel
+
+        user = User(protocol, "nick", "ident", "host")
+        user.add_channel(channel)
+        user.add_channel(other)
+
+        op = protocol.ranks.by_mode("o")
+        voice = protocol.ranks.by_mode("v")
+
+        user.add_rank_in_channel(channel, voice)
+        nosetools.eq_(user.get_highest_rank_in_channel(channel), voice)
+
+        user.add_rank_in_channel("#channel", op)
+        nosetools.eq_(user.get_ranks_in_channel(channel), [op, voice])
+        nosetools.eq_(user.get_highest_rank_in_channel(channel), op)
+        nosetools.eq_(user.get_highest_rank_in_channel(other), None)
+
+        user.remove_rank_in_channel(channel, op)
+        nosetools.eq_(user.get_ranks_in_channel(channel), [voice])
+
+        user.remove_channel(channel)
+        nosetools.eq_(user.get_ranks_in_channel(channel), [])
+        nosetools.eq_(set(user.channels), set([other]))
+
+    def test_parse_line(self):
+        """
+        IRC   | Test parsing lines, with and without tags and prefixes
+        """
+
+        message = parse_line(
+            "@time=2015-01-01T00:00:00Z;account=some\\sone\\:x;flag "
+            ":nick!ident@host PRIVMSG #channel :Hello, world!"
+        )
+
+        nosetools.eq_(message.tags, {
+            "time": "2015-01-01T00:00:00Z",
+            "account": "some one;x",
+            "flag": ""
+        })
+        nosetools.eq_(message.prefix, "nick!ident@host")
+        nosetools.eq_(
+            (message.nick, message.ident, message.host),
+            ("nick", "ident", "host")
+        )
+        nosetools.ok_(message.has_hostmask)
+        nosetools.eq_(message.command, "PRIVMSG")
+        nosetools.eq_(message.params, ["#channel", "Hello, world!"])
+
+        message = parse_line(":irc.example.com 001 Ultros :Welcome")
+
+        nosetools.eq_(message.tags, {})
+        nosetools.eq_(message.nick, "irc.example.com")
+        nosetools.ok_(not message.has_hostmask)
+        nosetools.eq_(message.command, "RPL_WELCOME")
+        nosetools.eq_(message.params, ["Ultros", "Welcome"])
+
+        message = parse_line("PING :irc.example.com")
+
+        nosetools.eq_(message.prefix, "")
+        nosetools.eq_(message.nick, None)
+        nosetools.eq_(message.params, ["irc.example.com"])
+
+        nosetools.assert_raises(IRCBadMessage, parse_line, "")
+        nosetools.assert_raises(IRCBadMessage, parse_line, ":prefix")
+        nosetools.assert_raises(IRCBadMessage, parse_line, "@tags=only")
@@ -0,0 +1,714 @@
+# coding=utf-8
+import shutil
+import struct
+import tempfile
+
+import nose.tools as nosetools
+
+from mock import MagicMock as Mock, patch
+from twisted.internet.task import Clock
+
+from system.protocols.mumble import Mumble_pb2
+from system.protocols.mumble.acl import Perms
+from system.protocols.mumble.audio import GeneratorSource, Player
+from system.protocols.mumble.blobs import BlobCache, blob_hash
+from system.protocols.mumble.cryptstate import CryptState
+from system.protocols.mumble.protocol import Protocol
+from system.protocols.mumble.receiver import JitterBuffer, VoiceReceiver
+from system.protocols.mumble.userstats import StatsScheduler
+from system.protocols.mumble.udp import VoiceTransport
+
+__author__ = 'Gareth Coles'
+
+"""
+Tests for the parts of the Mumble protocol that can be tested without a
+server
+"""
+
+CONFIG = {
+    "identity": {
+        "username": "Ultros",
+        "password": "",
+        "tokens": []
+    },
+    "network": {},
+    "control_chars": "."
+}
+
+KEY = "".join(chr(x) for x in xrange(16))
+
+
+class EchoServer(object):
+    """
+    A stand-in for Murmur's UDP port, which echoes everything back
+    """
+
+    def __init__(self, client_nonce, server_nonce):
+        self.crypt = CryptState()
+        self.crypt.set_key(KEY, server_nonce, client_nonce)
+
+        self.received = []
+
+    def write(self, data):
+        plain = self.crypt.decrypt(data)
+        self.received.append(plain)
+
+        if plain is not None:
+            self.client.datagramReceived(self.crypt.encrypt(plain), None)
+
+
+class FakeEncoder(object):
+    """
+    Stands in for Opus - "encodes" a frame as its first byte
+    """
+
+    def encode(self, pcm, frame_size):
+        return pcm[:1]
+
+
+class FakeDecoder(object):
+    """
+    Stands in for Opus - "decodes" a packet to its second byte, repeated
+    once per 10ms, or "?" for lost packets
+    """
+
+    resets = 0
+
+    def decode(self, data, frame_size):
+        if data is None:
+            return "?" * (frame_size // 480)
+        return data[1] * (frame_size // 480)
+
+    def reset(self):
+        self.resets += 1
+
+
+class test_mumble:
+    """
+    MUMB  | Tests for the Mumble protocol
+    """
+
+    def make_protocol(self):
+        protocol = Protocol("test_mumble", None, CONFIG)
+        protocol.transport = Mock(name="transport")
+
+        return protocol
+
+    def frame(self, message):
+        data = message.SerializeToString()
+
+        return struct.pack(
+            Protocol.PREFIX_FORMAT, Protocol.MESSAGE_ID[type(message)],
+            len(data)
+        ) + data
+
+    def test_framing(self):
+        """
+        MUMB  | Test reading messages split over several reads
+        """
+
+        ping = Mumble_pb2.Ping()
+        ping.timestamp = 1234
+
+        channel = Mumble_pb2.ChannelState()
+        channel.channel_id = 1
+        channel.name = "Channel"
+
+        data = self.frame(ping) + self.frame(channel) + self.frame(ping)
+
+        for chunk_size in (1, 7, len(data)):
+            protocol = self.make_protocol()
+            handled = []
+
+            protocol._handlers = [
+                (cls, handled.append) for cls, __ in protocol._handlers
+            ]
+
+            for x in xrange(0, len(data), chunk_size):
+                protocol.dataReceived(data[x:x + chunk_size])
+
+            nosetools.eq_(handled, [ping, channel, ping])
+            nosetools.eq_(len(protocol._recv_buffer), 0)
+
+    def test_invalid_message_type(self):
+        """
+        MUMB  | Test disconnecting on an unknown message type
+        """
+
+        protocol = self.make_protocol()
+        protocol.dataReceived(struct.pack(Protocol.PREFIX_FORMAT, 1000, 0))
+
+        protocol.transport.loseConnection.assert_called_with()
+
+    def test_batched_writes(self):
+        """
+        MUMB  | Test sending messages in a single write
+        """
+
+        protocol = self.make_protocol()
+        ping = Mumble_pb2.Ping()
+
+        with patch("system.protocols.mumble.protocol.reactor") as reactor:
+            protocol.sendProtobuf(ping)
+            protocol.sendProtobuf(ping)
+
+            nosetools.eq_(reactor.callLater.call_count, 1)
+
+        nosetools.ok_(not protocol.transport.writeSequence.called)
+
+        protocol.flush_writes()
+
+        protocol.transport.writeSequence.assert_called_once_with(
+            [struct.pack(Protocol.PREFIX_FORMAT, 3, 0), ""] * 2
+        )
+
+    def test_indexes(self):
+        """
+        MUMB  | Test the user and channel indexes and channel tree
+        """
+
+        protocol = self.make_protocol()
+        protocol.event_manager = Mock(name="event_manager")
+
+        for cid, name, parent, position in ((0, "Root", None, 0),
+                                            (1, "Lobby", 0, 1),
+                                            (2, "Games", 0, 0),
+                                            (3, "Chess", 2, 0),
+                                            (4, "Lobby", 2, 1)):
+            message = Mumble_pb2.ChannelState()
+            message.channel_id = cid
+            message.name = name
+            message.position = position
+
+            if parent is not None:
+                message.parent = parent
+
+            protocol.handle_msg_channelstate(message)
+
+        # These were there before we connected, so they weren't created
+        nosetools.eq_(protocol.event_manager.run_callback.call_count, 0)
+
+        nosetools.eq_(protocol.get_channel("lobby").channel_id, 1)
+        nosetools.eq_(protocol.get_channel("CHESS").channel_id, 3)
+        nosetools.eq_(
+            [c.channel_id for c in protocol.get_channel_children(0)], [2, 1]
+        )
+        nosetools.eq_(
+            [c.channel_id for c in protocol.get_channel_subtree(0)],
+            [0, 2, 3, 4, 1]
+        )
+
+        # Rename and move a channel
+        message = Mumble_pb2.ChannelState()
+        message.channel_id = 3
+        message.name = "Draughts"
+        message.parent = 1
+        protocol.handle_msg_channelstate(message)
+
+        nosetools.eq_(protocol.get_channel("chess"), None)
+        nosetools.eq_(protocol.get_channel("draughts").channel_id, 3)
+        nosetools.eq_(
+            [c.channel_id for c in protocol.get_channel_subtree(2)], [2, 4]
+        )
+        nosetools.eq_(
+            [c.channel_id for c in protocol.get_channel_subtree(1)], [1, 3]
+        )
+
+        message = Mumble_pb2.UserState()
+        message.session = 5
+        message.name = "Someone"
+        message.channel_id = 3
+        protocol.handle_msg_userstate(message)
+
+        nosetools.eq_(protocol.get_user("SOMEONE").session, 5)
+
+        message = Mumble_pb2.UserState()
+        message.session = 5
+        message.name = "Someone Else"
+        protocol.handle_msg_userstate(message)
+
+        nosetools.eq_(protocol.get_user("someone"), None)
+        nosetools.eq_(protocol.get_user("someone else").session, 5)
+
+        message = Mumble_pb2.UserRemove()
+        message.session = 5
+        protocol.handle_msg_userremove(message)
+
+        nosetools.eq_(protocol.get_user("someone else"), None)
+
+        message = Mumble_pb2.ChannelRemove()
+        message.channel_id = 3
+        protocol.handle_msg_channelremove(message)
+
+        nosetools.eq_(protocol.get_channel("draughts"), None)
+        nosetools.ok_(3 not in protocol.channels)
+        nosetools.eq_(protocol.get_channel_children(1), [])
+
+        # Once we've synced, new channels are new
+        protocol.sendProtobuf = Mock()
+        protocol.handle_msg_serversync(Mumble_pb2.ServerSync(session=1))
+        protocol.event_manager.run_callback.reset_mock()
+
+        message = Mumble_pb2.ChannelState()
+        message.channel_id = 5
+        message.name = "New"
+        message.parent = 0
+        protocol.handle_msg_channelstate(message)
+
+        nosetools.eq_(protocol.event_manager.run_callback.call_count, 1)
+
+        callback, event = protocol.event_manager.run_callback.call_args[0]
+        nosetools.eq_(callback, "Mumble/ChannelCreated")
+        nosetools.eq_(event.channel.name, "New")
+
+        # State belongs to the connection, not the class
+        nosetools.eq_(self.make_protocol().channels, {})
+
+    def test_ocb2_vectors(self):
+        """
+        MUMB  | Test OCB2-AES128 against Mumble's test vectors
+        """
+
+        crypt = CryptState()
+        crypt.set_key(KEY, KEY, KEY)
+
+        nosetools.eq_(crypt.ocb_encrypt("", KEY)[1].encode("hex"),
+                      "bf3108130773ad5ec70ec69e7875a7b0")
+
+        plain = "".join(chr(x) for x in xrange(40))
+        encrypted, tag = crypt.ocb_encrypt(plain, KEY)
+
+        nosetools.eq_(encrypted.encode("hex"),
+                      "f75d6bc8b4dc8d66b836a2b08b32a6369f1cd3c5228d79fd"
+                      "6c267f5f6aa7b231c7dfb9d59951ae9c")
+        nosetools.eq_(tag.encode("hex"), "9db0cdf880f73e3e10d4eb3217766688")
+        nosetools.eq_(crypt.ocb_decrypt(encrypted, KEY), (plain, tag))
+
+    def test_crypt_ordering(self):
+        """
+        MUMB  | Test decrypting late, lost and replayed packets
+        """
+
+        client = CryptState()
+        server = CryptState()
+
+        client.set_key(KEY, "c" * 16, "s" * 16)
+        server.set_key(KEY, "s" * 16, "c" * 16)
+
+        packets = [server.encrypt("packet %s" % x) for x in xrange(300)]
+
+        nosetools.eq_(client.decrypt(packets[0]), "packet 0")
+        nosetools.eq_(client.decrypt(packets[2]), "packet 2")
+        nosetools.eq_(client.decrypt(packets[1]), "packet 1")
+        nosetools.eq_(client.decrypt(packets[1]), None, "Replayed")
+
+        # Across the IV wrapping around
+        for x in xrange(3, 300):
+            nosetools.eq_(client.decrypt(packets[x]), "packet %s" % x)
+
+        nosetools.eq_(client.decrypt(packets[299][:4] + "x"), None)
+        nosetools.eq_((client.good, client.late, client.lost), (300, 1, 0))
+
+    def test_udp_echo(self):
+        """
+        MUMB  | Test the UDP voice transport against an echo server
+        """
+
+        protocol = self.make_protocol()
+        protocol.event_manager = Mock(name="event_manager")
+        protocol.crypt.set_key(KEY, "c" * 16, "s" * 16)
+
+        server = EchoServer("c" * 16, "s" * 16)
+
+        voice = VoiceTransport(protocol, protocol.crypt)
+        voice.transport = server
+        server.client = voice
+
+        protocol.voice = voice
+
+        # Until the server's answered a ping, voice is tunnelled
+        with patch("system.protocols.mumble.protocol.reactor"):
+            protocol.send_voice("\x80\x01voice")
+
+        nosetools.eq_(protocol._send_queue[1], "\x80\x01voice")
+
+        voice.ping()
+
+        nosetools.ok_(voice.active)
+        nosetools.eq_(voice.ping_count, 1)
+
+        protocol.send_voice("\x80\x05\x02voice")
+
+        nosetools.eq_(server.received[-1], "\x80\x05\x02voice")
+
+        event = protocol.event_manager.run_callback.call_args[0][1]
+
+        nosetools.eq_(event.codec, 4)
+        nosetools.eq_((event.sequence, event.payload), (2, "voice"))
+        nosetools.ok_(event.udp)
+
+        # Undecryptable packets make us ask for a resync
+        protocol.request_crypt_resync = Mock()
+        voice.last_good = 0
+        voice.datagramReceived("garbage", None)
+
+        protocol.request_crypt_resync.assert_called_with()
+
+    def test_playback_pacing(self):
+        """
+        MUMB  | Test pacing, underruns and termination of audio playback
+        """
+
+        protocol = self.make_protocol()
+        protocol.send_voice = Mock()
+
+        clock = Clock()
+        frame = 960 * 2  # 20ms at 48kHz
+
+        def audio():
+            for x in xrange(3):
+                yield chr(x) * frame
+            yield ""  # Underrun
+            yield "\x03" * (frame // 2)  # Padded out at the end
+
+        player = Player(protocol, GeneratorSource(audio()), clock=clock,
+                        encoder=FakeEncoder())
+        finished = []
+
+        player.play().addCallback(finished.append)
+
+        clock.advance(0)
+
+        # Timer jitter shouldn't add up into drift
+        for x in xrange(4):
+            clock.advance(0.021)
+
+        packets = [args[0] for args, __ in protocol.send_voice.call_args_list]
+
+        nosetools.eq_(packets, [
+            "\x80\x00\x01\x00",
+            "\x80\x02\x01\x01",
+            "\x80\x04\x01\x02",
+            "\x80\x06\xa0\x01\x03"  # Length 1, with the terminator
+        ])
+
+        nosetools.eq_(finished, [player.stats])
+        nosetools.eq_(player.stats.frames_sent, 4)
+        nosetools.eq_(player.stats.underruns, 1)
+        nosetools.eq_(player.stats.late_frames, 0)
+        nosetools.ok_(player.stats.jitter_max < 20)
+
+    def test_jitter_buffer(self):
+        """
+        MUMB  | Test reordering and loss in the voice jitter buffer
+        """
+
+        buf = JitterBuffer(depth=2)
+
+        buf.push(10, "\x98a", False)  # 20ms frames
+        nosetools.eq_(buf.pop(), [("\x98a", 2)])
+
+        buf.push(14, "\x98c", False)
+        nosetools.eq_(buf.pop(), [], "Waiting for 12")
+
+        buf.push(12, "\x98b", False)
+        nosetools.eq_(buf.pop(), [("\x98b", 2), ("\x98c", 2)])
+
+        buf.push(12, "\x98b", False)
+        nosetools.eq_(buf.late, 1)
+
+        buf.push(18, "\x98e", False)
+        buf.push(20, "\x98f", True)
+        nosetools.eq_(buf.pop(), [(None, 2), ("\x98e", 2), ("\x98f", 2)])
+        nosetools.eq_(buf.lost, 1)
+        nosetools.eq_(buf.next, None)
+
+    def test_voice_receiver(self):
+        """
+        MUMB  | Test demultiplexing, decoding and evicting voice streams
+        """
+
+        protocol = self.make_protocol()
+        protocol.users = {1: Mock(name="one"), 2: Mock(name="two")}
+        protocol.users[1].session = 1
+
+        clock = Clock()
+        receiver = VoiceReceiver(protocol, depth=2,
+                                 decoder_factory=FakeDecoder, clock=clock)
+
+        # Nobody's listening, so nothing is decoded
+        receiver.packet_received(1, 0, "\x02\x90a")
+        nosetools.eq_(receiver.streams, {})
+
+        received = []
+        receiver.add_callback(lambda user, pcm: received.append((user, pcm)))
+        stream = receiver.open_stream(protocol.users[1])
+
+        receiver.packet_received(1, 0, "\x02\x90a")
+        receiver.packet_received(2, 5, "\x02\x90x")
+        receiver.packet_received(1, 1, "\x02\x90b")
+
+        nosetools.eq_(received, [(protocol.users[1], "a"),
+                                 (protocol.users[2], "x"),
+                                 (protocol.users[1], "b")])
+        nosetools.eq_(stream.read(10), "ab")
+        nosetools.eq_(receiver.pool.created, 2)
+
+        # A missing packet is given up on after a while
+        receiver.packet_received(1, 3, "\x02\x90d")
+        clock.advance(0.2)
+
+        nosetools.eq_(stream.read(10), "?d")
+
+        # Quiet users' decoders go back to the pool, and are re-used
+        clock.advance(receiver.IDLE_TIMEOUT + 1)
+
+        nosetools.eq_(receiver.streams, {})
+        nosetools.eq_(len(receiver.pool.idle), 2)
+
+        receiver.packet_received(2, 0, "\x02\x90y")
+        nosetools.eq_(receiver.pool.created, 2)
+
+        receiver.user_left(1)
+        nosetools.ok_(stream.finished)
+
+    def test_userstats_scheduling(self):
+        """
+        MUMB  | Test spreading out and rate-limiting UserStats requests
+        """
+
+        protocol = self.make_protocol()
+        protocol.event_manager = Mock(name="event_manager")
+        protocol.event_manager.has_callback.return_value = True
+        protocol.request_userstats = Mock()
+
+        clock = Clock()
+        scheduler = StatsScheduler(protocol, interval=60, idle_interval=300,
+                                   max_rate=50, clock=clock)
+
+        for session in xrange(2000):
+            user = Mock(name="user %s" % session)
+            user.session = session
+            user.idle_time = 600 if session % 2 else 0
+
+            protocol.users[session] = user
+            scheduler.add(user)
+
+        scheduler.start()
+        counts = []
+
+        for x in xrange(240):  # Two minutes
+            before = protocol.request_userstats.call_count
+            clock.advance(scheduler.TICK)
+            counts.append(protocol.request_userstats.call_count - before)
+
+        nosetools.ok_(max(counts) <= 50 * scheduler.TICK, "Rate limited")
+        nosetools.ok_(min(counts[20:100]) > 0, "Spread out")
+
+        polled = {}
+
+        for args, __ in protocol.request_userstats.call_args_list:
+            polled[args[0].session] = polled.get(args[0].session, 0) + 1
+
+        nosetools.eq_(len(polled), 2000)
+        nosetools.eq_(polled[1], 1, "Idle users are polled less")
+        nosetools.eq_(polled[0], 2)
+
+        # With no plugin interested, only watched users are polled
+        protocol.event_manager.has_callback.return_value = False
+        protocol.request_userstats.reset_mock()
+        scheduler.watch(protocol.users[0])
+
+        for x in xrange(240):
+            clock.advance(scheduler.TICK)
+
+        nosetools.eq_(
+            [args[0].session
+             for args, __ in protocol.request_userstats.call_args_list],
+            [0, 0]
+        )
+
+    def test_blob_cache(self):
+        """
+        MUMB  | Test the size-bounded blob cache and spilling it to disk
+        """
+
+        directory = tempfile.mkdtemp()
+
+        try:
+            cache = BlobCache(10, directory, 15)
+
+            cache.put("a", "a" * 6)
+            cache.put("b", "b" * 4)
+            nosetools.eq_(cache.size, 10)
+
+            cache.put("c", "c" * 3)  # Pushes "a" out, to disk
+            nosetools.eq_(cache.size, 7)
+            nosetools.eq_(cache.disk_size, 6)
+
+            # Read back from disk, pushing "b" out
+            nosetools.eq_(cache.get("a"), "a" * 6)
+            nosetools.eq_(cache.size, 9)
+            nosetools.eq_(cache.disk_size, 10)
+
+            cache.put("d", "d" * 8)  # Pushes "c" out, and "a" again
+            nosetools.eq_(cache.size, 8)
+            nosetools.eq_(cache.disk_size, 13)
+
+            # Over the disk limit, so the oldest - "b" and "c" - go for good
+            cache.put("e", "e" * 8)
+            nosetools.eq_(cache.disk_size, 14)
+            nosetools.eq_(cache.get("b"), None)
+            nosetools.eq_(cache.get("c"), None)
+
+            # What's on disk is still there after a restart
+            nosetools.ok_("d" in BlobCache(10, directory, 15))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_blob_fetching(self):
+        """
+        MUMB  | Test fetching avatars and comments on demand
+        """
+
+        protocol = self.make_protocol()
+        protocol.sendProtobuf = Mock()
+
+        clock = Clock()
+        protocol.blobs.clock = clock
+
+        users = {}
+
+        for session in (1, 2):
+            message = Mumble_pb2.UserState()
+            message.session = session
+            message.name = "User %s" % session
+            message.channel_id = 0
+            message.texture_hash = blob_hash("avatar")
+            message.comment = u"Hello \u2603"
+            protocol.channels[0] = Mock(name="channel")
+            protocol.handle_msg_userstate(message)
+            users[session] = protocol.users[session]
+
+        # Comments sent in full are cached, and shared between users
+        nosetools.eq_(users[1].comment, u"Hello \u2603")
+        nosetools.eq_(users[1].comment_hash, users[2].comment_hash)
+        nosetools.eq_(len(protocol.blobs.cache), 1)
+
+        # Avatars are requested once, however many users share them
+        nosetools.eq_(users[1].avatar, None)
+
+        received = []
+        users[1].get_avatar().addCallback(received.append)
+        users[2].get_avatar().addCallback(received.append)
+
+        clock.advance(0)
+
+        request = protocol.sendProtobuf.call_args[0][0]
+        nosetools.eq_(list(request.session_texture), [1])
+
+        message = Mumble_pb2.UserState()
+        message.session = 1
+        message.texture = "avatar"
+        protocol.handle_msg_userstate(message)
+
+        nosetools.eq_(received, ["avatar", "avatar"])
+        nosetools.eq_(users[2].avatar, "avatar")
+
+    def test_permission_cache(self):
+        """
+        MUMB  | Test caching our permissions, and batching queries
+        """
+
+        protocol = self.make_protocol()
+        protocol.event_manager = Mock(name="event_manager")
+        protocol.sendProtobuf = Mock()
+
+        clock = Clock()
+        protocol.permissions.clock = clock
+        protocol.permissions.BATCH_SIZE = 2
+
+        for cid, parent in ((0, None), (1, 0), (2, 1), (3, 1), (4, 0)):
+            message = Mumble_pb2.ChannelState()
+            message.channel_id = cid
+            message.name = "Channel %s" % cid
+
+            if parent is not None:
+                message.parent = parent
+
+            protocol.handle_msg_channelstate(message)
+
+        message = Mumble_pb2.UserState()
+        message.session = 1
+        message.name = protocol.username
+        message.channel_id = 1
+        protocol.handle_msg_userstate(message)
+        protocol.sendProtobuf.reset_mock()
+
+        # ServerSync gives us the root channel, and we fetch the rest of the
+        # channels we're in or below, a batch at a time
+        message = Mumble_pb2.ServerSync()
+        message.session = 1
+        message.permissions = Perms.KICK | Perms.MOVE
+        protocol.handle_msg_serversync(message)
+
+        def queried():
+            sent = [
+                call[0][0].channel_id
+                for call in protocol.sendProtobuf.call_args_list
+            ]
+            protocol.sendProtobuf.reset_mock()
+            return sent
+
+        clock.advance(0)
+        nosetools.eq_(queried(), [1, 2])
+        clock.advance(protocol.permissions.BATCH_INTERVAL)
+        nosetools.eq_(queried(), [3])
+
+        nosetools.ok_(protocol.ourselves.can_kick(None, None))
+        nosetools.ok_(not protocol.ourselves.can_ban(None, None))
+
+        for cid in (1, 2, 3):
+            message = Mumble_pb2.PermissionQuery()
+            message.channel_id = cid
+            message.permissions = Perms.MOVE | Perms.ENTER
+            protocol.handle_msg_permissionquery(message)
+
+        nosetools.ok_(protocol.has_permission(2, Perms.MOVE, Perms.ENTER))
+        nosetools.ok_(not protocol.has_permission(2, Perms.MAKE_CHANNEL))
+
+        # Unknown channels are fetched for next time, once
+        user = protocol.ourselves
+        nosetools.ok_(not user.can_move(user, protocol.channels[4]))
+        nosetools.ok_(not protocol.has_permission(4, Perms.MOVE))
+
+        received = []
+        protocol.get_permissions(4).addCallback(received.append)
+
+        clock.advance(0)
+        nosetools.eq_(queried(), [4])
+
+        message = Mumble_pb2.PermissionQuery()
+        message.channel_id = 4
+        message.permissions = Perms.MOVE
+        protocol.handle_msg_permissionquery(message)
+
+        nosetools.eq_(received, [Perms.MOVE])
+        nosetools.ok_(user.can_move(user, protocol.channels[4]))
+        nosetools.eq_(queried(), [])
+
+        # A flush throws everything away, and we fetch what we need again
+        message = Mumble_pb2.PermissionQuery()
+        message.channel_id = 1
+        message.permissions = Perms.ENTER
+        message.flush = True
+        protocol.handle_msg_permissionquery(message)
+
+        nosetools.ok_(1 in protocol.permissions)
+        nosetools.ok_(4 not in protocol.permissions)
+        nosetools.ok_(not protocol.has_permission(0, Perms.KICK))
+
+        clock.advance(0)
+        nosetools.eq_(queried(), [2, 3])
+        clock.advance(protocol.permissions.BATCH_INTERVAL)
+        nosetools.eq_(queried(), [0])
@@ -0,0 +1,193 @@
+# coding=utf-8
+
+import nose.tools as nosetools
+
+from mock import MagicMock as Mock, patch
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from system.protocols.generic.factory import BaseFactory
+from system.protocols.generic.reconnect import ReconnectScheduler, \
+    backoff_delay
+
+__author__ = 'Gareth Coles'
+
+"""
+Tests for scheduling reconnections
+"""
+
+CONFIG = {
+    "delay": 10,
+    "max-delay": 300,
+    "attempts": 0,
+    "on-drop": True,
+    "on-failure": True,
+    "reset-on-success": True,
+    "jitter": False
+}
+
+
+class RefusingServer(object):
+    """
+    Stands in for a server that refuses connections until it's told to
+    accept them.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.accepting = False
+        self.attempts = 0
+
+
+class FakeConnector(object):
+    """
+    Stands in for a Twisted connector, connecting to a RefusingServer.
+    """
+
+    def __init__(self, factory, server, clock):
+        self.factory = factory
+        self.server = server
+        self.clock = clock
+
+    def getDestination(self):
+        return Mock(host=self.server.host)
+
+    def connect(self):
+        self.server.attempts += 1
+
+        # Connections take a second to succeed or fail
+        self.clock.callLater(1, self._result)
+
+    def _result(self):
+        if self.server.accepting:
+            self.factory.clientConnected()
+        else:
+            self.factory.clientConnectionFailed(
+                self, Failure(ConnectionRefusedError())
+            )
+
+
+class FakeFactory(BaseFactory):
+    def connect(self):
+        return True
+
+
+class test_reconnect:
+    """
+    RECON | Tests for scheduling reconnections
+    """
+
+    def setup(self):
+        self.clock = Clock()
+        self.manager = Mock(name="factory_manager")
+        self.manager.main_config = {"reconnections": CONFIG}
+        self.manager.reconnects = ReconnectScheduler(
+            max_connecting=2, max_per_host=1, clock=self.clock
+        )
+
+    def make_factory(self, name, server):
+        factory = FakeFactory(name, {}, self.manager)
+        connector = FakeConnector(factory, server, self.clock)
+
+        return factory, connector
+
+    def test_backoff(self):
+        """
+        RECON | Test exponential backoff, with and without jitter
+        """
+
+        nosetools.eq_(
+            [backoff_delay(x, 10, 300, False) for x in xrange(1, 8)],
+            [10, 20, 40, 80, 160, 300, 300]
+        )
+        nosetools.eq_(backoff_delay(1000, 10, 300, False), 300)
+
+        for attempt in xrange(1, 10):
+            delay = backoff_delay(attempt, 10, 300)
+            nosetools.ok_(0 <= delay <= min(300, 10 * 2 ** (attempt - 1)))
+
+    def test_limits(self):
+        """
+        RECON | Test limits on connections in progress, with refusing servers
+        """
+
+        scheduler = self.manager.reconnects
+
+        one = RefusingServer("one.example.com")
+        two = RefusingServer("two.example.com")
+        three = RefusingServer("three.example.com")
+
+        factories = [
+            self.make_factory("a", one),
+            self.make_factory("b", one),
+            self.make_factory("c", two),
+            self.make_factory("d", three),
+        ]
+
+        # Everything drops at once
+        for factory, connector in factories:
+            factory.clientConnectionLost(
+                connector, Failure(ConnectionRefusedError())
+            )
+
+        self.clock.advance(10)
+
+        # Only two at once, and only one to each host
+        nosetools.eq_(sorted(scheduler.connecting), ["a", "c"])
+        nosetools.eq_(
+            (one.attempts, two.attempts, three.attempts), (1, 1, 0)
+        )
+        nosetools.eq_(scheduler.stats.queued, 2)
+
+        # The refusals free up the slots, and the waiting ones go next
+        self.clock.advance(1)
+        self.clock.advance(0)
+
+        nosetools.eq_(sorted(scheduler.connecting), ["b", "d"])
+        nosetools.eq_(
+            (one.attempts, two.attempts, three.attempts), (2, 1, 1)
+        )
+
+        # The second attempts wait twice as long
+        nosetools.eq_(factories[0][0].reconnection_attempts, 2)
+        nosetools.ok_(scheduler.reconnections["a"].active())
+
+        for server in (one, two, three):
+            server.accepting = True
+
+        for __ in xrange(120):
+            self.clock.advance(1)
+
+        nosetools.eq_(scheduler.connecting, {})
+        nosetools.eq_(scheduler.reconnections, {})
+        nosetools.eq_(scheduler.down_since, {})
+        nosetools.eq_(scheduler.stats.reconnects, 4)
+        nosetools.ok_(scheduler.stats.max_time >= 30)
+
+        for factory, __ in factories:
+            nosetools.eq_(factory.reconnection_attempts, 0)
+
+    def test_shutdown(self):
+        """
+        RECON | Test that shutting down cancels a scheduled reconnection
+        """
+
+        scheduler = self.manager.reconnects
+        server = RefusingServer("one.example.com")
+        factory, connector = self.make_factory("a", server)
+
+        factory.clientConnectionFailed(
+            connector, Failure(ConnectionRefusedError())
+        )
+        nosetools.ok_(factory.task.active())
+
+        with patch.object(factory.logger, "exception") as exception:
+            factory.shutdown()
+            nosetools.ok_(not exception.called)
+
+        nosetools.ok_(not factory.task.active())
+        nosetools.eq_(scheduler.reconnections, {})
+
+        self.clock.advance(600)
+        nosetools.eq_(server.attempts, 0)
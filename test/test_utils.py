@@ -4,7 +4,11 @@ import sys
 
 import nose.tools as nosetools
 
-from utils import irc, misc, password, strings, html, console
+from mock import patch
+
+from mock_time import StoppedTime
+from utils import irc, lru, misc, password, protobuf, ratelimit, strings, \
+    html, console
 
 __author__ = 'Gareth Coles'
 
@@ -15,8 +19,10 @@ config   - Configuration file objects
 data     - Data file objects
 html     - HTML utilities
 irc      - Utilities for the IRC protocol
+lru      - Size-bounded LRU cache
 misc     - Uncategorised utilities
 password - Password generation utilities
+ratelimit - Token buckets
 strings  - String manipulation utilities
 """
 
@@ -104,6 +110,40 @@ class test_utils:
         nosetools.eq_(result_newlines_three, "Some body that I "
                                              "\nused to know\n")
 
+    def test_html_entities_and_escaping(self):
+        """
+        UTILS | Test HTML entities, skipped tags and escaping
+        """
+
+        nosetools.eq_(
+            html.html_to_text("a &amp; b &lt;c&gt; &#39;d&#x27; &bogus; & e"),
+            u"a & b <c> 'd' &bogus; & e"
+        )
+        nosetools.eq_(
+            html.html_to_text('<a href="http://x/?a=1&amp;b=>2">link</a>'),
+            u"link"
+        )
+        nosetools.eq_(
+            html.html_to_text("<style>p { x: 1 }</style><!-- x --><b>hi</b>"),
+            u"hi"
+        )
+        nosetools.eq_(html.html_to_text("a<p/>b", newlines=True), u"a\n\nb")
+
+        # Cached results are the same as fresh ones
+        nosetools.eq_(html.html_to_text("a<br>b", True), u"a\nb")
+        nosetools.eq_(html.html_to_text("a<br>b", True), u"a\nb")
+        nosetools.eq_(html.html_to_text("a<br>b"), u"ab")
+
+        nosetools.eq_(
+            html.text_to_html("<b> & \"quotes\""),
+            "&lt;b&gt; &amp; \"quotes\""
+        )
+        nosetools.eq_(html.text_to_html("a\nb", newlines=True), "a<br />b")
+        nosetools.eq_(
+            html.html_to_text(html.text_to_html("<a> & <b>\n", True), True),
+            u"<a> & <b>\n"
+        )
+
     # IRC
 
     def test_irc_split_hostmask(self):
@@ -125,6 +165,28 @@ class test_utils:
 
         irc.split_hostmask("aaa!bbbccc")
 
+    # LRU
+
+    def test_lru_eviction(self):
+        """
+        UTILS | Test that the LRU cache evicts the least recently used items
+        """
+
+        evicted = []
+        cache = lru.LRUCache(2, lambda k, v: evicted.append((k, v)))
+
+        cache["a"] = 1
+        cache["b"] = 2
+        nosetools.eq_(cache.get("a"), 1)
+
+        cache["c"] = 3
+
+        nosetools.eq_(len(cache), 2)
+        nosetools.assert_false("b" in cache)
+        nosetools.eq_(evicted, [("b", 2)])
+        nosetools.eq_(cache.evictions, 1)
+        nosetools.eq_(cache.keys(), ["a", "c"])
+
     # Misc
 
     def test_misc_chunker(self):
@@ -228,6 +290,72 @@ exception
 
         nosetools.eq_(0, len(duplicates), "1000 passwords")
 
+    # Protobuf
+
+    def test_protobuf_varints(self):
+        """
+        UTILS | Test encoding and decoding Mumble varints
+        """
+
+        values = [0, 1, 0x7F, 0x80, 0x3FFF, 0x4000, 0x1FFFFF, 0x200000,
+                  0xFFFFFFF, 0x10000000, 0xFFFFFFFF, 0x100000000,
+                  0xFFFFFFFFFFFFFFFF, -1, -4, -5, -0x12345678]
+
+        data = protobuf.encode_varints(*values)
+        decoded, pos = protobuf.read_varints(data, len(values))
+
+        nosetools.eq_(decoded, values)
+        nosetools.eq_(pos, len(data))
+
+        for value in values:
+            encoded = str(protobuf.encode_varints(value))
+
+            nosetools.eq_(protobuf.decode_varint("x" + encoded, 1),
+                          (value, len(encoded)))
+
+    # Ratelimit
+
+    def test_ratelimit_keyed_buckets(self):
+        """
+        UTILS | Test per-key token buckets with a global limit
+        """
+
+        mock_time = StoppedTime()
+
+        with patch("utils.ratelimit.time", mock_time):
+            buckets = ratelimit.KeyedTokenBuckets(2, 1, max_keys=10,
+                                                  global_capacity=3,
+                                                  global_fill_rate=1)
+
+            nosetools.assert_true(buckets.consume("a"))
+            nosetools.assert_true(buckets.consume("a"))
+            nosetools.assert_false(buckets.consume("a"), "Key limit")
+
+            nosetools.assert_true(buckets.consume("b"))
+            nosetools.assert_false(buckets.consume("c"), "Global limit")
+
+            mock_time.sleep(1)
+
+            nosetools.assert_true(buckets.consume("a"), "Refilled")
+            nosetools.assert_false(buckets.consume("a"))
+
+            nosetools.eq_(buckets.stats["accepted"], 4)
+            nosetools.eq_(buckets.stats["rejected_key"], 2)
+            nosetools.eq_(buckets.stats["rejected_global"], 1)
+
+    def test_ratelimit_keyed_buckets_bounded(self):
+        """
+        UTILS | Test that per-key token buckets are bounded in number
+        """
+
+        buckets = ratelimit.KeyedTokenBuckets(1, 1, max_keys=100)
+
+        for x in xrange(1000):
+            buckets.consume(x)
+
+        nosetools.eq_(len(buckets), 100)
+        nosetools.eq_(buckets.stats["evicted_keys"], 900)
+
     # Strings
 
     def test_strings_formatter_replacements(self):
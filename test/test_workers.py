@@ -0,0 +1,464 @@
+# coding=utf-8
+import nose.tools as nosetools
+
+from mock import MagicMock as Mock
+from twisted.internet.task import Clock
+from twisted.test import iosim
+
+from system.commands.manager import CommandManager
+from system.enums import CommandState, ProtocolState
+from system.events.general import MessageReceived, PreCommand, \
+    UnknownCommand
+from system.events.manager import EventManager
+from system.protocols.generic.protocol import Protocol
+from system.protocols.generic.reconnect import ReconnectScheduler
+from system.protocols.irc.channel import Channel
+from system.protocols.irc.user import User
+from system.workers.bus import BusConnection, WorkerBus, WorkerProcess
+from system.workers.commands import CHUNK_SIZE, LongString
+from system.workers.remote import RemoteChannel, RemoteProtocol, RemoteUser
+from system.workers.serialization import EventEncoder, decode_event, \
+    dump_args, load_args
+from system.workers.worker import WorkerConnection
+
+__author__ = 'Gareth Coles'
+
+"""
+Tests for passing events and calls between worker processes
+"""
+
+
+class FakeProtocol(Protocol):
+    TYPE = "fake"
+    CHANNELS = True
+
+    control_chars = "!"
+    ourselves = None
+
+    def __init__(self):
+        self.name = "fake"
+        self.nickname = "Ultros"
+
+        self.sent = []
+
+    def send_msg(self, target, message, target_type=None, use_event=True):
+        self.sent.append((target, message, target_type, use_event))
+        return True
+
+
+class FakeWorkerManager(object):
+    """
+    Stands in for a worker process' factory manager, running one protocol.
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.event_manager = Mock(name="event_manager")
+
+        self.loaded = []
+        self.unloaded = False
+
+    def load_protocol(self, name, conf_location):
+        self.loaded.append((name, conf_location))
+        return ProtocolState.Loaded
+
+    def get_protocol(self, name):
+        if name == self.protocol.name:
+            return self.protocol
+
+    def unload(self):
+        self.unloaded = True
+
+
+def connect_worker(bus, worker_id, secret, manager):
+    """
+    Connect a worker to the bus over a loopback, rather than a process and
+    a socket.
+
+    :return: (bus' connection, worker's connection, IOPump)
+    """
+
+    server = BusConnection(bus)
+    client = WorkerConnection(worker_id, secret, manager)
+
+    pump = iosim.connect(
+        server, iosim.makeFakeServer(server),
+        client, iosim.makeFakeClient(client)
+    )
+
+    return server, client, pump
+
+
+class test_workers:
+    """
+    WORK  | Tests for the worker process support
+    """
+
+    def test_event_round_trip(self):
+        """
+        WORK  | Test encoding and decoding events
+        """
+
+        protocol = FakeProtocol()
+        user = User(protocol, "nick", "ident", "host")
+        channel = Channel(protocol, "#channel")
+
+        event = MessageReceived(protocol, user, channel, "Hello \xe2\x98\x83",
+                                "message")
+
+        encoder = EventEncoder()
+        remote = RemoteProtocol("fake", None, Mock(name="bus"), 0)
+
+        decoded = decode_event(encoder.encode_event(event), remote, None)
+
+        nosetools.assert_is_instance(decoded, MessageReceived)
+        nosetools.eq_(decoded.caller, remote)
+        nosetools.eq_(decoded.message, "Hello \xe2\x98\x83")
+        nosetools.eq_(decoded.type, "message")
+
+        nosetools.assert_is_instance(decoded.source, RemoteUser)
+        nosetools.eq_(decoded.source.nickname, "nick")
+        nosetools.eq_(decoded.source.host, "host")
+
+        nosetools.assert_is_instance(decoded.target, RemoteChannel)
+        nosetools.eq_(decoded.target.name, "#channel")
+
+        # The same user gets the same proxy, even after a nick change
+        decoded.source.authorized = True
+        user.nickname = "other"
+
+        decoded = decode_event(encoder.encode_event(event), remote, None)
+
+        nosetools.eq_(decoded.source.nickname, "other")
+        nosetools.ok_(decoded.source.authorized)
+        nosetools.eq_(remote.get_user("OTHER"), decoded.source)
+
+    def test_forwarded_calls(self):
+        """
+        WORK  | Test forwarding calls to protocols in workers
+        """
+
+        bus = Mock(name="bus")
+        remote = RemoteProtocol("fake", None, bus, 3)
+
+        user = remote.get_remote_user(1, "nick", {})
+        user.respond("Hi")
+
+        bus.call_protocol.assert_called_with(
+            3, "fake", "send_msg", ("nick", "Hi", "user", True)
+        )
+
+        remote.send_action(remote.get_remote_channel("#Channel"), "waves")
+
+        bus.call_protocol.assert_called_with(
+            3, "fake", "send_action", ("#Channel", "waves", "channel", True)
+        )
+
+        nosetools.assert_raises(ValueError, remote.call, "shutdown")
+
+        nosetools.eq_(
+            load_args(dump_args(["#channel", "\xe2\x98\x83", None, True])),
+            ["#channel", "\xe2\x98\x83", None, True]
+        )
+
+    def test_get_user(self):
+        """
+        WORK  | Test finding remote users by nickname
+        """
+
+        remote = RemoteProtocol("fake", None, Mock(name="bus"), 0)
+        remote._users.max_size = 2
+
+        user = remote.get_remote_user(1, "Nick", {})
+        nosetools.eq_(remote.get_user("nick"), user)
+
+        # Nickname changes move the user
+        remote.get_remote_user(1, "Other", {})
+        nosetools.eq_(remote.get_user("nick"), None)
+        nosetools.eq_(remote.get_user("OTHER"), user)
+
+        # Someone else can take the old one
+        second = remote.get_remote_user(2, "Nick", {})
+        nosetools.eq_(remote.get_user("nick"), second)
+
+        # Users pushed out of the cache can't be found any more
+        remote.get_remote_user(3, "Third", {})
+        nosetools.eq_(remote.get_user("other"), None)
+        nosetools.eq_(remote.get_user("nick"), second)
+        nosetools.eq_(len(remote._nicknames), 2)
+
+    def test_run_command(self):
+        """
+        WORK  | Test running commands for messages from workers
+        """
+
+        factory_manager = Mock(name="factory_manager")
+        bus = WorkerBus(factory_manager, {})
+
+        remote = RemoteProtocol("fake", None, bus, 0)
+        remote.control_chars = "!"
+        remote.nickname = "Ultros"
+
+        event = MessageReceived(
+            remote, remote.get_remote_user(1, "nick", {}),
+            remote.get_remote_channel("#channel"), "!", "message"
+        )
+
+        # Just the control characters isn't a command - or an error
+        factory_manager.commands.process_input.return_value = False
+        nosetools.assert_false(bus.run_command(event))
+
+        factory_manager.commands.process_input.return_value = (
+            CommandState.Success, None
+        )
+        nosetools.assert_true(bus.run_command(event))
+
+    def test_bus(self):
+        """
+        WORK  | Test passing events and calls over the bus
+        """
+
+        factory_manager = Mock(name="factory_manager")
+        factory_manager.commands.process_input.return_value = (
+            CommandState.NotACommand, None
+        )
+
+        bus = WorkerBus(factory_manager, {"processes": 1,
+                                          "protocols": ["fake"]})
+
+        # Rather than spawning it
+        process = WorkerProcess(bus, 0)
+        bus.workers[0] = process
+
+        # Workers that don't know the secret are turned away
+        server, client, pump = connect_worker(
+            bus, 0, "wrong", FakeWorkerManager(FakeProtocol())
+        )
+
+        nosetools.eq_(server.worker, None)
+        nosetools.eq_(process.connection, None)
+
+        # Calls made before the worker connects wait for it
+        protocol = FakeProtocol()
+        manager = FakeWorkerManager(protocol)
+
+        factory = bus.load_protocol("fake", "protocols/fake.yml")
+        factory_manager.get_factory.return_value = factory
+
+        server, client, pump = connect_worker(bus, 0, bus.secret, manager)
+        pump.flush()
+
+        nosetools.eq_(process.connection, server)
+        nosetools.eq_(manager.event_manager.forwarder, client.forward_event)
+        nosetools.eq_(manager.loaded, [("fake", "protocols/fake.yml")])
+        factory_manager.remove_protocol.assert_not_called()
+
+        # Events in the worker are thrown in the main process
+        user = User(protocol, "nick", "ident", "host")
+        channel = Channel(protocol, "#channel")
+
+        client.forward_event("MessageReceived", MessageReceived(
+            protocol, user, channel, "Hello", "message"
+        ))
+        pump.flush()
+
+        run_callback = factory_manager.event_manager.run_callback
+        nosetools.eq_(run_callback.call_count, 1)
+
+        callback, event = run_callback.call_args[0]
+
+        nosetools.eq_(callback, "MessageReceived")
+        nosetools.eq_(event.caller, factory.protocol)
+        nosetools.eq_(event.source.nickname, "nick")
+        nosetools.eq_(event.target.name, "#channel")
+        nosetools.eq_(event.message, "Hello")
+        nosetools.eq_(factory.protocol.nickname, "Ultros")
+
+        # And calls in the main process are made in the worker
+        results = []
+
+        event.target.respond("Hi there")
+        bus.call_protocol(
+            0, "fake", "send_msg", ["nick", "Hello", "user", False]
+        ).addCallback(results.append)
+        pump.flush()
+
+        nosetools.eq_(protocol.sent, [
+            ("#channel", "Hi there", "channel", True),
+            ("nick", "Hello", "user", False)
+        ])
+        nosetools.eq_(results, [True])
+
+    def test_bus_commands(self):
+        """
+        WORK  | Test that commands from workers only throw their events once
+        """
+
+        commands = CommandManager()
+        events = EventManager()
+
+        plugin = Mock(name="plugin")
+        plugin.info.name = "Test"
+
+        factory_manager = Mock(name="factory_manager")
+        factory_manager.commands = commands
+        factory_manager.event_manager = events
+
+        bus = WorkerBus(factory_manager, {"processes": 1,
+                                          "protocols": ["fake"]})
+        bus.workers[0] = WorkerProcess(bus, 0)
+
+        factory = bus.load_protocol("fake", "protocols/fake.yml")
+        factory_manager.get_factory.return_value = factory
+
+        protocol = FakeProtocol()
+        server, client, pump = connect_worker(
+            bus, 0, bus.secret, FakeWorkerManager(protocol)
+        )
+
+        fired = []
+
+        commands.register_command("test", plugin.handler, plugin)
+        events.add_callback("PreCommand", plugin, fired.append, 0)
+        events.add_callback("UnknownCommand", plugin, fired.append, 0)
+
+        try:
+            user = User(protocol, "nick", "ident", "host")
+            channel = Channel(protocol, "#channel")
+
+            for message in ("!test arg", "!missing"):
+                command, args = (message[1:].split(" ", 1) + [""])[:2]
+
+                # What the worker's command manager throws, as it doesn't
+                # have any commands - and then the message, as it wasn't one
+                client.forward_event("PreCommand", PreCommand(
+                    protocol, command, args, user, channel, message, message
+                ))
+                client.forward_event("UnknownCommand", UnknownCommand(
+                    protocol, protocol, command, args, user, channel
+                ))
+                client.forward_event("MessageReceived", MessageReceived(
+                    protocol, user, channel, message, "message"
+                ))
+
+            pump.flush()
+
+            nosetools.eq_(
+                [(type(event), event.command) for event in fired],
+                [(PreCommand, "test"), (PreCommand, "missing"),
+                 (UnknownCommand, "missing")]
+            )
+            nosetools.eq_(plugin.handler.call_count, 1)
+        finally:
+            commands.unregister_commands_for_owner(plugin)
+            events.remove_callbacks_for_plugin("Test")
+
+    def test_bus_reconnects(self):
+        """
+        WORK  | Test that workers' reconnections share the main scheduler
+        """
+
+        clock = Clock()
+
+        factory_manager = Mock(name="factory_manager")
+        factory_manager.reconnects = ReconnectScheduler(
+            max_connecting=1, clock=clock
+        )
+        scheduler = factory_manager.reconnects
+
+        bus = WorkerBus(factory_manager, {"processes": 2,
+                                          "protocols": ["one", "two"]})
+
+        workers = []
+
+        for worker_id, name in enumerate(("one", "two")):
+            bus.workers[worker_id] = WorkerProcess(bus, worker_id)
+            server, client, pump = connect_worker(
+                bus, worker_id, bus.secret, FakeWorkerManager(FakeProtocol())
+            )
+
+            factory = Mock(reconnection_attempts=1)
+            factory.name = name
+
+            connector = Mock(name="connector")
+            connector.getDestination.return_value.host = "%s.example" % name
+
+            workers.append((client, pump, factory, connector))
+
+        def flush():
+            for _, pump, _, _ in workers:
+                pump.flush()
+
+        (client_1, _, factory_1, connector_1), \
+            (client_2, _, factory_2, connector_2) = workers
+
+        client_1.reconnects.schedule(factory_1, connector_1, 5)
+        client_2.reconnects.schedule(factory_2, connector_2, 5)
+        flush()
+
+        nosetools.eq_(sorted(scheduler.reconnections), ["one", "two"])
+
+        # Only one protocol can be connecting at once, whichever worker
+        # it's in
+        clock.advance(5)
+        flush()
+
+        nosetools.eq_(connector_1.connect.call_count, 1)
+        nosetools.eq_(connector_2.connect.call_count, 0)
+        nosetools.eq_(scheduler.stats.queued, 1)
+
+        client_1.reconnects.connected(factory_1)
+        flush()
+        clock.advance(0)
+        flush()
+
+        nosetools.eq_(connector_2.connect.call_count, 1)
+        nosetools.eq_(scheduler.stats.reconnects, 1)
+
+        # Failures free the slot too
+        client_2.reconnects.failed(factory_2)
+        flush()
+
+        nosetools.eq_(scheduler.connecting, {})
+
+        # Cancelled reconnections are cancelled in the main process
+        reconnection = client_1.reconnects.schedule(factory_1, connector_1, 5)
+        flush()
+        reconnection.cancel()
+        flush()
+
+        nosetools.ok_("one" not in scheduler.reconnections)
+
+        clock.advance(5)
+        flush()
+
+        nosetools.eq_(connector_1.connect.call_count, 1)
+
+        # As are those of protocols that are unloaded
+        client_2.reconnects.schedule(factory_2, connector_2, 5)
+        flush()
+        client_2.reconnects.forget(factory_2)
+        flush()
+
+        nosetools.eq_(scheduler.reconnections, {})
+        nosetools.ok_("two" not in scheduler.down_since)
+        nosetools.eq_(bus.connectors.keys(), ["one"])
+
+    def test_long_string(self):
+        """
+        WORK  | Test splitting long strings over several AMP values
+        """
+
+        argument = LongString()
+
+        for value in ("", "x", "x" * CHUNK_SIZE, "x" * (CHUNK_SIZE * 3 + 1)):
+            strings = {}
+            objects = {}
+
+            argument.toBox("value", strings, {"value": value}, None)
+
+            for string in strings.itervalues():
+                nosetools.ok_(len(string) <= CHUNK_SIZE)
+
+            argument.fromBox("value", strings, objects, None)
+            nosetools.eq_(objects["value"], value)
@@ -10,6 +10,27 @@ __author__ = 'Gareth Coles'
 
 from HTMLParser import HTMLParser
 import htmlentitydefs
+import re
+
+from utils.lru import LRUCache
+
+#: Converted messages are cached if they're no longer than this
+CACHE_MAX_LENGTH = 4096
+
+_cache = LRUCache(256)
+
+# Tags (with the closing slash, name and self-closing slash in groups),
+# character and entity references, and comments/doctypes - everything the
+# HTML that Mumble clients send is made of
+_TOKENS = re.compile(
+    r"<(/?)([a-zA-Z][a-zA-Z0-9]*)(?:[^>\"']|\"[^\"]*\"|'[^']*')*?(/?)>"
+    r"|&(#[xX][0-9a-fA-F]+|#[0-9]+|[a-zA-Z][a-zA-Z0-9]*);"
+    r"|<!--.*?-->|<![^>]*>",
+    re.S
+)
+
+# Tags whose contents aren't text
+_SKIPPED_TAGS = frozenset(("style", "script", "head", "title"))
 
 
 class HTMLTextExtractor(HTMLParser):
@@ -60,13 +81,110 @@ def html_to_text(html, newlines=False):
     """
     Given a HTML snippet, strip out all the HTML and leave just the text.
 
+    Text with no tags or entities is returned as-is, and the results for
+    short snippets are cached, as the same messages tend to come up again.
+
     :param html: HTML to strip
     :param newlines: Whether to replace <p>, <p/> and <br /> with newlines
     :return: The stripped snippet
     """
-    s = HTMLTextExtractor(newlines)
-    s.feed(html)
-    return s.get_text()
+
+    if "<" not in html and "&" not in html:
+        return html
+
+    if len(html) > CACHE_MAX_LENGTH:
+        return _convert(html, newlines)
+
+    key = (html, newlines)
+    text = _cache.get(key)
+
+    if text is None:
+        text = _convert(html, newlines)
+        _cache[key] = text
+
+    return text
+
+
+def _convert(html, newlines):
+    result = []
+    append = result.append
+    position = 0
+    skipping = None
+
+    for match in _TOKENS.finditer(html):
+        start = match.start()
+
+        if start > position and skipping is None:
+            append(html[position:start])
+
+        position = match.end()
+        closing, tag, self_closing, reference = match.group(1, 2, 3, 4)
+
+        if tag is not None:
+            tag = tag.lower()
+
+            if skipping is not None:
+                if closing and tag == skipping:
+                    skipping = None
+            elif tag in _SKIPPED_TAGS and not (closing or self_closing):
+                skipping = tag
+            elif newlines:
+                if tag == "br":
+                    append("\n")
+                elif tag == "p":
+                    append("\n")
+
+                    if self_closing:
+                        append("\n")
+        elif reference is not None and skipping is None:
+            append(_reference(reference, match.group(0)))
+
+    if position < len(html) and skipping is None:
+        append(html[position:])
+
+    return u"".join(result)
+
+
+def _reference(name, original):
+    if name[0] == "#":
+        if name[1] in "xX":
+            codepoint = int(name[2:], 16)
+        else:
+            codepoint = int(name[1:])
+
+        try:
+            return unichr(codepoint)
+        except ValueError:
+            return original
+
+    codepoint = htmlentitydefs.name2codepoint.get(name)
+
+    if codepoint is None:
+        return original
+
+    return unichr(codepoint)
+
+
+def text_to_html(text, newlines=False):
+    """
+    Escape some text so it can be sent as HTML - the reverse of
+    `html_to_text()`.
+
+    :param text: Text to escape
+    :param newlines: Whether to replace newlines with <br />
+    :return: The escaped text
+    """
+
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if newlines and "\n" in text:
+        text = text.replace("\n", "<br />")
+
+    return text
 
 
 def unescape_html_entities(text):
@@ -0,0 +1,106 @@
+# coding=utf-8
+
+"""
+A simple, size-bounded least-recently-used mapping.
+"""
+
+from collections import OrderedDict
+
+__author__ = 'Gareth Coles'
+
+
+class LRUCache(object):
+    """
+    A mapping that holds at most *max_size* items, discarding the least
+    recently used items first when it's full.
+
+    Reading an item with `get()` or `[]` counts as using it, but `in` and
+    `len()` don't. An optional *on_evict* callable is called with the key and
+    value of every item that's pushed out to make room.
+
+    >>> cache = LRUCache(2)
+    >>> cache["a"] = 1
+    >>> cache["b"] = 2
+    >>> cache.get("a")
+    1
+    >>> cache["c"] = 3
+    >>> "b" in cache
+    False
+    """
+
+    def __init__(self, max_size, on_evict=None):
+        """
+        :param max_size: The max number of items to store
+        :param on_evict: Callable taking (key, value), called on eviction
+        """
+
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.evictions = 0
+
+        self._data = OrderedDict()
+
+    def __repr__(self):
+        return "%s(max_size=%r, size=%r)" % (
+            self.__class__.__name__,
+            self.max_size,
+            len(self._data)
+        )
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __getitem__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        self._evict()
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def peek(self, key, default=None):
+        """
+        Get an item without counting it as used.
+        """
+
+        return self._data.get(key, default)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def _evict(self):
+        while len(self._data) > self.max_size:
+            key, value = self._data.popitem(last=False)
+            self.evictions += 1
+
+            if self.on_evict is not None:
+                self.on_evict(key, value)
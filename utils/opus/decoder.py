@@ -0,0 +1,58 @@
+# coding=utf-8
+import ctypes
+
+from utils.opus.lib import opus, CTL_RESET_STATE, MAX_FRAME_SIZE
+
+__author__ = 'Gareth Coles'
+
+
+class Decoder(object):
+    decoder = None
+
+    def __init__(self, sampling, channels):
+        self.sampling_rate = sampling
+        self.channels = channels
+        self.sample_size = 2 * self.channels
+
+        # Decoded audio is written here and copied out, rather than
+        # allocating a new buffer for every frame
+        self._output = (ctypes.c_int16 * (MAX_FRAME_SIZE * channels))()
+
+        self.decoder = self._get_decoder()
+
+    def __del__(self):
+        if self.decoder is not None:
+            opus.opus_decoder_destroy(self.decoder)
+            self.decoder = None
+
+    def _get_decoder(self):
+        return opus.opus_decoder_create(self.sampling_rate, self.channels)
+
+    def reset(self):
+        """
+        Reset the decoder's state, so it can be used for another stream.
+        """
+
+        opus.opus_decoder_ctl(self.decoder, CTL_RESET_STATE)
+
+    def decode(self, data, frame_size=MAX_FRAME_SIZE, fec=False):
+        """
+        Decode a packet.
+
+        :param data: The packet, as a string - or None if it was lost, to
+            have the decoder fill the gap with something plausible
+        :param frame_size: The most samples per channel to decode - when
+            filling a gap, this should be the length of the gap
+        :param fec: Whether to decode the forward error correction data in
+            this packet, which belongs to the packet before it
+        :return: Signed 16-bit native-endian PCM, as a string
+        """
+
+        length = len(data) if data is not None else 0
+
+        samples = opus.opus_decode(
+            self.decoder, data, length, self._output,
+            min(frame_size, MAX_FRAME_SIZE), int(fec)
+        )
+
+        return ctypes.string_at(self._output, samples * self.sample_size)
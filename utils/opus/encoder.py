@@ -2,7 +2,7 @@
 import ctypes
 
 from utils.opus.lib import opus, APPLICATION_AUDIO, CTL_SET_BITRATE, \
-    CTL_SET_BANDWIDTH, c_int16_p
+    CTL_SET_BANDWIDTH, MAX_PACKET_SIZE
 
 __author__ = 'Gareth Coles'
 
@@ -27,9 +27,13 @@ class Encoder(object):
         self.frame_length = 20
         self.sample_size = 2 * self.channels
         self.samples_per_frame = int(
-            self.sampling_rate / 100 * self.frame_length
+            self.sampling_rate / 1000 * self.frame_length
         )
 
+        # Encoded frames are written here and copied out, rather than
+        # allocating a new buffer for every frame
+        self._output = ctypes.create_string_buffer(MAX_PACKET_SIZE)
+
         self.encoder = self._get_encoder()
         self.set_bitrate(128)
         self.set_bandwidth("full")
@@ -63,10 +67,15 @@ class Encoder(object):
         opus.opus_encoder_ctl(self.encoder, CTL_SET_BANDWIDTH, k)
 
     def encode(self, pcm, frame_size):
-        max_data_bytes = len(pcm)
-        pcm = ctypes.cast(pcm, c_int16_p)
-        data = (ctypes.c_char * max_data_bytes)()
+        """
+        Encode a frame of audio.
+
+        :param pcm: Signed 16-bit native-endian PCM, as a string or any
+            ctypes buffer - it's passed to libopus as-is, without copying
+        :param frame_size: The number of samples per channel in the frame
+        :return: The encoded frame, as a string
+        """
 
         return opus.opus_encode(
-            self.encoder, pcm, frame_size, data, max_data_bytes
+            self.encoder, pcm, frame_size, self._output, MAX_PACKET_SIZE
         )
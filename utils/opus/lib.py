@@ -3,8 +3,8 @@
 # Based on: https://github.com/Rapptz/discord.py/blob/async/discord/opus.py
 # Discord.py is available under the MIT license, Copyright (c) 2015-2016 Rapptz
 
-import array
 import ctypes
+import ctypes.util
 
 from utils.opus.exceptions import OpusException
 
@@ -15,18 +15,30 @@ class EncoderStruct(ctypes.Structure):
     pass
 
 
+class DecoderStruct(ctypes.Structure):
+    pass
+
+
 OK = 0
 APPLICATION_AUDIO = 2049
 APPLICATION_VOIP = 2048
 APPLICATION_LOWDELAY = 2051
 CTL_SET_BITRATE = 4002
 CTL_SET_BANDWIDTH = 4008
+CTL_RESET_STATE = 4028
+
+# The largest packet the Opus documentation says we should ever need
+MAX_PACKET_SIZE = 4000
+
+# The longest frame a packet can hold - 120ms at 48kHz - in samples
+MAX_FRAME_SIZE = 5760
 
 
 c_int_p = ctypes.POINTER(ctypes.c_int)
 c_int16_p = ctypes.POINTER(ctypes.c_int16)
 c_float_p = ctypes.POINTER(ctypes.c_float)
 EncoderStruct_p = ctypes.POINTER(EncoderStruct)
+DecoderStruct_p = ctypes.POINTER(DecoderStruct)
 
 
 FUNCTIONS = {
@@ -39,7 +51,8 @@ FUNCTIONS = {
     ),
     "opus_encode": (
         (
-            EncoderStruct_p, c_int16_p,
+            # The PCM can be any buffer - a string, or a ctypes array
+            EncoderStruct_p, ctypes.c_void_p,
             ctypes.c_int, ctypes.c_char_p, ctypes.c_int32
         ),
         ctypes.c_int32
@@ -47,6 +60,22 @@ FUNCTIONS = {
     "opus_encoder_ctl": (None, ctypes.c_int32),
     "opus_encoder_destroy": ((EncoderStruct_p, ), None),
     # endregion
+
+    # region: Decoder stuff
+    "opus_decoder_create": (
+        (ctypes.c_int, ctypes.c_int, c_int_p),
+        DecoderStruct_p
+    ),
+    "opus_decode": (
+        (
+            DecoderStruct_p, ctypes.c_char_p, ctypes.c_int32,
+            ctypes.c_void_p, ctypes.c_int, ctypes.c_int
+        ),
+        ctypes.c_int
+    ),
+    "opus_decoder_ctl": (None, ctypes.c_int32),
+    "opus_decoder_destroy": ((DecoderStruct_p, ), None),
+    # endregion
 }
 
 
@@ -58,6 +87,9 @@ class OpusLibrary(object):
         self.setup_functions()
 
     def load_library(self, name):
+        if name is None:
+            raise OSError("Unable to find libopus")
+
         self.lib = ctypes.cdll.LoadLibrary(name)
 
     def setup_functions(self):
@@ -96,7 +128,7 @@ class OpusLibrary(object):
         if result < 0:
             raise OpusException(result)
 
-        return array.array('b', data[:result]).tobytes()
+        return ctypes.string_at(data, result)
 
     def opus_encoder_ctl(self, encoder, *args):
         result = self.lib.opus_encoder_ctl(encoder, *args)
@@ -109,5 +141,44 @@ class OpusLibrary(object):
     def opus_encoder_destroy(self, encoder):
         return self.lib.opus_encoder_destroy(encoder)
 
+    def opus_decoder_create(self, sampling_rate, channels):
+        return_value = ctypes.c_int()
+        result = self.lib.opus_decoder_create(
+            sampling_rate, channels, ctypes.byref(return_value)
+        )
+
+        if return_value.value != 0:
+            raise OpusException(return_value.value)
+
+        return result
+
+    def opus_decode(self, decoder, data, length, pcm, frame_size, fec):
+        result = self.lib.opus_decode(
+            decoder, data, length, pcm, frame_size, fec
+        )
+
+        if result < 0:
+            raise OpusException(result)
+
+        return result
+
+    def opus_decoder_ctl(self, decoder, *args):
+        result = self.lib.opus_decoder_ctl(decoder, *args)
+
+        if result < 0:
+            raise OpusException(result)
+
+        return result
+
+    def opus_decoder_destroy(self, decoder):
+        return self.lib.opus_decoder_destroy(decoder)
+
+
+try:
+    opus = OpusLibrary()
+except (OSError, AttributeError):
+    # libopus isn't installed, or it's too old to have what we need
+    opus = None
 
-opus = OpusLibrary()
+#: Whether libopus was loaded - nothing here will work if it wasn't
+AVAILABLE = opus is not None
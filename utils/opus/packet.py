@@ -0,0 +1,51 @@
+# coding=utf-8
+
+"""
+Reading the headers of Opus packets, without needing libopus.
+
+See RFC 6716, section 3.1, for the details.
+"""
+
+__author__ = 'Gareth Coles'
+
+# Frame lengths for each configuration in the TOC byte, in units of 1/400th
+# of a second (2.5ms): SILK (0 - 11), hybrid (12 - 15) and CELT (16 - 31)
+_FRAME_UNITS = (
+    [4, 8, 16, 24] * 3 +
+    [4, 8] * 2 +
+    [1, 2, 4, 8] * 4
+)
+
+
+def get_nb_frames(packet):
+    """
+    Get the number of frames in a packet.
+
+    :param packet: The packet, as a string
+    """
+
+    if not packet:
+        raise ValueError("Empty Opus packet")
+
+    code = ord(packet[0]) & 0x03
+
+    if code == 0:
+        return 1
+    elif code != 3:
+        return 2
+    elif len(packet) < 2:
+        raise ValueError("Truncated Opus packet")
+
+    return ord(packet[1]) & 0x3F
+
+
+def get_nb_samples(packet, sampling_rate=48000):
+    """
+    Get the number of samples (per channel) in a packet.
+
+    :param packet: The packet, as a string
+    :param sampling_rate: The rate it'll be decoded at
+    """
+
+    units = _FRAME_UNITS[ord(packet[0]) >> 3] * get_nb_frames(packet)
+    return units * sampling_rate // 400
@@ -1,37 +1,165 @@
 # coding=utf-8
 
+"""
+Mumble's variable-length integer encoding, as used in its voice packets.
+
+This isn't the same as Protobuf's varints - the length of the number is
+given by the leading bits of the first byte:
+
+    0xxxxxxx                    7-bit positive number
+    10xxxxxx + 1 byte           14-bit positive number
+    110xxxxx + 2 bytes          21-bit positive number
+    1110xxxx + 3 bytes          28-bit positive number
+    111100__ + 4 bytes          32-bit positive number
+    111101__ + 8 bytes          64-bit number
+    111110__ + varint           Negative varint
+    111111xx                    Byte-inverted negative two-bit number (~xx)
+
+The readers take a bytearray (or anything else that gives ints when
+indexed) and a position, and return the value and the position just after
+it, so several values can be read in a row without any slicing.
+"""
+
 __author__ = 'Sean'
 
 
-def decode_varint(data, pos=0):
-    first = ord(data[pos])
-    if (first & 0x80) == 0x00:
-        return (first & 0x7F), 1
-    elif (first & 0xC0) == 0x80:
-        return (first & 0x4F) << 8 | ord(data[pos + 1]), 2
-    elif (first & 0xF0) == 0xF0:
-        if (first & 0xFC) == 0xF0:
-            return (ord(data[pos + 1]) << 24 | ord(data[pos + 2]) << 16 | ord(
-                data[pos + 3]) << 8 | ord(data[pos + 4]), 5)
-        elif (first & 0xFC) == 0xF4:
-            return (ord(data[pos + 1]) << 56 | ord(data[pos + 2]) << 48 | ord(
-                data[pos + 3]) << 40 | ord(data[pos + 4]) << 32 | ord(
-                data[pos + 5]) << 24 | ord(data[pos + 6]) << 16 | ord(
-                data[pos + 7]) << 8 | ord(data[pos + 8]), 9)
-        elif (first & 0xFC) == 0xF8:
-            result, length = decode_varint(data, pos + 1)
-            return -result, length + 1
-        elif (first & 0xFC) == 0xFC:
-            return -(first & 0x03), 1
+def read_varint(data, pos=0):
+    """
+    Read a single varint.
+
+    :param data: A bytearray to read from
+    :param pos: The index of the first byte of the varint
+    :return: A tuple of (value, position after the varint)
+    """
+
+    first = data[pos]
+
+    if first < 0x80:
+        return first, pos + 1
+    elif first < 0xC0:
+        return (first & 0x3F) << 8 | data[pos + 1], pos + 2
+    elif first < 0xE0:
+        return ((first & 0x1F) << 16 | data[pos + 1] << 8 |
+                data[pos + 2]), pos + 3
+    elif first < 0xF0:
+        return ((first & 0x0F) << 24 | data[pos + 1] << 16 |
+                data[pos + 2] << 8 | data[pos + 3]), pos + 4
+
+    kind = first & 0xFC
+
+    if kind == 0xF0:
+        return (data[pos + 1] << 24 | data[pos + 2] << 16 |
+                data[pos + 3] << 8 | data[pos + 4]), pos + 5
+    elif kind == 0xF4:
+        value = 0
+
+        for x in xrange(pos + 1, pos + 9):
+            value = value << 8 | data[x]
+
+        return value, pos + 9
+    elif kind == 0xF8:
+        value, pos = read_varint(data, pos + 1)
+        return ~value, pos
+
+    return ~(first & 0x03), pos + 1
+
+
+def read_varints(data, count, pos=0):
+    """
+    Read several varints in a row - for example, the session and sequence
+    number at the start of a voice packet.
+
+    :param data: A bytearray to read from
+    :param count: How many varints to read
+    :param pos: The index of the first byte of the first varint
+    :return: A tuple of (list of values, position after the last varint)
+    """
+
+    values = []
+    append = values.append
+
+    for _ in xrange(count):
+        first = data[pos]
+
+        # Small numbers are by far the most common, so skip the call
+        if first < 0x80:
+            append(first)
+            pos += 1
         else:
-            raise ValueError("Invalid VarInt data")
-    elif (first & 0xF0) == 0xE0:
-        return (
-            (first & 0x0F) << 24 | ord(data[pos + 1]) << 16 | ord(
-                data[pos + 2]) << 8 | ord(
-                data[pos + 3]), 4)
-    elif (first & 0xE0) == 0xC0:
-        return (first & 0x1F) << 16 | ord(data[pos + 1]) << 8 | ord(
-            data[pos + 2]), 3
+            value, pos = read_varint(data, pos)
+            append(value)
+
+    return values, pos
+
+
+def decode_varint(data, pos=0):
+    """
+    Read a single varint from a string.
+
+    Kept for older code - use `read_varint()` instead, which returns the
+    position after the varint rather than its length.
+
+    :return: A tuple of (value, length of the varint in bytes)
+    """
+
+    value, end = read_varint(bytearray(data), pos)
+    return value, end - pos
+
+
+def write_varint(value, out):
+    """
+    Append a varint to a bytearray.
+
+    :param value: The integer to encode, which must fit in 64 bits
+    :param out: The bytearray to append to
+    """
+
+    if value < 0:
+        value = ~value
+
+        if value <= 0x3:
+            out.append(0xFC | value)
+            return
+
+        out.append(0xF8)
+
+    if value < 0x80:
+        out.append(value)
+    elif value < 0x4000:
+        out.append(value >> 8 | 0x80)
+        out.append(value & 0xFF)
+    elif value < 0x200000:
+        out.append(value >> 16 | 0xC0)
+        out.append(value >> 8 & 0xFF)
+        out.append(value & 0xFF)
+    elif value < 0x10000000:
+        out.append(value >> 24 | 0xE0)
+        out.append(value >> 16 & 0xFF)
+        out.append(value >> 8 & 0xFF)
+        out.append(value & 0xFF)
+    elif value < 0x100000000:
+        out.append(0xF0)
+        out.append(value >> 24 & 0xFF)
+        out.append(value >> 16 & 0xFF)
+        out.append(value >> 8 & 0xFF)
+        out.append(value & 0xFF)
     else:
-        raise ValueError("Invalid VarInt data")
+        out.append(0xF4)
+
+        for shift in xrange(56, -8, -8):
+            out.append(value >> shift & 0xFF)
+
+
+def encode_varints(*values):
+    """
+    Encode one or more varints.
+
+    :return: A bytearray containing all of the values, in order
+    """
+
+    out = bytearray()
+
+    for value in values:
+        write_varint(value, out)
+
+    return out
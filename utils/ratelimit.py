@@ -2,6 +2,8 @@
 
 import time
 
+from utils.lru import LRUCache
+
 __author__ = 'Sean'
 
 
@@ -14,6 +16,8 @@ class TokenBucket(object):
     it was about to perform. This is a form of rate limiting.
     """
 
+    __slots__ = ("capacity", "fill_rate", "_tokens", "_last_fill")
+
     def __init__(self, capacity, fill_rate, initial_capacity=None):
         """
         :param capacity: Max token count
@@ -61,6 +65,91 @@ class TokenBucket(object):
         Increase token count based on time passed since last fill, up to
         capacity.
         """
-        time_passed = time.time() - self._last_fill
+        now = time.time()
+        time_passed = now - self._last_fill
         new_tokens = time_passed * self.fill_rate
         self._tokens = min(self._tokens + new_tokens, self.capacity)
+        self._last_fill = now
+
+
+class KeyedTokenBuckets(object):
+    """
+    A set of token buckets, one per key (for example, per host), with an
+    optional global bucket that every key shares.
+
+    Only the *max_keys* most recently used buckets are kept, so this can't be
+    used to exhaust memory by throwing lots of different keys at it. A key
+    that's been forgotten about simply gets a fresh, full bucket.
+    """
+
+    def __init__(self, capacity, fill_rate, max_keys=10000,
+                 global_capacity=None, global_fill_rate=None):
+        """
+        :param capacity: Max token count for each key
+        :param fill_rate: Token count increase per second, for each key
+        :param max_keys: Max number of keys to keep buckets for
+        :param global_capacity: Max token count for the global bucket, or
+                                None for no global limit
+        :param global_fill_rate: Token count increase per second for the
+                                 global bucket
+        """
+
+        self.capacity = capacity
+        self.fill_rate = fill_rate
+
+        self._buckets = LRUCache(max_keys)
+
+        if global_capacity:
+            self._global = TokenBucket(global_capacity, global_fill_rate)
+        else:
+            self._global = None
+
+        self.accepted = 0
+        self.rejected_key = 0
+        self.rejected_global = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    @property
+    def stats(self):
+        """
+        Counts of what's been accepted and rejected, as a dict.
+        """
+
+        return {
+            "accepted": self.accepted,
+            "rejected_key": self.rejected_key,
+            "rejected_global": self.rejected_global,
+            "tracked_keys": len(self._buckets),
+            "evicted_keys": self._buckets.evictions
+        }
+
+    def consume(self, key, tokens=1):
+        """
+        Consume tokens from a key's bucket, and then from the global bucket.
+
+        Tokens are only taken from the global bucket if the key's bucket had
+        enough, so a single key can't use up the global limit on its own.
+
+        :param key: The key to consume tokens for
+        :param tokens: Number of tokens to consume
+        :return: Whether or not there were enough tokens to consume
+        """
+
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            bucket = TokenBucket(self.capacity, self.fill_rate)
+            self._buckets[key] = bucket
+
+        if not bucket.consume(tokens):
+            self.rejected_key += 1
+            return False
+
+        if self._global is not None and not self._global.consume(tokens):
+            self.rejected_global += 1
+            return False
+
+        self.accepted += 1
+        return True
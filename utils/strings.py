@@ -40,3 +40,20 @@ def to_filename(_string):
         lambda x: x in FILENAME_SAFE_CHARS,
         _string
     )
+
+
+def intern_string(_string):
+    """
+    Intern a string, so that identical strings share one object in memory.
+
+    This is useful for strings that are repeated across a lot of objects,
+    such as IRC idents and hosts. Only byte strings can be interned, so
+    anything else is returned untouched.
+
+    :param _string: The string to intern
+    :return: The interned string
+    """
+
+    if type(_string) is str:
+        return intern(_string)
+    return _string